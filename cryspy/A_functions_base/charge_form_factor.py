@@ -1,6 +1,7 @@
 import numpy
 from cryspy.A_functions_base.orbital_functions import calc_jl
-from cryspy.A_functions_base.database import DATABASE
+from cryspy.A_functions_base.database import DATABASE, DATABASE_HASH
+from cryspy.A_functions_base.function_1_cache import calc_by_table_cache
 
 
 def get_n_zeta_coeff_for_atom_with_orbital(atom_name: str, orbital_name: str):
@@ -178,3 +179,43 @@ def calc_scattering_amplitude_tabulated(ion_name: str, sthovl, flag_sthovl: bool
             a4*b4*numpy.exp(-b4*sthovl_sq)
         )
     return scattering_amplitude, dder
+
+
+def calc_scattering_amplitude_for_ion(ion_name: str, sthovl):
+    """Calculate X-ray scattering amplitude of the ion.
+
+    It is given by the radial Slater functions of the ion or, if they are
+    not found, by the tabulated coefficients. KeyError is raised if the ion
+    is not found.
+    """
+    try:
+        scattering_amplitude = calc_jl_for_ion(sthovl, ion_name, l_max=0)[:, 0]
+    except UserWarning:
+        scattering_amplitude = calc_scattering_amplitude_tabulated(ion_name, sthovl)[0]
+    return scattering_amplitude
+
+
+def get_table_scattering_amplitude(ion_name: str, table_sthovl):
+    """Give X-ray scattering amplitude of the ion on the grid table_sthovl.
+
+    The table is calculated once and kept in the table cache (see calc_by_table_cache),
+    the key includes the hash of the database.
+    """
+    return calc_by_table_cache(
+        "scattering_amplitude", calc_scattering_amplitude_for_ion, str(ion_name), numpy.asarray(table_sthovl, dtype=float),
+        source_hash=DATABASE_HASH)
+
+
+def calc_scattering_amplitude_by_table(sthovl, table_sthovl, table_atom_scattering_amplitude):
+    """Interpolate scattering amplitudes [hkl, a] of atoms by the tables [a, table_sthovl].
+
+    The positions of sthovl in the grid are found once for all atoms.
+    Outside of the grid the values at the edges are given (as numpy.interp).
+    """
+    sthovl_c = numpy.clip(sthovl, table_sthovl[0], table_sthovl[-1])
+    index_left = numpy.clip(numpy.searchsorted(table_sthovl, sthovl_c, side="right") - 1, 0, table_sthovl.size-2)
+    weight_right = (sthovl_c - table_sthovl[index_left])/(table_sthovl[index_left+1] - table_sthovl[index_left])
+    table_left = table_atom_scattering_amplitude[:, index_left]
+    table_right = table_atom_scattering_amplitude[:, index_left+1]
+    scattering_amplitude = table_left + weight_right[numpy.newaxis, :]*(table_right-table_left)
+    return scattering_amplitude.transpose()
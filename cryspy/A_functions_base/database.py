@@ -1,8 +1,13 @@
 import os
+import hashlib
 import pickle
 
 
 f_dir = os.path.dirname(__file__)
 
 with open(os.path.join(f_dir, "database.pickle"), "rb") as fid:
-    DATABASE = pickle.load(fid)
\ No newline at end of file
+    database_bytes = fid.read()
+DATABASE = pickle.loads(database_bytes)
+# it identifies the tables of the database (e.g. in the keys of the table cache)
+DATABASE_HASH = hashlib.blake2b(database_bytes, digest_size=16).hexdigest()
+del database_bytes
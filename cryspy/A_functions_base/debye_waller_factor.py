@@ -232,10 +232,30 @@ def calc_dwf(index_hkl, sthovl, b_iso, beta, symm_elems_r,
     dwf = numpy.exp(-power_3d)
     dder = {}
     if flag_sthovl:
-        dder["sthovl"] = None
+        dder["sthovl"] = -dder_power_iso_2d["sthovl"]*dwf
     if flag_b_iso:
-        dder["b_iso"] = None
+        dder["b_iso"] = -dder_power_iso_2d["b_iso"]*dwf
     if flag_beta:
-        dder["beta"] = None
+        dder["beta"] = -dder_power_aniso_3d["beta"]*numpy.expand_dims(dwf, axis=0)
     return dwf, dder
 
+
+
+def calc_dwf_by_atoms(index_hkl, sthovl, b_iso, beta, symm_elems_r):
+    """Calculate Debye-Waller factor [hkl, rs, a] (without derivatives).
+
+    index_hkl [3, hkl], sthovl [hkl], b_iso [a], beta [6, a], symm_elems_r [9, rs]
+    as in calc_dwf. The factor of isotropic atoms (beta is zero) does not
+    depend on symmetry elements, so the anisotropic part is calculated only
+    for anisotropic atoms and the output is [hkl, 1, a] if all atoms are
+    isotropic (it is broadcast over symmetry elements).
+    """
+    dwf_iso = numpy.exp(-calc_power_dwf_iso(sthovl[:, na], b_iso[na, :])[0])
+    flags_aniso = numpy.any(beta != 0., axis=0)
+    if not(numpy.any(flags_aniso)):
+        return dwf_iso[:, na, :]
+    dwf = numpy.repeat(dwf_iso[:, na, :], symm_elems_r.shape[-1], axis=1)
+    power_aniso = calc_power_dwf_aniso(
+        index_hkl[:, :, na, na], beta[:, flags_aniso][:, na, na, :], symm_elems_r[:, na, :, na])[0]
+    dwf[:, :, flags_aniso] *= numpy.exp(-power_aniso)
+    return dwf
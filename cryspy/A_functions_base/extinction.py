@@ -1,5 +1,7 @@
 import numpy
 
+from .function_1_profiling import profiled_stage
+
 
 def calc_extinction_sphere_primary(
         f_sq, radius, volume_unit_cell, cos_2theta, wavelength,
@@ -157,6 +159,7 @@ def calc_extinction_sphere_secondary_lorentz(
     return y_s, dder
 
 
+@profiled_stage
 def calc_extinction_sphere(
         f_sq, radius, mosaicity, volume_unit_cell, cos_2theta, wavelength,
         model: str, flag_f_sq: bool = False, flag_radius: bool = False,
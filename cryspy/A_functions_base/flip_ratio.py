@@ -1,6 +1,8 @@
 from typing import Callable
 import numpy
 
+from .function_1_profiling import profiled_stage
+
 
 def calc_iint(
         beam_polarization: float, 
@@ -397,6 +399,7 @@ def calc_asymmetry_by_iint(
     return asymmetry, dder
 
 
+@profiled_stage
 def calc_intensities_by_structure_factors(
         beam_polarization: float, flipper_efficiency: float, f_nucl, f_m_perp,
         axis_z, func_extinction: Callable = None,
@@ -0,0 +1,374 @@
+"""Cache of intermediate results with explicit dependencies.
+
+Each cached node is kept in dict_in_out under its own name. Together with
+the node the values of the inputs it was calculated from are recorded in
+dict_in_out["cache_dependencies"]. A node is reused only if all its inputs
+are unchanged, so after a parameter change only the nodes depending on this
+parameter are recalculated.
+
+Inputs which are cached nodes of the same dict_in_out are kept by reference
+and compared by identity (a recalculated node is always a new object), all
+other inputs are copied and compared by value.
+
+The nodes depending only on reflections and symmetry elements (PR2...PR5)
+are also kept in the process-wide cache with the least recently used
+eviction, so they are not recalculated for a new dict_in_out. The profile
+matrices of powder diffraction are kept in the same way in the separate
+process-wide cache, they are reused while the profile parameters are
+unchanged.
+
+The tables calculated once for the given arguments (form factors of ions
+on the grid of sthovl) are kept in memory. If the cache directory is set
+(by set_table_cache_directory or by the environment variable
+CRYSPY_CACHE_DIR) they are also saved there as .npy files, so they are
+loaded in the next sessions.
+
+Functions
+---------
+    - get_cached_node
+    - set_cached_node
+    - get_cache_statistics
+    - reset_cache_statistics
+    - calc_by_symmetry_cache
+    - set_symmetry_cache_budget
+    - get_symmetry_cache_budget
+    - clear_symmetry_cache
+    - calc_by_profile_cache
+    - set_profile_cache_budget
+    - get_profile_cache_budget
+    - clear_profile_cache
+    - calc_by_table_cache
+    - set_table_cache_directory
+    - get_table_cache_directory
+    - clear_table_cache
+"""
+import collections
+import hashlib
+import os
+import threading
+
+import numpy
+import scipy.sparse
+
+# {name of node: [number of hits, number of misses]}
+CACHE_STATISTICS = {}
+LOCK_CACHE_STATISTICS = threading.Lock()
+
+# {key: (value, number of bytes)}, from the least to the most recently used
+SYMMETRY_CACHE = collections.OrderedDict()
+DICT_SYMMETRY_CACHE = {"byte_budget": 256*2**20, "n_bytes": 0}
+LOCK_SYMMETRY_CACHE = threading.Lock()
+
+# {key: (value, number of bytes)} for profile matrices (dense or sparse)
+PROFILE_CACHE = collections.OrderedDict()
+DICT_PROFILE_CACHE = {"byte_budget": 256*2**20, "n_bytes": 0}
+LOCK_PROFILE_CACHE = threading.Lock()
+
+# {key: table}, the tables are saved in the directory (None is no saving)
+TABLE_CACHE = {}
+DICT_TABLE_CACHE = {"directory": os.environ.get("CRYSPY_CACHE_DIR", None)}
+LOCK_TABLE_CACHE = threading.Lock()
+# it is increased when the calculation of tables is changed
+TABLE_CACHE_VERSION = 2
+
+
+def is_equal_input(value_1, value_2) -> bool:
+    """Check whether two inputs of a node coincide."""
+    if value_1 is value_2:
+        return True
+    if isinstance(value_1, numpy.ndarray) or isinstance(value_2, numpy.ndarray):
+        return numpy.array_equal(value_1, value_2)
+    return value_1 == value_2
+
+
+def get_cached_node(
+        dict_in_out: dict, name: str, dict_dependency: dict,
+        flag_use_precalculated_data: bool = True):
+    """Give the cached node if its inputs are not changed.
+
+    Output is (flag_hit, value), value is None if flag_hit is False.
+    The hit or miss is counted in CACHE_STATISTICS.
+    """
+    flag_hit = False
+    value = None
+    if (flag_use_precalculated_data and (dict_in_out is not None) and
+            (name in dict_in_out.keys()) and ("cache_dependencies" in dict_in_out.keys())):
+        dict_cache_dependencies = dict_in_out["cache_dependencies"]
+        if name in dict_cache_dependencies.keys():
+            dict_saved = dict_cache_dependencies[name]
+            flag_hit = ((set(dict_saved.keys()) == set(dict_dependency.keys())) and
+                all([is_equal_input(dict_saved[key], dict_dependency[key]) for key in dict_dependency.keys()]))
+    if flag_hit:
+        value = dict_in_out[name]
+
+    count_cache_statistics(name, flag_hit)
+    return flag_hit, value
+
+
+def count_cache_statistics(name: str, flag_hit: bool):
+    """Count the hit or miss of the node in CACHE_STATISTICS."""
+    with LOCK_CACHE_STATISTICS:
+        if name not in CACHE_STATISTICS.keys():
+            CACHE_STATISTICS[name] = [0, 0]
+        CACHE_STATISTICS[name][0 if flag_hit else 1] += 1
+
+
+def set_cached_node(dict_in_out: dict, name: str, value, dict_dependency: dict):
+    """Save the node and the inputs it was calculated from."""
+    if dict_in_out is None:
+        return
+    if "cache_dependencies" in dict_in_out.keys():
+        dict_cache_dependencies = dict_in_out["cache_dependencies"]
+    else:
+        dict_cache_dependencies = {}
+        dict_in_out["cache_dependencies"] = dict_cache_dependencies
+
+    dict_saved = {}
+    for key, input_value in dict_dependency.items():
+        if ((key in dict_cache_dependencies.keys()) and (key in dict_in_out.keys()) and
+                (dict_in_out[key] is input_value)):
+            dict_saved[key] = input_value
+        else:
+            dict_saved[key] = numpy.copy(input_value) if isinstance(input_value, numpy.ndarray) else input_value
+    dict_cache_dependencies[name] = dict_saved
+    dict_in_out[name] = value
+
+
+def get_cache_statistics() -> dict:
+    """Give the numbers of hits and misses of cached nodes.
+
+    Output is a dictionary {name of node: (hits, misses)}. The statistics is
+    collected for the current process.
+    """
+    with LOCK_CACHE_STATISTICS:
+        return {name: tuple(hit_miss) for name, hit_miss in CACHE_STATISTICS.items()}
+
+
+def reset_cache_statistics():
+    """Set the numbers of hits and misses of cached nodes to zero."""
+    with LOCK_CACHE_STATISTICS:
+        CACHE_STATISTICS.clear()
+
+
+def calc_symmetry_cache_key(name: str, l_argument) -> tuple:
+    """Give the key of the process-wide cache by the name of node and its arguments.
+
+    The arrays are given by their types, shapes and hashes of the content.
+    """
+    l_key = [name]
+    for argument in l_argument:
+        if isinstance(argument, numpy.ndarray):
+            argument_c = numpy.ascontiguousarray(argument)
+            l_key.append((argument_c.dtype.str, argument_c.shape,
+                hashlib.blake2b(argument_c.tobytes(), digest_size=16).hexdigest()))
+        else:
+            l_key.append(argument)
+    return tuple(l_key)
+
+
+def calc_n_bytes(value) -> int:
+    """Give the number of bytes of arrays in value (array, sparse matrix or tuple of them)."""
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if scipy.sparse.isspmatrix_csr(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, tuple):
+        return sum([calc_n_bytes(hh) for hh in value])
+    return 0
+
+
+def set_read_only(value):
+    """Forbid changes of arrays in value, as they are shared between calculations."""
+    if isinstance(value, numpy.ndarray):
+        value.flags.writeable = False
+    elif scipy.sparse.isspmatrix_csr(value):
+        for hh in (value.data, value.indices, value.indptr):
+            hh.flags.writeable = False
+    elif isinstance(value, tuple):
+        for hh in value:
+            set_read_only(hh)
+
+
+def calc_by_lru_cache(cache, dict_cache: dict, lock, name: str, func, l_argument):
+    """Give func(*l_argument) from the process-wide cache with the least recently used eviction.
+
+    The arrays of the output are read-only. The hit or miss is counted in
+    CACHE_STATISTICS under the given name.
+    """
+    key = calc_symmetry_cache_key(name, l_argument)
+    with lock:
+        if key in cache.keys():
+            cache.move_to_end(key)
+            value = cache[key][0]
+        else:
+            value = None
+    if value is not None:
+        count_cache_statistics(name, True)
+        return value
+
+    value = func(*l_argument)
+    set_read_only(value)
+    n_bytes = calc_n_bytes(value)
+    count_cache_statistics(name, False)
+    with lock:
+        if (n_bytes <= dict_cache["byte_budget"]) and (key not in cache.keys()):
+            cache[key] = (value, n_bytes)
+            dict_cache["n_bytes"] += n_bytes
+            evict_lru_cache(cache, dict_cache)
+    return value
+
+
+def evict_lru_cache(cache, dict_cache: dict):
+    """Remove the least recently used nodes while the byte budget is exceeded."""
+    while dict_cache["n_bytes"] > dict_cache["byte_budget"]:
+        dict_cache["n_bytes"] -= cache.popitem(last=False)[1][1]
+
+
+def calc_by_symmetry_cache(name: str, func, *l_argument):
+    """Give func(*l_argument) from the process-wide cache.
+
+    It is used for the nodes depending only on reflections, symmetry
+    elements and unit cell parameters. The arrays of the output are read-only.
+    The hit or miss is counted in CACHE_STATISTICS as "name (symmetry cache)".
+    """
+    return calc_by_lru_cache(
+        SYMMETRY_CACHE, DICT_SYMMETRY_CACHE, LOCK_SYMMETRY_CACHE, f"{name:} (symmetry cache)", func, l_argument)
+
+
+def set_symmetry_cache_budget(byte_budget: int = 256*2**20):
+    """Set the maximal size in bytes of the process-wide cache of PR2...PR5.
+
+    Zero switches the cache off.
+    """
+    if byte_budget < 0:
+        raise AttributeError("The byte budget of symmetry cache should be non-negative.")
+    with LOCK_SYMMETRY_CACHE:
+        DICT_SYMMETRY_CACHE["byte_budget"] = int(byte_budget)
+        evict_lru_cache(SYMMETRY_CACHE, DICT_SYMMETRY_CACHE)
+
+
+def get_symmetry_cache_budget() -> int:
+    """Give the maximal size in bytes of the process-wide cache of PR2...PR5."""
+    return DICT_SYMMETRY_CACHE["byte_budget"]
+
+
+def clear_symmetry_cache():
+    """Remove all nodes from the process-wide cache of PR2...PR5."""
+    with LOCK_SYMMETRY_CACHE:
+        SYMMETRY_CACHE.clear()
+        DICT_SYMMETRY_CACHE["n_bytes"] = 0
+
+
+def calc_by_profile_cache(name: str, func, *l_argument):
+    """Give the profile matrix func(*l_argument) from the process-wide cache.
+
+    The arguments should be all parameters the profile depends on (positions
+    of points and reflections, resolution and asymmetry parameters), so the
+    profile is calculated once while only the integrated intensities are
+    refined, also for a new dict_in_out. The arrays of the output are
+    read-only. The hit or miss is counted in CACHE_STATISTICS as
+    "name (profile cache)".
+    """
+    return calc_by_lru_cache(
+        PROFILE_CACHE, DICT_PROFILE_CACHE, LOCK_PROFILE_CACHE, f"{name:} (profile cache)", func, l_argument)
+
+
+def set_profile_cache_budget(byte_budget: int = 256*2**20):
+    """Set the maximal size in bytes of the process-wide cache of profile matrices.
+
+    Zero switches the cache off.
+    """
+    if byte_budget < 0:
+        raise AttributeError("The byte budget of profile cache should be non-negative.")
+    with LOCK_PROFILE_CACHE:
+        DICT_PROFILE_CACHE["byte_budget"] = int(byte_budget)
+        evict_lru_cache(PROFILE_CACHE, DICT_PROFILE_CACHE)
+
+
+def get_profile_cache_budget() -> int:
+    """Give the maximal size in bytes of the process-wide cache of profile matrices."""
+    return DICT_PROFILE_CACHE["byte_budget"]
+
+
+def clear_profile_cache():
+    """Remove all profile matrices from the process-wide cache."""
+    with LOCK_PROFILE_CACHE:
+        PROFILE_CACHE.clear()
+        DICT_PROFILE_CACHE["n_bytes"] = 0
+
+
+def calc_by_table_cache(name: str, func, *l_argument, source_hash: str = ""):
+    """Give the table func(*l_argument) from the memory or from the cache directory.
+
+    The calculated table (numpy array) is saved in the directory (if it is
+    set) as "table_{name}_{hash of arguments}.npy". source_hash identifies
+    the data used by func which are not given by the arguments (e.g.
+    DATABASE_HASH), it is a part of the key. The output is read-only.
+    The hit or miss is counted in CACHE_STATISTICS as "name (table cache)".
+    """
+    key = calc_symmetry_cache_key(name, (TABLE_CACHE_VERSION, source_hash) + tuple(l_argument))
+    name_statistics = f"{name:} (table cache)"
+    with LOCK_TABLE_CACHE:
+        table = TABLE_CACHE.get(key, None)
+    if table is not None:
+        count_cache_statistics(name_statistics, True)
+        return table
+
+    directory = DICT_TABLE_CACHE["directory"]
+    file_name = None
+    if directory is not None:
+        file_name = os.path.join(directory, "table_{:}_{:}.npy".format(
+            name, hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()))
+
+    table = None
+    if (file_name is not None) and os.path.isfile(file_name):
+        try:
+            table = numpy.load(file_name, allow_pickle=False)
+        except (OSError, ValueError):
+            table = None
+    if table is None:
+        table = numpy.asarray(func(*l_argument))
+        if file_name is not None:
+            # the table is written in the temporary file first as the file can be read by other processes
+            try:
+                os.makedirs(directory, exist_ok=True)
+                file_name_tmp = f"{file_name:}.{os.getpid():}.tmp"
+                with open(file_name_tmp, "wb") as fid:
+                    numpy.save(fid, table, allow_pickle=False)
+                os.replace(file_name_tmp, file_name)
+            except OSError:
+                pass
+    set_read_only(table)
+    count_cache_statistics(name_statistics, False)
+    with LOCK_TABLE_CACHE:
+        TABLE_CACHE[key] = table
+    return table
+
+
+def set_table_cache_directory(directory: str = None):
+    """Set the directory where the tables are saved.
+
+    If directory is None the tables are kept in memory only. By default it is
+    given by the environment variable CRYSPY_CACHE_DIR (None if it is not set).
+    """
+    with LOCK_TABLE_CACHE:
+        DICT_TABLE_CACHE["directory"] = None if directory is None else os.fspath(directory)
+
+
+def get_table_cache_directory():
+    """Give the directory where the tables are saved (None if they are not saved)."""
+    return DICT_TABLE_CACHE["directory"]
+
+
+def clear_table_cache(flag_files: bool = False):
+    """Remove the tables from memory.
+
+    If flag_files is True the saved tables are also removed from the cache directory.
+    """
+    with LOCK_TABLE_CACHE:
+        TABLE_CACHE.clear()
+        directory = DICT_TABLE_CACHE["directory"]
+        if flag_files and (directory is not None) and os.path.isdir(directory):
+            for file_name in os.listdir(directory):
+                if file_name.startswith("table_") and file_name.endswith(".npy"):
+                    os.remove(os.path.join(directory, file_name))
@@ -9,71 +9,82 @@ Functions
 
 """
 import numpy
-import copy
 
 from numpy.linalg import LinAlgError
 
-def estimate_inversed_hessian_matrix(func, param_0):
-    """Estimate inversed Hessian matrix."""
+def estimate_inversed_hessian_matrix(func, param_0, executor=None):
+    """Estimate inversed Hessian matrix.
+
+    Hessian is calculated by the four-point scheme. All points are formed
+    first and calculated by executor.map if executor is given (func should
+    be picklable for a process pool).
+    """
     n_param = len(param_0)
+    param_0 = numpy.array(param_0, dtype=float)
     np_hessian = numpy.zeros(shape=(n_param, n_param), dtype=float)
     np_first_der = numpy.zeros(shape=(n_param,), dtype=float)
-    chi_sq = func(param_0)
     perc = 0.01
-    
-    for i_p_1, p_1 in enumerate(param_0):
-        delta_p_1 = perc * numpy.abs(p_1)
-        if delta_p_1 < 1e-5:
-            delta_p_1 = 1e-5
-        param_p = copy.deepcopy(param_0)
-        param_m = copy.deepcopy(param_0)
-        param_p[i_p_1] += delta_p_1
-        param_m[i_p_1] -= delta_p_1
-        # chi_sq_p = func(param_p)
-        # chi_sq_m = func(param_m)
-        # der_second = (chi_sq_p + chi_sq_m - 2.*chi_sq)/(delta_p_1**2)
-        # np_hessian[i_p_1, i_p_1] = der_second
-
-        # der_first = (chi_sq_p - chi_sq_m) / (2.*delta_p_1)
-        # np_first_der[i_p_1] = der_first
-
-        param_pp = copy.deepcopy(param_0)
-        param_pm = copy.deepcopy(param_0)
-        param_mp = copy.deepcopy(param_0)
-        param_mm = copy.deepcopy(param_0)
+    delta_p = numpy.maximum(perc * numpy.abs(param_0), 1e-5)
 
-        param_pp[i_p_1] += delta_p_1
-        param_pm[i_p_1] += delta_p_1
-        param_mp[i_p_1] -= delta_p_1
-        param_mm[i_p_1] -= delta_p_1
-        for i_p_2, p_2 in enumerate(param_0[:i_p_1+1]):
-            delta_p_2 = perc * numpy.abs(p_2)
-            if delta_p_2 < 1e-5:
-                delta_p_2 = 1e-5
-            param_pp[i_p_2] += delta_p_2
-            param_pm[i_p_2] -= delta_p_2
-            param_mp[i_p_2] += delta_p_2
-            param_mm[i_p_2] -= delta_p_2
-            
-            chi_sq_pp = func(param_pp)
-            chi_sq_pm = func(param_pm)
-            chi_sq_mp = func(param_mp)
-            chi_sq_mm = func(param_mm)
+    l_ind, l_param = [], []
+    for i_p_1 in range(n_param):
+        for i_p_2 in range(i_p_1+1):
+            for sign_1, sign_2 in ((1., 1.), (1., -1.), (-1., 1.), (-1., -1.)):
+                param = numpy.copy(param_0)
+                param[i_p_1] += sign_1*delta_p[i_p_1]
+                param[i_p_2] += sign_2*delta_p[i_p_2]
+                l_param.append(param)
+            l_ind.append((i_p_1, i_p_2))
 
-            der_second = (chi_sq_pp + chi_sq_mm - chi_sq_pm - chi_sq_mp) / (
-                4. * delta_p_1 * delta_p_2) 
-            np_hessian[i_p_1, i_p_2] = der_second
-            np_hessian[i_p_2, i_p_1] = der_second
+    if executor is None:
+        l_chi_sq = [func(param) for param in l_param]
+    else:
+        l_chi_sq = list(executor.map(func, l_param))
 
-            param_pp[i_p_2] -= delta_p_2
-            param_pm[i_p_2] += delta_p_2
-            param_mp[i_p_2] -= delta_p_2
-            param_mm[i_p_2] += delta_p_2
+    for i_ind, (i_p_1, i_p_2) in enumerate(l_ind):
+        chi_sq_pp, chi_sq_pm, chi_sq_mp, chi_sq_mm = l_chi_sq[4*i_ind:4*i_ind+4]
+        der_second = (chi_sq_pp + chi_sq_mm - chi_sq_pm - chi_sq_mp) / (
+            4. * delta_p[i_p_1] * delta_p[i_p_2]) 
+        np_hessian[i_p_1, i_p_2] = der_second
+        np_hessian[i_p_2, i_p_1] = der_second
 
     try:
         np_hessian_inv = numpy.linalg.inv(np_hessian)
     except LinAlgError:
         np_hessian_inv = None
-    func(param_0)
+    if executor is None:
+        func(param_0)
     return np_hessian_inv, np_first_der
 
+
+def estimate_jacobian_matrix(func, param_0, executor=None):
+    """Estimate Jacobian matrix of vector function by forward differences.
+    """
+    param_0 = numpy.array(param_0, dtype=float)
+    sign_param = numpy.where(param_0 >= 0., 1., -1.)
+    step = numpy.sqrt(numpy.finfo(float).eps) * sign_param * numpy.maximum(1., numpy.abs(param_0))
+    step = (param_0 + step) - param_0
+    l_param = [param_0] + [
+        param_0 + step[ind] * numpy.eye(1, param_0.size, ind)[0] for ind in range(param_0.size)]
+    if executor is None:
+        l_value = [func(param) for param in l_param]
+        func(param_0)
+    else:
+        l_value = list(executor.map(func, l_param))
+    value_0 = numpy.array(l_value[0], dtype=float)
+    jacobian = numpy.stack([
+        (numpy.array(value, dtype=float) - value_0)/step_p for value, step_p in zip(l_value[1:], step)], axis=1)
+    return jacobian
+
+
+def estimate_inversed_hessian_matrix_by_jacobian(jacobian):
+    """Gauss-Newton estimation of inversed Hessian matrix of chi_sq = r.r
+
+    by Jacobian of weighted residuals r: Hessian is 2 J^T J.
+    """
+    np_hessian = 2. * numpy.matmul(jacobian.transpose(), jacobian)
+    try:
+        np_hessian_inv = numpy.linalg.inv(np_hessian)
+    except LinAlgError:
+        np_hessian_inv = None
+    return np_hessian_inv
@@ -0,0 +1,91 @@
+"""Opt-in timing of stages of calculations.
+
+Functions decorated by profiled_stage are timed (inclusive time, nested
+stages are included in the time of the outer one) and their calls are
+counted when profiling is enabled. When it is disabled the decorator only
+checks the flag. The statistics is collected for the current process.
+
+Functions
+---------
+    - profiled_stage
+    - record_array_size
+    - enable_profiling
+    - disable_profiling
+    - reset_profiling
+    - get_profiling_report
+"""
+import functools
+import threading
+import time
+
+from .function_1_cache import get_cache_statistics
+
+# {"flag_profiling": bool, "stage": {name: [number of calls, time]}, "size": {name: size}}
+DICT_PROFILING = {"flag_profiling": False, "stage": {}, "size": {}}
+LOCK_PROFILING = threading.Lock()
+
+
+def profiled_stage(func):
+    """Decorator of a stage of calculations, the stage is named by the function."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not(DICT_PROFILING["flag_profiling"]):
+            return func(*args, **kwargs)
+        time_start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            time_stage = time.perf_counter() - time_start
+            with LOCK_PROFILING:
+                if name not in DICT_PROFILING["stage"].keys():
+                    DICT_PROFILING["stage"][name] = [0, 0.]
+                DICT_PROFILING["stage"][name][0] += 1
+                DICT_PROFILING["stage"][name][1] += time_stage
+    return wrapper
+
+
+def record_array_size(name: str, size: int):
+    """Record the size of an array (number of points, reflections, ...) if profiling is enabled."""
+    if DICT_PROFILING["flag_profiling"]:
+        with LOCK_PROFILING:
+            DICT_PROFILING["size"][name] = int(size)
+
+
+def enable_profiling():
+    """Start to collect timing of stages."""
+    DICT_PROFILING["flag_profiling"] = True
+
+
+def disable_profiling():
+    """Stop to collect timing of stages, collected statistics is kept."""
+    DICT_PROFILING["flag_profiling"] = False
+
+
+def reset_profiling():
+    """Remove collected timing, array sizes and cache statistics."""
+    with LOCK_PROFILING:
+        DICT_PROFILING["stage"].clear()
+        DICT_PROFILING["size"].clear()
+    from .function_1_cache import reset_cache_statistics
+    reset_cache_statistics()
+
+
+def get_profiling_report() -> dict:
+    """Give collected statistics.
+
+    Output is a dictionary with keys:
+        "stage": {name: {"calls", "time", "time_per_call"}} (time in seconds),
+        "cache": {name: {"hits", "misses", "hit_rate"}} for cached intermediates,
+        "size": {name: size} recorded sizes of arrays.
+    """
+    with LOCK_PROFILING:
+        dict_stage = {
+            name: {"calls": n_call, "time": time_stage, "time_per_call": time_stage/max(n_call, 1)}
+            for name, (n_call, time_stage) in DICT_PROFILING["stage"].items()}
+        dict_size = dict(DICT_PROFILING["size"])
+    dict_cache = {
+        name: {"hits": hits, "misses": misses, "hit_rate": hits/max(hits+misses, 1)}
+        for name, (hits, misses) in get_cache_statistics().items()}
+    return {"stage": dict_stage, "cache": dict_cache, "size": dict_size}
@@ -1,6 +1,8 @@
 from typing import Callable
 import numpy
 
+from .function_1_profiling import profiled_stage
+
 na = numpy.newaxis
 
 def calc_m_sq_sin_sq_para(tensor_sigma, flag_tensor_sigma: bool = False):
@@ -313,6 +315,7 @@ def calc_chiral_term_cos_sq_mix(
     return m_3, dder
 
 
+@profiled_stage
 def calc_powder_iint_1d_para(f_nucl, tensor_sigma, polarization, flipper, magnetic_field,
         flag_f_nucl: bool = False, flag_tensor_sigma: bool = False,
         flag_polarization: bool = False, flag_flipper: bool = False):
@@ -352,6 +355,7 @@ def calc_powder_iint_1d_para(f_nucl, tensor_sigma, polarization, flipper, magnet
     return iint_plus, iint_minus, dder_plus, dder_minus
 
 
+@profiled_stage
 def calc_powder_iint_1d_ordered(f_nucl, f_m_perp,
         flag_f_nucl: bool = False, flag_f_m_perp: bool = False):
     """Calculated powderly averaged integrated intensity for ordered sublattice in equatorial plane (alpha=90 deg.)
@@ -374,6 +378,7 @@ def calc_powder_iint_1d_ordered(f_nucl, f_m_perp,
     return iint, dder
 
 
+@profiled_stage
 def calc_powder_iint_1d_mix(f_nucl, f_m_perp, tensor_sigma, polarization, flipper, magnetic_field,
         flag_f_nucl: bool = False, flag_f_m_perp_ordered: bool = False, flag_tensor_sigma: bool = False,
         flag_polarization: bool = False, flag_flipper: bool = False,
@@ -425,6 +430,7 @@ def calc_powder_iint_1d_mix(f_nucl, f_m_perp, tensor_sigma, polarization, flippe
     return iint_plus, iint_minus, dder_plus, dder_minus
 
 
+@profiled_stage
 def calc_powder_iint_2d_para(f_nucl, tensor_sigma, beam_polarization, flipper_efficiency, magnetic_field,
         alpha_det, dict_in_out,
         flag_f_nucl: bool = False, flag_tensor_sigma: bool = False,
@@ -481,6 +487,7 @@ def calc_powder_iint_2d_para(f_nucl, tensor_sigma, beam_polarization, flipper_ef
     return iint_plus, iint_minus, dder_plus, dder_minus
 
 
+@profiled_stage
 def calc_powder_iint_2d_ordered(f_nucl, f_m_perp, beam_polarization, flipper_efficiency,
         alpha_det, dict_in_out, 
         flag_f_nucl: bool = False, flag_f_m_perp: bool = False,
@@ -527,6 +534,7 @@ def calc_powder_iint_2d_ordered(f_nucl, f_m_perp, beam_polarization, flipper_eff
 
 
 
+@profiled_stage
 def calc_powder_iint_2d_mix(f_nucl, tensor_sigma, f_m_perp_ordered, beam_polarization, flipper_efficiency, magnetic_field,
         alpha_det, dict_in_out_phase,
         flag_f_nucl: bool = False, flag_tensor_sigma: bool = False, flag_f_m_perp_ordered: bool = False,
@@ -1,13 +1,21 @@
 """Functions for magnetic section.
 
+The values <j0>, <j2> of ions are tabulated on the grid of sthovl/kappa,
+so the form factor is given by the interpolation of the tables also when
+kappa is refined.
+
 Functions
 ---------
     - get_j0_j2_by_symbol
+    - calc_j0_j2_table
+    - calc_form_factor_by_table
 """
 import numpy
 
 from cryspy.A_functions_base.database import DATABASE
 from cryspy.A_functions_base.charge_form_factor import get_atomic_symbol_ion_charge_isotope_number_by_ion_symbol
+from cryspy.A_functions_base.function_1_cache import calc_by_table_cache
+from cryspy.A_functions_base.orbital_functions import calc_by_hermite_table, TABLE_X_STEP, TABLE_X_MAX
 
 
 def get_j0_j2_parameters(symbols):
@@ -124,4 +132,53 @@ def calc_form_factor(
             dder["kappa"] = dder_j0["kappa"] + dder_j2["kappa"]*(2.0/lande_factor-1.0)
     if flag_lande_factor:
         dder["lande_factor"]=-2.0*j2_av/numpy.square(lande_factor)
-    return form_factor, dder
\ No newline at end of file
+    return form_factor, dder
+
+
+def calc_j0_j2_table(j0_parameters, j2_parameters):
+    """Calculate <j0>, d<j0>/dx, <j2>, d<j2>/dx [4, grid] of one ion on the grid of x = sthovl/kappa."""
+    table_x = numpy.arange(int(round(TABLE_X_MAX/TABLE_X_STEP))+1)*TABLE_X_STEP
+    x_sq = numpy.square(table_x)
+    l_res = []
+    for parameters in (j0_parameters, j2_parameters):
+        l_exp = [parameters[2*i]*numpy.exp(-parameters[2*i+1]*x_sq) for i in range(3)]
+        value = l_exp[0] + l_exp[1] + l_exp[2] + parameters[6]
+        value_der = -2.*table_x*(
+            l_exp[0]*parameters[1] + l_exp[1]*parameters[3] + l_exp[2]*parameters[5])
+        l_res.append((value, value_der))
+    (j0, j0_der), (j2_sum, j2_sum_der) = l_res
+    j2 = j2_sum*x_sq
+    j2_der = j2_sum_der*x_sq + 2.*table_x*j2_sum
+    return numpy.stack([j0, j0_der, j2, j2_der], axis=0)
+
+
+def calc_form_factor_by_table(
+        sthovl, lande_factor, kappa, j0_parameters, j2_parameters, flag_only_orbital=False):
+    """Calculate magnetic form factor [hkl, a] as calc_form_factor by the tables of ions.
+
+    sthovl [hkl], lande_factor [a], kappa [a], j0_parameters [7, a],
+    j2_parameters [7, a]. The tables are calculated once for each ion (see
+    calc_by_table_cache) and the atoms with the same ion and kappa are
+    calculated once. The derivatives are not calculated.
+    """
+    x_parameters = numpy.concatenate([j0_parameters, j2_parameters, kappa[numpy.newaxis, :]], axis=0)
+    x_parameters_unique, index_unique = numpy.unique(x_parameters, axis=1, return_inverse=True)
+    j0_unique = numpy.zeros((sthovl.size, x_parameters_unique.shape[1]), dtype=float)
+    j2_unique = numpy.zeros((sthovl.size, x_parameters_unique.shape[1]), dtype=float)
+    for i_unique, (j0_param, j2_param, kappa_u) in enumerate(zip(
+            x_parameters_unique[:7].transpose(), x_parameters_unique[7:14].transpose(), x_parameters_unique[14])):
+        x = sthovl/kappa_u
+        flag_table = x <= TABLE_X_MAX
+        table = calc_by_table_cache(
+            "magnetic_form_factor", calc_j0_j2_table, numpy.ascontiguousarray(j0_param),
+            numpy.ascontiguousarray(j2_param))
+        j0_u, j2_u = calc_by_hermite_table(x[flag_table], TABLE_X_STEP, table[0::2], table[1::2])
+        j0_unique[flag_table, i_unique], j2_unique[flag_table, i_unique] = j0_u, j2_u
+        if not(numpy.all(flag_table)):
+            j0_unique[~flag_table, i_unique] = calc_j0(x[~flag_table], 1., j0_param)[0]
+            j2_unique[~flag_table, i_unique] = calc_j2(x[~flag_table], 1., j2_param)[0]
+    index_unique = index_unique.flatten()
+    form_factor = (2.0/lande_factor[numpy.newaxis, :]-1.0)*j2_unique[:, index_unique]
+    if not(flag_only_orbital):
+        form_factor = form_factor + j0_unique[:, index_unique]
+    return form_factor
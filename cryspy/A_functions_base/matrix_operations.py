@@ -344,15 +344,15 @@ def calc_m_q_inv_m(m, q, flag_m: bool = False, flag_q: bool = False):
     if flag_q:
         oq = numpy.ones(q_11.shape, dtype=float)/det
         dder_q = numpy.stack([
-            numpy.stack([+(m_22*m_33-m_23*m_32)*m_11*oq, -(m_21*m_33-m_23*m_31)*m_12*oq, +(m_21*m_32-m_22*m_31)*m_13*oq, -(m_21*m_33-m_23*m_31)*m_11*oq+(m_22*m_33-m_23*m_32)*m_12*oq, +(m_21*m_32-m_22*m_31)*m_11*oq+(m_22*m_33-m_23*m_32)*m_13*oq, +(m_21*m_32-m_22*m_31)*m_12-(m_21*m_33-m_23*m_31)*m_13*oq], axis=0),
-            numpy.stack([-(m_12*m_33-m_13*m_32)*m_11*oq, +(m_11*m_33-m_13*m_31)*m_12*oq, -(m_11*m_32-m_12*m_31)*m_13*oq, +(m_11*m_33-m_13*m_31)*m_11*oq-(m_12*m_33-m_13*m_32)*m_12*oq, -(m_11*m_32-m_12*m_31)*m_11*oq-(m_12*m_33-m_13*m_32)*m_13*oq, -(m_11*m_32-m_12*m_31)*m_12+(m_11*m_33-m_13*m_31)*m_13*oq], axis=0),
-            numpy.stack([+(m_12*m_23-m_13*m_22)*m_11*oq, -(m_11*m_23-m_13*m_21)*m_12*oq, +(m_11*m_22-m_12*m_21)*m_13*oq, -(m_11*m_23-m_13*m_21)*m_11*oq+(m_12*m_23-m_13*m_22)*m_12*oq, +(m_11*m_22-m_12*m_21)*m_11*oq+(m_12*m_23-m_13*m_22)*m_13*oq, +(m_11*m_22-m_12*m_21)*m_12-(m_11*m_23-m_13*m_21)*m_13*oq], axis=0),
-            numpy.stack([+(m_22*m_33-m_23*m_32)*m_21*oq, -(m_21*m_33-m_23*m_31)*m_22*oq, +(m_21*m_32-m_22*m_31)*m_23*oq, -(m_21*m_33-m_23*m_31)*m_21*oq+(m_22*m_33-m_23*m_32)*m_22*oq, +(m_21*m_32-m_22*m_31)*m_21*oq+(m_22*m_33-m_23*m_32)*m_23*oq, +(m_21*m_32-m_22*m_31)*m_22-(m_21*m_33-m_23*m_31)*m_23*oq], axis=0),
-            numpy.stack([-(m_12*m_33-m_13*m_32)*m_21*oq, +(m_11*m_33-m_13*m_31)*m_22*oq, -(m_11*m_32-m_12*m_31)*m_23*oq, +(m_11*m_33-m_13*m_31)*m_21*oq-(m_12*m_33-m_13*m_32)*m_22*oq, -(m_11*m_32-m_12*m_31)*m_21*oq-(m_12*m_33-m_13*m_32)*m_23*oq, -(m_11*m_32-m_12*m_31)*m_22+(m_11*m_33-m_13*m_31)*m_23*oq], axis=0),
-            numpy.stack([+(m_12*m_23-m_13*m_22)*m_21*oq, -(m_11*m_23-m_13*m_21)*m_22*oq, +(m_11*m_22-m_12*m_21)*m_23*oq, -(m_11*m_23-m_13*m_21)*m_21*oq+(m_12*m_23-m_13*m_22)*m_22*oq, +(m_11*m_22-m_12*m_21)*m_21*oq+(m_12*m_23-m_13*m_22)*m_23*oq, +(m_11*m_22-m_12*m_21)*m_22-(m_11*m_23-m_13*m_21)*m_23*oq], axis=0),
-            numpy.stack([+(m_22*m_33-m_23*m_32)*m_31*oq, -(m_21*m_33-m_23*m_31)*m_32*oq, +(m_21*m_32-m_22*m_31)*m_33*oq, -(m_21*m_33-m_23*m_31)*m_31*oq+(m_22*m_33-m_23*m_32)*m_32*oq, +(m_21*m_32-m_22*m_31)*m_31*oq+(m_22*m_33-m_23*m_32)*m_33*oq, +(m_21*m_32-m_22*m_31)*m_32-(m_21*m_33-m_23*m_31)*m_33*oq], axis=0),
-            numpy.stack([-(m_12*m_33-m_13*m_32)*m_31*oq, +(m_11*m_33-m_13*m_31)*m_32*oq, -(m_11*m_32-m_12*m_31)*m_33*oq, +(m_11*m_33-m_13*m_31)*m_31*oq-(m_12*m_33-m_13*m_32)*m_32*oq, -(m_11*m_32-m_12*m_31)*m_31*oq-(m_12*m_33-m_13*m_32)*m_33*oq, -(m_11*m_32-m_12*m_31)*m_32+(m_11*m_33-m_13*m_31)*m_33*oq], axis=0),
-            numpy.stack([+(m_12*m_23-m_13*m_22)*m_31*oq, -(m_11*m_23-m_13*m_21)*m_32*oq, +(m_11*m_22-m_12*m_21)*m_33*oq, -(m_11*m_23-m_13*m_21)*m_31*oq+(m_12*m_23-m_13*m_22)*m_32*oq, +(m_11*m_22-m_12*m_21)*m_31*oq+(m_12*m_23-m_13*m_22)*m_33*oq, +(m_11*m_22-m_12*m_21)*m_32-(m_11*m_23-m_13*m_21)*m_33*oq], axis=0)], axis=0)
+            numpy.stack([+(m_22*m_33-m_23*m_32)*m_11*oq, -(m_21*m_33-m_23*m_31)*m_12*oq, +(m_21*m_32-m_22*m_31)*m_13*oq, -(m_21*m_33-m_23*m_31)*m_11*oq+(m_22*m_33-m_23*m_32)*m_12*oq, +(m_21*m_32-m_22*m_31)*m_11*oq+(m_22*m_33-m_23*m_32)*m_13*oq, (+(m_21*m_32-m_22*m_31)*m_12-(m_21*m_33-m_23*m_31)*m_13)*oq], axis=0),
+            numpy.stack([-(m_12*m_33-m_13*m_32)*m_11*oq, +(m_11*m_33-m_13*m_31)*m_12*oq, -(m_11*m_32-m_12*m_31)*m_13*oq, +(m_11*m_33-m_13*m_31)*m_11*oq-(m_12*m_33-m_13*m_32)*m_12*oq, -(m_11*m_32-m_12*m_31)*m_11*oq-(m_12*m_33-m_13*m_32)*m_13*oq, (-(m_11*m_32-m_12*m_31)*m_12+(m_11*m_33-m_13*m_31)*m_13)*oq], axis=0),
+            numpy.stack([+(m_12*m_23-m_13*m_22)*m_11*oq, -(m_11*m_23-m_13*m_21)*m_12*oq, +(m_11*m_22-m_12*m_21)*m_13*oq, -(m_11*m_23-m_13*m_21)*m_11*oq+(m_12*m_23-m_13*m_22)*m_12*oq, +(m_11*m_22-m_12*m_21)*m_11*oq+(m_12*m_23-m_13*m_22)*m_13*oq, (+(m_11*m_22-m_12*m_21)*m_12-(m_11*m_23-m_13*m_21)*m_13)*oq], axis=0),
+            numpy.stack([+(m_22*m_33-m_23*m_32)*m_21*oq, -(m_21*m_33-m_23*m_31)*m_22*oq, +(m_21*m_32-m_22*m_31)*m_23*oq, -(m_21*m_33-m_23*m_31)*m_21*oq+(m_22*m_33-m_23*m_32)*m_22*oq, +(m_21*m_32-m_22*m_31)*m_21*oq+(m_22*m_33-m_23*m_32)*m_23*oq, (+(m_21*m_32-m_22*m_31)*m_22-(m_21*m_33-m_23*m_31)*m_23)*oq], axis=0),
+            numpy.stack([-(m_12*m_33-m_13*m_32)*m_21*oq, +(m_11*m_33-m_13*m_31)*m_22*oq, -(m_11*m_32-m_12*m_31)*m_23*oq, +(m_11*m_33-m_13*m_31)*m_21*oq-(m_12*m_33-m_13*m_32)*m_22*oq, -(m_11*m_32-m_12*m_31)*m_21*oq-(m_12*m_33-m_13*m_32)*m_23*oq, (-(m_11*m_32-m_12*m_31)*m_22+(m_11*m_33-m_13*m_31)*m_23)*oq], axis=0),
+            numpy.stack([+(m_12*m_23-m_13*m_22)*m_21*oq, -(m_11*m_23-m_13*m_21)*m_22*oq, +(m_11*m_22-m_12*m_21)*m_23*oq, -(m_11*m_23-m_13*m_21)*m_21*oq+(m_12*m_23-m_13*m_22)*m_22*oq, +(m_11*m_22-m_12*m_21)*m_21*oq+(m_12*m_23-m_13*m_22)*m_23*oq, (+(m_11*m_22-m_12*m_21)*m_22-(m_11*m_23-m_13*m_21)*m_23)*oq], axis=0),
+            numpy.stack([+(m_22*m_33-m_23*m_32)*m_31*oq, -(m_21*m_33-m_23*m_31)*m_32*oq, +(m_21*m_32-m_22*m_31)*m_33*oq, -(m_21*m_33-m_23*m_31)*m_31*oq+(m_22*m_33-m_23*m_32)*m_32*oq, +(m_21*m_32-m_22*m_31)*m_31*oq+(m_22*m_33-m_23*m_32)*m_33*oq, (+(m_21*m_32-m_22*m_31)*m_32-(m_21*m_33-m_23*m_31)*m_33)*oq], axis=0),
+            numpy.stack([-(m_12*m_33-m_13*m_32)*m_31*oq, +(m_11*m_33-m_13*m_31)*m_32*oq, -(m_11*m_32-m_12*m_31)*m_33*oq, +(m_11*m_33-m_13*m_31)*m_31*oq-(m_12*m_33-m_13*m_32)*m_32*oq, -(m_11*m_32-m_12*m_31)*m_31*oq-(m_12*m_33-m_13*m_32)*m_33*oq, (-(m_11*m_32-m_12*m_31)*m_32+(m_11*m_33-m_13*m_31)*m_33)*oq], axis=0),
+            numpy.stack([+(m_12*m_23-m_13*m_22)*m_31*oq, -(m_11*m_23-m_13*m_21)*m_32*oq, +(m_11*m_22-m_12*m_21)*m_33*oq, -(m_11*m_23-m_13*m_21)*m_31*oq+(m_12*m_23-m_13*m_22)*m_32*oq, +(m_11*m_22-m_12*m_21)*m_31*oq+(m_12*m_23-m_13*m_22)*m_33*oq, (+(m_11*m_22-m_12*m_21)*m_32-(m_11*m_23-m_13*m_21)*m_33)*oq], axis=0)], axis=0)
         if q.dtype == float:
             dder["q"] = dder_q
         else:
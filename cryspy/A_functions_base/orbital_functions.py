@@ -2,6 +2,12 @@ import numpy
 import scipy
 import scipy.special
 
+from cryspy.A_functions_base.function_1_cache import calc_by_table_cache
+
+# grid of sthovl/kappa for the tables of <j_l>
+TABLE_X_STEP = 0.002
+TABLE_X_MAX = 4.
+
 
 def calc_rho_normalized(radius, coeff, zeta, n, kappa=1):
     """
@@ -30,10 +36,13 @@ def calc_density_spherical(radius, shell_population, shell_coeff, shell_zeta, sh
     return density_spherical
 
 
-def calc_transs(l_max, nn, zeta, sthovl):
+def calc_transs(l_max, nn, zeta, sthovl, flag_sthovl: bool = False):
     """ integral( r**nn * exp(-zeta r) * j_l(Qr) dr) / Q**l
     Q = 4 pi sint / lambda
     # ATTENTION: in one of my note it was written factor r**2 but it looks that it was mistake
+
+    If flag_sthovl is True the derivatives over sthovl are also given
+    (by the derivatives of the recurrence).
     """
     Q = 4*numpy.pi*sthovl
     a = [0. for h in range(17)]
@@ -44,21 +53,37 @@ def calc_transs(l_max, nn, zeta, sthovl):
     n = nn-1
     tz = 2.*zeta
     ts = 4.*numpy.pi
+    if flag_sthovl:
+        # d'/d = (dd/dsthovl)/d
+        d_der_per_d = 8.*numpy.pi*Q/d
+        a_der = [0. for h in range(17)]
+        ff_der = [0 for h in range(l_max+1)]
+        a_der[1] = -a[1]*d_der_per_d
     for l in range(l_max+1):
         ll = l+1
         if (ll != 1):
             a[ll] = a[ll-1]*ts*l*1./d
             a[ll-1] = numpy.zeros_like(sthovl) 
+            if flag_sthovl:
+                a_der[ll] = a_der[ll-1]*ts*l*1./d - a[ll]*d_der_per_d
+                a_der[ll-1] = numpy.zeros_like(sthovl)
         for nx in range(ll, n+1):
             i1 = nx
             i2 = nx+1
             i3 = i2+1
             a[i3-1] = (tz*nx*a[i2-1] - (nx+l)*(nx-ll)*a[i1-1])*1./d
+            if flag_sthovl:
+                a_der[i3-1] = (tz*nx*a_der[i2-1] - (nx+l)*(nx-ll)*a_der[i1-1])*1./d - a[i3-1]*d_der_per_d
         ff[ll-1] = a[i3-1]
+        if flag_sthovl:
+            ff_der[ll-1] = a_der[i3-1]
+    if flag_sthovl:
+        return ff, ff_der
     return ff
 
 
-def calc_jl_per_2sthovll(sthovl, coeff, n, zeta, kappa=1, l_max = 3):
+def calc_jl_per_2sthovll(sthovl, coeff, n, zeta, kappa=1, l_max = 3, flag_sthovl: bool = False):
+    """If flag_sthovl is True the derivatives over sthovl [sthovl, l_max+1] are also given."""
     c_ij = numpy.expand_dims(coeff, axis=1) * numpy.expand_dims(coeff, axis=0)
     zeta_ang = kappa*zeta/0.529177
     hh = numpy.power(2.*zeta_ang, n.astype(float)+0.5)
@@ -69,13 +94,21 @@ def calc_jl_per_2sthovll(sthovl, coeff, n, zeta, kappa=1, l_max = 3):
     zeta_ij = numpy.expand_dims(zeta_ang, axis=1) + numpy.expand_dims(zeta_ang, axis=0)
 
     res = numpy.zeros(sthovl.shape+(l_max+1,))
+    if flag_sthovl:
+        res_der = numpy.zeros(sthovl.shape+(l_max+1,))
 
     for c, cc, nn, zz in zip(c_ij.flatten(), coeff_norm_ij.flatten(), nn_ij.flatten(), zeta_ij.flatten()):
-        ff = calc_transs(l_max, nn, zz, sthovl)
+        if flag_sthovl:
+            ff, ff_der = calc_transs(l_max, nn, zz, sthovl, flag_sthovl=True)
+            res_der += c*cc*numpy.stack(ff_der, axis=1)
+        else:
+            ff = calc_transs(l_max, nn, zz, sthovl)
         ff_l = numpy.stack(ff, axis=1)
         
         val = c*cc*ff_l
         res += val
+    if flag_sthovl:
+        return res, res_der
     return res
 
 
@@ -84,4 +117,57 @@ def calc_jl(sthovl, coeff, n, zeta, kappa=1, l_max = 3):
     q_l = numpy.power(numpy.expand_dims(2.*sthovl, axis=1), numpy.expand_dims(numpy.arange(l_max+1), axis=0))
     jl_per_2sthovll = calc_jl_per_2sthovll(sthovl, coeff, n, zeta, kappa=kappa, l_max=l_max)
     jl = jl_per_2sthovll*q_l
-    return jl
\ No newline at end of file
+    return jl
+
+
+def calc_by_hermite_table(x, x_step: float, table, table_der):
+    """Interpolate the tables [..., grid] on the uniform grid from zero with step x_step.
+
+    The cubic Hermite interpolation by the values and derivatives in the
+    nodes is used. x [x] should be in the grid. Output is [..., x].
+    """
+    n_grid = table.shape[-1]
+    index_left = numpy.clip(numpy.floor(x/x_step).astype(int), 0, n_grid-2)
+    t = x/x_step - index_left
+    t_sq = numpy.square(t)
+    t_cub = t_sq*t
+    h_00 = 2.*t_cub - 3.*t_sq + 1.
+    h_10 = t_cub - 2.*t_sq + t
+    h_01 = -2.*t_cub + 3.*t_sq
+    h_11 = t_cub - t_sq
+    res = (
+        h_00*table[..., index_left] + h_10*x_step*table_der[..., index_left] +
+        h_01*table[..., index_left+1] + h_11*x_step*table_der[..., index_left+1])
+    return res
+
+
+def calc_jl_table(coeff, n, zeta, l_max: int = 3):
+    """Calculate <j_l> [l_max+1, grid] and its analytical derivatives [l_max+1, grid] on the grid of sthovl at kappa = 1."""
+    table_x = numpy.arange(int(round(TABLE_X_MAX/TABLE_X_STEP))+1)*TABLE_X_STEP
+    jl_per_2sthovll, jl_per_2sthovll_der = calc_jl_per_2sthovll(
+        table_x, coeff, n, zeta, kappa=1., l_max=l_max, flag_sthovl=True)
+    np_l = numpy.arange(l_max+1)
+    q_l = numpy.power(2.*table_x[:, numpy.newaxis], np_l[numpy.newaxis, :])
+    q_l_der = 2.*np_l[numpy.newaxis, :]*numpy.power(2.*table_x[:, numpy.newaxis], numpy.maximum(np_l-1, 0)[numpy.newaxis, :])
+    jl = (jl_per_2sthovll*q_l).transpose()
+    jl_der = (jl_per_2sthovll_der*q_l + jl_per_2sthovll*q_l_der).transpose()
+    return numpy.stack([jl, jl_der], axis=0)
+
+
+def calc_jl_by_table(sthovl, coeff, n, zeta, kappa=1, l_max = 3):
+    """Calculate <j_l> [sthovl, l_max+1] as calc_jl by the table of the orbitals.
+
+    The table is calculated at kappa = 1 once (see calc_by_table_cache) and
+    kappa is taken into account by rescaling of the argument:
+    <j_l>(sthovl, kappa) = <j_l>(sthovl/kappa, 1).
+    """
+    table = calc_by_table_cache(
+        "jl", calc_jl_table, numpy.asarray(coeff, dtype=float), numpy.asarray(n, dtype=int),
+        numpy.asarray(zeta, dtype=float), int(l_max))
+    x = numpy.asarray(sthovl, dtype=float)/kappa
+    flag_table = x <= TABLE_X_MAX
+    jl = numpy.zeros(x.shape + (l_max+1, ), dtype=float)
+    jl[flag_table] = calc_by_hermite_table(x[flag_table], TABLE_X_STEP, table[0], table[1]).transpose()
+    if not(numpy.all(flag_table)):
+        jl[~flag_table] = calc_jl(x[~flag_table], coeff, n, zeta, kappa=1., l_max=l_max)
+    return jl
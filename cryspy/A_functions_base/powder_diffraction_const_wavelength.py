@@ -1,7 +1,15 @@
 import numpy
+import scipy.sparse
+import scipy.special
+
+from .function_1_profiling import profiled_stage
 
 na = numpy.newaxis
 
+# Half-width of the window (in units of FWHM of the peak) for the sparse
+# profile. None means that the dense profile [tth, hkl] is calculated.
+DICT_SPARSE_PROFILE = {"n_fwhm": None}
+
 
 def calc_lorentz_factor(ttheta, k:float=0.0, cthm:float = 0.91, flag_ttheta: bool=False):
     """Lorentz factor for 1D powder diffraction profile.
@@ -192,6 +200,7 @@ def calc_eta(h_l, h_pv, flag_h_l: bool = False, flag_h_pv: bool = False):
     return res, dder
 
 
+@profiled_stage
 def calc_profile_pseudo_voight(ttheta, ttheta_hkl, u, v, w, i_g, x, y,
         p_1, p_2, p_3, p_4, 
         flag_ttheta: bool=False, 
@@ -235,6 +244,128 @@ def calc_profile_pseudo_voight(ttheta, ttheta_hkl, u, v, w, i_g, x, y,
     return res, dder
 
 
+def calc_profile_cutoff_error(n_fwhm, eta=1.):
+    """Fraction of the area of pseudo-Voight peak outside the window +-n_fwhm*FWHM.
+
+    It is the upper bound of the relative error of the integrated signal
+    given by the sparse profile. The Lorentz part gives
+    1-2/pi*arctan(2*n_fwhm), the Gauss part gives erfc(2*sqrt(ln 2)*n_fwhm).
+    """
+    error_l = 1. - 2./numpy.pi*numpy.arctan(2.*n_fwhm)
+    error_g = scipy.special.erfc(2.*numpy.sqrt(numpy.log(2.))*n_fwhm)
+    return eta*error_l + (1.-eta)*error_g
+
+
+def calc_n_fwhm_by_accuracy(accuracy: float):
+    """Half-width of the window (in FWHM) for which calc_profile_cutoff_error is not larger than accuracy.
+
+    The Lorentz peak (eta = 1) is taken as the worst case.
+    """
+    if not(0. < accuracy < 1.):
+        raise AttributeError("The accuracy of the sparse profile should be between 0 and 1.")
+    return 0.5*numpy.tan(0.5*numpy.pi*(1.-accuracy))
+
+
+def set_sparse_profile(n_fwhm: float = None, accuracy: float = None):
+    """Switch on the sparse profile of 1D powder diffraction.
+
+    Each peak is calculated inside the window +-n_fwhm*FWHM only and the
+    profile is kept as CSR matrix [tth, hkl]. Instead of n_fwhm the accuracy
+    (upper bound of the lost fraction of the peak area, see
+    calc_profile_cutoff_error) can be given. Because of the long Lorentz
+    tails the accuracy 1e-2 requires n_fwhm = 32. Without arguments the dense
+    profile is used.
+    """
+    if accuracy is not None:
+        n_fwhm = calc_n_fwhm_by_accuracy(accuracy)
+    if n_fwhm is not None:
+        n_fwhm = float(n_fwhm)
+        if n_fwhm <= 0.:
+            raise AttributeError("The window of the sparse profile should be positive.")
+    DICT_SPARSE_PROFILE["n_fwhm"] = n_fwhm
+
+
+def get_sparse_profile():
+    """Give the half-width of the window (in FWHM) of the sparse profile or None for the dense profile."""
+    return DICT_SPARSE_PROFILE["n_fwhm"]
+
+
+def calc_profile_window(ttheta, ttheta_hkl, half_width):
+    """Give the points [tth] inside the windows ttheta_hkl +- half_width [hkl].
+
+    Output is the indexes of points and reflections of the entries sorted by
+    reflections. The windows are found by searchsorted on the sorted ttheta.
+    """
+    if numpy.all(ttheta[1:] >= ttheta[:-1]):
+        order = None
+        ttheta_sorted = ttheta
+    else:
+        order = numpy.argsort(ttheta, kind="stable")
+        ttheta_sorted = ttheta[order]
+    i_start = numpy.searchsorted(ttheta_sorted, ttheta_hkl - half_width, side="left")
+    i_end = numpy.searchsorted(ttheta_sorted, ttheta_hkl + half_width, side="right")
+    counts = i_end - i_start
+    index_hkl_entry = numpy.repeat(numpy.arange(ttheta_hkl.size), counts)
+    offsets = numpy.cumsum(counts) - counts
+    index_tth_entry = numpy.arange(counts.sum()) + numpy.repeat(i_start - offsets, counts)
+    if order is not None:
+        index_tth_entry = order[index_tth_entry]
+    return index_tth_entry, index_hkl_entry
+
+
+@profiled_stage
+def calc_profile_pseudo_voight_sparse(ttheta, ttheta_hkl, u, v, w, i_g, x, y,
+        p_1, p_2, p_3, p_4, n_fwhm: float = 8.):
+    """Calculate profile as psevdo-Voight function inside the windows +-n_fwhm*FWHM of the peaks.
+
+    Output is CSR matrix [tth, hkl], its entries are equal to the ones of
+    calc_profile_pseudo_voight. The widths of windows are calculated at
+    ttheta_hkl. The derivatives are not calculated.
+    """
+    h_pv_hkl = calc_h_pv(
+        calc_h_g(u, v, w, i_g, ttheta_hkl)[0], calc_h_l(x, y, ttheta_hkl)[0])[0]
+    index_tth_entry, index_hkl_entry = calc_profile_window(
+        ttheta, ttheta_hkl, n_fwhm*h_pv_hkl*numpy.pi/180.)
+
+    h_g = calc_h_g(u, v, w, i_g, ttheta)[0]
+    h_l = calc_h_l(x, y, ttheta)[0]
+    h_pv = calc_h_pv(h_g, h_l)[0]
+    eta = calc_eta(h_l, h_pv)[0]
+
+    ttheta_entry, h_pv_entry, eta_entry = ttheta[index_tth_entry], h_pv[index_tth_entry], eta[index_tth_entry]
+    delta_angle = (ttheta_entry - ttheta_hkl[index_hkl_entry])[:, na]
+    z = (delta_angle*180./numpy.pi)/h_pv_entry[:, na]
+    af = calc_asymmetry_factor(z, ttheta_entry, p_1, p_2, p_3, p_4)[0]
+    profile_l = func_lorentz_by_h_pv(delta_angle, h_pv_entry)[0]
+    profile_g = func_gauss_by_h_pv(delta_angle, h_pv_entry)[0]
+    profile_entry = ((eta_entry[:, na] * profile_l + (1.-eta_entry)[:, na]*profile_g)*af)[:, 0]
+
+    res = scipy.sparse.csr_matrix(
+        (profile_entry, (index_tth_entry, index_hkl_entry)), shape=(ttheta.size, ttheta_hkl.size))
+    dder = {}
+    return res, dder
+
+
+@profiled_stage
+def calc_signal_plus_minus_by_profile(profile, iint_plus, iint_minus):
+    """Calculate signals up and down as sum over reflections of profile [..., hkl] multiplied by intensities [hkl].
+
+    Both signals are given by one matrix product of the profile (dense or
+    sparse) and the block of intensities [hkl, 2], so the profile is read
+    once. If the intensities up and down coincide one column is used.
+    """
+    if (iint_plus is iint_minus) or numpy.array_equal(iint_plus, iint_minus):
+        iint_block = iint_plus[:, na]
+    else:
+        iint_block = numpy.stack([iint_plus, iint_minus], axis=-1)
+    if scipy.sparse.issparse(profile):
+        signal_block = profile.dot(iint_block)
+    else:
+        n_hkl = profile.shape[-1]
+        signal_block = numpy.matmul(profile.reshape(-1, n_hkl), iint_block).reshape(profile.shape[:-1] + (-1,))
+    return signal_block[..., 0], signal_block[..., -1]
+
+
 def calc_gamma_nu_by_ttheta_phi(ttheta, phi, flag_ttheta: bool = False, flag_phi: bool = False):
     """See the documentation module "Powder diffraction at constant wavelength".
     """
@@ -263,6 +394,7 @@ def calc_ttheta_phi_by_gamma_nu(gamma, nu, flag_gamma: bool = False, flag_nu: bo
     return ttheta, phi, dder_ttheta, dder_phi
 
 
+@profiled_stage
 def calc_profile_pseudo_voight_2d(ttheta, phi,
         ttheta_hkl, u, v, w, i_g, x, y,
         p_1, p_2, p_3, p_4, p_phi,
@@ -2,10 +2,13 @@ import numpy
 import scipy
 import scipy.special
 
+from .function_1_profiling import profiled_stage
+
 na = numpy.newaxis
 
 
 
+@profiled_stage
 def calc_spectrum(time, spectrum_type, spectrum_parameters, flag_spectrum_parameters=False):
     exp = numpy.exp
     time_sq = numpy.square(time)
@@ -223,6 +226,7 @@ def tof_Carpenter():
 
 
 
+@profiled_stage
 def calc_peak_shape_function(alphas, betas, sigmas,
         d, time, time_hkl, gammas = None, size_g: float = 0., strain_g: float = 0.,
         size_l: float = 0., strain_l: float = 0., peak_shape: str = "pseudo-Voigt"):
@@ -2,6 +2,8 @@ import numpy
 
 from scipy.special import erfc, exp1
 
+from .function_1_profiling import profiled_stage
+
 def calc_n(alpha, beta):
     y = 0.5 * alpha * beta / (alpha + beta)
     return y
@@ -139,6 +141,7 @@ def calc_beta_1_prime(d, beta_10):
     return y
 
 
+@profiled_stage
 def calc_profile_by_zcode_parameters(
         delta_t, d,
         sigma_0_sq, sigma_1_sq, sigma_2_sq,
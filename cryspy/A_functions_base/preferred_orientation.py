@@ -2,6 +2,7 @@ import numpy
 
 from .unit_cell import calc_eq_ccs_by_unit_cell_parameters
 from .powder_diffraction_const_wavelength import calc_gamma_nu_by_ttheta_phi
+from .function_1_profiling import profiled_stage
 
 def calc_cos_ang(cell, h_1, k_1, l_1, h_2, k_2, l_2):
     """Calculate directed cosines."""
@@ -16,6 +17,7 @@ def calc_cos_ang(cell, h_1, k_1, l_1, h_2, k_2, l_2):
 
 na = numpy.newaxis
 
+@profiled_stage
 def calc_preferred_orientation_pd(
         index_hkl, texture_g1, texture_g2, texture_axis, unit_cell_parameters,
         flag_texture_g1: bool = False, flag_texture_g2: bool = False,
@@ -48,6 +50,7 @@ def calc_preferred_orientation_pd(
     return preferred_orientation, dder_po
 
 
+@profiled_stage
 def calc_preferred_orientation_pd2d(alpha_det,
         index_hkl, texture_g1, texture_g2, texture_axis, unit_cell_parameters,
         flag_texture_g1: bool = False, flag_texture_g2: bool = False,
@@ -0,0 +1,142 @@
+"""Crystal-level store of structure factors shared by experiments.
+
+Experiments referencing the same crystal register their reflections in the
+store of the crystal. Structure factors are calculated once for all
+registered reflections (in the dictionary dict_in_out of the store, so the
+cached intermediates are reused as for one experiment) and each experiment
+takes its reflections by index mapping.
+
+The store is a dictionary {crystal name: store of the crystal}. It is kept
+in dict_in_out of the chi_sq calculation and it has to be reset by
+reset_reflection_store when the precalculated data are not used.
+
+Experiments can be calculated concurrently by threads. The store of a
+crystal is read and updated under the lock of the crystal, the structure
+factors are calculated outside of it.
+
+Functions
+---------
+    - calc_hkl_keys
+    - get_crystal_store_lock
+    - get_crystal_reflection_store
+    - reset_reflection_store
+    - calc_by_reflection_store
+"""
+import threading
+
+import numpy
+
+# {crystal name: lock of its store}, LOCK_REFLECTION_STORE guards the dictionary itself
+DICT_LOCK_CRYSTAL_STORE = {}
+LOCK_REFLECTION_STORE = threading.Lock()
+
+# the nodes [..., hkl] which are given to the experiment for its reflections
+NAMES_REFLECTION_NODES = ("sthovl", "f_nucl", "sft_ccs", "eq_ccs", "f_m_o", "f_m_perp_o")
+
+HKL_KEY_BASE = 2**20
+
+
+def calc_hkl_keys(index_hkl):
+    """Give integer keys [hkl] of reflections (|h|, |k|, |l| < 2**19)."""
+    hkl = numpy.asarray(index_hkl, dtype=numpy.int64) + HKL_KEY_BASE//2
+    return (hkl[0]*HKL_KEY_BASE + hkl[1])*HKL_KEY_BASE + hkl[2]
+
+
+def calc_index_hkl_by_keys(hkl_keys):
+    """Give reflections [3, hkl] by their integer keys (see calc_hkl_keys)."""
+    h, hh = numpy.divmod(hkl_keys, HKL_KEY_BASE*HKL_KEY_BASE)
+    k, l = numpy.divmod(hh, HKL_KEY_BASE)
+    return numpy.stack([h, k, l], axis=0).astype(int) - HKL_KEY_BASE//2
+
+
+def get_crystal_store_lock(crystal_name: str):
+    """Give the lock of the reflection store of the crystal."""
+    with LOCK_REFLECTION_STORE:
+        if crystal_name not in DICT_LOCK_CRYSTAL_STORE.keys():
+            DICT_LOCK_CRYSTAL_STORE[crystal_name] = threading.Lock()
+        return DICT_LOCK_CRYSTAL_STORE[crystal_name]
+
+
+def get_crystal_reflection_store(dict_reflection_store: dict, crystal_name: str, label: str, index_hkl):
+    """Register reflections index_hkl of the experiment 'label' in the store of the crystal.
+
+    Output is the store of the crystal and the positions of index_hkl in
+    the reflections of the store. If the registered reflections are changed
+    the dictionary dict_in_out of the store is formed again.
+    """
+    if crystal_name in dict_reflection_store.keys():
+        dict_crystal_store = dict_reflection_store[crystal_name]
+    else:
+        dict_crystal_store = {"requests": {}, "hkl_keys": numpy.zeros((0,), dtype=numpy.int64), "dict_in_out": {}}
+        dict_reflection_store[crystal_name] = dict_crystal_store
+
+    dict_requests = dict_crystal_store["requests"]
+    hkl_keys = calc_hkl_keys(index_hkl)
+    if not((label in dict_requests.keys()) and numpy.array_equal(dict_requests[label], hkl_keys)):
+        dict_requests[label] = hkl_keys
+        store_hkl_keys = numpy.unique(numpy.concatenate(list(dict_requests.values())))
+        if not(numpy.array_equal(store_hkl_keys, dict_crystal_store["hkl_keys"])):
+            dict_crystal_store["hkl_keys"] = store_hkl_keys
+            dict_crystal_store["dict_in_out"] = {"index_hkl": calc_index_hkl_by_keys(store_hkl_keys)}
+    index_map = numpy.searchsorted(dict_crystal_store["hkl_keys"], hkl_keys)
+    return dict_crystal_store, index_map
+
+
+def reset_reflection_store(dict_reflection_store: dict):
+    """Remove the calculated data from the store.
+
+    The registered reflections are kept, so the structure factors are
+    calculated once for all experiments.
+    """
+    for crystal_name, dict_crystal_store in list(dict_reflection_store.items()):
+        with get_crystal_store_lock(crystal_name):
+            dict_in_out_store = dict_crystal_store["dict_in_out"]
+            if "index_hkl" in dict_in_out_store.keys():
+                dict_crystal_store["dict_in_out"] = {"index_hkl": dict_in_out_store["index_hkl"]}
+
+
+def calc_by_reflection_store(
+        func, dict_crystal, dict_in_out, dict_reflection_store: dict = None, label: str = "",
+        flag_use_precalculated_data: bool = False, flag_calc_analytical_derivatives: bool = False):
+    """Calculate structure factors by func (calc_f_nucl_by_dictionary, calc_sft_ccs_by_dictionary
+    or calc_f_m_perp_ordered_by_dictionary) for the reflections dict_in_out["index_hkl"].
+
+    If dict_reflection_store is given the structure factors are calculated
+    for all reflections registered in the store of the crystal and the ones
+    of the experiment 'label' are taken. The nodes NAMES_REFLECTION_NODES are
+    written in dict_in_out as by func. The derivatives over atom parameters
+    [..., hkl, a] are taken in the same way. The analytical derivatives are
+    calculated without the store.
+    """
+    if (dict_reflection_store is None) or flag_calc_analytical_derivatives:
+        return func(
+            dict_crystal, dict_in_out, flag_use_precalculated_data=flag_use_precalculated_data,
+            flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
+
+    crystal_name = dict_crystal["name"]
+    lock_crystal_store = get_crystal_store_lock(crystal_name)
+    with lock_crystal_store:
+        dict_crystal_store, index_map = get_crystal_reflection_store(
+            dict_reflection_store, crystal_name, label, dict_in_out["index_hkl"])
+        dict_in_out_store = dict_crystal_store["dict_in_out"]
+        # the calculation is done in the copy, the nodes are replaced but not changed in place
+        dict_in_out_calc = dict(dict_in_out_store)
+        if "cache_dependencies" in dict_in_out_calc.keys():
+            dict_in_out_calc["cache_dependencies"] = dict(dict_in_out_calc["cache_dependencies"])
+
+    # the store is reset when the precalculated data are not used
+    res_store, dder_store = func(dict_crystal, dict_in_out_calc, flag_use_precalculated_data=True)
+
+    with lock_crystal_store:
+        # the copy is kept if the reflections of the store were not changed meanwhile
+        if dict_crystal_store["dict_in_out"] is dict_in_out_store:
+            dict_crystal_store["dict_in_out"] = dict_in_out_calc
+
+    dict_cache_dependencies = dict_in_out.get("cache_dependencies", {})
+    for name in NAMES_REFLECTION_NODES:
+        if name in dict_in_out_calc.keys():
+            dict_in_out[name] = dict_in_out_calc[name][..., index_map]
+            dict_cache_dependencies.pop(name, None)
+    res = res_store[..., index_map]
+    dder = {name: value[..., index_map, :] for name, value in dder_store.items()}
+    return res, dder
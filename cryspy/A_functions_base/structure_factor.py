@@ -6,15 +6,62 @@ For details see documentation.
 """
 import numpy
 
-from .matrix_operations import calc_det_m, calc_m1_m2, calc_m1_m2_inv_m1, calc_m_v, calc_vector_product_v1_v2_v1, calc_m_q_inv_m
-from .unit_cell import calc_eq_ccs_by_unit_cell_parameters, calc_m_m_by_unit_cell_parameters, calc_m_m_norm_by_unit_cell_parameters, calc_sthovl_by_unit_cell_parameters
-from .debye_waller_factor import calc_dwf
-from .symmetry_elements import calc_multiplicity_by_atom_symm_elems, calc_full_symm_elems_by_reduced, calc_equivalent_reflections
-from .magnetic_form_factor import calc_form_factor
+from .matrix_operations import calc_det_m, calc_m1_m2, calc_m1_m2_inv_m1, calc_m_v, calc_vector_product_v1_v2_v1, calc_m_q_inv_m, calc_vv_as_v1_v2_v1
+from .unit_cell import calc_m_reciprocal_g_by_unit_cell_parameters, calc_eq_ccs_by_unit_cell_parameters, calc_m_m_by_unit_cell_parameters, calc_m_m_norm_by_unit_cell_parameters, calc_sthovl_by_unit_cell_parameters
+from .debye_waller_factor import calc_dwf, calc_dwf_by_atoms
+from .symmetry_elements import calc_multiplicity_by_atom_symm_elems, calc_full_symm_elems_by_reduced
+from .magnetic_form_factor import calc_form_factor, calc_form_factor_by_table
+from .charge_form_factor import calc_scattering_amplitude_by_table
 from .local_susceptibility import calc_m_r_inv_m
+from .function_1_cache import get_cached_node, set_cached_node, calc_by_symmetry_cache
+from .function_1_profiling import profiled_stage
+from .structure_factor_kernel import DICT_KERNEL, calc_f_asym_a_fused
 
 na = numpy.newaxis
 
+# Memory budget (in bytes) for tensors [hkl, reduced symmetry, atom] formed in
+# calculations of structure factors. If it is None the tensors are formed for
+# all reflections at once and they are kept in dict_in_out.
+DICT_MEMORY_BUDGET = {"bytes": None}
+
+# Relative margin of sthovl for the superset of reflections of powder
+# experiments (see calc_index_hkl_multiplicity_by_superset).
+DICT_HKL_SUPERSET = {"sthovl_margin": 0.02}
+
+
+def set_structure_factor_memory_budget(n_bytes: int = None):
+    """Set the memory budget (in bytes) for calculations of structure factors.
+
+    If the tensors [hkl, reduced symmetry, atom] exceed the budget the
+    reflections are processed by chunks and only arrays [hkl, atom] are kept.
+    None switches off the chunking.
+    """
+    if n_bytes is not None:
+        n_bytes = int(n_bytes)
+        if n_bytes <= 0:
+            raise AttributeError("The memory budget should be positive")
+    DICT_MEMORY_BUDGET["bytes"] = n_bytes
+
+
+def get_structure_factor_memory_budget():
+    """Give the memory budget (in bytes) for calculations of structure factors."""
+    return DICT_MEMORY_BUDGET["bytes"]
+
+
+def calc_hkl_chunk_size(n_hkl: int, n_element_per_hkl: int, n_byte_per_element: int):
+    """Give the number of reflections in one chunk.
+
+    None is given if the memory budget is not defined or the calculation
+    for all reflections fits into it.
+    """
+    n_bytes = DICT_MEMORY_BUDGET["bytes"]
+    if n_bytes is None:
+        return None
+    n_byte_per_hkl = max(int(n_element_per_hkl) * int(n_byte_per_element), 1)
+    if n_hkl * n_byte_per_hkl <= n_bytes:
+        return None
+    return max(n_bytes // n_byte_per_hkl, 1)
+
 def get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz):
     ones = numpy.ones_like(atom_fract_xyz[0]).astype(int)
     atom_symm_elems = numpy.stack([
@@ -28,6 +75,17 @@ def get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz):
     return atom_symm_elems
 
  
+@profiled_stage
+def calc_dder_by_sc_matrix(dder, sc_matrix):
+    """Transform derivatives [..., n, hkl, a] over constrained parameters of atoms
+    to the derivatives over refined ones.
+
+    The constrained parameters are sc_matrix [n*n, a] (or [n, n, a]) multiplied by refined ones.
+    """
+    n = dder.shape[-3]
+    return numpy.einsum("...iha,ija->...jha", dder, sc_matrix.reshape(n, n, -1))
+
+
 def calc_f_m_perp_by_sft(
         sft_ccs, magnetic_field, eq_ccs,
         flag_sft_ccs: bool = False,
@@ -88,10 +146,10 @@ def calc_pr1(index_hkl, reduced_symm_elems, fract_xyz, flag_fract_xyz: bool = Fa
     res = numpy.exp(-2.*numpy.pi*1j*hh)
     dder = {}
     if flag_fract_xyz:
-        dder["fract_xyz"] = numpy.stack([
-            numpy.exp(-2.*numpy.pi*1j*(h*r_11 + k*r_21 + l*r_31)),
-            numpy.exp(-2.*numpy.pi*1j*(h*r_11 + k*r_21 + l*r_31)),
-            numpy.exp(-2.*numpy.pi*1j*(h*r_11 + k*r_21 + l*r_31))], axis=0)
+        dder["fract_xyz"] = -2.*numpy.pi*1j*numpy.stack([
+            (h*r_11 + k*r_21 + l*r_31)*res,
+            (h*r_12 + k*r_22 + l*r_32)*res,
+            (h*r_13 + k*r_23 + l*r_33)*res], axis=0)
     return res, dder
 
 
@@ -142,6 +200,41 @@ def calc_pr5(reduced_symm_elems, unit_cell_parameters, flag_unit_cell_parameters
     return res, dder
 
 
+def calc_pr5_by_symmetry_cache(reduced_symm_elems, unit_cell_parameters, flag_unit_cell_parameters: bool = False):
+    """Calculate PR5 (see calc_pr5), it is taken from the process-wide cache if the derivatives are not needed.
+    """
+    if flag_unit_cell_parameters:
+        return calc_pr5(reduced_symm_elems, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
+    return calc_by_symmetry_cache("pr_5", calc_pr5, reduced_symm_elems, unit_cell_parameters)
+
+
+def calc_pr12_cos(index_hkl, reduced_symm_elems, fract_xyz):
+    """Calculate real part of PR1*PR2, dimensions [hkl, rs, atoms].
+    It is used for centrosymmetric structures with the inversion at the origin.
+    """
+    index_hkl_exp = numpy.expand_dims(numpy.expand_dims(index_hkl, axis=2), axis=3)
+    h, k, l = index_hkl_exp[0], index_hkl_exp[1], index_hkl_exp[2]
+    reduced_symm_elems_exp = numpy.expand_dims(numpy.expand_dims(reduced_symm_elems, axis=1), axis=3)
+    b_1, b_2, b_3, b_d = reduced_symm_elems_exp[0], reduced_symm_elems_exp[1], reduced_symm_elems_exp[2], reduced_symm_elems_exp[3]
+    r_11, r_12, r_13 = reduced_symm_elems_exp[4], reduced_symm_elems_exp[5], reduced_symm_elems_exp[6]
+    r_21, r_22, r_23 = reduced_symm_elems_exp[7], reduced_symm_elems_exp[8], reduced_symm_elems_exp[9]
+    r_31, r_32, r_33 = reduced_symm_elems_exp[10], reduced_symm_elems_exp[11], reduced_symm_elems_exp[12]
+    fract_xyz_exp = numpy.expand_dims(numpy.expand_dims(fract_xyz, axis=1), axis=2)
+    x, y, z = fract_xyz_exp[0], fract_xyz_exp[1], fract_xyz_exp[2]
+
+    hh = h*(r_11*x + r_12*y + r_13*z + b_1.astype(float)/b_d) + k*(r_21*x + r_22*y + r_23*z + b_2.astype(float)/b_d) + \
+        l*(r_31*x + r_32*y + r_33*z + b_3.astype(float)/b_d)
+    res = numpy.cos(2.*numpy.pi*hh)
+    return res
+
+
+def calc_flag_centrosymmetry_at_origin(centrosymmetry, centrosymmetry_position) -> bool:
+    """Check whether the structure is centrosymmetric with the inversion at the origin (PR4 = 1)."""
+    if not(centrosymmetry) or (centrosymmetry_position is None):
+        return False
+    return bool(numpy.all(numpy.mod(centrosymmetry_position[:3], centrosymmetry_position[3]) == 0))
+
+
 def calc_f_asym_a_by_pr(
         atom_multiplicity, debye_waller, atom_occupancy, pr_1, pr_2,
         flag_debye_waller: bool = False, flag_atom_occupancy: bool = False, flag_pr_1: bool = False):
@@ -168,6 +261,180 @@ def calc_f_asym_a_by_pr(
         dder["pr_1_imag"] = 1j*(pr_2[:,:,na]*atom_multiplicity[na, na, :]*atom_occupancy[na, na, :]*debye_waller)/pr_2.shape[-1]
     return res, dder
 
+def calc_f_asym_real_by_pr(atom_multiplicity, debye_waller, atom_occupancy, pr_12_cos):
+    """Calculate real part of preliminary asymmetric structure factor [hkl, a].
+    It is used for centrosymmetric structures with the inversion at the origin.
+    """
+    res = (pr_12_cos*debye_waller).sum(axis=1)*(atom_multiplicity*atom_occupancy/pr_12_cos.shape[1])[na, :]
+    return res
+
+
+def calc_f_asym_a_by_hkl_chunks(
+        index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        atom_multiplicity, atom_occupancy, pr_2, n_hkl_chunk: int, flag_real: bool = False):
+    """Calculate preliminary asymmetric structure factor [hkl, a] by chunks of reflections.
+
+    PR1 and Debye-Waller factor [hkl, rs, a] are formed only for n_hkl_chunk reflections.
+    If flag_real is True only the real part is calculated (see calc_f_asym_real_by_pr).
+    """
+    f_asym_a = numpy.zeros((index_hkl.shape[-1], atom_fract_xyz.shape[-1]), dtype=float if flag_real else complex)
+    for i_hkl in range(0, index_hkl.shape[-1], n_hkl_chunk):
+        chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+        index_hkl_chunk = index_hkl[:, chunk]
+        debye_waller_factor = calc_dwf_by_atoms(
+            index_hkl_chunk, sthovl[chunk], atom_b_iso, atom_beta, reduced_symm_elems)
+        if flag_real:
+            pr_12_cos = calc_pr12_cos(index_hkl_chunk, reduced_symm_elems, atom_fract_xyz)
+            f_asym_a[chunk] = calc_f_asym_real_by_pr(
+                atom_multiplicity, debye_waller_factor, atom_occupancy, pr_12_cos)
+        else:
+            pr_1 = calc_pr1(index_hkl_chunk, reduced_symm_elems, atom_fract_xyz)[0]
+            f_asym_a[chunk] = calc_f_asym_a_by_pr(
+                atom_multiplicity, debye_waller_factor, atom_occupancy, pr_1, pr_2[chunk])[0]
+    return f_asym_a
+
+
+def calc_f_asym_atom(index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta, pr_2,
+        flag_real: bool = False):
+    """Calculate contributions of atoms with unit multiplicity and occupancy
+    to preliminary asymmetric structure factor [hkl, a].
+
+    The fused kernel or the chain of PR1 and Debye-Waller factor (by chunks of
+    reflections if the memory budget is exceeded) is used.
+    If flag_real is True only the real part is calculated.
+    """
+    ones_atom = numpy.ones((atom_fract_xyz.shape[-1], ), dtype=float)
+    if DICT_KERNEL["kernel"] == "fused":
+        # Debye-Waller factor is calculated with the same elements as in calc_dwf
+        return calc_f_asym_a_fused(
+            index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+            reduced_symm_elems[:9], ones_atom, ones_atom, flag_jit=DICT_KERNEL["flag_jit"], flag_real=flag_real)
+
+    n_hkl_chunk = calc_hkl_chunk_size(
+        index_hkl.shape[-1], reduced_symm_elems.shape[-1]*atom_fract_xyz.shape[-1], 48 if flag_real else 96)
+    if n_hkl_chunk is None:
+        n_hkl_chunk = max(index_hkl.shape[-1], 1)
+    return calc_f_asym_a_by_hkl_chunks(
+        index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        ones_atom, ones_atom, pr_2, n_hkl_chunk, flag_real=flag_real)
+
+
+def calc_f_asym_atom_by_changed_atoms(
+        dict_in_out, dict_dependency, index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        pr_2, flag_real: bool = False, flag_use_precalculated_data: bool = False):
+    """Give contributions of atoms f_asym_atom [hkl, a] (see calc_f_asym_atom) recalculating
+    only the atoms with changed parameters.
+
+    The contributions are kept in dict_in_out if the inputs common for all
+    atoms (dict_dependency) are unchanged. The parameters of atoms
+    (fract_xyz, b_iso, beta) are compared atom by atom.
+    """
+    atom_parameters = numpy.concatenate([atom_fract_xyz, atom_b_iso[na, :], atom_beta], axis=0)
+    flag_hit, f_asym_atom = get_cached_node(
+        dict_in_out, "f_asym_atom", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_hit:
+        atom_parameters_saved = dict_in_out["f_asym_atom_parameters"]
+        flag_hit = atom_parameters_saved.shape == atom_parameters.shape
+
+    if flag_hit:
+        flags_atom_changed = numpy.any(atom_parameters != atom_parameters_saved, axis=0)
+        if not(numpy.any(flags_atom_changed)):
+            return f_asym_atom
+        f_asym_atom = numpy.copy(f_asym_atom)
+        f_asym_atom[:, flags_atom_changed] = calc_f_asym_atom(
+            index_hkl, reduced_symm_elems, atom_fract_xyz[:, flags_atom_changed], sthovl,
+            atom_b_iso[flags_atom_changed], atom_beta[:, flags_atom_changed], pr_2, flag_real=flag_real)
+    else:
+        f_asym_atom = calc_f_asym_atom(
+            index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta, pr_2, flag_real=flag_real)
+    set_cached_node(dict_in_out, "f_asym_atom", f_asym_atom, dict_dependency)
+    if dict_in_out is not None:
+        dict_in_out["f_asym_atom_parameters"] = atom_parameters
+    return f_asym_atom
+
+
+
+def calc_dder_by_pr1_dwf(dder_f_asym_a, dder_pr_1, dder_dwf):
+    """Calculate derivatives of preliminary asymmetric structure factor over
+    fract_xyz, b_iso, beta and sthovl by the derivatives over PR1 and
+    Debye-Waller factor given for each reduced symmetry element [..., hkl, rs, a].
+
+    Dimensions of output are [..., 3, hkl, a] for fract_xyz, [..., 6, hkl, a]
+    for beta and [..., hkl, a] for b_iso and sthovl.
+    """
+    dder = {}
+    if "fract_xyz" in dder_pr_1.keys():
+        dder["fract_xyz"] = (
+            numpy.einsum("...hra,jhra->...jha", dder_f_asym_a["pr_1_real"], dder_pr_1["fract_xyz"].real) +
+            numpy.einsum("...hra,jhra->...jha", dder_f_asym_a["pr_1_imag"], dder_pr_1["fract_xyz"].imag))
+    for key in ("b_iso", "sthovl"):
+        if key in dder_dwf.keys():
+            dder[key] = (dder_f_asym_a["debye_waller"]*dder_dwf[key]).sum(axis=-2)
+    if "beta" in dder_dwf.keys():
+        dder["beta"] = numpy.einsum("...hra,jhra->...jha", dder_f_asym_a["debye_waller"], dder_dwf["beta"])
+    return dder
+
+
+def calc_dder_by_f_asym_a(dder_f, dder_f_asym_a):
+    """Calculate derivatives of structure factor by the derivatives over real and
+    imaginary parts of preliminary asymmetric structure factor (see calc_f_by_f_asym_a_pr)
+    and the derivatives of preliminary asymmetric structure factor over parameters.
+    """
+    dder = {}
+    for key, value in dder_f_asym_a.items():
+        dder_f_real, dder_f_imag = dder_f["f_asym_a_real"], dder_f["f_asym_a_imag"]
+        if value.ndim > dder_f_real.ndim:
+            # the parameter has several components [..., n, hkl, a]
+            dder_f_real = numpy.expand_dims(dder_f_real, axis=-3)
+            dder_f_imag = numpy.expand_dims(dder_f_imag, axis=-3)
+        dder[key] = dder_f_real*value.real + dder_f_imag*value.imag
+    return dder
+
+
+def concatenate_dder_by_hkl_chunks(l_dder):
+    """Join derivatives calculated for chunks of reflections [..., hkl, a]."""
+    return {key: numpy.concatenate([dder[key] for dder in l_dder], axis=-2) for key in l_dder[0].keys()}
+
+
+def calc_f_asym_a_derivatives(
+        index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        atom_multiplicity, atom_occupancy, pr_2, n_hkl_chunk: int = None,
+        flag_atom_fract_xyz: bool = False, flag_atom_occupancy: bool = False,
+        flag_atom_b_iso: bool = False, flag_atom_beta: bool = False, flag_sthovl: bool = False):
+    """Calculate derivatives of preliminary asymmetric structure factor [hkl, a]
+    over parameters of atoms and sin(theta)/lambda.
+
+    The keys of output are "fract_xyz" [3, hkl, a], "occupancy" [hkl, a],
+    "b_iso" [hkl, a], "beta" [6, hkl, a] and "sthovl" [hkl, a].
+    Reflections are processed by chunks if n_hkl_chunk is given.
+    """
+    n_hkl = index_hkl.shape[-1]
+    if ((n_hkl_chunk is not None) and (n_hkl_chunk < n_hkl)):
+        l_dder = []
+        for i_hkl in range(0, n_hkl, n_hkl_chunk):
+            chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+            l_dder.append(calc_f_asym_a_derivatives(
+                index_hkl[:, chunk], reduced_symm_elems, atom_fract_xyz, sthovl[chunk], atom_b_iso, atom_beta,
+                atom_multiplicity, atom_occupancy, pr_2[chunk],
+                flag_atom_fract_xyz=flag_atom_fract_xyz, flag_atom_occupancy=flag_atom_occupancy,
+                flag_atom_b_iso=flag_atom_b_iso, flag_atom_beta=flag_atom_beta, flag_sthovl=flag_sthovl))
+        return concatenate_dder_by_hkl_chunks(l_dder)
+
+    pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems, atom_fract_xyz, flag_fract_xyz=flag_atom_fract_xyz)
+    debye_waller_factor, dder_dwf = calc_dwf(
+        index_hkl[:, :, na, na], sthovl[:, na, na], atom_b_iso[na, na, :],
+        atom_beta[:, na, na, :], reduced_symm_elems[:, na, :, na],
+        flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_b_iso, flag_beta=flag_atom_beta)
+    f_asym_a, dder_f_asym_a = calc_f_asym_a_by_pr(
+        atom_multiplicity, debye_waller_factor, atom_occupancy, pr_1, pr_2,
+        flag_debye_waller=(flag_sthovl or flag_atom_b_iso or flag_atom_beta),
+        flag_atom_occupancy=flag_atom_occupancy, flag_pr_1=flag_atom_fract_xyz)
+    dder = calc_dder_by_pr1_dwf(dder_f_asym_a, dder_pr_1, dder_dwf)
+    if flag_atom_occupancy:
+        dder["occupancy"] = dder_f_asym_a["atom_occupancy"].sum(axis=1)
+    return dder
+
+
 # Delete IT
 # def calc_f_asym_by_pr(
 #         atom_multiplicity, scat_length_neutron, debye_waller, atom_occupancy, pr_1, pr_2,
@@ -257,6 +524,24 @@ def calc_f_by_f_asym_a_pr(f_asym_a, scattering_length, pr_3, centrosymmetry, pr_
         pass
     return res, dder
 
+def calc_f_by_f_asym_real_pr(f_asym_real, scattering_length, pr_3):
+    """Calculate structure factor of centrosymmetric structure with the inversion at the origin.
+
+    It is 0.5*(f_h + conj(f_h)) given by calc_f_by_f_asym_a_pr with PR4 = 1
+    (PR3 is real as the translations are given together with opposite ones).
+
+    Dimensions:
+    f_asym_real = [hkl, a]
+    scattering length = [hkl, a] or [a]
+    pr_3 = [hkl]
+    """
+    if len(scattering_length.shape) == 1:
+        scat_length_2d = scattering_length[na, :] # neutron diffraction [atoms]
+    else:
+        scat_length_2d = scattering_length # X-ray diffraction [hkl, atoms]
+    res = pr_3 * (scat_length_2d * f_asym_real).sum(axis=1)
+    return res
+
 # DELETE iT
 # def calc_f_by_f_asym_pr(f_asym, pr_3, centrosymmetry, pr_4, flag_f_asym: bool = False):
 #     """Calculate structure factor by preliminary defined parameters.
@@ -306,8 +591,89 @@ def calc_sft_ccs_asym_a_by_pr(
     if flag_atom_para_susceptibility:
         dder_hh_2 = 0.2695*(dder_hh["q"][:,:, na,:, :]* atom_para_sc_chi[na, :, :, na,:]).sum(axis=1)
         dder["atom_para_susceptibility"] =  (pr_2[na, na, :, :, na] * hh_3[na, na, :, :, :] * dder_hh_2[:, :, na, :, :]).sum(axis=3)/pr_2.shape[-1]
+    if (flag_debye_waller or flag_atom_para_occupancy or flag_pr_1):
+        # dimensions [9, hkl, rs, a]
+        hh_4 = pr_2[na, :, :, na] * hh[:, na, :, :]/pr_2.shape[-1]
+    if flag_debye_waller:
+        dder["debye_waller"] = hh_4 * (pr_1*hh_1[na, na, :])[na, :, :, :]
+    if flag_atom_para_occupancy:
+        dder["atom_para_occupancy"] = hh_4 * (pr_1*debye_waller_factor*atom_para_multiplicity[na, na, :])[na, :, :, :]
+    if flag_pr_1:
+        dder["pr_1_real"] = hh_4 * (debye_waller_factor*hh_1[na, na, :])[na, :, :, :]
+        dder["pr_1_imag"] = 1j*dder["pr_1_real"]
     return res, dder
 
+def calc_sft_ccs_asym_a_by_hkl_chunks(
+        index_hkl, reduced_symm_elems, atom_para_fract_xyz, sthovl, atom_para_b_iso, atom_para_beta,
+        atom_para_multiplicity, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
+        pr_2, pr_5, n_hkl_chunk: int, flag_atom_para_susceptibility: bool = False):
+    """Calculate preliminary asymmetric structure factor tensor [9, hkl, a] by chunks of reflections.
+
+    PR1 and Debye-Waller factor [hkl, rs, a] are formed only for n_hkl_chunk reflections.
+    """
+    l_res, l_dder_susceptibility = [], []
+    for i_hkl in range(0, index_hkl.shape[-1], n_hkl_chunk):
+        chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+        index_hkl_chunk = index_hkl[:, chunk]
+        pr_1 = calc_pr1(index_hkl_chunk, reduced_symm_elems, atom_para_fract_xyz)[0]
+        debye_waller_factor = calc_dwf_by_atoms(
+            index_hkl_chunk, sthovl[chunk], atom_para_b_iso, atom_para_beta, reduced_symm_elems)
+        res_chunk, dder_chunk = calc_sft_ccs_asym_a_by_pr(
+            atom_para_multiplicity, debye_waller_factor, atom_para_occupancy,
+            atom_para_susceptibility, atom_para_sc_chi, pr_1, pr_2[chunk], pr_5,
+            flag_atom_para_susceptibility=flag_atom_para_susceptibility)
+        l_res.append(res_chunk)
+        if flag_atom_para_susceptibility:
+            l_dder_susceptibility.append(dder_chunk["atom_para_susceptibility"])
+    res = numpy.concatenate(l_res, axis=1)
+    dder = {}
+    if flag_atom_para_susceptibility:
+        dder["atom_para_susceptibility"] = numpy.concatenate(l_dder_susceptibility, axis=2)
+    return res, dder
+
+
+def calc_sft_ccs_asym_a_derivatives(
+        index_hkl, reduced_symm_elems, atom_para_fract_xyz, sthovl, atom_para_b_iso, atom_para_beta,
+        atom_para_multiplicity, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
+        pr_2, pr_5, n_hkl_chunk: int = None,
+        flag_atom_para_fract_xyz: bool = False, flag_atom_para_occupancy: bool = False,
+        flag_atom_para_b_iso: bool = False, flag_atom_para_beta: bool = False, flag_sthovl: bool = False):
+    """Calculate derivatives of preliminary asymmetric structure factor tensor [9, hkl, a]
+    over parameters of atoms and sin(theta)/lambda.
+
+    The keys of output are "fract_xyz" [9, 3, hkl, a], "occupancy" [9, hkl, a],
+    "b_iso" [9, hkl, a], "beta" [9, 6, hkl, a] and "sthovl" [9, hkl, a].
+    Reflections are processed by chunks if n_hkl_chunk is given.
+    """
+    n_hkl = index_hkl.shape[-1]
+    if ((n_hkl_chunk is not None) and (n_hkl_chunk < n_hkl)):
+        l_dder = []
+        for i_hkl in range(0, n_hkl, n_hkl_chunk):
+            chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+            l_dder.append(calc_sft_ccs_asym_a_derivatives(
+                index_hkl[:, chunk], reduced_symm_elems, atom_para_fract_xyz, sthovl[chunk], atom_para_b_iso,
+                atom_para_beta, atom_para_multiplicity, atom_para_occupancy, atom_para_susceptibility,
+                atom_para_sc_chi, pr_2[chunk], pr_5,
+                flag_atom_para_fract_xyz=flag_atom_para_fract_xyz, flag_atom_para_occupancy=flag_atom_para_occupancy,
+                flag_atom_para_b_iso=flag_atom_para_b_iso, flag_atom_para_beta=flag_atom_para_beta,
+                flag_sthovl=flag_sthovl))
+        return concatenate_dder_by_hkl_chunks(l_dder)
+
+    pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems, atom_para_fract_xyz, flag_fract_xyz=flag_atom_para_fract_xyz)
+    debye_waller_factor, dder_dwf = calc_dwf(
+        index_hkl[:, :, na, na], sthovl[:, na, na], atom_para_b_iso[na, na, :],
+        atom_para_beta[:, na, na, :], reduced_symm_elems[:, na, :, na],
+        flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_para_b_iso, flag_beta=flag_atom_para_beta)
+    sft_ccs_asym, dder_sft_ccs_asym = calc_sft_ccs_asym_a_by_pr(
+        atom_para_multiplicity, debye_waller_factor, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
+        pr_1, pr_2, pr_5, flag_debye_waller=(flag_sthovl or flag_atom_para_b_iso or flag_atom_para_beta),
+        flag_atom_para_occupancy=flag_atom_para_occupancy, flag_pr_1=flag_atom_para_fract_xyz)
+    dder = calc_dder_by_pr1_dwf(dder_sft_ccs_asym, dder_pr_1, dder_dwf)
+    if flag_atom_para_occupancy:
+        dder["occupancy"] = dder_sft_ccs_asym["atom_para_occupancy"].sum(axis=2)
+    return dder
+
+
 # DELETE IT
 # def calc_sft_ccs_asym_by_pr(
 #         atom_para_multiplicity, atom_para_form_factor, debye_waller_factor, atom_para_occupancy,
@@ -335,9 +701,13 @@ def calc_sft_ccs_asym_a_by_pr(
 #     return res, dder
 
 
-def calc_f_nucl_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False):
+def calc_f_nucl_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False,
+        flag_calc_analytical_derivatives: bool = False):
     """Calculate nuclear structure factor based on the information given in dictionary.
     Output information is written in the same dictionary. The following keys have to be defined.
+
+    If flag_calc_analytical_derivatives is True the derivatives over refined parameters
+    of crystal are given.
     """
     dict_crystal_keys = dict_crystal.keys()
     dict_in_out_keys = dict_in_out.keys()
@@ -399,11 +769,11 @@ def calc_f_nucl_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_
         atom_sc_beta[:, :, atom_site_aniso_index] = atom_site_aniso_sc_beta
         atom_beta = (atom_sc_beta*numpy.expand_dims(atom_beta, axis=0)).sum(axis=1)
 
-    flag_unit_cell_parameters = numpy.any(dict_crystal["flags_unit_cell_parameters"])
-    flag_atom_fract_xyz = numpy.any(dict_crystal["flags_atom_fract_xyz"])
-    flag_atom_occupancy = numpy.any(dict_crystal["flags_atom_occupancy"])
-    flag_atom_b_iso = numpy.any(dict_crystal["flags_atom_b_iso"])
-    flag_atom_beta = numpy.any(dict_crystal["flags_atom_beta"])
+    flag_unit_cell_parameters = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_unit_cell_parameters"])
+    flag_atom_fract_xyz = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_fract_xyz"])
+    flag_atom_occupancy = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_occupancy"])
+    flag_atom_b_iso = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_b_iso"])
+    flag_atom_beta = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_beta"])
 
     
     f_nucl, dder = calc_f_nucl(index_hkl,
@@ -413,12 +783,17 @@ def calc_f_nucl_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_
         flag_unit_cell_parameters=flag_unit_cell_parameters, flag_atom_fract_xyz=flag_atom_fract_xyz,
         flag_atom_occupancy=flag_atom_occupancy, flag_atom_b_iso=flag_atom_b_iso, flag_atom_beta=flag_atom_beta,
         flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_atom_fract_xyz:
+        dder["atom_fract_xyz"] = calc_dder_by_sc_matrix(dder["atom_fract_xyz"], atom_site_sc_fract)
+    if (flag_atom_beta and ("atom_site_aniso_sc_beta" in dict_crystal_keys)):
+        dder["atom_beta"] = calc_dder_by_sc_matrix(dder["atom_beta"], atom_sc_beta)
     
     if "atom_multiplicity" in dict_in_out.keys():
         dict_crystal["atom_multiplicity"] = dict_in_out["atom_multiplicity"]
     return f_nucl, dder
 
 
+@profiled_stage
 def calc_f_nucl(index_hkl,
         reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems,
         unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
@@ -429,125 +804,117 @@ def calc_f_nucl(index_hkl,
     """Calculate nuclear structure factor based on the information given in dictionary.
     Output information is written in the same dictionary. The following keys have to be defined.
     """
-    if dict_in_out is None:
-        flag_dict = False
-        dict_in_out_keys = []
-    else:
-        flag_dict = True
-        dict_in_out_keys = dict_in_out.keys()
-        if (flag_use_precalculated_data and ('index_hkl' in dict_in_out_keys)):
-            if numpy.any(dict_in_out["index_hkl"] != index_hkl):
-                dict_in_out.clear()
-                dict_in_out["index_hkl"] = index_hkl
-
-    if (flag_use_precalculated_data and ("atom_multiplicity" in dict_in_out_keys)):
-        atom_multiplicity = dict_in_out["atom_multiplicity"]
-    else:
-        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz)
-
-        if "full_symm_elems" in dict_in_out_keys:
-            full_symm_elems = dict_in_out["full_symm_elems"]
-        else:
-            full_symm_elems = calc_full_symm_elems_by_reduced(
-                reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
-            if flag_dict:
-                dict_in_out["full_symm_elems"] = full_symm_elems
-        atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
-        if flag_dict:
-            dict_in_out["atom_multiplicity"] = atom_multiplicity
-
     flag_pr_1 = flag_atom_fract_xyz
-    if (flag_use_precalculated_data and ("pr_1" in dict_in_out_keys) and not(flag_atom_fract_xyz)):
-        pr_1 = dict_in_out["pr_1"] 
-    else:
-        pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems, atom_fract_xyz, flag_fract_xyz=flag_atom_fract_xyz)
-        if flag_dict:
-            dict_in_out["pr_1"] = pr_1
-
-    if (flag_use_precalculated_data and ("pr_2" in dict_in_out_keys)):
-        pr_2 = dict_in_out["pr_2"] 
-    else:
-        pr_2 = calc_pr2(index_hkl, reduced_symm_elems)
-        if flag_dict:
-            dict_in_out["pr_2"] = pr_2 
-
-    if (flag_use_precalculated_data and ("pr_3" in dict_in_out_keys)):
-        pr_3 = dict_in_out["pr_3"] 
-    else:
-        pr_3 = calc_pr3(index_hkl, translation_elems)
-        if flag_dict:
-            dict_in_out["pr_3"] = pr_3 
-
-    if (flag_use_precalculated_data and ("pr_4" in dict_in_out_keys)):
-        pr_4 = dict_in_out["pr_4"] 
-    else:
-        pr_4 = calc_pr4(index_hkl, centrosymmetry_position)
-        if flag_dict:
-            dict_in_out["pr_4"] = pr_4 
-
-
     flag_sthovl = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("sthovl" in dict_in_out_keys) and not(flag_sthovl)):
-        sthovl = dict_in_out["sthovl"] 
-    else:
-        sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
-            index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["sthovl"] = sthovl
-
-    # dimensions ["hkl", "reduced symmetry", "atom"]
-    flag_debye_waller_factor = flag_sthovl or flag_atom_b_iso or flag_atom_beta
-    if (flag_use_precalculated_data and ("debye_waller_factor" in dict_in_out_keys) and not(flag_debye_waller_factor)):
-        debye_waller_factor = dict_in_out["debye_waller_factor"] 
-    else:
-        debye_waller_factor, dder_dw = calc_dwf(
-            index_hkl[:, :, na, na], sthovl[:, na, na], atom_b_iso[na, na, :],
-            atom_beta[:, na, na, :], reduced_symm_elems[:, na, :, na],
-            flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_b_iso, flag_beta=flag_atom_beta)
-        if flag_dict:
-            dict_in_out["debye_waller_factor"] = debye_waller_factor
-
     flag_scat_length_neutron = False
     flag_debye_waller = flag_atom_b_iso or flag_atom_beta
-    flag_f_asym = flag_scat_length_neutron or flag_debye_waller or flag_pr_1 
-
-    if (flag_use_precalculated_data and ("f_asym" in dict_in_out_keys) and
-            not(flag_f_asym)):
-        f_asym = dict_in_out["f_asym"]
-    else: 
-        f_asym, dder_f_asym = calc_f_asym_a_by_pr(
-            atom_multiplicity, debye_waller_factor, atom_occupancy,
-            pr_1, pr_2, 
-            flag_debye_waller=flag_debye_waller, flag_atom_occupancy=flag_atom_occupancy,
-            flag_pr_1=flag_pr_1)
-        if flag_dict:
-            dict_in_out["f_asym"] = f_asym
-
-    flag_f_nucl = flag_f_asym
-    
-    if (flag_use_precalculated_data and ("f_nucl" in dict_in_out_keys) and
-            not(flag_f_nucl)):
-        f_nucl = dict_in_out["f_nucl"]
-    else:
-        f_nucl, dder_f_nucl = calc_f_by_f_asym_a_pr(f_asym, scat_length_neutron, pr_3, centrosymmetry, pr_4, flag_f_asym_a=flag_f_asym, flag_scattering_length=flag_scat_length_neutron)
-        if flag_dict:
-            dict_in_out["f_nucl"] = f_nucl
+    flag_f_asym = flag_scat_length_neutron or flag_debye_waller or flag_pr_1 or flag_sthovl or flag_atom_occupancy
+
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems, "centrosymmetry": centrosymmetry,
+        "centrosymmetry_position": centrosymmetry_position, "translation_elems": translation_elems}
+    flag_hit, full_symm_elems = get_cached_node(
+        dict_in_out, "full_symm_elems", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        full_symm_elems = calc_full_symm_elems_by_reduced(
+            reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
+        set_cached_node(dict_in_out, "full_symm_elems", full_symm_elems, dict_dependency)
+
+    dict_dependency = {"full_symm_elems": full_symm_elems, "atom_fract_xyz": atom_fract_xyz}
+    flag_hit, atom_multiplicity = get_cached_node(
+        dict_in_out, "atom_multiplicity", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz)
+        atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
+        set_cached_node(dict_in_out, "atom_multiplicity", atom_multiplicity, dict_dependency)
+
+    # only cosine terms are calculated for centrosymmetric structures with the inversion at the origin
+    flag_real = calc_flag_centrosymmetry_at_origin(centrosymmetry, centrosymmetry_position)
+
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems}
+    flag_hit, pr_2 = get_cached_node(
+        dict_in_out, "pr_2", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_2 = calc_by_symmetry_cache("pr_2", calc_pr2, index_hkl, reduced_symm_elems)
+        set_cached_node(dict_in_out, "pr_2", pr_2, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "translation_elems": translation_elems}
+    flag_hit, pr_3 = get_cached_node(
+        dict_in_out, "pr_3", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_3 = calc_by_symmetry_cache("pr_3", calc_pr3, index_hkl, translation_elems)
+        set_cached_node(dict_in_out, "pr_3", pr_3, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "centrosymmetry_position": centrosymmetry_position}
+    flag_hit, pr_4 = get_cached_node(
+        dict_in_out, "pr_4", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_4 = calc_by_symmetry_cache("pr_4", calc_pr4, index_hkl, centrosymmetry_position)
+        set_cached_node(dict_in_out, "pr_4", pr_4, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, sthovl = get_cached_node(
+        dict_in_out, "sthovl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
+            index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
+        set_cached_node(dict_in_out, "sthovl", sthovl, dict_dependency)
+
+    # contributions of atoms are kept, only the atoms with changed parameters are recalculated
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems, "sthovl": sthovl,
+        "flag_real": flag_real}
+    f_asym_atom = calc_f_asym_atom_by_changed_atoms(
+        dict_in_out, dict_dependency, index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        pr_2, flag_real=flag_real, flag_use_precalculated_data=flag_use_precalculated_data)
+
+    dict_dependency = {"f_asym_atom": f_asym_atom, "atom_multiplicity": atom_multiplicity,
+        "atom_occupancy": atom_occupancy}
+    flag_hit, f_asym = get_cached_node(
+        dict_in_out, "f_asym", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        f_asym = f_asym_atom * (atom_multiplicity*atom_occupancy)[na, :]
+        set_cached_node(dict_in_out, "f_asym", f_asym, dict_dependency)
+
+    dict_dependency = {"f_asym": f_asym, "scat_length_neutron": scat_length_neutron, "pr_3": pr_3,
+        "centrosymmetry": centrosymmetry, "pr_4": pr_4}
+    flag_hit, f_nucl = get_cached_node(
+        dict_in_out, "f_nucl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit) and flag_real:
+        f_nucl = calc_f_by_f_asym_real_pr(f_asym, scat_length_neutron, pr_3)
+        set_cached_node(dict_in_out, "f_nucl", f_nucl, dict_dependency)
+    elif not(flag_hit):
+        f_nucl, dder_f_nucl = calc_f_by_f_asym_a_pr(f_asym, scat_length_neutron, pr_3, centrosymmetry, pr_4)
+        set_cached_node(dict_in_out, "f_nucl", f_nucl, dict_dependency)
 
     dder = {}
+    if flag_f_asym:
+        # derivatives are calculated without cached data, dimensions [..., hkl, a]
+        n_hkl_chunk = calc_hkl_chunk_size(
+            index_hkl.shape[-1], reduced_symm_elems.shape[-1]*atom_fract_xyz.shape[-1], 384)
+        dder_f_asym = calc_f_asym_a_derivatives(
+            index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+            atom_multiplicity, atom_occupancy, pr_2, n_hkl_chunk=n_hkl_chunk,
+            flag_atom_fract_xyz=flag_atom_fract_xyz, flag_atom_occupancy=flag_atom_occupancy,
+            flag_atom_b_iso=flag_atom_b_iso, flag_atom_beta=flag_atom_beta, flag_sthovl=flag_sthovl)
+        dder_f_nucl = calc_f_by_f_asym_a_pr(
+            f_asym, scat_length_neutron, pr_3, centrosymmetry, pr_4, flag_f_asym_a=True)[1]
+        dder_atom = calc_dder_by_f_asym_a(dder_f_nucl, dder_f_asym)
+
     if flag_unit_cell_parameters:
-        dder["unit_cell_parameters"] = None
+        dder_sthovl = calc_sthovl_by_unit_cell_parameters(
+            index_hkl, unit_cell_parameters, flag_unit_cell_parameters=True)[1]
+        dder["unit_cell_parameters"] = dder_atom["sthovl"].sum(axis=-1)[na, :]*dder_sthovl["unit_cell_parameters"]
 
     if flag_atom_fract_xyz:
-        dder["atom_fract_xyz"] = None
+        dder["atom_fract_xyz"] = dder_atom["fract_xyz"]
 
     if flag_atom_occupancy:
-        dder["atom_occupancy"] = None
+        dder["atom_occupancy"] = dder_atom["occupancy"]
 
     if flag_atom_b_iso:
-        dder["atom_b_iso"] = None
+        dder["atom_b_iso"] = dder_atom["b_iso"]
 
     if flag_atom_beta:
-        dder["atom_beta"] = None
+        dder["atom_beta"] = dder_atom["beta"]
 
     return f_nucl, dder
 
@@ -646,6 +1013,7 @@ def calc_f_charge_by_dictionary(dict_crystal, wavelength:float, dict_in_out, fla
 
 
 
+@profiled_stage
 def calc_f_charge(index_hkl,
         reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems,
         unit_cell_parameters, atom_fract_xyz, atom_occupancy, table_sthovl, table_atom_scattering_amplitude, atom_dispersion, atom_b_iso, atom_beta,
@@ -656,116 +1024,96 @@ def calc_f_charge(index_hkl,
     """Calculate nuclear structure factor based on the information given in dictionary.
     Output information is written in the same dictionary. The following keys have to be defined.
     """
-    if dict_in_out is None:
-        flag_dict = False
-        dict_in_out_keys = []
-    else:
-        flag_dict = True
-        dict_in_out_keys = dict_in_out.keys()
-        if (flag_use_precalculated_data and ('index_hkl' in dict_in_out_keys)):
-            if numpy.any(dict_in_out["index_hkl"] != index_hkl):
-                dict_in_out.clear()
-                dict_in_out["index_hkl"] = index_hkl
-
-    if (flag_use_precalculated_data and ("atom_multiplicity" in dict_in_out_keys)):
-        atom_multiplicity = dict_in_out["atom_multiplicity"]
-    else:
-        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz)
-
-        if "full_symm_elems" in dict_in_out_keys:
-            full_symm_elems = dict_in_out["full_symm_elems"]
-        else:
-            full_symm_elems = calc_full_symm_elems_by_reduced(
-                reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
-            if flag_dict:
-                dict_in_out["full_symm_elems"] = full_symm_elems
-        atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
-        if flag_dict:
-            dict_in_out["atom_multiplicity"] = atom_multiplicity
-
     flag_pr_1 = flag_atom_fract_xyz
-    if (flag_use_precalculated_data and ("pr_1" in dict_in_out_keys) and not(flag_atom_fract_xyz)):
-        pr_1 = dict_in_out["pr_1"] 
-    else:
-        pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems, atom_fract_xyz, flag_fract_xyz=flag_atom_fract_xyz)
-        if flag_dict:
-            dict_in_out["pr_1"] = pr_1
-
-    if (flag_use_precalculated_data and ("pr_2" in dict_in_out_keys)):
-        pr_2 = dict_in_out["pr_2"] 
-    else:
-        pr_2 = calc_pr2(index_hkl, reduced_symm_elems)
-        if flag_dict:
-            dict_in_out["pr_2"] = pr_2 
-
-    if (flag_use_precalculated_data and ("pr_3" in dict_in_out_keys)):
-        pr_3 = dict_in_out["pr_3"] 
-    else:
-        pr_3 = calc_pr3(index_hkl, translation_elems)
-        if flag_dict:
-            dict_in_out["pr_3"] = pr_3 
-
-    if (flag_use_precalculated_data and ("pr_4" in dict_in_out_keys)):
-        pr_4 = dict_in_out["pr_4"] 
-    else:
-        pr_4 = calc_pr4(index_hkl, centrosymmetry_position)
-        if flag_dict:
-            dict_in_out["pr_4"] = pr_4 
-
-
-    flag_sthovl = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("sthovl" in dict_in_out_keys) and not(flag_sthovl)):
-        sthovl = dict_in_out["sthovl"] 
-    else:
-        sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
-            index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["sthovl"] = sthovl
-
-    # dimensions ["hkl", "reduced symmetry", "atom"]
-    flag_debye_waller_factor = flag_sthovl or flag_atom_b_iso or flag_atom_beta
-    if (flag_use_precalculated_data and ("debye_waller_factor" in dict_in_out_keys) and not(flag_debye_waller_factor)):
-        debye_waller_factor = dict_in_out["debye_waller_factor"] 
-    else:
-        debye_waller_factor, dder_dw = calc_dwf(
-            index_hkl[:, :, na, na], sthovl[:, na, na], atom_b_iso[na, na, :],
-            atom_beta[:, na, na, :], reduced_symm_elems[:, na, :, na],
-            flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_b_iso, flag_beta=flag_atom_beta)
-        if flag_dict:
-            dict_in_out["debye_waller_factor"] = debye_waller_factor
-
     flag_scat_length_neutron = False
     flag_debye_waller = flag_atom_b_iso or flag_atom_beta
     flag_f_asym = flag_scat_length_neutron or flag_debye_waller or flag_pr_1 
 
-    if (flag_use_precalculated_data and ("f_asym" in dict_in_out_keys) and
-            not(flag_f_asym)):
-        f_asym = dict_in_out["f_asym"]
-    else: 
-        l_scat_length_xray = [
-            numpy.interp(sthovl, table_sthovl, table_sc_ampl) for table_sc_ampl in table_atom_scattering_amplitude]
-        hh = numpy.stack(l_scat_length_xray, axis=1)
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems, "centrosymmetry": centrosymmetry,
+        "centrosymmetry_position": centrosymmetry_position, "translation_elems": translation_elems}
+    flag_hit, full_symm_elems = get_cached_node(
+        dict_in_out, "full_symm_elems", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        full_symm_elems = calc_full_symm_elems_by_reduced(
+            reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
+        set_cached_node(dict_in_out, "full_symm_elems", full_symm_elems, dict_dependency)
+
+    dict_dependency = {"full_symm_elems": full_symm_elems, "atom_fract_xyz": atom_fract_xyz}
+    flag_hit, atom_multiplicity = get_cached_node(
+        dict_in_out, "atom_multiplicity", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_fract_xyz)
+        atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
+        set_cached_node(dict_in_out, "atom_multiplicity", atom_multiplicity, dict_dependency)
+
+    # only cosine terms are calculated for centrosymmetric structures with the inversion at the origin
+    flag_real = calc_flag_centrosymmetry_at_origin(centrosymmetry, centrosymmetry_position)
+
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems}
+    flag_hit, pr_2 = get_cached_node(
+        dict_in_out, "pr_2", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_2 = calc_by_symmetry_cache("pr_2", calc_pr2, index_hkl, reduced_symm_elems)
+        set_cached_node(dict_in_out, "pr_2", pr_2, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "translation_elems": translation_elems}
+    flag_hit, pr_3 = get_cached_node(
+        dict_in_out, "pr_3", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_3 = calc_by_symmetry_cache("pr_3", calc_pr3, index_hkl, translation_elems)
+        set_cached_node(dict_in_out, "pr_3", pr_3, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "centrosymmetry_position": centrosymmetry_position}
+    flag_hit, pr_4 = get_cached_node(
+        dict_in_out, "pr_4", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_4 = calc_by_symmetry_cache("pr_4", calc_pr4, index_hkl, centrosymmetry_position)
+        set_cached_node(dict_in_out, "pr_4", pr_4, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, sthovl = get_cached_node(
+        dict_in_out, "sthovl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
+            index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
+        set_cached_node(dict_in_out, "sthovl", sthovl, dict_dependency)
+
+    dict_dependency = {"sthovl": sthovl, "table_sthovl": table_sthovl,
+        "table_atom_scattering_amplitude": table_atom_scattering_amplitude, "atom_dispersion": atom_dispersion}
+    flag_hit, scat_length_xray = get_cached_node(
+        dict_in_out, "scat_length_xray", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
         scat_length_xray = (
-            numpy.stack(l_scat_length_xray, axis=1) + 
+            calc_scattering_amplitude_by_table(sthovl, table_sthovl, table_atom_scattering_amplitude) + 
             numpy.expand_dims(atom_dispersion, axis=0)
         )
-
-        f_asym, dder_f_asym = calc_f_asym_a_by_pr(
-            atom_multiplicity, debye_waller_factor, atom_occupancy,
-            pr_1, pr_2, 
-            flag_debye_waller=flag_debye_waller, flag_atom_occupancy=flag_atom_occupancy,
-            flag_pr_1=flag_pr_1)
-        if flag_dict:
-            dict_in_out["f_asym"] = f_asym
-    
-    flag_f_charge = flag_f_asym
-    if (flag_use_precalculated_data and ("f_charge" in dict_in_out_keys) and
-            not(flag_f_charge)):
-        f_charge = dict_in_out["f_charge"]
-    else:
+        set_cached_node(dict_in_out, "scat_length_xray", scat_length_xray, dict_dependency)
+
+    # contributions of atoms are kept, only the atoms with changed parameters are recalculated
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems, "sthovl": sthovl,
+        "flag_real": flag_real}
+    f_asym_atom = calc_f_asym_atom_by_changed_atoms(
+        dict_in_out, dict_dependency, index_hkl, reduced_symm_elems, atom_fract_xyz, sthovl, atom_b_iso, atom_beta,
+        pr_2, flag_real=flag_real, flag_use_precalculated_data=flag_use_precalculated_data)
+
+    dict_dependency = {"f_asym_atom": f_asym_atom, "atom_multiplicity": atom_multiplicity,
+        "atom_occupancy": atom_occupancy}
+    flag_hit, f_asym = get_cached_node(
+        dict_in_out, "f_asym", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        f_asym = f_asym_atom * (atom_multiplicity*atom_occupancy)[na, :]
+        set_cached_node(dict_in_out, "f_asym", f_asym, dict_dependency)
+
+    dict_dependency = {"f_asym": f_asym, "scat_length_xray": scat_length_xray, "pr_3": pr_3,
+        "centrosymmetry": centrosymmetry, "pr_4": pr_4}
+    flag_hit, f_charge = get_cached_node(
+        dict_in_out, "f_charge", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit) and flag_real:
+        f_charge = calc_f_by_f_asym_real_pr(f_asym, scat_length_xray, pr_3)
+        set_cached_node(dict_in_out, "f_charge", f_charge, dict_dependency)
+    elif not(flag_hit):
         f_charge, dder_f_charge = calc_f_by_f_asym_a_pr(f_asym, scat_length_xray, pr_3, centrosymmetry, pr_4, flag_f_asym_a=flag_f_asym, flag_scattering_length=flag_scat_length_neutron)
-        if flag_dict:
-            dict_in_out["f_charge"] = f_charge
+        set_cached_node(dict_in_out, "f_charge", f_charge, dict_dependency)
 
     dder = {}
     if flag_unit_cell_parameters:
@@ -786,9 +1134,13 @@ def calc_f_charge(index_hkl,
     return f_charge, dder
 
 
-def calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False):
+def calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False,
+        flag_calc_analytical_derivatives: bool = False):
     """Calculate structure factor tensor in CCS (X||a*, Z||c) based on the information given in dictionary.
     Output information is written in the same dictionary. 
+
+    The derivatives over susceptibility are always given, the derivatives over
+    other refined parameters of crystal if flag_calc_analytical_derivatives is True.
     """
     dict_crystal_keys = dict_crystal.keys()
     dict_in_out_keys = dict_in_out.keys()
@@ -873,14 +1225,14 @@ def calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated
 
     atom_para_susceptibility = dict_crystal["atom_para_susceptibility"]
     atom_para_sc_chi = dict_crystal["atom_para_sc_chi"] 
-    flag_unit_cell_parameters = numpy.any(dict_crystal["flags_unit_cell_parameters"])
-    flag_atom_para_fract_xyz = numpy.any(dict_crystal["flags_atom_fract_xyz"][:, atom_para_index])
-    flag_atom_para_occupancy = numpy.any(dict_crystal["flags_atom_occupancy"][atom_para_index])
-    flag_atom_para_b_iso = numpy.any(dict_crystal["flags_atom_b_iso"][atom_para_index])
-    flag_atom_para_beta = numpy.any(dict_crystal["flags_atom_beta"][:, atom_para_index])
+    flag_unit_cell_parameters = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_unit_cell_parameters"])
+    flag_atom_para_fract_xyz = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_fract_xyz"][:, atom_para_index])
+    flag_atom_para_occupancy = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_occupancy"][atom_para_index])
+    flag_atom_para_b_iso = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_b_iso"][atom_para_index])
+    flag_atom_para_beta = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_beta"][:, atom_para_index])
     flag_atom_para_susceptibility = numpy.any(dict_crystal["flags_atom_para_susceptibility"])
-    flag_atom_para_lande_factor = numpy.any(dict_crystal["flags_mag_atom_lande_factor"][mag_atom_para_index])
-    flag_atom_para_kappa = numpy.any(dict_crystal["flags_mag_atom_kappa"][mag_atom_para_index])
+    flag_atom_para_lande_factor = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_mag_atom_lande_factor"][mag_atom_para_index])
+    flag_atom_para_kappa = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_mag_atom_kappa"][mag_atom_para_index])
 
     
     sft_ccs, dder = calc_sft_ccs(index_hkl,
@@ -893,9 +1245,14 @@ def calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated
         flag_atom_para_b_iso=flag_atom_para_b_iso, flag_atom_para_beta=flag_atom_para_beta,
         flag_atom_para_lande_factor=flag_atom_para_lande_factor, flag_atom_para_kappa=flag_atom_para_kappa, 
         flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_atom_para_fract_xyz:
+        dder["atom_para_fract_xyz"] = calc_dder_by_sc_matrix(dder["atom_para_fract_xyz"], atom_para_sc_fract)
+    if (flag_atom_para_beta and ("atom_site_aniso_sc_beta" in dict_crystal_keys)):
+        dder["atom_para_beta"] = calc_dder_by_sc_matrix(dder["atom_para_beta"], atom_sc_beta[:, :, atom_para_index])
     return sft_ccs, dder
 
 
+@profiled_stage
 def calc_sft_ccs(index_hkl,
         reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems,
         unit_cell_parameters, atom_para_fract_xyz, atom_para_occupancy, atom_para_susceptibility, atom_para_b_iso, atom_para_beta,
@@ -910,116 +1267,132 @@ def calc_sft_ccs(index_hkl,
     Note, that the susceptibility parameters are given in mu_B. 
     """
     
-    if dict_in_out is None:
-        flag_dict = False
-        dict_in_out_keys = []
-    else:
-        flag_dict = True
-        dict_in_out_keys = dict_in_out.keys()
-        if 'index_hkl' in dict_in_out_keys:
-            if numpy.any(dict_in_out["index_hkl"] != index_hkl):
-                dict_in_out.clear()
-                dict_in_out["index_hkl"] = index_hkl
-
-    if (flag_use_precalculated_data and ("atom_para_multiplicity" in dict_in_out_keys)):
-        mag_atom_multiplicity = dict_in_out["atom_para_multiplicity"]
-    else:
-        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_para_fract_xyz)
-
-        if "full_symm_elems" in dict_in_out_keys:
-            full_symm_elems = dict_in_out["full_symm_elems"]
-        else:
-            full_symm_elems = calc_full_symm_elems_by_reduced(
-                reduced_symm_elems[:13], centrosymmetry, centrosymmetry_position, translation_elems)
-            if flag_dict:
-                dict_in_out["full_symm_elems"] = full_symm_elems
-        mag_atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
-        if flag_dict:
-            dict_in_out["atom_para_multiplicity"] = mag_atom_multiplicity
+    if dict_in_out is not None:
+        dict_in_out["flag_only_orbital"] = flag_only_orbital
 
-    flag_pr_1 = flag_atom_para_fract_xyz
-    if (flag_use_precalculated_data and ("pr_1_atom_para" in dict_in_out_keys) and not(flag_atom_para_fract_xyz)):
-        pr_1 = dict_in_out["pr_1_atom_para"] 
-    else:
-        pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems[:13], atom_para_fract_xyz, flag_fract_xyz=flag_atom_para_fract_xyz)
-        if flag_dict:
-            dict_in_out["pr_1_atom_para"] = pr_1
-
-    if (flag_use_precalculated_data and ("pr_2" in dict_in_out_keys)):
-        pr_2 = dict_in_out["pr_2"] 
-    else:
-        pr_2 = calc_pr2(index_hkl, reduced_symm_elems[:13])
-        if flag_dict:
-            dict_in_out["pr_2"] = pr_2 
-
-    if (flag_use_precalculated_data and ("pr_3" in dict_in_out_keys)):
-        pr_3 = dict_in_out["pr_3"] 
-    else:
-        pr_3 = calc_pr3(index_hkl, translation_elems)
-        if flag_dict:
-            dict_in_out["pr_3"] = pr_3 
+    flag_sthovl = flag_unit_cell_parameters
+    flag_atom_para_form_factor = (flag_sthovl or flag_atom_para_lande_factor or flag_atom_para_kappa)
 
-    if (flag_use_precalculated_data and ("pr_4" in dict_in_out_keys)):
-        pr_4 = dict_in_out["pr_4"] 
-    else:
-        pr_4 = calc_pr4(index_hkl, centrosymmetry_position)
-        if flag_dict:
-            dict_in_out["pr_4"] = pr_4 
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems[:13], "centrosymmetry": centrosymmetry,
+        "centrosymmetry_position": centrosymmetry_position, "translation_elems": translation_elems}
+    flag_hit, full_symm_elems = get_cached_node(
+        dict_in_out, "full_symm_elems", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        full_symm_elems = calc_full_symm_elems_by_reduced(
+            reduced_symm_elems[:13], centrosymmetry, centrosymmetry_position, translation_elems)
+        set_cached_node(dict_in_out, "full_symm_elems", full_symm_elems, dict_dependency)
+
+    dict_dependency = {"full_symm_elems": full_symm_elems, "atom_para_fract_xyz": atom_para_fract_xyz}
+    flag_hit, mag_atom_multiplicity = get_cached_node(
+        dict_in_out, "atom_para_multiplicity", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_para_fract_xyz)
+        mag_atom_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
+        set_cached_node(dict_in_out, "atom_para_multiplicity", mag_atom_multiplicity, dict_dependency)
 
-    flag_sthovl = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("sthovl" in dict_in_out_keys) and not(flag_sthovl)):
-        sthovl = dict_in_out["sthovl"] 
-    else:
+    # reflections are processed by chunks if tensors [hkl, rs, atom] exceed the memory budget
+    n_byte_per_element = 384
+    if flag_atom_para_susceptibility:
+        n_byte_per_element += 288*atom_para_sc_chi.shape[1]
+    n_hkl_chunk = calc_hkl_chunk_size(
+        index_hkl.shape[-1], reduced_symm_elems.shape[-1]*atom_para_fract_xyz.shape[-1], n_byte_per_element)
+
+    if n_hkl_chunk is None:
+        dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems[:13], "atom_para_fract_xyz": atom_para_fract_xyz}
+        flag_hit, pr_1 = get_cached_node(
+            dict_in_out, "pr_1_atom_para", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
+            pr_1 = calc_pr1(index_hkl, reduced_symm_elems[:13], atom_para_fract_xyz)[0]
+            set_cached_node(dict_in_out, "pr_1_atom_para", pr_1, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems[:13]}
+    flag_hit, pr_2 = get_cached_node(
+        dict_in_out, "pr_2", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_2 = calc_by_symmetry_cache("pr_2", calc_pr2, index_hkl, reduced_symm_elems[:13])
+        set_cached_node(dict_in_out, "pr_2", pr_2, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "translation_elems": translation_elems}
+    flag_hit, pr_3 = get_cached_node(
+        dict_in_out, "pr_3", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_3 = calc_by_symmetry_cache("pr_3", calc_pr3, index_hkl, translation_elems)
+        set_cached_node(dict_in_out, "pr_3", pr_3, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "centrosymmetry_position": centrosymmetry_position}
+    flag_hit, pr_4 = get_cached_node(
+        dict_in_out, "pr_4", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_4 = calc_by_symmetry_cache("pr_4", calc_pr4, index_hkl, centrosymmetry_position)
+        set_cached_node(dict_in_out, "pr_4", pr_4, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, sthovl = get_cached_node(
+        dict_in_out, "sthovl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
         sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
             index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["sthovl"] = sthovl
-
-    flag_pr_5 = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("pr_5" in dict_in_out_keys) and not(flag_pr_5)):
-        pr_5 = dict_in_out["pr_5"] 
-    else:
-        pr_5, dder_pr_5 = calc_pr5(reduced_symm_elems[:13], unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["pr_5"] = pr_5
-
-    flag_atom_para_form_factor = (flag_sthovl or flag_atom_para_lande_factor or flag_atom_para_kappa)
-    flag_hh = True
-    if "flag_only_orbital" in dict_in_out_keys:
-        flag_hh = flag_only_orbital == dict_in_out["flag_only_orbital"]
-    dict_in_out["flag_only_orbital"] = flag_only_orbital
-    if (flag_use_precalculated_data and ("atom_para_form_factor" in dict_in_out_keys) and not(flag_atom_para_form_factor) and flag_hh):
-        atom_para_form_factor = dict_in_out["atom_para_form_factor"] 
-    else:
+        set_cached_node(dict_in_out, "sthovl", sthovl, dict_dependency)
+
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems[:13], "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, pr_5 = get_cached_node(
+        dict_in_out, "pr_5", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_5, dder_pr_5 = calc_pr5_by_symmetry_cache(reduced_symm_elems[:13], unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
+        set_cached_node(dict_in_out, "pr_5", pr_5, dict_dependency)
+
+    dict_dependency = {"sthovl": sthovl, "atom_para_lande_factor": atom_para_lande_factor,
+        "atom_para_kappa": atom_para_kappa, "atom_para_j0_parameters": atom_para_j0_parameters,
+        "atom_para_j2_parameters": atom_para_j2_parameters, "flag_only_orbital": flag_only_orbital}
+    flag_hit, atom_para_form_factor = get_cached_node(
+        dict_in_out, "atom_para_form_factor", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit) and not(flag_atom_para_form_factor):
+        atom_para_form_factor = calc_form_factor_by_table(
+            sthovl, atom_para_lande_factor, atom_para_kappa, atom_para_j0_parameters, atom_para_j2_parameters,
+            flag_only_orbital=flag_only_orbital)
+        set_cached_node(dict_in_out, "atom_para_form_factor", atom_para_form_factor, dict_dependency)
+    elif not(flag_hit):
         atom_para_form_factor, dder_ff = calc_form_factor(
             sthovl[:, na], atom_para_lande_factor[na, :], atom_para_kappa[na, :], atom_para_j0_parameters[:, na, :], atom_para_j2_parameters[:, na, :],
             flag_lande_factor=flag_atom_para_lande_factor,
             flag_only_orbital=flag_only_orbital,
             flag_sthovl=flag_sthovl, 
             flag_kappa=flag_atom_para_kappa)
-        if flag_dict:
-            dict_in_out["atom_para_form_factor"] = atom_para_form_factor
-
-    # dimensions ["hkl", "reduced symmetry", "atom"]
-    flag_debye_waller_factor = flag_sthovl or flag_atom_para_b_iso or flag_atom_para_beta
-    if (flag_use_precalculated_data and ("atom_para_debye_waller_factor" in dict_in_out_keys) and not(flag_debye_waller_factor)):
-        debye_waller_factor = dict_in_out["atom_para_debye_waller_factor"] 
+        set_cached_node(dict_in_out, "atom_para_form_factor", atom_para_form_factor, dict_dependency)
+
+    # the derivatives over susceptibility are always calculated, so the nodes are recalculated
+    flag_use_sft_ccs = flag_use_precalculated_data and not(flag_atom_para_susceptibility)
+
+    if n_hkl_chunk is None:
+        # dimensions ["hkl", "reduced symmetry", "atom"]
+        dict_dependency = {"index_hkl": index_hkl, "sthovl": sthovl, "atom_para_b_iso": atom_para_b_iso,
+            "atom_para_beta": atom_para_beta, "reduced_symm_elems": reduced_symm_elems[:13]}
+        flag_hit, debye_waller_factor = get_cached_node(
+            dict_in_out, "atom_para_debye_waller_factor", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
+            debye_waller_factor = calc_dwf_by_atoms(
+                index_hkl, sthovl, atom_para_b_iso, atom_para_beta, reduced_symm_elems[:13])
+            set_cached_node(dict_in_out, "atom_para_debye_waller_factor", debye_waller_factor, dict_dependency)
+
+        dict_dependency = {"atom_para_multiplicity": mag_atom_multiplicity, "atom_para_debye_waller_factor": debye_waller_factor,
+            "atom_para_occupancy": atom_para_occupancy, "atom_para_susceptibility": atom_para_susceptibility,
+            "atom_para_sc_chi": atom_para_sc_chi, "pr_1_atom_para": pr_1, "pr_2": pr_2, "pr_5": pr_5}
     else:
-        debye_waller_factor, dder_dw = calc_dwf(
-            index_hkl[:, :, na, na], sthovl[:, na, na], atom_para_b_iso[na, na, :],
-            atom_para_beta[:, na, na, :], reduced_symm_elems[:13, na, :, na],
-            flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_para_b_iso, flag_beta=flag_atom_para_beta)
-        if flag_dict:
-            dict_in_out["atom_para_debye_waller_factor"] = debye_waller_factor
-
-    flag_scat_length_neutron = False
-    flag_debye_waller = flag_atom_para_b_iso or flag_atom_para_beta
-
-    flag_sft_ccs_asym = flag_atom_para_form_factor or flag_debye_waller or flag_atom_para_occupancy or flag_atom_para_susceptibility or flag_pr_1 or flag_pr_5
-    if (flag_use_precalculated_data and ("sft_ccs_asym" in dict_in_out_keys) and
-            not(flag_sft_ccs_asym)):
-        sft_ccs_asym = dict_in_out["sft_ccs_asym"]
-    else: 
+        dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": reduced_symm_elems[:13],
+            "atom_para_fract_xyz": atom_para_fract_xyz, "sthovl": sthovl,
+            "atom_para_b_iso": atom_para_b_iso, "atom_para_beta": atom_para_beta,
+            "atom_para_multiplicity": mag_atom_multiplicity, "atom_para_occupancy": atom_para_occupancy,
+            "atom_para_susceptibility": atom_para_susceptibility, "atom_para_sc_chi": atom_para_sc_chi,
+            "pr_2": pr_2, "pr_5": pr_5}
+    flag_hit, sft_ccs_asym = get_cached_node(
+        dict_in_out, "sft_ccs_asym", dict_dependency, flag_use_precalculated_data=flag_use_sft_ccs)
+    if (not(flag_hit) and (n_hkl_chunk is not None)):
+        sft_ccs_asym, dder_sft_ccs_asym = calc_sft_ccs_asym_a_by_hkl_chunks(
+            index_hkl, reduced_symm_elems[:13], atom_para_fract_xyz, sthovl, atom_para_b_iso, atom_para_beta,
+            mag_atom_multiplicity, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
+            pr_2, pr_5, n_hkl_chunk, flag_atom_para_susceptibility=flag_atom_para_susceptibility)
+        set_cached_node(dict_in_out, "sft_ccs_asym", sft_ccs_asym, dict_dependency)
+    elif not(flag_hit):
         theta = None
         # if reduced_symm_elems.shape[0] == 14:
         #     theta = reduced_symm_elems[13] # * calc_det_m(reduced_symm_elems[4:13], flag_m=False)[0]
@@ -1027,62 +1400,156 @@ def calc_sft_ccs(index_hkl,
         sft_ccs_asym, dder_sft_ccs_asym = calc_sft_ccs_asym_a_by_pr(
             mag_atom_multiplicity, debye_waller_factor, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
             pr_1, pr_2, pr_5, theta=theta,
-            flag_debye_waller=flag_debye_waller, flag_atom_para_occupancy=flag_atom_para_occupancy,
-            flag_atom_para_susceptibility = flag_atom_para_susceptibility,
-            flag_pr_1=flag_pr_1, flag_pr_5=flag_pr_5)
-        if flag_dict:
-            dict_in_out["sft_ccs_asym"] = sft_ccs_asym
-
-    flag_sft_ccs = flag_sft_ccs_asym
-    if (flag_use_precalculated_data and ("sft_ccs" in dict_in_out_keys) and
-            not(flag_sft_ccs)):
-        sft_ccs = dict_in_out["sft_ccs"]
-    else:
-        sft_ccs, dder_sft_ccs = calc_f_by_f_asym_a_pr(sft_ccs_asym, atom_para_form_factor, pr_3, centrosymmetry, pr_4, flag_f_asym_a=flag_sft_ccs_asym, flag_scattering_length=flag_atom_para_form_factor)
-        if flag_dict:
-            dict_in_out["sft_ccs"] = sft_ccs
+            flag_atom_para_susceptibility = flag_atom_para_susceptibility)
+        set_cached_node(dict_in_out, "sft_ccs_asym", sft_ccs_asym, dict_dependency)
+
+    dict_dependency = {"sft_ccs_asym": sft_ccs_asym, "atom_para_form_factor": atom_para_form_factor, "pr_3": pr_3,
+        "centrosymmetry": centrosymmetry, "pr_4": pr_4}
+    flag_hit, sft_ccs = get_cached_node(
+        dict_in_out, "sft_ccs", dict_dependency, flag_use_precalculated_data=flag_use_sft_ccs)
+    if not(flag_hit):
+        sft_ccs = calc_f_by_f_asym_a_pr(sft_ccs_asym, atom_para_form_factor, pr_3, centrosymmetry, pr_4)[0]
+        set_cached_node(dict_in_out, "sft_ccs", sft_ccs, dict_dependency)
 
     dder = {}
+    flag_atom_derivatives = (flag_atom_para_fract_xyz or flag_atom_para_occupancy or
+        flag_atom_para_b_iso or flag_atom_para_beta)
+    if (flag_atom_derivatives or flag_atom_para_susceptibility):
+        dder_sft_ccs = calc_f_by_f_asym_a_pr(
+            sft_ccs_asym, atom_para_form_factor, pr_3, centrosymmetry, pr_4, flag_f_asym_a=True)[1]
+
+    if flag_atom_derivatives:
+        # derivatives are calculated without cached data, dimensions [9, ..., hkl, a]
+        n_hkl_chunk = calc_hkl_chunk_size(
+            index_hkl.shape[-1], reduced_symm_elems.shape[-1]*atom_para_fract_xyz.shape[-1], 1536)
+        dder_sft_ccs_asym_atom = calc_sft_ccs_asym_a_derivatives(
+            index_hkl, reduced_symm_elems[:13], atom_para_fract_xyz, sthovl, atom_para_b_iso, atom_para_beta,
+            mag_atom_multiplicity, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
+            pr_2, pr_5, n_hkl_chunk=n_hkl_chunk,
+            flag_atom_para_fract_xyz=flag_atom_para_fract_xyz, flag_atom_para_occupancy=flag_atom_para_occupancy,
+            flag_atom_para_b_iso=flag_atom_para_b_iso, flag_atom_para_beta=flag_atom_para_beta)
+        dder_atom = calc_dder_by_f_asym_a(dder_sft_ccs, dder_sft_ccs_asym_atom)
+
     if flag_unit_cell_parameters:
         dder["unit_cell_parameters"] = None
 
     if flag_atom_para_fract_xyz:
-        dder["atom_para_fract_xyz"] = None
+        dder["atom_para_fract_xyz"] = dder_atom["fract_xyz"]
 
     if flag_atom_para_occupancy:
-        dder["atom_para_occupancy"] = None
+        dder["atom_para_occupancy"] = dder_atom["occupancy"]
 
     if flag_atom_para_b_iso:
-        dder["atom_para_b_iso"] = None
+        dder["atom_para_b_iso"] = dder_atom["b_iso"]
 
     if flag_atom_para_beta:
-        dder["atom_para_beta"] = None
+        dder["atom_para_beta"] = dder_atom["beta"]
     if flag_atom_para_susceptibility:
-        dder["atom_para_susceptibility"] = (
-            dder_sft_ccs["f_asym_a_real"][:, na, :, :]*dder_sft_ccs_asym["atom_para_susceptibility"]+
-            dder_sft_ccs["f_asym_a_imag"][:, na, :, :]*dder_sft_ccs_asym["atom_para_susceptibility"])
+        dder["atom_para_susceptibility"] = calc_dder_by_f_asym_a(
+            dder_sft_ccs, {"susceptibility": dder_sft_ccs_asym["atom_para_susceptibility"]})["susceptibility"]
     return sft_ccs, dder
 
 
+def calc_index_range(index_min, index_max):
+    """Give the positions [n] in the intervals and the indexes [n] for integer intervals [index_min, index_max]."""
+    n_index = numpy.maximum(index_max - index_min + 1, 0)
+    position = numpy.repeat(numpy.arange(n_index.size), n_index)
+    index = index_min[position] + numpy.arange(position.size) - numpy.repeat(numpy.cumsum(n_index) - n_index, n_index)
+    return position, index
+
+
+def calc_index_quadratic_range(coeff_2, coeff_1, coeff_0):
+    """Give integer intervals [index_min, index_max] where coeff_2*x**2 + coeff_1*x + coeff_0 <= 0 (coeff_2 > 0).
+
+    The intervals are extended by 1e-6 (the reflections are checked later by sthovl).
+    """
+    discriminant = numpy.square(coeff_1) - 4.*coeff_2*coeff_0
+    sqrt_discriminant = numpy.sqrt(numpy.maximum(discriminant, 0.))
+    index_min = numpy.ceil((-coeff_1 - sqrt_discriminant)/(2.*coeff_2) - 1e-6).astype(int)
+    index_max = numpy.floor((-coeff_1 + sqrt_discriminant)/(2.*coeff_2) + 1e-6).astype(int)
+    index_max[discriminant < 0.] = index_min[discriminant < 0.] - 1
+    return index_min, index_max
+
+
+def calc_index_hkl_multiplicity_asymmetric_unit(sthovl_max, unit_cell_parameters, reduced_symm_elems, centrosymmetry: bool):
+    """Give reflections [3, hkl] of asymmetric unit with sthovl <= sthovl_max (and a few above) and their multiplicities [hkl].
+
+    The reflection of asymmetric unit is the maximal one (by h, k and then l)
+    among the equivalent reflections. Its indexes are not less than the ones
+    of the equivalent reflections (the first index for all symmetry elements,
+    the second one for the elements keeping the first index and so on), so
+    only the reflections in this cone and in the ellipsoid of sthovl_max are
+    enumerated. The multiplicity is the number of different equivalent
+    reflections. The output is sorted by h, k and l.
+    """
+    # hkl is transformed as row vector: hkl * r_ij
+    r_ij = reduced_symm_elems[4:13].transpose().reshape((-1, 3, 3)).astype(int)
+    if centrosymmetry:
+        r_ij = numpy.concatenate([r_ij, -r_ij], axis=0)
+    r_ij = numpy.unique(r_ij, axis=0)
+
+    # the linear conditions coeff_h*h + coeff_k*k + coeff_l*l >= 0 of the cone
+    unit = numpy.identity(3, dtype=int)
+    l_condition = []
+    flag_keep = numpy.ones(r_ij.shape[0], dtype=bool)
+    for i_index in range(3):
+        l_condition.append(unit[:, i_index][numpy.newaxis, :] - r_ij[flag_keep, :, i_index])
+        flag_keep = numpy.logical_and(flag_keep, numpy.all(r_ij[:, :, i_index] == unit[numpy.newaxis, :, i_index], axis=1))
+    condition = numpy.concatenate(l_condition, axis=0)
+    condition = numpy.unique(condition[numpy.any(condition != 0, axis=1)], axis=0)
+
+    # metric m_ij of reciprocal space: (2*sthovl)**2 = hkl * m_ij * hkl
+    index_hkl_basis = numpy.array([[1, 0, 0, 1, 1, 0], [0, 1, 0, 1, 0, 1], [0, 0, 1, 0, 1, 1]], dtype=int)
+    q_sq = numpy.square(2.*calc_sthovl_by_unit_cell_parameters(index_hkl_basis, unit_cell_parameters)[0])
+    m_11, m_22, m_33 = q_sq[0], q_sq[1], q_sq[2]
+    m_12, m_13, m_23 = 0.5*(q_sq[3]-m_11-m_22), 0.5*(q_sq[4]-m_11-m_33), 0.5*(q_sq[5]-m_22-m_33)
+    # the ellipsoid is slightly extended, so the reflections at sthovl_max are not lost by rounding
+    q_sq_max = numpy.square(2.*sthovl_max)*(1. + 1e-6)
+
+    h_max = int(numpy.floor(2.*sthovl_max*unit_cell_parameters[0] + 1e-6))
+    index_h = numpy.arange(-h_max, h_max+1, dtype=int)
+    condition_h = condition[numpy.all(condition[:, 1:] == 0, axis=1)]
+    index_h = index_h[numpy.all(condition_h[:, 0][:, numpy.newaxis]*index_h[numpy.newaxis, :] >= 0, axis=0)]
+
+    # the minimum over l of the quadratic form is the quadratic function of k
+    index_k_min, index_k_max = calc_index_quadratic_range(
+        (m_22 - m_23**2/m_33)*numpy.ones(index_h.shape, dtype=float), 2.*(m_12 - m_13*m_23/m_33)*index_h,
+        (m_11 - m_13**2/m_33)*numpy.square(index_h) - q_sq_max)
+    position, index_k = calc_index_range(index_k_min, index_k_max)
+    index_h = index_h[position]
+    condition_hk = condition[numpy.logical_and(condition[:, 2] == 0, condition[:, 1] != 0)]
+    flag_hk = numpy.all(
+        condition_hk[:, 0][:, numpy.newaxis]*index_h[numpy.newaxis, :] +
+        condition_hk[:, 1][:, numpy.newaxis]*index_k[numpy.newaxis, :] >= 0, axis=0)
+    index_h, index_k = index_h[flag_hk], index_k[flag_hk]
+
+    index_l_min, index_l_max = calc_index_quadratic_range(
+        m_33*numpy.ones(index_h.shape, dtype=float), 2.*(m_13*index_h + m_23*index_k),
+        m_11*numpy.square(index_h) + m_22*numpy.square(index_k) + 2.*m_12*index_h*index_k - q_sq_max)
+    for coeff_h, coeff_k, coeff_l in condition[condition[:, 2] != 0]:
+        if coeff_l > 0:
+            index_l_min = numpy.maximum(index_l_min, -((coeff_h*index_h + coeff_k*index_k)//coeff_l))
+        else:
+            index_l_max = numpy.minimum(index_l_max, (coeff_h*index_h + coeff_k*index_k)//(-coeff_l))
+    position, index_l = calc_index_range(index_l_min, index_l_max)
+    index_hkl = numpy.stack([index_h[position], index_k[position], index_l], axis=0)
+
+    # the conditions of the cone are necessary only, the maximal reflections are chosen
+    index_hkl_equivalent = numpy.einsum("in,gij->jng", index_hkl, r_ij)
+    base = 2*int(numpy.abs(index_hkl).max(initial=0)) + 1
+    label_hkl_equivalent = (
+        (index_hkl_equivalent[0].astype(numpy.int64)*base + index_hkl_equivalent[1])*base + index_hkl_equivalent[2])
+    label_hkl = (index_hkl[0].astype(numpy.int64)*base + index_hkl[1])*base + index_hkl[2]
+    flag_max = label_hkl == label_hkl_equivalent.max(axis=1)
+    label_hkl_equivalent = numpy.sort(label_hkl_equivalent[flag_max], axis=1)
+    multiplicity = 1 + numpy.count_nonzero(numpy.diff(label_hkl_equivalent, axis=1), axis=1)
+    return index_hkl[:, flag_max], multiplicity
+
+
+@profiled_stage
 def calc_index_hkl_multiplicity_in_range(sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry: bool):
-    a, b, c = unit_cell_parameters[0], unit_cell_parameters[1], unit_cell_parameters[2]
-    h_max = int(2.*a*sthovl_max)
-    k_max = int(2.*b*sthovl_max)
-    l_max = int(2.*c*sthovl_max)
-    
-    index_h = numpy.arange(-h_max, h_max+1, 1, dtype=int)
-    index_k = numpy.arange(-k_max, k_max+1, 1, dtype=int)
-    index_l = numpy.arange(-l_max, l_max+1, 1, dtype=int)
-
-    index_h, index_k, index_l = numpy.meshgrid(index_h, index_k, index_l, indexing="ij")
-    index_h, index_k, index_l = index_h.flatten(), index_k.flatten(), index_l.flatten()
-    index_hkl_full = numpy.stack([index_h, index_k, index_l], axis=0)
-    index_hkl_equivalent = calc_equivalent_reflections(index_hkl_full, reduced_symm_elems, centrosymmetry=centrosymmetry)
-    
-    label_hkl_equivalent = 1000000*index_hkl_equivalent[0] + 1000*index_hkl_equivalent[1] + index_hkl_equivalent[2]
-    index_max = numpy.argsort(label_hkl_equivalent, axis=1)[:,-1]
-    index_hkl_sort = index_hkl_equivalent[:, numpy.arange(index_max.size),index_max]
-    index_hkl_unique, counts_unique = numpy.unique(index_hkl_sort, axis=1, return_counts=True)
+    index_hkl_unique, counts_unique = calc_index_hkl_multiplicity_asymmetric_unit(
+        sthovl_max, unit_cell_parameters, reduced_symm_elems, centrosymmetry)
 
     pr_3 = calc_pr3(index_hkl_unique, translation_elems)
     flag = numpy.logical_not(numpy.isclose(pr_3, 0.))
@@ -1091,7 +1558,8 @@ def calc_index_hkl_multiplicity_in_range(sthovl_min, sthovl_max, unit_cell_param
     counts = counts_unique[flag]
     sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(index_hkl, unit_cell_parameters)
 
-    arg_sort_sthovl = numpy.argsort(sthovl)
+    # the reflections with the same sthovl are kept in order of h, k, l
+    arg_sort_sthovl = numpy.argsort(sthovl, kind="stable")
     index_hkl_sort = index_hkl[:, arg_sort_sthovl]
     counts_sort = counts[arg_sort_sthovl]
     sthovl_sort = sthovl[arg_sort_sthovl]
@@ -1102,7 +1570,165 @@ def calc_index_hkl_multiplicity_in_range(sthovl_min, sthovl_max, unit_cell_param
     return index_hkl_out, counts_out
 
 
-def calc_f_m_perp_ordered_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False):
+def set_hkl_superset_margin(sthovl_margin: float = 0.02):
+    """Set the relative margin of sthovl for the superset of reflections of powder experiments.
+
+    The superset is calculated for the range of sthovl extended by the margin
+    and it is kept while it contains all reflections of the range for the
+    refined unit cell. Zero switches off the superset (the reflections are
+    calculated again for each new unit cell).
+    """
+    if sthovl_margin < 0.:
+        raise AttributeError("The margin of sthovl should be non-negative.")
+    DICT_HKL_SUPERSET["sthovl_margin"] = float(sthovl_margin)
+
+
+def get_hkl_superset_margin() -> float:
+    """Give the relative margin of sthovl for the superset of reflections of powder experiments."""
+    return DICT_HKL_SUPERSET["sthovl_margin"]
+
+
+def calc_sthovl_ratio_range(unit_cell_parameters, unit_cell_parameters_0):
+    """Give the minimal and maximal ratios of sthovl calculated for unit_cell_parameters and unit_cell_parameters_0.
+
+    The ratios are taken over all directions of reciprocal space.
+    """
+    l_m_ij = []
+    for uc_parameters in (unit_cell_parameters, unit_cell_parameters_0):
+        g_11, g_22, g_33, g_12, g_13, g_23 = calc_m_reciprocal_g_by_unit_cell_parameters(uc_parameters)[0]
+        l_m_ij.append(numpy.array([[g_11, g_12, g_13], [g_12, g_22, g_23], [g_13, g_23, g_33]], dtype=float))
+    eigenvalues = numpy.linalg.eigvals(numpy.linalg.solve(l_m_ij[1], l_m_ij[0])).real
+    return numpy.sqrt(eigenvalues.min()), numpy.sqrt(eigenvalues.max())
+
+
+def calc_index_hkl_multiplicity_by_superset(
+        dict_in_out: dict, sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems,
+        centrosymmetry: bool, flag_use_precalculated_data: bool = False):
+    """Give reflections [3, hkl] in the range of sthovl and their multiplicities [hkl] by the superset of reflections.
+
+    The output is the same as given by calc_index_hkl_multiplicity_in_range,
+    reflections are sorted by sthovl of the current unit cell (the order of
+    reflections with equal sthovl is the order of the superset). The superset is calculated
+    for the range extended by the margin (see set_hkl_superset_margin) and
+    it is kept in dict_in_out while it contains all reflections of the
+    range. If the reflections in the range and their order are not changed
+    by the refinement of the unit cell the node "index_hkl" is not
+    recalculated, so the nodes depending on it are kept.
+    """
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems, "translation_elems": translation_elems,
+        "centrosymmetry": centrosymmetry}
+    flag_hit, index_hkl_superset = get_cached_node(
+        dict_in_out, "index_hkl_superset", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_hit:
+        sthovl_min_superset, sthovl_max_superset, unit_cell_parameters_superset = dict_in_out["hkl_superset_range"]
+        ratio_min, ratio_max = calc_sthovl_ratio_range(unit_cell_parameters, unit_cell_parameters_superset)
+        flag_hit = (sthovl_max <= sthovl_max_superset*ratio_min) and (sthovl_min >= sthovl_min_superset*ratio_max)
+    if not(flag_hit):
+        sthovl_margin = DICT_HKL_SUPERSET["sthovl_margin"]
+        sthovl_min_superset, sthovl_max_superset = sthovl_min*(1.-sthovl_margin), sthovl_max*(1.+sthovl_margin)
+        index_hkl_superset, multiplicity_hkl_superset = calc_index_hkl_multiplicity_in_range(
+            sthovl_min_superset, sthovl_max_superset, unit_cell_parameters, reduced_symm_elems, translation_elems,
+            centrosymmetry)
+        set_cached_node(dict_in_out, "index_hkl_superset", index_hkl_superset, dict_dependency)
+        dict_in_out["multiplicity_hkl_superset"] = multiplicity_hkl_superset
+        dict_in_out["hkl_superset_range"] = (
+            sthovl_min_superset, sthovl_max_superset, numpy.array(unit_cell_parameters, dtype=float))
+
+    sthovl_superset = calc_sthovl_by_unit_cell_parameters(index_hkl_superset, unit_cell_parameters)[0]
+    flags_hkl = numpy.logical_and(sthovl_superset >= sthovl_min, sthovl_superset <= sthovl_max)
+    ind_hkl = numpy.flatnonzero(flags_hkl)
+    # rounding keeps the order of reflections with equal sthovl (e.g. Friedel pairs)
+    ind_hkl = ind_hkl[numpy.argsort(numpy.round(sthovl_superset[ind_hkl], decimals=12), kind="stable")]
+    dict_dependency = {"index_hkl_superset": index_hkl_superset, "ind_hkl": ind_hkl}
+    flag_hit, index_hkl = get_cached_node(
+        dict_in_out, "index_hkl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_hit:
+        multiplicity_hkl = dict_in_out["multiplicity_hkl"]
+    else:
+        index_hkl = index_hkl_superset[:, ind_hkl]
+        multiplicity_hkl = dict_in_out["multiplicity_hkl_superset"][ind_hkl]
+        set_cached_node(dict_in_out, "index_hkl", index_hkl, dict_dependency)
+        dict_in_out["multiplicity_hkl"] = multiplicity_hkl
+    return index_hkl, multiplicity_hkl
+
+
+def calc_f_m_ordered_by_hkl_chunks(
+        index_hkl, reduced_symm_elems, atom_ordered_fract_xyz, sthovl, atom_ordered_b_iso, atom_ordered_beta,
+        atom_ordered_factor, moment_ccs, pr_2, n_hkl_chunk: int):
+    """Calculate magnetic structure factor [3, hkl] of ordered atoms by chunks of reflections.
+
+    atom_ordered_factor [hkl, a] is the product of the form factor, multiplicity and occupancy,
+    moment_ccs [3, rs, a] are magnetic moments of atoms transformed by symmetry elements.
+    PR1 and Debye-Waller factor [hkl, rs, a] are formed only for n_hkl_chunk reflections.
+    """
+    f_m = numpy.zeros((3, index_hkl.shape[-1]), dtype=complex)
+    for i_hkl in range(0, index_hkl.shape[-1], n_hkl_chunk):
+        chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+        index_hkl_chunk = index_hkl[:, chunk]
+        pr_1 = calc_pr1(index_hkl_chunk, reduced_symm_elems, atom_ordered_fract_xyz)[0]
+        debye_waller_factor = calc_dwf_by_atoms(
+            index_hkl_chunk, sthovl[chunk], atom_ordered_b_iso, atom_ordered_beta, reduced_symm_elems)
+        hh_3 = pr_1*debye_waller_factor*atom_ordered_factor[chunk, na, :]
+        f_m[:, chunk] = (pr_2[na, chunk, :] * (hh_3[na, :, :, :] * moment_ccs[:, na, :, :]).sum(axis=3)).sum(axis=2)/pr_2.shape[-1]
+    return f_m
+
+
+def calc_f_m_ordered_derivatives(
+        index_hkl, reduced_symm_elems, atom_ordered_fract_xyz, sthovl, atom_ordered_b_iso, atom_ordered_beta,
+        atom_ordered_factor, moment_ccs, pr_2, n_hkl_chunk: int = None, dder_moment_ccs=None,
+        flag_atom_ordered_fract_xyz: bool = False, flag_atom_ordered_factor: bool = False,
+        flag_atom_ordered_b_iso: bool = False, flag_atom_ordered_beta: bool = False):
+    """Calculate derivatives of magnetic structure factor [3, hkl] of ordered atoms
+    over parameters of atoms (see calc_f_m_ordered_by_hkl_chunks).
+
+    dder_moment_ccs [3, 3, rs] is the derivative of moment_ccs over the moments
+    of atoms along crystal axes. The keys of output are "fract_xyz" [3, 3, hkl, a],
+    "factor" [3, hkl, a] (over atom_ordered_factor), "b_iso" [3, hkl, a],
+    "beta" [3, 6, hkl, a] and "moment" [3, 3, hkl, a].
+    Reflections are processed by chunks if n_hkl_chunk is given.
+    """
+    n_hkl = index_hkl.shape[-1]
+    if ((n_hkl_chunk is not None) and (n_hkl_chunk < n_hkl)):
+        l_dder = []
+        for i_hkl in range(0, n_hkl, n_hkl_chunk):
+            chunk = slice(i_hkl, i_hkl + n_hkl_chunk)
+            l_dder.append(calc_f_m_ordered_derivatives(
+                index_hkl[:, chunk], reduced_symm_elems, atom_ordered_fract_xyz, sthovl[chunk], atom_ordered_b_iso,
+                atom_ordered_beta, atom_ordered_factor[chunk], moment_ccs, pr_2[chunk], dder_moment_ccs=dder_moment_ccs,
+                flag_atom_ordered_fract_xyz=flag_atom_ordered_fract_xyz, flag_atom_ordered_factor=flag_atom_ordered_factor,
+                flag_atom_ordered_b_iso=flag_atom_ordered_b_iso, flag_atom_ordered_beta=flag_atom_ordered_beta))
+        return concatenate_dder_by_hkl_chunks(l_dder)
+
+    pr_1, dder_pr_1 = calc_pr1(index_hkl, reduced_symm_elems, atom_ordered_fract_xyz, flag_fract_xyz=flag_atom_ordered_fract_xyz)
+    debye_waller_factor, dder_dwf = calc_dwf(
+        index_hkl[:, :, na, na], sthovl[:, na, na], atom_ordered_b_iso[na, na, :],
+        atom_ordered_beta[:, na, na, :], reduced_symm_elems[:, na, :, na],
+        flag_b_iso=flag_atom_ordered_b_iso, flag_beta=flag_atom_ordered_beta)
+    # dimensions [3, hkl, rs, a]
+    hh_4 = pr_2[na, :, :, na]*moment_ccs[:, na, :, :]/pr_2.shape[-1]
+    dder_f_m_asym = {}
+    if (flag_atom_ordered_b_iso or flag_atom_ordered_beta):
+        dder_f_m_asym["debye_waller"] = hh_4 * (pr_1*atom_ordered_factor[:, na, :])[na, :, :, :]
+    if flag_atom_ordered_fract_xyz:
+        dder_f_m_asym["pr_1_real"] = hh_4 * (debye_waller_factor*atom_ordered_factor[:, na, :])[na, :, :, :]
+        dder_f_m_asym["pr_1_imag"] = 1j*dder_f_m_asym["pr_1_real"]
+    dder = calc_dder_by_pr1_dwf(dder_f_m_asym, dder_pr_1, dder_dwf)
+    if flag_atom_ordered_factor:
+        dder["factor"] = (hh_4 * (pr_1*debye_waller_factor)[na, :, :, :]).sum(axis=2)
+    if dder_moment_ccs is not None:
+        dder["moment"] = numpy.einsum(
+            "hr,hra,ijr->ijha", pr_2, pr_1*debye_waller_factor*atom_ordered_factor[:, na, :], dder_moment_ccs)/pr_2.shape[-1]
+    return dder
+
+
+def calc_f_m_perp_ordered_by_dictionary(dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False,
+        flag_calc_analytical_derivatives: bool = False):
+    """Calculate magnetic structure factor of ordered atoms perpendicular to the scattering vector
+    in CCS (X||a*, Z||c) based on the information given in dictionary.
+
+    If flag_calc_analytical_derivatives is True the derivatives over refined parameters
+    of crystal are given.
+    """
     dict_crystal_keys = dict_crystal.keys()
     dict_in_out_keys = dict_in_out.keys()
     necessary_crystal_keys = set(["unit_cell_parameters", "full_mcif_elems"])
@@ -1162,17 +1788,17 @@ def calc_f_m_perp_ordered_by_dictionary(dict_crystal, dict_in_out, flag_use_prec
 
     atom_ordered_moment_crystalaxis_xyz = dict_crystal["atom_ordered_moment_crystalaxis_xyz"]
     flags_atom_ordered_moment_crystalaxis_xyz = dict_crystal["flags_atom_ordered_moment_crystalaxis_xyz"]
-    flag_unit_cell_parameters = numpy.any(dict_crystal["flags_unit_cell_parameters"])
-    flag_atom_ordered_fract_xyz = numpy.any(dict_crystal["flags_atom_fract_xyz"][:, atom_ordered_index])
-    flag_atom_ordered_occupancy = numpy.any(dict_crystal["flags_atom_occupancy"][atom_ordered_index])
-    flag_atom_ordered_b_iso = numpy.any(dict_crystal["flags_atom_b_iso"][atom_ordered_index])
-    flag_atom_ordered_beta = numpy.any(dict_crystal["flags_atom_beta"][:, atom_ordered_index])
-    flag_atom_ordered_lande_factor = numpy.any(dict_crystal["flags_mag_atom_lande_factor"][mag_atom_ordered_index])
-    flag_atom_ordered_kappa = numpy.any(dict_crystal["flags_mag_atom_kappa"][mag_atom_ordered_index])
+    flag_unit_cell_parameters = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_unit_cell_parameters"])
+    flag_atom_ordered_fract_xyz = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_fract_xyz"][:, atom_ordered_index])
+    flag_atom_ordered_occupancy = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_occupancy"][atom_ordered_index])
+    flag_atom_ordered_b_iso = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_b_iso"][atom_ordered_index])
+    flag_atom_ordered_beta = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_atom_beta"][:, atom_ordered_index])
+    flag_atom_ordered_lande_factor = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_mag_atom_lande_factor"][mag_atom_ordered_index])
+    flag_atom_ordered_kappa = flag_calc_analytical_derivatives and numpy.any(dict_crystal["flags_mag_atom_kappa"][mag_atom_ordered_index])
 
     
 
-    flag_atom_ordered_moment_crystalaxis_xyz = numpy.any(flags_atom_ordered_moment_crystalaxis_xyz)
+    flag_atom_ordered_moment_crystalaxis_xyz = flag_calc_analytical_derivatives and numpy.any(flags_atom_ordered_moment_crystalaxis_xyz)
     f_m_perp_o, dder = calc_f_m_perp_ordered(index_hkl,
         full_mcif_elems,
         unit_cell_parameters, atom_ordered_fract_xyz, atom_ordered_occupancy, atom_ordered_moment_crystalaxis_xyz, atom_ordered_b_iso, atom_ordered_beta,
@@ -1183,9 +1809,14 @@ def calc_f_m_perp_ordered_by_dictionary(dict_crystal, dict_in_out, flag_use_prec
         flag_atom_ordered_b_iso=flag_atom_ordered_b_iso, flag_atom_ordered_beta=flag_atom_ordered_beta,
         flag_atom_ordered_lande_factor=flag_atom_ordered_lande_factor, flag_atom_ordered_kappa=flag_atom_ordered_kappa, 
         flag_use_precalculated_data=flag_use_precalculated_data)
+    if flag_atom_ordered_fract_xyz:
+        dder["atom_ordered_fract_xyz"] = calc_dder_by_sc_matrix(dder["atom_ordered_fract_xyz"], atom_ordered_sc_fract)
+    if (flag_atom_ordered_beta and ("atom_site_aniso_sc_beta" in dict_crystal_keys)):
+        dder["atom_ordered_beta"] = calc_dder_by_sc_matrix(dder["atom_ordered_beta"], atom_sc_beta[:, :, atom_ordered_index])
     return f_m_perp_o, dder
 
 
+@profiled_stage
 def calc_f_m_perp_ordered(index_hkl,
         full_mcif_elems,
         unit_cell_parameters, atom_ordered_fract_xyz, atom_ordered_occupancy, atom_ordered_moment_crystalaxis_xyz, atom_ordered_b_iso, atom_ordered_beta,
@@ -1197,81 +1828,77 @@ def calc_f_m_perp_ordered(index_hkl,
         flag_atom_ordered_lande_factor: bool = False, flag_atom_ordered_kappa: bool = False, 
         flag_use_precalculated_data: bool = False):
 
-    if dict_in_out is None:
-        flag_dict = False
-        dict_in_out_keys = []
-    else:
-        flag_dict = True
-        dict_in_out_keys = dict_in_out.keys()
-        if 'index_hkl' in dict_in_out_keys:
-            if numpy.any(dict_in_out["index_hkl"] != index_hkl):
-                dict_in_out.clear()
-                dict_in_out["index_hkl"] = index_hkl
-
-    if (flag_use_precalculated_data and ("atom_ordered_multiplicity" in dict_in_out_keys)):
-        atom_ordered_multiplicity = dict_in_out["atom_ordered_multiplicity"]
-    else:
-        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_ordered_fract_xyz)
-
-        atom_ordered_multiplicity = calc_multiplicity_by_atom_symm_elems(full_mcif_elems[:13], atom_symm_elems)
-        if flag_dict:
-            dict_in_out["atom_ordered_multiplicity"] = atom_ordered_multiplicity
+    if dict_in_out is not None:
+        dict_in_out["flag_only_orbital"] = flag_only_orbital
 
     flag_pr_1 = flag_atom_ordered_fract_xyz
-    if (flag_use_precalculated_data and ("pr_1_atom_ordered" in dict_in_out_keys) and not(flag_atom_ordered_fract_xyz)):
-        pr_1 = dict_in_out["pr_1_atom_ordered"] 
-    else:
-        pr_1, dder_pr_1 = calc_pr1(index_hkl, full_mcif_elems[:13], atom_ordered_fract_xyz, flag_fract_xyz=flag_atom_ordered_fract_xyz)
-        if flag_dict:
-            dict_in_out["pr_1_atom_ordered"] = pr_1
-
-    if (flag_use_precalculated_data and ("pr_2" in dict_in_out_keys)):
-        pr_2 = dict_in_out["pr_2"] 
-    else:
-        pr_2 = calc_pr2(index_hkl, full_mcif_elems[:13])
-        if flag_dict:
-            dict_in_out["pr_2"] = pr_2 
-
-
     flag_sthovl = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("sthovl" in dict_in_out_keys) and not(flag_sthovl)):
-        sthovl = dict_in_out["sthovl"] 
-    else:
+    flag_atom_ordered_form_factor = flag_atom_ordered_lande_factor or flag_sthovl or flag_atom_ordered_kappa
+
+    dict_dependency = {"full_mcif_elems": full_mcif_elems[:13], "atom_ordered_fract_xyz": atom_ordered_fract_xyz}
+    flag_hit, atom_ordered_multiplicity = get_cached_node(
+        dict_in_out, "atom_ordered_multiplicity", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_ordered_fract_xyz)
+        atom_ordered_multiplicity = calc_multiplicity_by_atom_symm_elems(full_mcif_elems[:13], atom_symm_elems)
+        set_cached_node(dict_in_out, "atom_ordered_multiplicity", atom_ordered_multiplicity, dict_dependency)
+
+    # reflections are processed by chunks if tensors [hkl, rs, atom] exceed the memory budget
+    n_hkl_chunk = calc_hkl_chunk_size(
+        index_hkl.shape[-1], full_mcif_elems.shape[-1]*atom_ordered_fract_xyz.shape[-1], 192)
+
+    if n_hkl_chunk is None:
+        dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": full_mcif_elems[:13], "atom_ordered_fract_xyz": atom_ordered_fract_xyz}
+        flag_hit, pr_1 = get_cached_node(
+            dict_in_out, "pr_1_atom_ordered", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
+            pr_1 = calc_pr1(index_hkl, full_mcif_elems[:13], atom_ordered_fract_xyz)[0]
+            set_cached_node(dict_in_out, "pr_1_atom_ordered", pr_1, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "reduced_symm_elems": full_mcif_elems[:13]}
+    flag_hit, pr_2 = get_cached_node(
+        dict_in_out, "pr_2", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_2 = calc_by_symmetry_cache("pr_2", calc_pr2, index_hkl, full_mcif_elems[:13])
+        set_cached_node(dict_in_out, "pr_2", pr_2, dict_dependency)
+
+    dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, sthovl = get_cached_node(
+        dict_in_out, "sthovl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
         sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(
             index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["sthovl"] = sthovl
-
-    flag_mag_atom_form_factor = (flag_sthovl or flag_atom_ordered_lande_factor or flag_atom_ordered_kappa)
-    flag_hh = True
-    if "flag_only_orbital" in dict_in_out_keys:
-        flag_hh = flag_only_orbital == dict_in_out["flag_only_orbital"]
-    dict_in_out["flag_only_orbital"] = flag_only_orbital
-
-    flag_atom_ordered_form_factor = flag_atom_ordered_lande_factor or flag_sthovl or flag_atom_ordered_kappa
-    if (flag_use_precalculated_data and ("atom_ordered_form_factor" in dict_in_out_keys) and not(flag_atom_ordered_form_factor) and flag_hh):
-        atom_ordered_form_factor = dict_in_out["atom_ordered_form_factor"] 
-    else:
+        set_cached_node(dict_in_out, "sthovl", sthovl, dict_dependency)
+
+    dict_dependency = {"sthovl": sthovl, "atom_ordered_lande_factor": atom_ordered_lande_factor,
+        "atom_ordered_kappa": atom_ordered_kappa, "atom_ordered_j0_parameters": atom_ordered_j0_parameters,
+        "atom_ordered_j2_parameters": atom_ordered_j2_parameters, "flag_only_orbital": flag_only_orbital}
+    flag_hit, atom_ordered_form_factor = get_cached_node(
+        dict_in_out, "atom_ordered_form_factor", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit) and not(flag_atom_ordered_form_factor):
+        atom_ordered_form_factor = calc_form_factor_by_table(
+            sthovl, atom_ordered_lande_factor, atom_ordered_kappa, atom_ordered_j0_parameters, atom_ordered_j2_parameters,
+            flag_only_orbital=flag_only_orbital)
+        set_cached_node(dict_in_out, "atom_ordered_form_factor", atom_ordered_form_factor, dict_dependency)
+    elif not(flag_hit):
         atom_ordered_form_factor, dder_ff = calc_form_factor(
             sthovl[:, na], atom_ordered_lande_factor[na, :], atom_ordered_kappa[na, :], atom_ordered_j0_parameters[:, na, :], atom_ordered_j2_parameters[:, na, :],
             flag_lande_factor=flag_atom_ordered_lande_factor,
             flag_only_orbital=flag_only_orbital,
             flag_sthovl=flag_sthovl, 
             flag_kappa=flag_atom_ordered_kappa)
-        if flag_dict:
-            dict_in_out["atom_ordered_form_factor"] = atom_ordered_form_factor
-
-    # dimensions ["hkl", "reduced symmetry", "atom"]
-    flag_debye_waller_factor = flag_sthovl or flag_atom_ordered_b_iso or flag_atom_ordered_beta
-    if (flag_use_precalculated_data and ("atom_ordered_debye_waller_factor" in dict_in_out_keys) and not(flag_debye_waller_factor)):
-        debye_waller_factor = dict_in_out["atom_ordered_debye_waller_factor"] 
-    else:
-        debye_waller_factor, dder_dw = calc_dwf(
-            index_hkl[:, :, na, na], sthovl[:, na, na], atom_ordered_b_iso[na, na, :],
-            atom_ordered_beta[:, na, na, :], full_mcif_elems[:13, na, :, na],
-            flag_sthovl=flag_sthovl, flag_b_iso=flag_atom_ordered_b_iso, flag_beta=flag_atom_ordered_beta)
-        if flag_dict:
-            dict_in_out["atom_ordered_debye_waller_factor"] = debye_waller_factor
+        set_cached_node(dict_in_out, "atom_ordered_form_factor", atom_ordered_form_factor, dict_dependency)
+
+    if n_hkl_chunk is None:
+        # dimensions ["hkl", "reduced symmetry", "atom"]
+        dict_dependency = {"index_hkl": index_hkl, "sthovl": sthovl, "atom_ordered_b_iso": atom_ordered_b_iso,
+            "atom_ordered_beta": atom_ordered_beta, "reduced_symm_elems": full_mcif_elems[:13]}
+        flag_hit, debye_waller_factor = get_cached_node(
+            dict_in_out, "atom_ordered_debye_waller_factor", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
+            debye_waller_factor = calc_dwf_by_atoms(
+                index_hkl, sthovl, atom_ordered_b_iso, atom_ordered_beta, full_mcif_elems[:13])
+            set_cached_node(dict_in_out, "atom_ordered_debye_waller_factor", debye_waller_factor, dict_dependency)
 
     flag_debye_waller = flag_atom_ordered_b_iso or flag_atom_ordered_beta
 
@@ -1292,8 +1919,13 @@ def calc_f_m_perp_ordered(index_hkl,
     
     hh_1 = atom_ordered_multiplicity*atom_ordered_occupancy
     hh_2 = atom_ordered_form_factor*hh_1[na, :]
-    hh_3 = pr_1*debye_waller_factor*hh_2[:, na, :]
-    f_m = (pr_2[na, :, :] * (hh_3[na, :, :, :] * moment_ccs[:, na, :, :]).sum(axis=3)).sum(axis=2)/pr_2.shape[-1]
+    if n_hkl_chunk is None:
+        hh_3 = pr_1*debye_waller_factor*hh_2[:, na, :]
+        f_m = (pr_2[na, :, :] * (hh_3[na, :, :, :] * moment_ccs[:, na, :, :]).sum(axis=3)).sum(axis=2)/pr_2.shape[-1]
+    else:
+        f_m = calc_f_m_ordered_by_hkl_chunks(
+            index_hkl, full_mcif_elems[:13], atom_ordered_fract_xyz, sthovl, atom_ordered_b_iso, atom_ordered_beta,
+            hh_2, moment_ccs, pr_2, n_hkl_chunk)
     eq_ccs, dder_eq_ccs = calc_eq_ccs_by_unit_cell_parameters(
         index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
     dict_in_out["eq_ccs"] = eq_ccs
@@ -1304,10 +1936,43 @@ def calc_f_m_perp_ordered(index_hkl,
     f_m_perp_o, dder_f_m_perp_o = calc_vector_product_v1_v2_v1(eq_ccs, f_m, flag_v1=flag_unit_cell_parameters, flag_v2=flag_f_m)
     dict_in_out["f_m_perp_o"] = f_m_perp_o
     dder = {}
+    flag_atom_derivatives = (flag_atom_ordered_fract_xyz or flag_atom_ordered_occupancy or
+        flag_atom_ordered_moment_crystalaxis_xyz or flag_atom_ordered_b_iso or flag_atom_ordered_beta)
+    if flag_atom_derivatives:
+        dder_moment_ccs = None
+        if flag_atom_ordered_moment_crystalaxis_xyz:
+            # dimensions [3, 3, rs]
+            dder_moment_ccs = 0.2695*numpy.einsum(
+                "ik,kjr->ijr", m_norm.reshape(3, 3), r_direct.reshape(3, 3, -1))*(theta_s*det_r)[na, na, :]
+        # derivatives are calculated without cached data, dimensions [3, ..., hkl, a]
+        n_hkl_chunk = calc_hkl_chunk_size(
+            index_hkl.shape[-1], full_mcif_elems.shape[-1]*atom_ordered_fract_xyz.shape[-1], 768)
+        dder_f_m = calc_f_m_ordered_derivatives(
+            index_hkl, full_mcif_elems[:13], atom_ordered_fract_xyz, sthovl, atom_ordered_b_iso, atom_ordered_beta,
+            hh_2, moment_ccs, pr_2, n_hkl_chunk=n_hkl_chunk, dder_moment_ccs=dder_moment_ccs,
+            flag_atom_ordered_fract_xyz=flag_atom_ordered_fract_xyz, flag_atom_ordered_factor=flag_atom_ordered_occupancy,
+            flag_atom_ordered_b_iso=flag_atom_ordered_b_iso, flag_atom_ordered_beta=flag_atom_ordered_beta)
+        # f_m_perp_o is linear over f_m
+        vv = calc_vv_as_v1_v2_v1(eq_ccs)[0]
+        dder_atom = {key: numpy.einsum("ikh,k...ha->i...ha", vv, value) for key, value in dder_f_m.items()}
+
+    if flag_unit_cell_parameters:
+        dder["unit_cell_parameters"] = None
+
+    if flag_atom_ordered_fract_xyz:
+        dder["atom_ordered_fract_xyz"] = dder_atom["fract_xyz"]
+
+    if flag_atom_ordered_occupancy:
+        dder["atom_ordered_occupancy"] = dder_atom["factor"]*(atom_ordered_form_factor*atom_ordered_multiplicity[na, :])[na, :, :]
+
     if flag_atom_ordered_moment_crystalaxis_xyz:
-        dder["atom_ordered_moment_crystalaxis_xyz"] = None
+        dder["atom_ordered_moment_crystalaxis_xyz"] = dder_atom["moment"]
 
-    dder = {}
+    if flag_atom_ordered_b_iso:
+        dder["atom_ordered_b_iso"] = dder_atom["b_iso"]
+
+    if flag_atom_ordered_beta:
+        dder["atom_ordered_beta"] = dder_atom["beta"]
     return f_m_perp_o, dder
 
 
@@ -1379,42 +2044,36 @@ def calc_bulk_susceptibility_by_dictionary(dict_crystal, dict_in_out, flag_use_p
     return bulk_susceptibility, error_bars
 
 
+@profiled_stage
 def calc_bulk_susceptibility(reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems,
         unit_cell_parameters, atom_para_fract_xyz, atom_para_occupancy, atom_para_susceptibility, atom_para_sc_chi,
         dict_in_out: dict = None, flag_unit_cell_parameters: bool = False, flag_atom_para_fract_xyz: bool = False,
         flag_atom_para_occupancy: bool = False, flag_atom_para_susceptibility: bool = False, 
         flag_use_precalculated_data: bool = False):
 
-    if dict_in_out is None:
-        flag_dict = True
-        dict_in_out_keys = []
-    else:       
-        dict_in_out_keys = dict_in_out.keys()
-        flag_dict = True
-
-    if (flag_use_precalculated_data and ("atom_para_multiplicity" in dict_in_out_keys)):
-        atom_para_multiplicity = dict_in_out["atom_para_multiplicity"]
-    else:
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems, "centrosymmetry": centrosymmetry,
+        "centrosymmetry_position": centrosymmetry_position, "translation_elems": translation_elems}
+    flag_hit, full_symm_elems = get_cached_node(
+        dict_in_out, "full_symm_elems", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        full_symm_elems = calc_full_symm_elems_by_reduced(
+            reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
+        set_cached_node(dict_in_out, "full_symm_elems", full_symm_elems, dict_dependency)
+
+    dict_dependency = {"full_symm_elems": full_symm_elems, "atom_para_fract_xyz": atom_para_fract_xyz}
+    flag_hit, atom_para_multiplicity = get_cached_node(
+        dict_in_out, "atom_para_multiplicity", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
         atom_symm_elems = get_atom_symm_elems_by_atom_fract_xyz(atom_para_fract_xyz)
-
-        if "full_symm_elems" in dict_in_out_keys:
-            full_symm_elems = dict_in_out["full_symm_elems"]
-        else:
-            full_symm_elems = calc_full_symm_elems_by_reduced(
-                reduced_symm_elems, centrosymmetry, centrosymmetry_position, translation_elems)
-            if flag_dict:
-                dict_in_out["full_symm_elems"] = full_symm_elems
         atom_para_multiplicity = calc_multiplicity_by_atom_symm_elems(full_symm_elems, atom_symm_elems)
-        if flag_dict:
-            dict_in_out["atom_para_multiplicity"] = atom_para_multiplicity
-
-    flag_pr_5 = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and ("pr_5" in dict_in_out_keys) and not(flag_pr_5)):
-        pr_5 = dict_in_out["pr_5"] 
-    else:
-        pr_5, dder_pr_5 = calc_pr5(reduced_symm_elems, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["pr_5"] = pr_5
+        set_cached_node(dict_in_out, "atom_para_multiplicity", atom_para_multiplicity, dict_dependency)
+
+    dict_dependency = {"reduced_symm_elems": reduced_symm_elems, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, pr_5 = get_cached_node(
+        dict_in_out, "pr_5", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        pr_5, dder_pr_5 = calc_pr5_by_symmetry_cache(reduced_symm_elems, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
+        set_cached_node(dict_in_out, "pr_5", pr_5, dict_dependency)
 
 
     mas_constr = (atom_para_sc_chi * atom_para_susceptibility[na, :, :]).sum(axis=1)
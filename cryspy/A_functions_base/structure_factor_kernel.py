@@ -0,0 +1,212 @@
+"""Fused kernel of the asymmetric structure factor.
+
+The kernel calculates the preliminary asymmetric structure factor [hkl, atom]
+in one sweep over reflections, reduced symmetry elements and atoms. The
+phase factors PR1, PR2 and the Debye-Waller factor are combined into one
+complex exponent and accumulated into the output, so no tensors
+[hkl, reduced symmetry, atom] are formed.
+
+If numba is installed the kernel is compiled on its first call, otherwise
+the NumPy version (loop over reduced symmetry elements) is used.
+
+Functions
+---------
+    - set_structure_factor_kernel
+    - get_structure_factor_kernel
+    - calc_f_asym_a_fused
+    - benchmark_structure_factor_kernel
+"""
+import time
+
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+na = numpy.newaxis
+
+# "chain" is the chain of calc_pr1, calc_pr2, calc_dwf, calc_f_asym_a_by_pr
+# with cached intermediates, "fused" is the fused kernel.
+DICT_KERNEL = {"kernel": "chain", "flag_jit": True}
+
+
+def set_structure_factor_kernel(kernel: str = "chain", flag_jit: bool = True):
+    """Choose the calculation of structure factors: "chain" or "fused".
+
+    For the fused kernel the JIT-compiled version is used if flag_jit is
+    True and numba is installed.
+    """
+    if kernel not in ("chain", "fused"):
+        raise AttributeError(f"Unknown kernel of structure factor calculations '{kernel:}'")
+    DICT_KERNEL["kernel"] = kernel
+    DICT_KERNEL["flag_jit"] = bool(flag_jit)
+
+
+def get_structure_factor_kernel() -> str:
+    """Give the used calculation of structure factors: "chain", "fused_numpy" or "fused_numba"."""
+    if DICT_KERNEL["kernel"] == "chain":
+        return "chain"
+    if DICT_KERNEL["flag_jit"] and (numba is not None):
+        return "fused_numba"
+    return "fused_numpy"
+
+
+def calc_f_asym_a_fused_numpy(
+        index_hkl, reduced_symm_elems, fract_xyz, sthovl, b_iso, beta, symm_elems_r, atom_factor,
+        flag_real: bool = False):
+    """Calculate preliminary asymmetric structure factor [hkl, a] by loop over reduced symmetry elements.
+
+    symm_elems_r [9, rs] are the elements used for anisotropic Debye-Waller factor,
+    atom_factor [a] is the product of the multiplicity and occupancy of atoms.
+    If flag_real is True only the real part (cosine terms) is calculated.
+    """
+    h = index_hkl[0][:, na].astype(float)
+    k = index_hkl[1][:, na].astype(float)
+    l = index_hkl[2][:, na].astype(float)
+    x, y, z = fract_xyz[0][na, :], fract_xyz[1][na, :], fract_xyz[2][na, :]
+    power_iso = numpy.square(sthovl)[:, na]*b_iso[na, :]
+    f_asym_a = numpy.zeros((index_hkl.shape[-1], fract_xyz.shape[-1]), dtype=float if flag_real else complex)
+    for symm_elem, symm_elem_r in zip(reduced_symm_elems.transpose(), symm_elems_r.transpose()):
+        b_1, b_2, b_3, b_d = symm_elem[:4].astype(float)
+        r_11, r_12, r_13, r_21, r_22, r_23, r_31, r_32, r_33 = symm_elem[4:13]
+        hr_1 = h*r_11 + k*r_21 + l*r_31
+        hr_2 = h*r_12 + k*r_22 + l*r_32
+        hr_3 = h*r_13 + k*r_23 + l*r_33
+        phase = hr_1*x + hr_2*y + hr_3*z + (h*b_1 + k*b_2 + l*b_3)/b_d
+
+        s_11, s_12, s_13, s_21, s_22, s_23, s_31, s_32, s_33 = symm_elem_r
+        h_s = h*s_11 + k*s_21 + l*s_31
+        k_s = h*s_12 + k*s_22 + l*s_32
+        l_s = h*s_13 + k*s_23 + l*s_33
+        power = power_iso + (
+            beta[0]*numpy.square(h_s) + beta[1]*numpy.square(k_s) + beta[2]*numpy.square(l_s) +
+            2.*beta[3]*h_s*k_s + 2.*beta[4]*h_s*l_s + 2.*beta[5]*k_s*l_s)
+        if flag_real:
+            f_asym_a += numpy.exp(-power)*numpy.cos(2.*numpy.pi*phase)
+        else:
+            f_asym_a += numpy.exp(-power - 2.*numpy.pi*1j*phase)
+    f_asym_a *= atom_factor[na, :]/reduced_symm_elems.shape[-1]
+    return f_asym_a
+
+
+if numba is not None:
+    @numba.njit(parallel=True)
+    def calc_f_asym_a_fused_jit(
+            index_hkl, reduced_symm_elems, fract_xyz, sthovl, b_iso, beta, symm_elems_r, atom_factor,
+            flag_real):
+        """JIT-compiled version of calc_f_asym_a_fused_numpy (all arrays are float).
+
+        For flag_real the imaginary part of the output is zero.
+        """
+        n_hkl = index_hkl.shape[1]
+        n_symm = reduced_symm_elems.shape[1]
+        n_atom = fract_xyz.shape[1]
+        f_asym_a = numpy.zeros((n_hkl, n_atom), dtype=numpy.complex128)
+        for i_hkl in numba.prange(n_hkl):
+            h, k, l = index_hkl[0, i_hkl], index_hkl[1, i_hkl], index_hkl[2, i_hkl]
+            sthovl_sq = sthovl[i_hkl]*sthovl[i_hkl]
+            for i_symm in range(n_symm):
+                symm_elem = reduced_symm_elems[:, i_symm]
+                phase_b = (h*symm_elem[0] + k*symm_elem[1] + l*symm_elem[2])/symm_elem[3]
+                hr_1 = h*symm_elem[4] + k*symm_elem[7] + l*symm_elem[10]
+                hr_2 = h*symm_elem[5] + k*symm_elem[8] + l*symm_elem[11]
+                hr_3 = h*symm_elem[6] + k*symm_elem[9] + l*symm_elem[12]
+                symm_elem_r = symm_elems_r[:, i_symm]
+                h_s = h*symm_elem_r[0] + k*symm_elem_r[3] + l*symm_elem_r[6]
+                k_s = h*symm_elem_r[1] + k*symm_elem_r[4] + l*symm_elem_r[7]
+                l_s = h*symm_elem_r[2] + k*symm_elem_r[5] + l*symm_elem_r[8]
+                for i_atom in range(n_atom):
+                    phase = 2.*numpy.pi*(
+                        hr_1*fract_xyz[0, i_atom] + hr_2*fract_xyz[1, i_atom] + hr_3*fract_xyz[2, i_atom] + phase_b)
+                    power = b_iso[i_atom]*sthovl_sq + (
+                        beta[0, i_atom]*h_s*h_s + beta[1, i_atom]*k_s*k_s + beta[2, i_atom]*l_s*l_s +
+                        2.*beta[3, i_atom]*h_s*k_s + 2.*beta[4, i_atom]*h_s*l_s + 2.*beta[5, i_atom]*k_s*l_s)
+                    amplitude = numpy.exp(-power)
+                    if flag_real:
+                        f_asym_a[i_hkl, i_atom] += amplitude*numpy.cos(phase)
+                    else:
+                        f_asym_a[i_hkl, i_atom] += amplitude*numpy.cos(phase) - 1j*amplitude*numpy.sin(phase)
+            for i_atom in range(n_atom):
+                f_asym_a[i_hkl, i_atom] *= atom_factor[i_atom]/n_symm
+        return f_asym_a
+
+
+def calc_f_asym_a_fused(
+        index_hkl, reduced_symm_elems, fract_xyz, sthovl, b_iso, beta, symm_elems_r,
+        atom_multiplicity, atom_occupancy, flag_jit: bool = True, flag_real: bool = False):
+    """Calculate preliminary asymmetric structure factor [hkl, a] by the fused kernel.
+
+    It gives the same result as calc_f_asym_a_by_pr with PR1, PR2 and
+    Debye-Waller factor (calculated with symm_elems_r [9, rs]). If flag_real
+    is True the real part is given (as calc_f_asym_real_by_pr).
+    """
+    atom_factor = atom_multiplicity*atom_occupancy
+    if flag_jit and (numba is not None):
+        l_arg = [numpy.ascontiguousarray(arg, dtype=float) for arg in (
+            index_hkl, reduced_symm_elems, fract_xyz, sthovl, b_iso, beta, symm_elems_r, atom_factor)]
+        f_asym_a = calc_f_asym_a_fused_jit(*l_arg, bool(flag_real))
+        if flag_real:
+            f_asym_a = f_asym_a.real.copy()
+        return f_asym_a
+    return calc_f_asym_a_fused_numpy(
+        index_hkl, reduced_symm_elems, fract_xyz, sthovl, b_iso, beta, symm_elems_r, atom_factor,
+        flag_real=flag_real)
+
+
+def benchmark_structure_factor_kernel(
+        n_hkl: int = 5000, n_atom: int = 20, n_repeat: int = 3, seed: int = 0) -> dict:
+    """Compare times of calc_f_nucl (without cached data) for the chained and fused kernels.
+
+    Random structure with n_atom atoms, 48 reduced symmetry elements (point
+    group m-3m given by signed permutations of axes) and n_hkl random
+    reflections is used. Output is a dictionary {kernel: {"time", "max_deviation"}},
+    time is the best of n_repeat calls in seconds, max_deviation is the maximal
+    deviation of the structure factor from the one given by the chained kernel.
+    """
+    from itertools import permutations, product
+    from .structure_factor import calc_f_nucl
+
+    rng = numpy.random.default_rng(seed)
+    l_symm_elem = []
+    for permutation in permutations(range(3)):
+        for signs in product((1, -1), repeat=3):
+            r_ij = numpy.zeros((3, 3), dtype=int)
+            r_ij[range(3), permutation] = signs
+            l_symm_elem.append(numpy.concatenate([[0, 0, 0, 1], r_ij.flatten()]))
+    reduced_symm_elems = numpy.array(l_symm_elem, dtype=int).transpose()
+    translation_elems = numpy.array([[0], [0], [0], [1]], dtype=int)
+
+    index_hkl = rng.integers(-12, 13, size=(3, n_hkl))
+    unit_cell_parameters = numpy.array([10., 10., 10., 0.5*numpy.pi, 0.5*numpy.pi, 0.5*numpy.pi], dtype=float)
+    atom_fract_xyz = rng.random((3, n_atom))
+    atom_occupancy = rng.random(n_atom)
+    scat_length_neutron = rng.random(n_atom).astype(complex)
+    atom_b_iso = rng.random(n_atom)
+    atom_beta = 0.001*rng.random((6, n_atom))
+
+    kernel, flag_jit = DICT_KERNEL["kernel"], DICT_KERNEL["flag_jit"]
+    dict_benchmark = {}
+    l_kernel = [("chain", "chain", True), ("fused_numpy", "fused", False)]
+    if numba is not None:
+        l_kernel.append(("fused_numba", "fused", True))
+    try:
+        for name, kernel_name, flag_jit_name in l_kernel:
+            set_structure_factor_kernel(kernel_name, flag_jit=flag_jit_name)
+            l_time = []
+            for i_repeat in range(n_repeat+1):
+                time_start = time.perf_counter()
+                f_nucl = calc_f_nucl(
+                    index_hkl, reduced_symm_elems, False, None, translation_elems,
+                    unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+                    dict_in_out={})[0]
+                l_time.append(time.perf_counter() - time_start)
+            if name == "chain":
+                f_nucl_chain = f_nucl
+            # the first call is excluded (compilation of the JIT kernel)
+            dict_benchmark[name] = {
+                "time": min(l_time[1:]), "max_deviation": float(numpy.abs(f_nucl-f_nucl_chain).max())}
+    finally:
+        set_structure_factor_kernel(kernel, flag_jit=flag_jit)
+    return dict_benchmark
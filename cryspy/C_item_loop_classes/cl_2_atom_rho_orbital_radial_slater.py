@@ -10,7 +10,7 @@ import scipy.optimize
 from cryspy.A_functions_base.function_1_objects import \
     form_items_by_dictionary
 
-from cryspy.A_functions_base.orbital_functions import calc_jl
+from cryspy.A_functions_base.orbital_functions import calc_jl, calc_jl_by_table
 
 from cryspy.B_parent_classes.cl_1_item import ItemN
 from cryspy.B_parent_classes.cl_2_loop import LoopN
@@ -137,7 +137,7 @@ class AtomRhoOrbitalRadialSlater(ItemN):
         """Calculate jl for l from 0 until l_max of atomic orbital."""
         zeta0 = self.zeta0
         n0 = self.n0
-        jl = calc_jl(sthovl, [1.], [n0], [zeta0, ], kappa=kappa, l_max=l_max)
+        jl = calc_jl_by_table(sthovl, [1.], [n0], [zeta0, ], kappa=kappa, l_max=l_max)
         return jl
 
 
@@ -6,7 +6,7 @@ import numpy
 from typing import NoReturn
 
 from cryspy.A_functions_base.database import DATABASE
-from cryspy.A_functions_base.charge_form_factor import calc_jl_for_ion, calc_scattering_amplitude_tabulated, get_atom_name_ion_charge_shell, get_atomic_symbol_ion_charge_isotope_number_by_ion_symbol
+from cryspy.A_functions_base.charge_form_factor import get_table_scattering_amplitude, get_atom_name_ion_charge_shell, get_atomic_symbol_ion_charge_isotope_number_by_ion_symbol
 from cryspy.A_functions_base.debye_waller_factor import calc_param_iso_aniso_by_b_iso_beta, calc_u_ij_by_beta
 from cryspy.A_functions_base.matrix_operations import calc_m1_m2_inv_m1, calc_m_v
 from cryspy.A_functions_base.magnetic_form_factor import get_j0_j2_parameters
@@ -695,13 +695,9 @@ class Crystal(DataN):
             flag_atom_scattering_amplitude = True
             for type_symbol in atom_type_symbol:
                 try:
-                    jl = calc_jl_for_ion(table_sthovl, type_symbol)
-                    scattering_amplitude = jl[:,0]
-                except UserWarning:
-                    try:
-                        scattering_amplitude = calc_scattering_amplitude_tabulated(type_symbol, table_sthovl)[0]
-                    except KeyError:
-                        flag_atom_scattering_amplitude = False
+                    scattering_amplitude = get_table_scattering_amplitude(type_symbol, table_sthovl)
+                except KeyError:
+                    flag_atom_scattering_amplitude = False
                 if flag_atom_scattering_amplitude:
                     l_table_atom_scattering_amplitude.append(scattering_amplitude)
 
@@ -60,6 +60,18 @@ from cryspy.A_functions_base.function_1_atomic_vibrations import calc_beta_by_u,
 from cryspy.A_functions_base.function_1_error_simplex import error_estimation_simplex
 from cryspy.A_functions_base.function_1_gamma_nu import gammanu_to_tthphi, tthphi_to_gammanu, recal_int_to_tthphi_grid, recal_int_to_gammanu_grid
 
+from cryspy.A_functions_base.function_1_cache import get_cache_statistics, reset_cache_statistics, \
+    set_symmetry_cache_budget, get_symmetry_cache_budget, clear_symmetry_cache, \
+    set_profile_cache_budget, get_profile_cache_budget, clear_profile_cache, \
+    set_table_cache_directory, get_table_cache_directory, clear_table_cache
+from cryspy.A_functions_base.function_1_profiling import enable_profiling, disable_profiling, \
+    reset_profiling, get_profiling_report
+from cryspy.A_functions_base.structure_factor import set_structure_factor_memory_budget, \
+    get_structure_factor_memory_budget, set_hkl_superset_margin, get_hkl_superset_margin
+from cryspy.A_functions_base.structure_factor_kernel import set_structure_factor_kernel, \
+    get_structure_factor_kernel, benchmark_structure_factor_kernel
+from cryspy.A_functions_base.powder_diffraction_const_wavelength import set_sparse_profile, \
+    get_sparse_profile, calc_profile_cutoff_error
 from cryspy.A_functions_base.function_1_inversed_hessian import estimate_inversed_hessian_matrix
 from cryspy.A_functions_base.function_1_magnetic import get_j0_j2_by_symbol
 from cryspy.A_functions_base.function_1_markdown import md_to_html
@@ -155,7 +167,8 @@ from cryspy.H_functions_global.powder_experiments import \
 
 from cryspy.procedure_rhochi.rhochi import rhochi_rietveld_refinement, \
     rhochi_rietveld_refinement_with_parameters, \
-    rhochi_no_refinement, rhochi_inversed_hessian
+    rhochi_no_refinement, rhochi_inversed_hessian, rhochi_sequential_refinement, \
+    rhochi_batch_refinement
 
 
 from cryspy.procedure_mempy.mempy import  mempy_magnetization_density_reconstruction, \
@@ -213,6 +226,16 @@ L_FUNCTION = [
     error_estimation_simplex,
     gammanu_to_tthphi, tthphi_to_gammanu, recal_int_to_tthphi_grid, recal_int_to_gammanu_grid,
     estimate_inversed_hessian_matrix,
+    get_cache_statistics,
+    reset_cache_statistics,
+    set_symmetry_cache_budget, get_symmetry_cache_budget, clear_symmetry_cache,
+    set_profile_cache_budget, get_profile_cache_budget, clear_profile_cache,
+    set_table_cache_directory, get_table_cache_directory, clear_table_cache,
+    enable_profiling, disable_profiling, reset_profiling, get_profiling_report,
+    set_structure_factor_memory_budget, get_structure_factor_memory_budget,
+    set_hkl_superset_margin, get_hkl_superset_margin,
+    set_structure_factor_kernel, get_structure_factor_kernel, benchmark_structure_factor_kernel,
+    set_sparse_profile, get_sparse_profile, calc_profile_cutoff_error,
     get_j0_j2_by_symbol,
     md_to_html,
     calc_chi_sq, tri_linear_interpolation, transform_string_to_r_b, transform_string_to_digits,
@@ -269,6 +292,8 @@ L_FUNCTION = [
     rhochi_rietveld_refinement_with_parameters, 
     rhochi_no_refinement,
     rhochi_inversed_hessian,
+    rhochi_sequential_refinement,
+    rhochi_batch_refinement,
     mempy_magnetization_density_reconstruction, 
     mempy_spin_density_reconstruction,
     mempy_reconstruction_with_parameters,
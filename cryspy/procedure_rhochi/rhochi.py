@@ -1,4 +1,6 @@
 from typing import List, Union
+import concurrent.futures
+import os
 import numpy
 import scipy
 import scipy.optimize
@@ -7,7 +9,8 @@ from warnings import warn
 
 
 from cryspy.A_functions_base.function_1_inversed_hessian import \
-    estimate_inversed_hessian_matrix
+    estimate_inversed_hessian_matrix, estimate_jacobian_matrix, \
+    estimate_inversed_hessian_matrix_by_jacobian
 from cryspy.A_functions_base.function_1_error_simplex import \
     error_estimation_simplex
 
@@ -25,7 +28,13 @@ from cryspy.E_data_classes.cl_2_tof import TOF
 
 from cryspy.procedure_rhochi.rhochi_by_dictionary import \
     rhochi_lsq_by_dictionary, rhochi_rietveld_refinement_by_dictionary,\
-    rhochi_calc_chi_sq_by_dictionary
+    rhochi_calc_chi_sq_by_dictionary, rhochi_lm_refinement_by_dictionary, \
+    rhochi_least_squares_by_dictionary, rhochi_calc_residual_by_dictionary, \
+    init_chi_sq_worker, calc_chi_sq_in_worker, calc_residual_in_worker, \
+    rhochi_sequential_refinement_by_dictionary, form_sequential_results_table, \
+    rhochi_batch_refinement_by_dictionary, calc_hess_inv_of_parameters_by_dictionary
+from cryspy.procedure_rhochi.rhochi_parameter_map import \
+    form_parameter_map, get_parameters_by_map, set_parameters_by_map
 
 import cryspy
 
@@ -79,9 +88,22 @@ def rhochi_rietveld_refinement(cryspy_object: cryspy.GlobalN) -> dict:
 
 def rhochi_rietveld_refinement_with_parameters(
         cryspy_object: cryspy.GlobalN,
-        optimization_method: str = "BFGS") -> dict:
+        optimization_method: str = "BFGS", n_processes: int = 1,
+        covariance_method: str = "four_point", n_threads: int = 1) -> dict:
     """Run refinement by RhoChi procedure with non-default parameters.
+
+    optimization_method is a method of scipy.optimize.minimize, "LM"
+    (Levenberg-Marquardt with analytical derivatives where available) or
+    "least_squares" (scipy.optimize.least_squares on weighted residuals).
+    n_processes > 1 gives numerical derivatives calculated in parallel.
+    n_threads > 1 gives experiments calculated concurrently by threads
+    (for methods of scipy.optimize.minimize).
+    covariance_method is a method of rhochi_inversed_hessian ("four_point",
+    "jacobian" or "hess_inv"), "hess_inv" takes the matrix of the optimizer.
+    If the optimizer gives no matrix "four_point" is used with a warning.
     """
+    if covariance_method not in ("four_point", "jacobian", "hess_inv"):
+        raise AttributeError(f"Unknown method '{covariance_method:}' of estimation of inversed Hessian matrix")
 
     # check object
     rhochi_check_items(cryspy_object)
@@ -92,23 +114,43 @@ def rhochi_rietveld_refinement_with_parameters(
         
         DICT_PARAMS["previous_arg"] = ()
         DICT_PARAMS["iteration"] = 0
-        chi_sq, parameter_name, dict_in_out, res = rhochi_rietveld_refinement_by_dictionary(
-            obj_dict, method=optimization_method, callback=_f_callback)
+        if optimization_method == "LM":
+            chi_sq, parameter_name, dict_in_out, res = rhochi_lm_refinement_by_dictionary(
+                obj_dict, callback=_f_callback)
+        elif optimization_method == "least_squares":
+            chi_sq, parameter_name, dict_in_out, res = rhochi_least_squares_by_dictionary(obj_dict)
+        else:
+            chi_sq, parameter_name, dict_in_out, res = rhochi_rietveld_refinement_by_dictionary(
+                obj_dict, method=optimization_method, callback=_f_callback, n_processes=n_processes,
+                n_threads=n_threads)
         dict_out = {"chi_sq": chi_sq, "parameter_name": parameter_name}
         if "hess_inv" in res.keys():
-            hess_inv = res["hess_inv"]
+            hess_inv = numpy.array(res["hess_inv"], dtype=float)
+            if hess_inv.shape[0] != len(parameter_name):
+                # hess_inv is given for free parameters, constrained ones are added as T * hess_inv * T^T
+                hess_inv_full = calc_hess_inv_of_parameters_by_dictionary(obj_dict, parameter_name, hess_inv)
+                if hess_inv_full is not None:
+                    hess_inv = hess_inv_full
+                    res["hess_inv"] = hess_inv
+                else:
+                    warn(
+                        f"Inversed Hessian matrix of the optimizer is {hess_inv.shape[0]:}x{hess_inv.shape[0]:}, "
+                        f"{len(parameter_name):} refined parameters are expected. "
+                        "The matrix is not used.", UserWarning)
             sigma_p = numpy.sqrt(numpy.abs(numpy.diag(hess_inv)))
             correlation_matrix = hess_inv/(sigma_p[:, na]*sigma_p[na, :])
             dict_out["correlation_matrix"] = correlation_matrix
 
-            l_label = [hh[-1][0] for hh in parameter_name]
-            if len(l_label) == hess_inv.shape[0]:
+            if len(parameter_name) == hess_inv.shape[0]:
+                l_label = [hh[-1][0] for hh in parameter_name]
                 inv_hessian = InversedHessian()
                 inv_hessian.set_labels(l_label)
                 inv_hessian.set_inversed_hessian(hess_inv)
                 inv_hessian.form_inversed_hessian()
                 inv_hessian.form_object()
                 cryspy_object.add_items([inv_hessian, ])
+            else:
+                sigma_p = numpy.zeros((len(parameter_name),), dtype=float)
         else:
             sigma_p = numpy.zeros((len(parameter_name),), dtype=float)
     else:
@@ -130,11 +172,100 @@ def rhochi_rietveld_refinement_with_parameters(
         value = cryspy_object.get_variable_by_name(name)
         print(f" - {name[-1][0]:} {value:.5f}")
     
-    print("Errors are estimating by numerical derivatives.")
-    rhochi_inversed_hessian(cryspy_object)
+    if covariance_method == "hess_inv":
+        if (flag_scipy_refinements and ("hess_inv" in res.keys()) and
+                (numpy.shape(res["hess_inv"]) == (len(parameter_name), len(parameter_name)))):
+            print("Errors are estimated by inversed Hessian matrix of the optimizer.")
+            rhochi_inversed_hessian(cryspy_object, method="hess_inv", hess_inv=res["hess_inv"])
+        else:
+            warn(
+                f"Inversed Hessian matrix is not given by the optimization method '{optimization_method:}', "
+                "errors are estimated by numerical second derivatives of chi_sq.", UserWarning)
+            rhochi_inversed_hessian(cryspy_object, n_processes=n_processes)
+    elif covariance_method == "jacobian":
+        print("Errors are estimated by Jacobian of weighted residuals.")
+        rhochi_inversed_hessian(cryspy_object, method="jacobian", n_processes=n_processes)
+    else:
+        print("Errors are estimated by numerical second derivatives of chi_sq.")
+        rhochi_inversed_hessian(cryspy_object, n_processes=n_processes)
     return dict_out
 
 
+def calc_sequential_chain(
+        l_file_name, method: str = "BFGS", flag_carry_parameters: bool = True) -> dict:
+    """Load datasets of the chain and refine them sequentially."""
+    l_global_dict = [cryspy.load_file(file_name).get_dictionary() for file_name in l_file_name]
+    l_label = [os.path.basename(file_name) for file_name in l_file_name]
+    return rhochi_sequential_refinement_by_dictionary(
+        l_global_dict, l_label=l_label, method=method, flag_carry_parameters=flag_carry_parameters)
+
+
+def rhochi_sequential_refinement(
+        l_chain, method: str = "BFGS", n_processes: int = 1, flag_carry_parameters: bool = True,
+        file_table: str = None) -> list:
+    """Sequential (parametric) refinement of series of datasets.
+
+    l_chain is a list of rcif files refined one after another (converged
+    parameters and intermediate results are carried to the next dataset),
+    or a list of such lists for independent chains (e.g. field scans at
+    different temperatures). If n_processes > 1 chains are refined in
+    parallel. The table of results is written into file_table if given.
+
+    Output is a list of dictionaries, one per chain
+    (see rhochi_sequential_refinement_by_dictionary).
+    """
+    if all([isinstance(file_name, str) for file_name in l_chain]):
+        l_chain = [l_chain, ]
+    if (n_processes > 1) and (len(l_chain) > 1):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+            l_future = [
+                executor.submit(calc_sequential_chain, l_file_name, method, flag_carry_parameters)
+                for l_file_name in l_chain]
+            l_result = [future.result() for future in l_future]
+    else:
+        l_result = [calc_sequential_chain(l_file_name, method, flag_carry_parameters) for l_file_name in l_chain]
+
+    if file_table is not None:
+        ls_out = []
+        for i_chain, dict_result in enumerate(l_result):
+            if len(l_result) > 1:
+                ls_out.append(f"# chain {i_chain+1:}\n")
+            ls_out.append(form_sequential_results_table(dict_result))
+        with open(file_table, "w") as fid:
+            fid.write("\n".join(ls_out))
+    return l_result
+
+
+def rhochi_batch_refinement(
+        l_job, n_processes: int = 1, timeout: float = None) -> list:
+    """Run a batch of refinements (multi-start) on a pool of processes.
+
+    l_job is a list of (cryspy_object or its dictionary, starting vector,
+    method), e.g. for a search of magnetic structure from different starting
+    moments or candidate magnetic space groups. Each object is sent to the
+    workers once. Refinement of a job is stopped at the first iteration
+    after timeout (in seconds), a running iteration is not interrupted.
+
+    Output is a list of results ranked by chi_sq
+    (see rhochi_batch_refinement_by_dictionary). Objects are not changed.
+    """
+    l_object, l_global_dict, l_job_dict = [], [], []
+    for cryspy_object, param_0, method in l_job:
+        l_id = [id(hh) for hh in l_object]
+        if id(cryspy_object) in l_id:
+            global_dict = l_global_dict[l_id.index(id(cryspy_object))]
+        else:
+            if isinstance(cryspy_object, GlobalN):
+                rhochi_check_items(cryspy_object)
+                global_dict = cryspy_object.get_dictionary()
+            else:
+                global_dict = cryspy_object
+            l_object.append(cryspy_object)
+            l_global_dict.append(global_dict)
+        l_job_dict.append((global_dict, param_0, method))
+    return rhochi_batch_refinement_by_dictionary(l_job_dict, n_processes=n_processes, timeout=timeout)
+
+
 def rhochi_no_refinement(cryspy_object: cryspy.GlobalN) -> dict:
     """Run calculations by RhoChi procedure.
     """
@@ -174,8 +305,15 @@ def _f_callback(*arg, d_info: dict = None) -> bool:
     # return flag_out
 
 
-def rhochi_inversed_hessian(global_object: GlobalN):
-    """Estimate inversed Hessian matrix."""
+def rhochi_inversed_hessian(
+        global_object: GlobalN, method: str = "four_point", n_processes: int = 1, hess_inv=None):
+    """Estimate inversed Hessian matrix.
+
+    method is "four_point" (numerical second derivatives of chi_sq),
+    "jacobian" (Gauss-Newton by numerical Jacobian of weighted residuals)
+    or "hess_inv" (given matrix, e.g. hess_inv of the optimizer).
+    n_processes > 1 gives calculations on a pool of processes.
+    """
     if global_object.is_attribute("inversed_hessian"):
         global_object.items.remove(global_object.inversed_hessian)
 
@@ -192,12 +330,12 @@ def rhochi_inversed_hessian(global_object: GlobalN):
         dict_in_out=dict_in_out,
         flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
     
-    param_0 = [global_dict[way[0]][way[1]][way[2]] for way  in parameter_names]
+    parameter_map = form_parameter_map(global_dict, parameter_names)
+    param_0 = get_parameters_by_map(global_dict, parameter_map)
 
     flag_use_precalculated_data = True
     def tempfunc(l_param):
-        for way, param in zip(parameter_names, l_param):
-            global_dict[way[0]][way[1]][way[2]] = param
+        set_parameters_by_map(global_dict, parameter_map, l_param)
         chi_sq = rhochi_calc_chi_sq_by_dictionary(
             global_dict,
             dict_in_out=dict_in_out,
@@ -205,8 +343,35 @@ def rhochi_inversed_hessian(global_object: GlobalN):
             flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)[0]
         return chi_sq
 
-    hess_inv, np_first_der = estimate_inversed_hessian_matrix(tempfunc, param_0)
-    if (numpy.all(hess_inv == numpy.zeros_like(hess_inv)) or (hess_inv is None)):
+    def tempfunc_residual(l_param):
+        set_parameters_by_map(global_dict, parameter_map, l_param)
+        return rhochi_calc_residual_by_dictionary(
+            global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=flag_use_precalculated_data)
+
+    if method == "hess_inv":
+        if ((hess_inv is None) or (numpy.shape(hess_inv) != (len(parameter_names), len(parameter_names)))):
+            raise AttributeError("Inversed Hessian matrix of refined parameters should be given")
+        hess_inv = numpy.array(hess_inv, dtype=float)
+    elif method in ("four_point", "jacobian"):
+        if n_processes > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_processes, initializer=init_chi_sq_worker,
+                initargs=(global_dict, parameter_names, ()))
+            func, func_residual = calc_chi_sq_in_worker, calc_residual_in_worker
+        else:
+            executor = None
+            func, func_residual = tempfunc, tempfunc_residual
+        if method == "four_point":
+            hess_inv, np_first_der = estimate_inversed_hessian_matrix(func, param_0, executor=executor)
+        else:
+            jacobian = estimate_jacobian_matrix(func_residual, param_0, executor=executor)
+            hess_inv = estimate_inversed_hessian_matrix_by_jacobian(jacobian)
+        if executor is not None:
+            executor.shutdown()
+    else:
+        raise AttributeError(f"Unknown method '{method:}' of estimation of inversed Hessian matrix")
+
+    if ((hess_inv is None) or numpy.all(hess_inv == numpy.zeros_like(hess_inv))):
         return 
     corr_matrix, sigmas = inversed_hessian_to_correlation(hess_inv) 
     global_object.take_parameters_from_dictionary(
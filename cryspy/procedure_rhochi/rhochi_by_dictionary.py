@@ -1,4 +1,9 @@
 from typing import Callable
+import concurrent.futures
+import contextlib
+import copy
+import io
+import time
 import numpy
 import scipy
 import scipy.optimize
@@ -7,9 +12,13 @@ from .rhochi_diffrn import calc_chi_sq_for_diffrn_by_dictionary
 from .rhochi_pd import calc_chi_sq_for_pd_by_dictionary
 from .rhochi_pd2d import calc_chi_sq_for_pd2d_by_dictionary
 from .rhochi_tof import calc_chi_sq_for_tof_by_dictionary
+from .rhochi_parameter_map import form_parameter_map, get_parameters_by_map, \
+    set_parameters_by_map, add_derivatives_by_map, form_constraint_matrix
 
 from cryspy.A_functions_base.function_1_inversed_hessian import \
     estimate_inversed_hessian_matrix
+from cryspy.A_functions_base.function_1_profiling import profiled_stage, record_array_size
+from cryspy.A_functions_base.reflection_store import reset_reflection_store
 
 na = numpy.newaxis
 
@@ -79,13 +88,69 @@ def calc_shift_p_by_constraints_hamilton(delta_p, dder_chi_sq, matrix_q):
 
 def form_matrix_q(linear_constraints, parameter_name):
     matrix_q = numpy.zeros((len(linear_constraints), len(parameter_name)), dtype=float)
+    dict_index = {p_name: ind for ind, p_name in enumerate(parameter_name)}
     for i_constraint, value_constraint in enumerate(linear_constraints):
         for coeff, p_name in value_constraint:
-            ind_p_name = parameter_name.index(p_name)
-            matrix_q[i_constraint, ind_p_name] = coeff
+            matrix_q[i_constraint, dict_index[p_name]] = coeff
     return matrix_q
 
 
+def set_parameters_by_dictionary(
+        global_dict, parameter_names, l_param, linear_constraints=(), parameter_map: dict = None):
+    """Put parameters into global_dict, constrained parameters are recalculated.
+
+    The linear constraint is on one parameter (temporary solution).
+    For repeated calls parameter_map formed by form_parameter_map should be given.
+    """
+    if parameter_map is None:
+        parameter_map = form_parameter_map(global_dict, parameter_names, linear_constraints)
+    set_parameters_by_map(global_dict, parameter_map, l_param)
+
+
+# copy of global_dict and warm dict_in_out of a worker process
+DICT_WORKER = {}
+
+
+def init_chi_sq_worker(global_dict, parameter_names, linear_constraints):
+    dict_in_out = {}
+    rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=False,
+        flag_calc_analytical_derivatives=False)
+    DICT_WORKER["global_dict"] = global_dict
+    DICT_WORKER["dict_in_out"] = dict_in_out
+    DICT_WORKER["parameter_map"] = form_parameter_map(global_dict, parameter_names, linear_constraints)
+
+
+def calc_chi_sq_in_worker(l_param):
+    global_dict = DICT_WORKER["global_dict"]
+    set_parameters_by_map(global_dict, DICT_WORKER["parameter_map"], l_param)
+    chi_sq = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=DICT_WORKER["dict_in_out"], flag_use_precalculated_data=True,
+        flag_calc_analytical_derivatives=False)[0]
+    return chi_sq + calc_punishement_function(global_dict)
+
+
+def calc_residual_in_worker(l_param):
+    global_dict = DICT_WORKER["global_dict"]
+    set_parameters_by_map(global_dict, DICT_WORKER["parameter_map"], l_param)
+    return rhochi_calc_residual_by_dictionary(
+        global_dict, dict_in_out=DICT_WORKER["dict_in_out"], flag_use_precalculated_data=True)
+
+
+def calc_gradient_by_pool(executor, l_param, chi_sq_0: float):
+    """Forward finite-difference gradient of chi_sq, perturbed points are calculated by executor.
+
+    Steps are the same as for '2-point' scheme of scipy.optimize.
+    """
+    l_param = numpy.array(l_param, dtype=float)
+    sign_param = numpy.where(l_param >= 0., 1., -1.)
+    step = numpy.sqrt(numpy.finfo(float).eps) * sign_param * numpy.maximum(1., numpy.abs(l_param))
+    step = (l_param + step) - l_param
+    l_param_shifted = [l_param + step[ind] * numpy.eye(1, l_param.size, ind)[0] for ind in range(l_param.size)]
+    chi_sq_shifted = numpy.array(list(executor.map(calc_chi_sq_in_worker, l_param_shifted)), dtype=float)
+    return (chi_sq_shifted - chi_sq_0)/step
+
+
 def rhochi_one_iteration_by_dictionary(
         global_dict, dict_in_out: dict = None, flag_use_precalculated_data: bool = False):
     chi_sq_sum, n_point_sum, der_chi_sq_sum, dder_chi_sq_sum, parameter_name_sum = \
@@ -99,76 +164,119 @@ def rhochi_one_iteration_by_dictionary(
         matrix_q = form_matrix_q(linear_constraints, parameter_name_sum)
         shift_p = calc_shift_p_by_constraints_hamilton(delta_p, dder_chi_sq_sum, matrix_q)
         delta_p += shift_p
-    for way, d_p in zip(parameter_name_sum, delta_p):
-        global_dict[way[0]][way[1]][way[2]] += d_p
+    parameter_map = dict_in_out["parameter_map"]
+    set_parameters_by_map(global_dict, parameter_map, get_parameters_by_map(global_dict, parameter_map) + delta_p)
     return chi_sq_sum, n_point_sum, delta_p, parameter_name_sum, der_chi_sq_sum, dder_chi_sq_sum
 
 
-def rhochi_rietveld_refinement_by_dictionary(global_dict: dict, method: str = "BFGS", callback: Callable = None):
-    print("*********************************************")
-    print("Rietveld refinement by CrysPy (module RhoChi)")
-    print("*********************************************\n")
-    print("Derivatives are calculated numerically.")
-    dict_in_out = {}
-    flag_use_precalculated_data = False
-    flag_calc_analytical_derivatives = False
-    print("Preliminary calculations...", end="\r")
-    chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_names = rhochi_calc_chi_sq_by_dictionary(
-        global_dict,
-        dict_in_out=dict_in_out,
-        flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
-
+def form_free_parameters_by_dictionary(global_dict: dict, parameter_names) -> dict:
+    """Form free parameters of the refinement: refined ones except the ones given by linear constraints.
 
+    Output keys are "parameter_name" (free parameters), "linear_constraints",
+    "parameter_map" (of free parameters, the constrained ones are set
+    together with them) and "matrix_t" (parameters are matrix_t * free ones).
+    """
     if "linear_constraints" in global_dict.keys():
         linear_constraints = global_dict["linear_constraints"]
-        # try:
-        #     matrix_q = form_matrix_q(linear_constraints, parameter_names)
-        #     lb = numpy.zeros((matrix_q.shape[0],), dtype=float)
-        #     ub = numpy.zeros((matrix_q.shape[0],), dtype=float)
-        #     linear_constraint = scipy.optimize.LinearConstraint(matrix_q, lb, ub)
-        # except ValueError:
-        #     print(f"User constraints are not used.")
     else:
         linear_constraints = []
-
     parameter_names_fixed = [linear_constraint[1][1] for linear_constraint in linear_constraints]
-    parameter_names_free = [way for way  in parameter_names if not(way in parameter_names_fixed)]
-    param_0 = [global_dict[way[0]][way[1]][way[2]] for way  in parameter_names_free]
+    parameter_names_free = [way for way in parameter_names if not(way in parameter_names_fixed)]
+    dict_free = {
+        "parameter_name": parameter_names_free,
+        "linear_constraints": linear_constraints,
+        "parameter_map": form_parameter_map(global_dict, parameter_names_free, linear_constraints),
+        "matrix_t": form_constraint_matrix(parameter_names, parameter_names_free, linear_constraints)}
+    return dict_free
+
+
+def calc_hess_inv_of_parameters_by_dictionary(global_dict: dict, parameter_names, hess_inv):
+    """Transform inversed Hessian matrix of free parameters into the one of all refined parameters.
+
+    It is matrix_t * hess_inv * matrix_t^T (see form_free_parameters_by_dictionary).
+    None is given if the matrix corresponds to neither free nor refined parameters.
+    """
+    hess_inv = numpy.array(hess_inv, dtype=float)
+    matrix_t = form_free_parameters_by_dictionary(global_dict, parameter_names)["matrix_t"]
+    if hess_inv.shape == (matrix_t.shape[1], matrix_t.shape[1]):
+        return numpy.matmul(numpy.matmul(matrix_t, hess_inv), matrix_t.transpose())
+    elif hess_inv.shape == (matrix_t.shape[0], matrix_t.shape[0]):
+        return hess_inv
+    return None
+
+
+def start_refinement_by_dictionary(global_dict: dict, dict_in_out: dict, flag_use_precalculated_data: bool = False):
+    """Calculate chi_sq at starting parameters and form free parameters of the refinement.
+
+    Output is chi_sq, n_point, parameter_names, dict_free (see
+    form_free_parameters_by_dictionary) and starting values of free
+    parameters param_0. If there are no refined parameters a message is printed.
+    """
+    print("Preliminary calculations...", end="\r")
+    chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_names = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out,
+        flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=False)
+    dict_free = form_free_parameters_by_dictionary(global_dict, parameter_names)
+    param_0 = get_parameters_by_map(global_dict, dict_free["parameter_map"])
     print(f"Started chi_sq per number of points is {chi_sq/n_point:.2f}.         ")
-    if len(param_0) == 0:
-        res = {}
+    if param_0.size == 0:
         print(r"<b>UNSUCCESSFULL TRY<\b>")
         print("\nFor refinement procedure some parameters have to be set as refined.")
         print("Print parenthesis after parameter which heve to be refined.")
         print("Example: 1.23()")
-        return chi_sq, parameter_names, dict_in_out, res
-    print(f"Number of fitting parameters {len(param_0):}")
-    for name, val in zip(parameter_names_free, param_0):
+        return chi_sq, n_point, parameter_names, dict_free, param_0
+    print(f"Number of fitting parameters {param_0.size:}")
+    for name, val in zip(dict_free["parameter_name"], param_0):
         print(f" - {name:}  {val:.5f}")
-
-    if len(parameter_names_fixed) >0:
-        print(f"Number of constrained parameters:")
+    parameter_names_fixed = [way for way in parameter_names if not(way in dict_free["parameter_name"])]
+    if len(parameter_names_fixed) > 0:
+        print("Number of constrained parameters:")
     for name in parameter_names_fixed:
         print(f" - {name:}")
+    return chi_sq, n_point, parameter_names, dict_free, param_0
+
+
+def rhochi_rietveld_refinement_by_dictionary(
+        global_dict: dict, method: str = "BFGS", callback: Callable = None, n_processes: int = 1,
+        dict_in_out: dict = None, n_threads: int = 1):
+    """Refinement by scipy.optimize.minimize.
+
+    If n_processes > 1 numerical derivatives are calculated on a pool of
+    processes, each of them keeps its own copy of global_dict.
+    If n_threads > 1 experiments are calculated concurrently by threads.
+    dict_in_out of a previous calculation (e.g. of a similar dataset) can be
+    given, its intermediate results are used where their inputs coincide.
+    """
+    print("*********************************************")
+    print("Rietveld refinement by CrysPy (module RhoChi)")
+    print("*********************************************\n")
+    print("Derivatives are calculated numerically.")
+    flag_warm_start = dict_in_out is not None
+    if not(flag_warm_start):
+        dict_in_out = {}
+    flag_calc_analytical_derivatives = False
+    chi_sq, n_point, parameter_names, dict_free, param_0 = start_refinement_by_dictionary(
+        global_dict, dict_in_out, flag_use_precalculated_data=flag_warm_start)
+    if param_0.size == 0:
+        return chi_sq, parameter_names, dict_in_out, {}
+    parameter_map = dict_free["parameter_map"]
 
 
     flag_use_precalculated_data = True
+    if n_threads > 1:
+        print(f"Experiments are calculated by {n_threads:} threads.")
+        executor_threads = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+    else:
+        executor_threads = None
     def tempfunc(l_param):
-        for way, param in zip(parameter_names_free, l_param):
-            global_dict[way[0]][way[1]][way[2]] = param
-        # linear constraint on one parameter (temporary solution)
-        for linear_constraint in linear_constraints:
-            first_name = linear_constraint[0][1]
-            second_name = linear_constraint[1][1]
-            coeff = -linear_constraint[1][0]/linear_constraint[0][0]
-            constr_param = coeff*l_param[parameter_names_free.index(first_name)]
-            global_dict[second_name[0]][second_name[1]][second_name[2]] = constr_param
+        set_parameters_by_map(global_dict, parameter_map, l_param)
 
         chi_sq = rhochi_calc_chi_sq_by_dictionary(
             global_dict,
             dict_in_out=dict_in_out,
             flag_use_precalculated_data=flag_use_precalculated_data,
-            flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)[0]
+            flag_calc_analytical_derivatives=flag_calc_analytical_derivatives,
+            executor=executor_threads)[0]
         
         chi_sq_punishement = calc_punishement_function(global_dict)
         return chi_sq + chi_sq_punishement
@@ -183,12 +291,35 @@ def rhochi_rietveld_refinement_by_dictionary(global_dict: dict, method: str = "B
     #    if hess_inv is not None:
     #        res["hess_inv"] = hess_inv
     #else:
-    res = scipy.optimize.minimize(tempfunc, param_0, method=method, callback=callback)
+    try:
+        if n_processes > 1:
+            print(f"Derivatives are calculated by {n_processes:} processes.")
+            dict_last = {}
+            def tempfunc_last(l_param):
+                l_param = numpy.array(l_param, dtype=float)
+                if not(("l_param" in dict_last.keys()) and numpy.array_equal(dict_last["l_param"], l_param)):
+                    dict_last["l_param"] = l_param
+                    dict_last["chi_sq"] = tempfunc(l_param)
+                return dict_last["chi_sq"]
+
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=n_processes, initializer=init_chi_sq_worker,
+                    initargs=(global_dict, dict_free["parameter_name"], dict_free["linear_constraints"])) as executor:
+                res = scipy.optimize.minimize(
+                    tempfunc_last, param_0, method=method, callback=callback,
+                    jac=lambda l_param: calc_gradient_by_pool(executor, l_param, tempfunc_last(l_param)))
+            tempfunc(res.x)
+        else:
+            res = scipy.optimize.minimize(tempfunc, param_0, method=method, callback=callback)
+    finally:
+        if executor_threads is not None:
+            executor_threads.shutdown()
     print("Optimization is done.                          ", end="\n")
 
     print("Calculations for optimal parameters... ", end="\r")
-    dict_in_out = {}
-    flag_use_precalculated_data = False
+    if not(flag_warm_start):
+        dict_in_out = {}
+    flag_use_precalculated_data = flag_warm_start
     chi_sq, n_point = rhochi_calc_chi_sq_by_dictionary(
         global_dict,
         dict_in_out=dict_in_out,
@@ -197,6 +328,413 @@ def rhochi_rietveld_refinement_by_dictionary(global_dict: dict, method: str = "B
 
     return chi_sq, parameter_names, dict_in_out, res
 
+def rhochi_lm_refinement_by_dictionary(
+        global_dict: dict, callback: Callable = None, max_iteration: int = 100,
+        tolerance: float = 1e-5, damping: float = 1e-3, dict_in_out: dict = None):
+    """Levenberg-Marquardt refinement by the first and second derivatives of chi_sq.
+
+    Gauss-Newton Hessian 2 J^T J and gradient 2 J^T r are built from the
+    Jacobian J of weighted residuals r (including the punishment function).
+    The columns of parameters without analytical derivatives are calculated
+    numerically (central differences), so the mixed terms are kept and
+    res["hess_inv"] is the inverse of the full Hessian.
+    dict_in_out of a previous calculation can be given for a warm start.
+    """
+    print("*********************************************")
+    print("Rietveld refinement by CrysPy (module RhoChi)")
+    print("*********************************************\n")
+    print("Levenberg-Marquardt algorithm is used.")
+    flag_warm_start = dict_in_out is not None
+    if not(flag_warm_start):
+        dict_in_out = {}
+    chi_sq, n_point, parameter_names, dict_free, param_0 = start_refinement_by_dictionary(
+        global_dict, dict_in_out, flag_use_precalculated_data=flag_warm_start)
+    if param_0.size == 0:
+        return chi_sq, parameter_names, dict_in_out, {}
+    # full parameters are matrix_t * free parameters
+    matrix_t = dict_free["matrix_t"]
+
+    def set_parameters(l_param):
+        set_parameters_by_map(global_dict, dict_free["parameter_map"], l_param)
+
+    def tempfunc(l_param):
+        set_parameters(l_param)
+        chi_sq = rhochi_calc_chi_sq_by_dictionary(
+            global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True,
+            flag_calc_analytical_derivatives=False)[0]
+        return chi_sq + calc_punishement_function(global_dict)
+
+    def calc_residual(l_param):
+        set_parameters(l_param)
+        return rhochi_calc_residual_by_dictionary(global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True)
+
+    def calc_residual_punishment(l_param):
+        set_parameters(l_param)
+        return numpy.sqrt(numpy.abs(calc_punishement_function(global_dict)))
+
+    flag_punishment = "punishment_function" in global_dict.keys()
+    def calc_derivatives(l_param):
+        set_parameters(l_param)
+        residual, der_residual, flags_analytical = rhochi_calc_residual_jacobian_by_dictionary(
+            global_dict, parameter_names, dict_in_out=dict_in_out)
+        jacobian = numpy.matmul(der_residual, matrix_t)
+        # the free parameter is analytical if all parameters given by it are analytical
+        flags_free = numpy.all(numpy.logical_or(matrix_t == 0., flags_analytical[:, na]), axis=0)
+        for ind in range(l_param.size):
+            step = 1e-4 * max(abs(l_param[ind]), 1e-2)
+            l_param_h = numpy.copy(l_param)
+            if not(flags_free[ind]):
+                l_param_h[ind] += step
+                residual_plus = calc_residual(l_param_h)
+                l_param_h[ind] -= 2*step
+                residual_minus = calc_residual(l_param_h)
+                jacobian[:, ind] = (residual_plus - residual_minus)/(2*step)
+            elif flag_punishment:
+                # the last residual is the punishment function
+                l_param_h[ind] += step
+                residual_plus = calc_residual_punishment(l_param_h)
+                l_param_h[ind] -= 2*step
+                residual_minus = calc_residual_punishment(l_param_h)
+                jacobian[-1, ind] = (residual_plus - residual_minus)/(2*step)
+        set_parameters(l_param)
+        chi_sq = numpy.square(residual).sum()
+        der_chi_sq = 2. * numpy.matmul(jacobian.transpose(), residual)
+        dder_chi_sq = 2. * numpy.matmul(jacobian.transpose(), jacobian)
+        return chi_sq, der_chi_sq, dder_chi_sq
+
+    print("\nMinimization procedure of chi_sq is running... ", end="\r")
+    param = param_0
+    chi_sq, der_chi_sq, dder_chi_sq = calc_derivatives(param)
+    n_iteration, flag_success, message = 0, False, "Maximal number of iterations is reached."
+    while n_iteration < max_iteration:
+        n_iteration += 1
+        diag_dder = numpy.diag(dder_chi_sq)
+        diag_dder = numpy.where(diag_dder > 0., diag_dder, 1.)
+        matrix_a = dder_chi_sq + damping * numpy.diag(diag_dder)
+        try:
+            delta_p = -1. * numpy.linalg.solve(matrix_a, der_chi_sq)
+        except numpy.linalg.LinAlgError:
+            delta_p = -1. * numpy.linalg.lstsq(matrix_a, der_chi_sq, rcond=None)[0]
+        param_new = param + delta_p
+        chi_sq_new = tempfunc(param_new)
+        if chi_sq_new < chi_sq:
+            flag_converged = (chi_sq - chi_sq_new) < tolerance * chi_sq
+            param = param_new
+            damping = max(damping * 0.1, 1e-12)
+            if callback is not None:
+                callback(param)
+            chi_sq, der_chi_sq, dder_chi_sq = calc_derivatives(param)
+            if flag_converged:
+                flag_success, message = True, "Relative decrease of chi_sq is below the tolerance."
+                break
+        else:
+            damping *= 10.
+            if damping > 1e12:
+                message = "Damping exceeds 1e12, chi_sq is not decreased along the gradient."
+                break
+    set_parameters(param)
+    print("Optimization is done.                          ", end="\n")
+
+    res = {"x": param, "fun": chi_sq, "jac": der_chi_sq,
+           "nit": n_iteration, "success": flag_success, "message": message}
+    # hess_inv is not given for a singular Hessian, errors are estimated numerically then
+    try:
+        res["hess_inv"] = numpy.linalg.inv(dder_chi_sq)
+    except numpy.linalg.LinAlgError:
+        pass
+
+    print("Calculations for optimal parameters... ", end="\r")
+    if not(flag_warm_start):
+        dict_in_out = {}
+    chi_sq, n_point = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out,
+        flag_use_precalculated_data=flag_warm_start, flag_calc_analytical_derivatives=False)[:2]
+    print(f"Optimal chi_sq per n is {chi_sq/n_point:.2f}", end="\n")
+
+    return chi_sq, parameter_names, dict_in_out, res
+
+
+def rhochi_least_squares_by_dictionary(
+        global_dict: dict, method: str = "trf", dict_in_out: dict = None, callback: Callable = None):
+    """Refinement by scipy.optimize.least_squares on the vector of weighted residuals.
+
+    dict_in_out of a previous calculation can be given for a warm start.
+    callback is called with parameters after each calculation of residuals.
+    """
+    print("*********************************************")
+    print("Rietveld refinement by CrysPy (module RhoChi)")
+    print("*********************************************\n")
+    print(f"Least squares on weighted residuals (method '{method:}').")
+    flag_warm_start = dict_in_out is not None
+    if not(flag_warm_start):
+        dict_in_out = {}
+    chi_sq, n_point, parameter_names, dict_free, param_0 = start_refinement_by_dictionary(
+        global_dict, dict_in_out, flag_use_precalculated_data=flag_warm_start)
+    if param_0.size == 0:
+        return chi_sq, parameter_names, dict_in_out, {}
+    parameter_map = dict_free["parameter_map"]
+
+    def tempfunc(l_param):
+        set_parameters_by_map(global_dict, parameter_map, l_param)
+
+        residual = rhochi_calc_residual_by_dictionary(
+            global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True)
+        if callback is not None:
+            callback(l_param)
+        return residual
+
+    print("\nMinimization procedure of chi_sq is running... ", end="\r")
+    res = scipy.optimize.least_squares(tempfunc, param_0, method=method, x_scale="jac")
+    tempfunc(res.x)
+    print("Optimization is done.                          ", end="\n")
+    # chi_sq = residual.residual, its Hessian is 2 J^T J
+    res["hess_inv"] = numpy.linalg.pinv(2.*numpy.matmul(res.jac.transpose(), res.jac))
+
+    print("Calculations for optimal parameters... ", end="\r")
+    if not(flag_warm_start):
+        dict_in_out = {}
+    chi_sq, n_point = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out,
+        flag_use_precalculated_data=flag_warm_start, flag_calc_analytical_derivatives=False)[:2]
+    print(f"Optimal chi_sq per n is {chi_sq/n_point:.2f}", end="\n")
+
+    return chi_sq, parameter_names, dict_in_out, res
+
+
+def carry_parameters_by_dictionary(global_dict_from: dict, global_dict_to: dict, parameter_names):
+    """Copy values of parameters from one global_dict into another one.
+
+    Only parameters refined in global_dict_to (by its flags) are changed.
+    """
+    for way in parameter_names:
+        if not((way[0] in global_dict_to.keys()) and (way[0] in global_dict_from.keys())):
+            continue
+        dict_to, dict_from = global_dict_to[way[0]], global_dict_from[way[0]]
+        flags_name = f"flags_{way[1]:}"
+        if not((way[1] in dict_to.keys()) and (way[1] in dict_from.keys()) and (flags_name in dict_to.keys())):
+            continue
+        if ((numpy.shape(dict_to[way[1]]) == numpy.shape(dict_from[way[1]])) and
+                (numpy.shape(dict_to[flags_name]) == numpy.shape(dict_to[way[1]])) and
+                dict_to[flags_name][way[2]]):
+            dict_to[way[1]][way[2]] = dict_from[way[1]][way[2]]
+
+
+def rhochi_sequential_refinement_by_dictionary(
+        l_global_dict, l_label=None, method: str = "BFGS", flag_carry_parameters: bool = True,
+        flag_warm_start: bool = True):
+    """Sequential refinement of a series of datasets (temperature, field, ...).
+
+    Datasets are refined one by one. Converged parameters of a dataset are
+    starting values for the next one (flag_carry_parameters) and its
+    dict_in_out is used for the next refinement (flag_warm_start), so
+    intermediate results with unchanged inputs (hkl, symmetry, pr_2, ...)
+    are not recalculated.
+
+    method is a method of scipy.optimize.minimize, "LM" or "least_squares".
+
+    Output is a dictionary with keys "label", "chi_sq", "n_point", "time"
+    (per dataset), "parameter_name" (refined parameters of all datasets)
+    and "parameter_value", "parameter_sigma" ([dataset, parameter], nan
+    if parameter is not refined for the dataset).
+
+    parameter_sigma are given by res["hess_inv"] of the optimizer: for
+    BFGS it is the approximation accumulated during the minimization and
+    it can differ from the covariance matrix noticeably, for LM and
+    least_squares it is the Gauss-Newton one. The errors of a dataset can
+    be estimated by rhochi_inversed_hessian (numerical derivatives).
+    """
+    if l_label is None:
+        l_label = [f"{ind+1:}" for ind in range(len(l_global_dict))]
+    l_chi_sq, l_n_point, l_time, l_dict_value, l_dict_sigma = [], [], [], [], []
+    dict_in_out = None
+    global_dict_previous, parameter_names_previous = None, ()
+    for label, global_dict in zip(l_label, l_global_dict):
+        time_start = time.perf_counter()
+        if flag_carry_parameters and (global_dict_previous is not None):
+            carry_parameters_by_dictionary(global_dict_previous, global_dict, parameter_names_previous)
+        if not(flag_warm_start):
+            dict_in_out = None
+
+        if method == "LM":
+            chi_sq, parameter_names, dict_in_out, res = rhochi_lm_refinement_by_dictionary(
+                global_dict, dict_in_out=dict_in_out)
+        elif method == "least_squares":
+            chi_sq, parameter_names, dict_in_out, res = rhochi_least_squares_by_dictionary(
+                global_dict, dict_in_out=dict_in_out)
+        else:
+            chi_sq, parameter_names, dict_in_out, res = rhochi_rietveld_refinement_by_dictionary(
+                global_dict, method=method, dict_in_out=dict_in_out)
+        n_point = rhochi_calc_chi_sq_by_dictionary(
+            global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True)[1]
+
+        parameter_map = form_parameter_map(global_dict, parameter_names)
+        dict_value = dict(zip(parameter_names, get_parameters_by_map(global_dict, parameter_map)))
+        dict_sigma = {}
+        if "hess_inv" in res.keys():
+            hess_inv = calc_hess_inv_of_parameters_by_dictionary(global_dict, parameter_names, res["hess_inv"])
+            if hess_inv is not None:
+                dict_sigma = dict(zip(parameter_names, numpy.sqrt(numpy.abs(numpy.diag(hess_inv)))))
+
+        l_chi_sq.append(chi_sq)
+        l_n_point.append(n_point)
+        l_time.append(time.perf_counter() - time_start)
+        l_dict_value.append(dict_value)
+        l_dict_sigma.append(dict_sigma)
+        global_dict_previous, parameter_names_previous = global_dict, parameter_names
+
+    parameter_name = list(dict.fromkeys([way for dict_value in l_dict_value for way in dict_value.keys()]))
+    parameter_value = numpy.array([
+        [dict_value.get(way, numpy.nan) for way in parameter_name] for dict_value in l_dict_value],
+        dtype=float).reshape(len(l_dict_value), len(parameter_name))
+    parameter_sigma = numpy.array([
+        [dict_sigma.get(way, numpy.nan) for way in parameter_name] for dict_sigma in l_dict_sigma],
+        dtype=float).reshape(len(l_dict_sigma), len(parameter_name))
+    dict_out = {
+        "label": list(l_label), "chi_sq": numpy.array(l_chi_sq, dtype=float),
+        "n_point": numpy.array(l_n_point, dtype=int), "time": numpy.array(l_time, dtype=float),
+        "parameter_name": parameter_name, "parameter_value": parameter_value,
+        "parameter_sigma": parameter_sigma}
+    return dict_out
+
+
+def form_sequential_results_table(dict_results: dict) -> str:
+    """Form text table of results of sequential refinement.
+
+    One line per dataset: label, chi_sq, n_point, chi_sq/n_point, time of
+    refinement in seconds, values and sigmas of refined parameters.
+    """
+    l_column = ["label", "chi_sq", "n_point", "chi_sq_per_n", "time"]
+    for way in dict_results["parameter_name"]:
+        name = f"{way[0]:}.{way[1]:}{str(way[2]).replace(' ', ''):}"
+        l_column.extend([name, f"{name:}_sigma"])
+    l_row = []
+    for ind, label in enumerate(dict_results["label"]):
+        chi_sq, n_point = dict_results["chi_sq"][ind], dict_results["n_point"][ind]
+        row = [str(label), f"{chi_sq:.5f}", f"{n_point:}", f"{chi_sq/max(n_point, 1):.5f}",
+               f"{dict_results['time'][ind]:.3f}"]
+        for value, sigma in zip(dict_results["parameter_value"][ind], dict_results["parameter_sigma"][ind]):
+            row.extend([f"{value:.8g}", f"{sigma:.3g}"])
+        l_row.append(row)
+    l_width = [max([len(column)] + [len(row[ind]) for row in l_row]) for ind, column in enumerate(l_column)]
+    ls_out = ["# " + " ".join([f"{column:>{width:}}" for column, width in zip(l_column, l_width)])]
+    for row in l_row:
+        ls_out.append("  " + " ".join([f"{item:>{width:}}" for item, width in zip(row, l_width)]))
+    return "\n".join(ls_out) + "\n"
+
+
+def init_batch_worker(l_global_dict):
+    DICT_WORKER["l_global_dict"] = l_global_dict
+
+
+def calc_batch_job_in_worker(ind_global_dict: int, param_0, method: str = "BFGS", timeout: float = None) -> dict:
+    """Run one refinement job of the batch in the worker.
+
+    The job starts from a copy of the original global_dict, so its result
+    does not depend on previous jobs of the worker. timeout (in seconds) is
+    checked between iterations of the optimizer: the refinement is stopped
+    at the first iteration after timeout and the last iteration is taken,
+    a running iteration is not interrupted.
+    """
+    time_start = time.perf_counter()
+    global_dict = copy.deepcopy(DICT_WORKER["l_global_dict"][ind_global_dict])
+    dict_in_out = {}
+    parameter_names = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True)[4]
+    dict_free = form_free_parameters_by_dictionary(global_dict, parameter_names)
+    parameter_names_free, parameter_map = dict_free["parameter_name"], dict_free["parameter_map"]
+    if param_0 is None:
+        param_0 = get_parameters_by_map(global_dict, parameter_map)
+    param_0 = numpy.array(param_0, dtype=float)
+    if param_0.size != len(parameter_names_free):
+        raise AttributeError(
+            f"Starting vector has {param_0.size:} elements, {len(parameter_names_free):} are expected")
+    set_parameters_by_map(global_dict, parameter_map, param_0)
+
+    dict_last = {"param": param_0}
+    def callback(l_param, *arg):
+        dict_last["param"] = numpy.array(l_param, dtype=float)
+        if (timeout is not None) and ((time.perf_counter() - time_start) > timeout):
+            raise TimeoutError
+
+    status, message = "success", ""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if method == "LM":
+                res = rhochi_lm_refinement_by_dictionary(
+                    global_dict, callback=callback, dict_in_out=dict_in_out)[3]
+            elif method == "least_squares":
+                res = rhochi_least_squares_by_dictionary(
+                    global_dict, callback=callback, dict_in_out=dict_in_out)[3]
+            else:
+                res = rhochi_rietveld_refinement_by_dictionary(
+                    global_dict, method=method, callback=callback, dict_in_out=dict_in_out)[3]
+        if not(res.get("success", True)):
+            status = "failed"
+    except TimeoutError:
+        status = "timeout"
+        set_parameters_by_map(global_dict, parameter_map, dict_last["param"])
+    except Exception as error:
+        status, message = "error", str(error)
+        set_parameters_by_map(global_dict, parameter_map, dict_last["param"])
+
+    chi_sq, n_point = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True)[:2]
+    if not(numpy.isfinite(chi_sq)):
+        chi_sq = numpy.inf
+    dict_out = {
+        "chi_sq": chi_sq, "n_point": n_point, "method": method, "status": status, "message": message,
+        "parameter_name": parameter_names_free,
+        "parameter_value": get_parameters_by_map(global_dict, parameter_map),
+        "time": time.perf_counter() - time_start}
+    return dict_out
+
+
+def rhochi_batch_refinement_by_dictionary(
+        l_job, n_processes: int = 1, timeout: float = None) -> list:
+    """Run a batch of refinements (multi-start) on a pool of processes.
+
+    l_job is a list of (global_dict, starting vector, method). The starting
+    vector gives refined parameters in the order of
+    rhochi_calc_chi_sq_by_dictionary (parameters calculated by linear
+    constraints are excluded), None keeps the values of global_dict.
+    method is a method of scipy.optimize.minimize, "LM" or "least_squares".
+
+    Each distinct global_dict is sent to the workers once, jobs give only
+    its index, the starting vector and the method. Each job starts from the
+    original global_dict. Refinement of a job is stopped at the first
+    iteration after timeout (in seconds), see calc_batch_job_in_worker.
+
+    Output is a list of dictionaries (job, chi_sq, n_point, status, refined
+    parameters, ...) ranked by chi_sq. Given global_dicts are not changed.
+    """
+    l_global_dict, l_job_short = [], []
+    for global_dict, param_0, method in l_job:
+        l_id = [id(hh) for hh in l_global_dict]
+        if id(global_dict) in l_id:
+            ind_global_dict = l_id.index(id(global_dict))
+        else:
+            ind_global_dict = len(l_global_dict)
+            l_global_dict.append(global_dict)
+        l_job_short.append((ind_global_dict, param_0, method, timeout))
+
+    if n_processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_processes, initializer=init_batch_worker,
+                initargs=(l_global_dict, )) as executor:
+            l_future = [executor.submit(calc_batch_job_in_worker, *job) for job in l_job_short]
+            l_result = [future.result() for future in l_future]
+    else:
+        dict_worker_saved = dict(DICT_WORKER)
+        init_batch_worker(l_global_dict)
+        l_result = [calc_batch_job_in_worker(*job) for job in l_job_short]
+        DICT_WORKER.clear()
+        DICT_WORKER.update(dict_worker_saved)
+
+    for ind_job, dict_result in enumerate(l_result):
+        dict_result["job"] = ind_job
+    return sorted(l_result, key=lambda dict_result: dict_result["chi_sq"])
+
+
 def func_callback(*arg):
     print(arg)
 
@@ -225,20 +763,38 @@ def rhochi_lsq_by_dictionary(global_dict):
             parameter_name_sum = parameter_name_sum_2
             dict_in_out = dict_in_out_2
         else:
-            for way, d_p in zip(parameter_name_sum_2, delta_p_2):
-                global_dict[way[0]][way[1]][way[2]] -= d_p
-            for way, d_p in zip(parameter_name_sum, delta_p):
-                global_dict[way[0]][way[1]][way[2]] -= d_p
+            parameter_map_2 = dict_in_out_2["parameter_map"]
+            set_parameters_by_map(
+                global_dict, parameter_map_2, get_parameters_by_map(global_dict, parameter_map_2) - delta_p_2)
+            parameter_map = form_parameter_map(global_dict, parameter_name_sum)
+            set_parameters_by_map(
+                global_dict, parameter_map, get_parameters_by_map(global_dict, parameter_map) - delta_p)
             flag = False
     return chi_sq_sum, n_point, delta_p, parameter_name_sum, der_chi_sq_sum, dder_chi_sq_sum, dict_in_out
 
 
+@profiled_stage
 def rhochi_calc_chi_sq_by_dictionary(
         global_dict, dict_in_out:dict=None, flag_use_precalculated_data: bool=False,
-        flag_calc_analytical_derivatives: bool = False):
+        flag_calc_analytical_derivatives: bool = False,
+        executor: concurrent.futures.Executor = None):
     """Calculate chi_sq.
+
+    Experiments are independent, they can be calculated concurrently by
+    executor (thread based, as dict_in_out is filled in place). The results
+    are collected in the order of experiments, so the output is the same.
+
+    Structure factors of a crystal are calculated once for the reflections
+    of all experiments, they are kept in dict_in_out["reflection_store"].
     """
     dict_in_out_keys = dict_in_out.keys()
+    if "reflection_store" in dict_in_out_keys:
+        dict_reflection_store = dict_in_out["reflection_store"]
+        if not(flag_use_precalculated_data):
+            reset_reflection_store(dict_reflection_store)
+    else:
+        dict_reflection_store = {}
+        dict_in_out["reflection_store"] = dict_reflection_store
     dict_keys = global_dict.keys()
     l_dict_crystal, l_dict_magcrystal = [], []
     l_dict_diffrn = []
@@ -262,6 +818,7 @@ def rhochi_calc_chi_sq_by_dictionary(
     l_parameter_name, parameter_name_full = [], []
     dder = {}
     l_experiments, l_diff_chi = [], []
+    l_task = []
     for name_key_diffrn, dict_diffrn in l_dict_diffrn:
         if flag_use_precalculated_data and (name_key_diffrn in dict_in_out_keys):
             dict_in_out_diffrn = dict_in_out[name_key_diffrn]
@@ -284,17 +841,7 @@ def rhochi_calc_chi_sq_by_dictionary(
         else:
             raise AttributeError(f"Phase {phase_label:} is not found")
 
-        chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_name = calc_chi_sq_for_diffrn_by_dictionary(
-            dict_diffrn, dict_crystal, dict_in_out=dict_in_out_diffrn,
-            flag_use_precalculated_data=flag_use_precalculated_data,
-            flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
-        l_chi_sq.append(chi_sq)
-        l_n_point.append(n_point)
-        l_der_chi_sq.append(der_chi_sq)
-        l_dder_chi_sq.append(dder_chi_sq)
-        l_parameter_name.append(parameter_name)
-        parameter_name_full.extend(parameter_name)
-        l_experiments.append(name_key_diffrn)
+        l_task.append((name_key_diffrn, calc_chi_sq_for_diffrn_by_dictionary, dict_diffrn, dict_crystal, dict_in_out_diffrn))
 
     dict_crystals = [hh[1] for hh in l_dict_crystal]
     for name_key_exp, dict_exp in l_dict_pd + l_dict_pd2d + l_dict_tof:
@@ -305,67 +852,134 @@ def rhochi_calc_chi_sq_by_dictionary(
             dict_in_out[name_key_exp] = dict_in_out_diffrn
 
         if name_key_exp.startswith("pd_"):
-            chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_name = \
-                calc_chi_sq_for_pd_by_dictionary(
-                    dict_exp, dict_crystals,
-                    dict_in_out=dict_in_out_diffrn,
-                    flag_use_precalculated_data=flag_use_precalculated_data,
-                    flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
-            l_chi_sq.append(chi_sq)
-            l_n_point.append(n_point)
-            l_der_chi_sq.append(der_chi_sq)
-            l_dder_chi_sq.append(dder_chi_sq)
-            l_parameter_name.append(parameter_name)
-            parameter_name_full.extend(parameter_name)
-            l_experiments.append(name_key_exp)
-
+            l_task.append((name_key_exp, calc_chi_sq_for_pd_by_dictionary, dict_exp, dict_crystals, dict_in_out_diffrn))
         elif name_key_exp.startswith("tof_"):
-            chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_name = \
-                calc_chi_sq_for_tof_by_dictionary(
-                    dict_exp, dict_crystals,
-                    dict_in_out=dict_in_out_diffrn,
-                    flag_use_precalculated_data=flag_use_precalculated_data,
-                    flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
-            l_chi_sq.append(chi_sq)
-            l_n_point.append(n_point)
-            l_der_chi_sq.append(der_chi_sq)
-            l_dder_chi_sq.append(dder_chi_sq)
-            l_parameter_name.append(parameter_name)
-            parameter_name_full.extend(parameter_name)
-            l_experiments.append(name_key_exp)
-
+            l_task.append((name_key_exp, calc_chi_sq_for_tof_by_dictionary, dict_exp, dict_crystals, dict_in_out_diffrn))
         elif name_key_exp.startswith("pd2d_"):
-            chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_name = \
-                calc_chi_sq_for_pd2d_by_dictionary(
-                    dict_exp, dict_crystals,
-                    dict_in_out=dict_in_out_diffrn,
-                    flag_use_precalculated_data=flag_use_precalculated_data,
-                    flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
-
-            l_chi_sq.append(chi_sq)
-            l_n_point.append(n_point)
-            l_der_chi_sq.append(der_chi_sq)
-            l_dder_chi_sq.append(dder_chi_sq)
-            l_parameter_name.append(parameter_name)
-            parameter_name_full.extend(parameter_name)
-            l_experiments.append(name_key_exp)
-
+            l_task.append((name_key_exp, calc_chi_sq_for_pd2d_by_dictionary, dict_exp, dict_crystals, dict_in_out_diffrn))
+
+    if executor is None:
+        l_result = [
+            func(dict_exp, dict_crystal, dict_in_out=dict_in_out_exp,
+                 flag_use_precalculated_data=flag_use_precalculated_data,
+                 flag_calc_analytical_derivatives=flag_calc_analytical_derivatives,
+                 dict_reflection_store=dict_reflection_store)
+            for name_key_exp, func, dict_exp, dict_crystal, dict_in_out_exp in l_task]
+    else:
+        l_future = [
+            executor.submit(
+                func, dict_exp, dict_crystal, dict_in_out=dict_in_out_exp,
+                flag_use_precalculated_data=flag_use_precalculated_data,
+                flag_calc_analytical_derivatives=flag_calc_analytical_derivatives,
+                dict_reflection_store=dict_reflection_store)
+            for name_key_exp, func, dict_exp, dict_crystal, dict_in_out_exp in l_task]
+        l_result = [future.result() for future in l_future]
+
+    for task, result in zip(l_task, l_result):
+        chi_sq, n_point, der_chi_sq, dder_chi_sq, parameter_name = result
+        # refined parameters of the experiment (columns of its Jacobian der_residual)
+        task[4]["parameter_name"] = parameter_name
+        l_chi_sq.append(chi_sq)
+        l_n_point.append(n_point)
+        l_der_chi_sq.append(der_chi_sq)
+        l_dder_chi_sq.append(dder_chi_sq)
+        l_parameter_name.append(parameter_name)
+        parameter_name_full.extend(parameter_name)
+        l_experiments.append(task[0])
+        record_array_size(f"{task[0]:}: n_point", n_point)
 
     chi_sq_sum = sum(l_chi_sq) #Unity weighting scheme
     n_point_sum = sum(l_n_point)
 
-    parameter_name_sum = list(set(parameter_name_full))
+    # the order of the first appearance, it does not depend on hash seed
+    parameter_name_sum = list(dict.fromkeys(parameter_name_full))
+    # the map is formed once and kept while refined parameters are the same
+    if (("parameter_map" in dict_in_out_keys) and
+            (dict_in_out["parameter_map"]["parameter_names"] == tuple(parameter_name_sum))):
+        parameter_map = dict_in_out["parameter_map"]
+    else:
+        parameter_map = form_parameter_map(global_dict, parameter_name_sum)
+        dict_in_out["parameter_map"] = parameter_map
     der_chi_sq_sum = numpy.zeros((len(parameter_name_sum),), dtype=float)
     dder_chi_sq_sum = numpy.zeros((len(parameter_name_sum), len(parameter_name_sum)), dtype=float)
     if flag_calc_analytical_derivatives:
         for l_pn, dc, ddc in zip(l_parameter_name, l_der_chi_sq, l_dder_chi_sq):
-            for i_pn_1, pn_1 in enumerate(l_pn):
-                ind_1 = parameter_name_sum.index(pn_1)
-                der_chi_sq_sum[ind_1] += dc[i_pn_1]
-                dder_chi_sq_sum[ind_1, ind_1] += ddc[i_pn_1, i_pn_1]
-                if len(l_pn) > (i_pn_1+1):
-                    for i_pn_2, pn_2 in enumerate(l_pn[i_pn_1+1:]):
-                        ind_2 = parameter_name_sum.index(pn_2)
-                        dder_chi_sq_sum[ind_1, ind_2] += ddc[i_pn_1, i_pn_2+i_pn_1+1]
-                        dder_chi_sq_sum[ind_2, ind_1] += ddc[i_pn_2+i_pn_1+1, i_pn_1]
+            add_derivatives_by_map(parameter_map, der_chi_sq_sum, dder_chi_sq_sum, l_pn, dc, ddc)
     return chi_sq_sum, n_point_sum, der_chi_sq_sum, dder_chi_sq_sum, parameter_name_sum
+
+
+def rhochi_calc_residual_by_dictionary(
+        global_dict, dict_in_out: dict = None, flag_use_precalculated_data: bool = False):
+    """Calculate weighted residuals (exp - calc)/sigma of all experiments.
+
+    Residuals are concatenated in the order of diffrn, pd, pd2d and tof
+    experiments in global_dict, excluded points give zero. The sum of
+    squares is chi_sq. The punishment function is added as the last element.
+    """
+    if dict_in_out is None:
+        dict_in_out = {}
+    rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=flag_use_precalculated_data,
+        flag_calc_analytical_derivatives=False)
+    return collect_residual_by_dictionary(global_dict, dict_in_out)
+
+
+def collect_residual_by_dictionary(global_dict, dict_in_out: dict):
+    """Collect weighted residuals of experiments calculated in dict_in_out (see rhochi_calc_residual_by_dictionary)."""
+    dict_keys = global_dict.keys()
+    l_residual = []
+    for prefix in ("diffrn_", "pd_", "pd2d_", "tof_"):
+        for name_key in dict_keys:
+            if name_key.startswith(prefix):
+                l_residual.append(dict_in_out[name_key]["residual"])
+    if "punishment_function" in dict_keys:
+        l_residual.append(numpy.atleast_1d(numpy.sqrt(numpy.abs(calc_punishement_function(global_dict)))))
+    residual = numpy.concatenate(l_residual, axis=0)
+    # the same convention as for chi_sq
+    residual[numpy.logical_not(numpy.isfinite(residual))] = 1e15
+    return residual
+
+
+def rhochi_calc_residual_jacobian_by_dictionary(global_dict, parameter_names, dict_in_out: dict = None):
+    """Calculate weighted residuals and their analytical Jacobian [residual, parameter].
+
+    Residuals are the same as by rhochi_calc_residual_by_dictionary. The
+    third output flags the parameters with analytical derivatives in all
+    experiments, the columns of other parameters (and the row of the
+    punishment function) are zero and have to be calculated numerically.
+    """
+    if dict_in_out is None:
+        dict_in_out = {}
+    rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=True,
+        flag_calc_analytical_derivatives=True)
+    residual = collect_residual_by_dictionary(global_dict, dict_in_out)
+
+    dict_index = {way: ind for ind, way in enumerate(parameter_names)}
+    der_residual = numpy.zeros((residual.size, len(parameter_names)), dtype=float)
+    flags_analytical = numpy.ones((len(parameter_names), ), dtype=bool)
+    ind_start = 0
+    for prefix in ("diffrn_", "pd_", "pd2d_", "tof_"):
+        for name_key in global_dict.keys():
+            if not(name_key.startswith(prefix)):
+                continue
+            dict_in_out_exp = dict_in_out[name_key]
+            ind_end = ind_start + dict_in_out_exp["residual"].size
+            parameter_name_exp = dict_in_out_exp.get("parameter_name", [])
+            if "der_residual" in dict_in_out_exp.keys():
+                der_residual_exp = dict_in_out_exp["der_residual"]
+                flags_exp = dict_in_out_exp["flags_der_residual"]
+            else:
+                der_residual_exp = None
+                flags_exp = numpy.zeros((len(parameter_name_exp), ), dtype=bool)
+            for ind_exp, way in enumerate(parameter_name_exp):
+                if way not in dict_index.keys():
+                    continue
+                ind = dict_index[way]
+                if flags_exp[ind_exp]:
+                    der_residual[ind_start:ind_end, ind] += der_residual_exp[:, ind_exp]
+                else:
+                    flags_analytical[ind] = False
+            ind_start = ind_end
+    der_residual[:, numpy.logical_not(flags_analytical)] = 0.
+    return residual, der_residual, flags_analytical
@@ -14,9 +14,53 @@ from cryspy.A_functions_base.flip_ratio import \
     calc_intensities_by_structure_factors, calc_flip_ratio_by_iint, \
     calc_asymmetry_by_iint
 
+from cryspy.A_functions_base.reflection_store import calc_by_reflection_store
+
+from cryspy.A_functions_base.function_1_cache import get_cached_node, set_cached_node
+from cryspy.A_functions_base.function_1_profiling import profiled_stage, record_array_size
+
 na = numpy.newaxis
 
 
+def calc_dder_iint_by_atom_parameters(
+        dder_iint, dder_f_nucl, dder_sft_ccs, dder_f_m_perp, atom_para_index, n_atom: int, suffix: str = ""):
+    """Calculate derivatives of integrated intensities over refined parameters of atoms [hkl, ..., a]
+    by the derivatives of nuclear structure factor and structure factor tensor [..., hkl, a].
+
+    suffix is "" for the reflections hkl and "_2hkl" for the reflections 2hkl.
+    """
+    dder = {}
+    if f"f_nucl{suffix:}_real" in dder_iint.keys():
+        for name in ("atom_fract_xyz", "atom_occupancy", "atom_b_iso", "atom_beta"):
+            if name in dder_f_nucl.keys():
+                dder[name] = numpy.moveaxis(
+                    dder_iint[f"f_nucl{suffix:}_real"][:, na]*dder_f_nucl[name].real +
+                    dder_iint[f"f_nucl{suffix:}_imag"][:, na]*dder_f_nucl[name].imag, -2, 0)
+
+    if f"f_m_perp{suffix:}_real" in dder_iint.keys():
+        for name in ("atom_para_fract_xyz", "atom_para_occupancy", "atom_para_b_iso", "atom_para_beta",
+                "atom_para_susceptibility"):
+            if name in dder_sft_ccs.keys():
+                # dimensions [3, ..., hkl, a]
+                dder_f_m_perp_p = (
+                    numpy.einsum("ckh,k...ha->c...ha", dder_f_m_perp["sft_ccs_real"], dder_sft_ccs[name].real) +
+                    numpy.einsum("ckh,k...ha->c...ha", dder_f_m_perp["sft_ccs_imag"], dder_sft_ccs[name].imag))
+                dder_p = numpy.moveaxis(
+                    numpy.einsum("ch,c...ha->...ha", dder_iint[f"f_m_perp{suffix:}_real"], dder_f_m_perp_p.real) +
+                    numpy.einsum("ch,c...ha->...ha", dder_iint[f"f_m_perp{suffix:}_imag"], dder_f_m_perp_p.imag), -2, 0)
+                if name == "atom_para_susceptibility":
+                    dder[name] = dder_p
+                else:
+                    name_atom = name.replace("atom_para_", "atom_")
+                    dder_atom = numpy.zeros(dder_p.shape[:-1] + (n_atom, ), dtype=float)
+                    dder_atom[..., atom_para_index] = dder_p
+                    if name_atom in dder.keys():
+                        dder[name_atom] = dder[name_atom] + dder_atom
+                    else:
+                        dder[name_atom] = dder_atom
+    return dder
+
+
 
 def get_flags(obj_dict):
     obj_dict_keys = obj_dict.keys()
@@ -43,11 +87,16 @@ def get_flags(obj_dict):
     return dict_out_refinement
 
 
+@profiled_stage
 def calc_chi_sq_for_diffrn_by_dictionary(
         dict_diffrn, dict_crystal, dict_in_out: dict = None,
         flag_use_precalculated_data: bool=False,
-        flag_calc_analytical_derivatives: bool = False):
+        flag_calc_analytical_derivatives: bool = False,
+        dict_reflection_store: dict = None):
     """Calculate chi_sq for diffrn experiment.
+
+    Structure factors are taken from the store of crystal reflections shared
+    by experiments if dict_reflection_store is given (see reflection_store).
     """
     if dict_in_out is None:
         flag_dict = False
@@ -61,6 +110,7 @@ def calc_chi_sq_for_diffrn_by_dictionary(
 
     unit_cell_parameters = dict_crystal["unit_cell_parameters"]
     index_hkl = dict_diffrn["index_hkl"]
+    record_array_size(f"{dict_diffrn['type_name']:}: n_hkl", index_hkl.shape[1])
     flags_unit_cell_parameters = dict_crystal["flags_unit_cell_parameters"]
     flag_unit_cell_parameters = numpy.any(flags_unit_cell_parameters)
     flag_volume_unit_cell = flag_unit_cell_parameters
@@ -102,12 +152,12 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         index_2hkl = None
 
     flag_eq_ccs = flag_unit_cell_parameters
-    if (flag_use_precalculated_data and not(flag_eq_ccs) and ("eq_ccs" in dict_in_out_keys)):
-        eq_ccs = dict_in_out["eq_ccs"]
-    else:
+    dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+    flag_hit, eq_ccs = get_cached_node(
+        dict_in_out, "eq_ccs", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
         eq_ccs, dder_eq_ccs = calc_eq_ccs_by_unit_cell_parameters(index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-        if flag_dict:
-            dict_in_out["eq_ccs"] = eq_ccs
+        set_cached_node(dict_in_out, "eq_ccs", eq_ccs, dict_dependency)
 
     flags_extinction_radius, flags_extinction_mosaicity = False, False
     if "extinction_model" in dict_diffrn_keys:
@@ -118,22 +168,21 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         flags_extinction_mosaicity = dict_diffrn["flags_extinction_mosaicity"]
 
         flag_sthovl = flag_unit_cell_parameters
-        if (flag_use_precalculated_data and not(flag_sthovl) and ("sthovl" in dict_in_out_keys)):
-            sthovl = dict_in_out["sthovl"]
-        else:
+        dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+        flag_hit, sthovl = get_cached_node(
+            dict_in_out, "sthovl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             sthovl, dder_sthovl = calc_sthovl_by_unit_cell_parameters(index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
-            if flag_dict:
-                dict_in_out["sthovl"] = sthovl
+            set_cached_node(dict_in_out, "sthovl", sthovl, dict_dependency)
         
         flag_cos_2theta = flag_sthovl or flags_wavelength
-        if (flag_use_precalculated_data and not(flag_cos_2theta) and ("cos_2theta" in dict_in_out_keys)):
-            cos_2theta = dict_in_out["cos_2theta"]
-        else:        
+        dict_dependency = {"sthovl": sthovl, "wavelength": wavelength}
+        flag_hit, cos_2theta = get_cached_node(
+            dict_in_out, "cos_2theta", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             cos_2theta = 1.-2*numpy.square(sthovl * wavelength)
-            if flag_dict:
-                dict_in_out["cos_2theta"] = cos_2theta
+            set_cached_node(dict_in_out, "cos_2theta", cos_2theta, dict_dependency)
 
-        flag_extincton = flags_extinction_radius or flags_extinction_mosaicity or flags_wavelength
 
         def func_extinction(f_sq, flag_f_sq: bool = False):
             return calc_extinction_sphere(
@@ -148,7 +197,6 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         extinction_radius = None
         extinction_mosaicity = None
         func_extinction = None
-        flag_extincton = False
     
     if (flag_use_precalculated_data and (f"dict_in_out_hkl_{dict_crystal['name']:}" in dict_in_out_keys)):
         dict_in_out_crystal_hkl = dict_in_out[f"dict_in_out_hkl_{dict_crystal['name']:}"]
@@ -158,23 +206,32 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         dict_in_out[f"dict_in_out_hkl_{dict_crystal['name']:}"] = dict_in_out_crystal_hkl
 
     dict_in_out[f"dict_in_out_hkl_{dict_crystal['name']:}"] = dict_in_out_crystal_hkl
-    f_nucl, dder_f_nucl = calc_f_nucl_by_dictionary(dict_crystal, dict_in_out_crystal_hkl, flag_use_precalculated_data=flag_use_precalculated_data)
+    f_nucl, dder_f_nucl = calc_by_reflection_store(
+        calc_f_nucl_by_dictionary, dict_crystal, dict_in_out_crystal_hkl,
+        dict_reflection_store=dict_reflection_store, label=f"{dict_diffrn['type_name']:}_hkl",
+        flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
     flag_f_nucl = len(dder_f_nucl.keys()) > 0
 
-    sft_ccs, dder_sft_ccs = calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out_crystal_hkl, flag_use_precalculated_data=flag_use_precalculated_data)
+    sft_ccs, dder_sft_ccs = calc_by_reflection_store(
+        calc_sft_ccs_by_dictionary, dict_crystal, dict_in_out_crystal_hkl,
+        dict_reflection_store=dict_reflection_store, label=f"{dict_diffrn['type_name']:}_hkl",
+        flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
     flag_sft_ccs = len(dder_sft_ccs.keys()) > 0
 
-    flag_mag_atom_susceptibility = "mag_atom_susceptibility" in dder_sft_ccs.keys()
+    # derivatives over refined parameters of atoms (and susceptibility) are given by structure factors
+    flag_atom_derivatives = flag_calc_analytical_derivatives and (flag_f_nucl or flag_sft_ccs)
 
     flag_f_m_perp = flag_sft_ccs or flag_magnetic_field or flag_eq_ccs
     
-    if (flag_use_precalculated_data and not(flag_f_m_perp) and "f_m_perp" in dict_in_out_keys):
-        f_m_perp = dict_in_out["f_m_perp"]
-    else:
+    # the derivatives of f_m_perp are used for the parameters of atoms, so the node is recalculated
+    flag_use_f_m_perp = flag_use_precalculated_data and not(flag_atom_derivatives)
+    dict_dependency = {"sft_ccs": sft_ccs, "magnetic_field": magnetic_field, "eq_ccs": eq_ccs}
+    flag_hit, f_m_perp = get_cached_node(
+        dict_in_out, "f_m_perp", dict_dependency, flag_use_precalculated_data=flag_use_f_m_perp)
+    if not(flag_hit):
         f_m_perp, dder_f_m_perp = calc_f_m_perp_by_sft(
                 sft_ccs, magnetic_field, eq_ccs, flag_sft_ccs=flag_sft_ccs, flag_magnetic_field=flag_magnetic_field, flag_eq_ccs=flag_eq_ccs)
-        if flag_dict:
-            dict_in_out["f_m_perp"] = f_m_perp
+        set_cached_node(dict_in_out, "f_m_perp", f_m_perp, dict_dependency)
 
     if c_lambda2 is not None:
         if (flag_use_precalculated_data and (f"dict_in_out_2hkl_{dict_crystal['name']:}" in dict_in_out_keys)):
@@ -184,24 +241,30 @@ def calc_chi_sq_for_diffrn_by_dictionary(
             dict_in_out_crystal_2hkl = {"index_hkl": index_2hkl}
             dict_in_out[f"dict_in_out_2hkl_{dict_crystal['name']:}"] = dict_in_out_crystal_2hkl
 
-        f_nucl_2hkl, dder_f_nucl_2hkl = calc_f_nucl_by_dictionary(dict_crystal, dict_in_out_crystal_2hkl, flag_use_precalculated_data=flag_use_precalculated_data)
+        f_nucl_2hkl, dder_f_nucl_2hkl = calc_by_reflection_store(
+            calc_f_nucl_by_dictionary, dict_crystal, dict_in_out_crystal_2hkl,
+            dict_reflection_store=dict_reflection_store, label=f"{dict_diffrn['type_name']:}_2hkl",
+            flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
         flag_f_nucl_2hkl = len(dder_f_nucl_2hkl.keys()) > 0
         if flag_dict:
             dict_in_out["f_nucl_2hkl"] = f_nucl_2hkl
 
-        sft_ccs_2hkl, dder_sft_ccs_2hkl = calc_sft_ccs_by_dictionary(dict_crystal, dict_in_out_crystal_2hkl, flag_use_precalculated_data=flag_use_precalculated_data)
+        sft_ccs_2hkl, dder_sft_ccs_2hkl = calc_by_reflection_store(
+            calc_sft_ccs_by_dictionary, dict_crystal, dict_in_out_crystal_2hkl,
+            dict_reflection_store=dict_reflection_store, label=f"{dict_diffrn['type_name']:}_2hkl",
+            flag_use_precalculated_data=flag_use_precalculated_data, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
         flag_sft_ccs_2hkl = len(dder_sft_ccs_2hkl.keys()) > 0
         if flag_dict:
             dict_in_out["sft_ccs_2hkl"] = sft_ccs_2hkl
 
         flag_f_m_perp_2hkl = flag_sft_ccs_2hkl or flag_magnetic_field or flag_eq_ccs
-        if (flag_use_precalculated_data and not(flag_f_m_perp) and "f_m_perp_2hkl" in dict_in_out_keys):
-            f_m_perp_2hkl = dict_in_out["f_m_perp_2hkl"]
-        else:
+        dict_dependency = {"sft_ccs_2hkl": sft_ccs_2hkl, "magnetic_field": magnetic_field, "eq_ccs": eq_ccs}
+        flag_hit, f_m_perp_2hkl = get_cached_node(
+            dict_in_out, "f_m_perp_2hkl", dict_dependency, flag_use_precalculated_data=flag_use_f_m_perp)
+        if not(flag_hit):
             f_m_perp_2hkl, dder_f_m_perp_2hkl = calc_f_m_perp_by_sft(
                 sft_ccs_2hkl, magnetic_field, eq_ccs, flag_sft_ccs=flag_sft_ccs_2hkl, flag_magnetic_field=flag_magnetic_field, flag_eq_ccs=flag_eq_ccs)
-            if flag_dict:
-                dict_in_out["f_m_perp_2hkl"] = f_m_perp_2hkl
+            set_cached_node(dict_in_out, "f_m_perp_2hkl", f_m_perp_2hkl, dict_dependency)
 
     else:
         f_nucl_2hkl = None
@@ -210,14 +273,24 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         flag_f_m_perp_2hkl = False
 
 
-    flag_flip_ratio = flag_extincton or flags_beam_polarization or flags_flipper_efficiency or \
-        flag_f_nucl or flag_f_m_perp or flags_c_lambda2 or flag_f_nucl_2hkl or flag_f_m_perp_2hkl
-    if (flag_use_precalculated_data and not(flag_flip_ratio) 
-            and "iint_plus" in dict_in_out_keys and "iint_minus" in dict_in_out_keys):
-        iint_plus = dict_in_out["iint_plus"]
-        iint_minus = dict_in_out["iint_minus"]
-    else:
-        axis_z = matrix_u[6:9]
+    # the derivatives of intensities are used for the refined parameters of experiment and atoms
+    flag_iint_derivatives = (flags_beam_polarization or flags_flipper_efficiency or flags_extinction_radius or
+        flags_extinction_mosaicity or flags_c_lambda2 or flag_atom_derivatives)
+    axis_z = matrix_u[6:9]
+    dict_dependency = {"beam_polarization": beam_polarization, "flipper_efficiency": flipper_efficiency,
+        "f_nucl": f_nucl, "f_m_perp": f_m_perp, "axis_z": axis_z, "extinction_model": extinction_model,
+        "extinction_radius": extinction_radius, "extinction_mosaicity": extinction_mosaicity,
+        "volume_unit_cell": volume_unit_cell, "wavelength": wavelength, "c_lambda2": c_lambda2,
+        "f_nucl_2hkl": f_nucl_2hkl, "f_m_perp_2hkl": f_m_perp_2hkl}
+    if extinction_model != "":
+        dict_dependency["cos_2theta"] = cos_2theta
+    flag_hit_plus, iint_plus = get_cached_node(
+        dict_in_out, "iint_plus", dict_dependency,
+        flag_use_precalculated_data=flag_use_precalculated_data and not(flag_iint_derivatives))
+    flag_hit_minus, iint_minus = get_cached_node(
+        dict_in_out, "iint_minus", dict_dependency,
+        flag_use_precalculated_data=flag_use_precalculated_data and not(flag_iint_derivatives))
+    if not(flag_hit_plus and flag_hit_minus):
         iint_plus, iint_minus, dder_plus, dder_minus = calc_intensities_by_structure_factors(
             beam_polarization, flipper_efficiency, f_nucl, f_m_perp, axis_z,
             func_extinction=func_extinction,
@@ -227,9 +300,8 @@ def calc_chi_sq_for_diffrn_by_dictionary(
             flag_c_lambda2=flags_c_lambda2,
             flag_f_nucl_2hkl=flag_f_nucl_2hkl, flag_f_m_perp_2hkl=flag_f_m_perp_2hkl,
             dict_in_out=dict_in_out)
-        if flag_dict:
-            dict_in_out["iint_plus"] = iint_plus
-            dict_in_out["iint_minus"] = iint_minus
+        set_cached_node(dict_in_out, "iint_plus", iint_plus, dict_dependency)
+        set_cached_node(dict_in_out, "iint_minus", iint_minus, dict_dependency)
 
     if flag_asymmetry:
         asymmetry_e = (flip_ratio_es[0] -1.)/(flip_ratio_es[0] + 1.)
@@ -267,31 +339,32 @@ def calc_chi_sq_for_diffrn_by_dictionary(
 
     diff_exp_model = (exp_value[0, index_true]-model_exp[index_true])
     inv_sigma_sq_exp_value = 1./numpy.square(exp_value[1, index_true])
+    if flag_dict:
+        # weighted residuals (exp - model)/sigma, excluded reflections are zero
+        residual = numpy.zeros(index_true.shape, dtype=float)
+        residual[index_true] = diff_exp_model/exp_value[1, index_true]
+        dict_in_out["residual"] = residual
     
     dder_plus_crystal, dder_minus_crystal = {}, {}
-    if flag_mag_atom_susceptibility:
-        dder_f_m_perp_mas = (
-            dder_f_m_perp['sft_ccs_real'][:,:, na, :, na]*dder_sft_ccs["mag_atom_susceptibility"].real[na, :, :, : , :]+
-            dder_f_m_perp['sft_ccs_imag'][:,:, na, :, na]*dder_sft_ccs["mag_atom_susceptibility"].imag[na, :, :, : , :]).sum(axis=1)
-        dder_plus_mas = (
-            dder_plus["f_m_perp_real"][:, na, :, na] * dder_f_m_perp_mas.real + 
-            dder_plus["f_m_perp_imag"][:, na, :, na] * dder_f_m_perp_mas.imag).sum(axis=0)
-        dder_minus_mas = (
-            dder_minus["f_m_perp_real"][:, na, :, na] * dder_f_m_perp_mas.real + 
-            dder_minus["f_m_perp_imag"][:, na, :, na] * dder_f_m_perp_mas.imag).sum(axis=0)
+    if flag_atom_derivatives:
+        atom_para_index = dict_crystal.get("atom_para_index", None)
+        n_atom = dict_crystal["atom_fract_xyz"].shape[-1]
+        dder_plus_crystal = calc_dder_iint_by_atom_parameters(
+            dder_plus, dder_f_nucl, dder_sft_ccs, dder_f_m_perp, atom_para_index, n_atom)
+        dder_minus_crystal = calc_dder_iint_by_atom_parameters(
+            dder_minus, dder_f_nucl, dder_sft_ccs, dder_f_m_perp, atom_para_index, n_atom)
         if c_lambda2 is not None:
-            dder_f_m_perp_mas_2hkl = (
-                dder_f_m_perp_2hkl['sft_ccs_real'][:,:, na, :, na]*dder_sft_ccs_2hkl["mag_atom_susceptibility"].real[na, :, :, : , :]+
-                dder_f_m_perp_2hkl['sft_ccs_imag'][:,:, na, :, na]*dder_sft_ccs_2hkl["mag_atom_susceptibility"].imag[na, :, :, : , :]).sum(axis=1)
-            dder_plus_mas += (
-            dder_plus["f_m_perp_2hkl_real"][:, na, :, na] * dder_f_m_perp_mas_2hkl.real + 
-            dder_plus["f_m_perp_2hkl_imag"][:, na, :, na] * dder_f_m_perp_mas_2hkl.imag).sum(axis=0)
-            dder_minus_mas += (
-            dder_minus["f_m_perp_2hkl_real"][:, na, :, na] * dder_f_m_perp_mas_2hkl.real + 
-            dder_minus["f_m_perp_2hkl_imag"][:, na, :, na] * dder_f_m_perp_mas_2hkl.imag).sum(axis=0)
-        dder_plus_crystal["mag_atom_susceptibility"] = numpy.swapaxes(dder_plus_mas, 0, 1)
-        dder_minus_crystal["mag_atom_susceptibility"] = numpy.swapaxes(dder_minus_mas, 0, 1)
-        
+            dder_plus_2hkl = calc_dder_iint_by_atom_parameters(
+                dder_plus, dder_f_nucl_2hkl, dder_sft_ccs_2hkl, dder_f_m_perp_2hkl, atom_para_index, n_atom,
+                suffix="_2hkl")
+            dder_minus_2hkl = calc_dder_iint_by_atom_parameters(
+                dder_minus, dder_f_nucl_2hkl, dder_sft_ccs_2hkl, dder_f_m_perp_2hkl, atom_para_index, n_atom,
+                suffix="_2hkl")
+            for name, value in dder_plus_2hkl.items():
+                dder_plus_crystal[name] = dder_plus_crystal[name] + value
+            for name, value in dder_minus_2hkl.items():
+                dder_minus_crystal[name] = dder_minus_crystal[name] + value
+
     dder_plus_diffrn, dder_minus_diffrn = {}, {}
     if flags_beam_polarization:
         dder_plus_diffrn["beam_polarization"] = dder_plus["beam_polarization"][:, na]
@@ -312,9 +385,9 @@ def calc_chi_sq_for_diffrn_by_dictionary(
     dder_minus_diffrn_keys = dder_minus_diffrn.keys()
     dder_plus_crystal_keys = dder_plus_crystal.keys()
     dder_minus_crystal_keys = dder_minus_crystal.keys()
-    l_dder_plus_p = []
-    l_dder_minus_p = []
+    l_der_model_p = []
     l_parameter_name = []
+    l_flag_analytical = []
     der_chi_sq, dder_chi_sq = numpy.array([], dtype=float), numpy.array([[]], dtype=float)
     if True: # len(dder_plus_diffrn_keys) + len(dder_minus_diffrn_keys) + len(dder_plus_crystal_keys) + len(dder_minus_crystal_keys) > 0
         # Cacluation first and second derivatives over refinement parameters
@@ -323,68 +396,61 @@ def calc_chi_sq_for_diffrn_by_dictionary(
         flags_diffrn = get_flags(dict_diffrn) 
         flags_crystal = get_flags(dict_crystal) 
 
+        def calc_der_model_p(dder_plus_p, dder_minus_p):
+            return (der_model_int_plus[:, na]*dder_plus_p + der_model_int_minus[:, na]*dder_minus_p)[index_true]
+
         for way, flags in flags_diffrn.items():
             ind_1d = numpy.atleast_1d(numpy.argwhere(flags)) #.flatten()
             name = way[0]
             if ((name in dder_plus_diffrn_keys) and (name in dder_minus_diffrn_keys)):
-                dder_plus_p = dder_plus_diffrn[name][:, flags] # numpy.take(dder_plus_diffrn[name], ind_1d, axis=1)
-                dder_minus_p = dder_minus_diffrn[name][:, flags]
+                der_model_p = calc_der_model_p(dder_plus_diffrn[name][:, flags], dder_minus_diffrn[name][:, flags])
             elif name in dder_plus_diffrn_keys:
                 dder_plus_p = dder_plus_diffrn[name][:, flags]
-                dder_minus_p = numpy.zeros_like(dder_plus_p)
+                der_model_p = calc_der_model_p(dder_plus_p, numpy.zeros_like(dder_plus_p))
             elif name in dder_minus_diffrn_keys:
                 dder_minus_p = dder_minus_diffrn[name][:, flags]
-                dder_plus_p = numpy.zeros_like(dder_minus_p)
-            elif name == "phase_scale":#FIXME
-                dder_plus_p = numpy.zeros(shape=(index_true.size, 1), dtype=float)
-                dder_minus_p = numpy.zeros(shape=(index_true.size, 1), dtype=float)
+                der_model_p = calc_der_model_p(numpy.zeros_like(dder_minus_p), dder_minus_p)
+            elif name == "phase_scale":
+                # model is linear over the phase scale
+                der_model_p = (iint_plus + iint_minus)[index_true, na]
             else:
                 raise AttributeError("It should not be like this.")
             parameter_name = [(diffrn_type_name, ) + way + (tuple(ind_1d[ind,:]), ) for ind in range(ind_1d.shape[0])]
-            l_dder_plus_p.append(dder_plus_p)
-            l_dder_minus_p.append(dder_minus_p)
+            l_der_model_p.append(der_model_p)
             l_parameter_name.extend(parameter_name)
+            l_flag_analytical.extend([True for hh in parameter_name])
 
         for way, flags in flags_crystal.items():
-            flag_der_hh = True
             ind_1d = numpy.atleast_1d(numpy.argwhere(flags)) #.flatten()
             name = way[0]
             if ((name in dder_plus_crystal_keys) and (name in dder_minus_crystal_keys)):
-                dder_plus_p = dder_plus_crystal[name][:, flags]
-                dder_minus_p = dder_minus_crystal[name][:, flags]
+                der_model_p = calc_der_model_p(dder_plus_crystal[name][:, flags], dder_minus_crystal[name][:, flags])
             elif name in dder_plus_crystal_keys:
                 dder_plus_p = dder_plus_crystal[name][:, flags]
-                dder_minus_p = numpy.zeros_like(dder_plus_p)
+                der_model_p = calc_der_model_p(dder_plus_p, numpy.zeros_like(dder_plus_p))
             elif name in dder_minus_crystal_keys:
                 dder_minus_p = dder_minus_crystal[name][:, flags]
-                dder_plus_p = numpy.zeros_like(dder_minus_p)
+                der_model_p = calc_der_model_p(numpy.zeros_like(dder_minus_p), dder_minus_p)
             else:
-                flag_der_hh = False # raise AttributeError("It should not be like this.")
+                # analytical derivatives are not available
+                der_model_p = numpy.zeros((n_hkl, ind_1d.shape[0]), dtype=float)
+            flag_analytical = ((name in dder_plus_crystal_keys) or (name in dder_minus_crystal_keys))
 
             parameter_name = [(crystal_type_name, ) + way + (tuple(ind_1d[ind,:]), ) for ind in range(ind_1d.shape[0])]
+            l_der_model_p.append(der_model_p)
             l_parameter_name.extend(parameter_name)
-            if flag_der_hh:
-                l_dder_plus_p.append(dder_plus_p)
-                l_dder_minus_p.append(dder_minus_p)
-
-        if len(l_dder_plus_p) > 0:
-            dder_plus_p = numpy.concatenate(l_dder_plus_p, axis=1)
-            dder_minus_p = numpy.concatenate(l_dder_minus_p, axis=1)
+            l_flag_analytical.extend([flag_analytical for hh in parameter_name])
 
-            der_model_p = der_model_int_plus[:, na]*dder_plus_p + der_model_int_minus[:, na]*dder_minus_p
+        if len(l_der_model_p) > 0:
+            der_model_p = numpy.concatenate(l_der_model_p, axis=1)
             der_chi_sq = -2.* (diff_exp_model[:, na] * inv_sigma_sq_exp_value[:, na] * der_model_p).sum(axis=0)
-            dder_chi_sq = 2.* (inv_sigma_sq_exp_value[:, na, na]*(der_model_p[:, na, :]*der_model_p[:, :, na])).sum(axis=0) #w_diff is equal to zero
-
-            # iint_minus_sq = numpy.square(iint_minus)
-            # der_fr_p = (iint_minus[:, na] * dder_plus_p - iint_plus[:, na] * dder_minus_p) / iint_minus_sq[:, na]
-            
-            # dder_fr_p = (2*iint_minus[:, na, na] * dder_minus_p[:, :, na] * dder_minus_p[:, na, :] - 
-            #    iint_minus_sq[:, na, na] * dder_plus_p[:, :, na] * dder_minus_p[:, na, :] - 
-            #    dder_minus_p[:, :, na] * dder_plus_p[:, na, :]) / numpy.square(iint_minus_sq)[:, na, na]
-    
-            # der_chi_sq = -2.* (diff_exp_model[:, na] * inv_sigma_sq_exp_value[:, na] * der_fr_p).sum(axis=0)
-            # dder_chi_sq = 2.* (inv_sigma_sq_exp_value[:, na, na]*(der_fr_p[:, na, :]*der_fr_p[:, :, na] - 
-            #     0*diff_exp_model[:, na, na]*dder_fr_p)).sum(axis=0) #w_diff is equal to zero
+            dder_chi_sq = 2.* numpy.matmul(der_model_p.transpose(), inv_sigma_sq_exp_value[:, na] * der_model_p) #w_diff is equal to zero
+            if flag_dict and flag_calc_analytical_derivatives:
+                # Jacobian of weighted residuals [hkl, parameter], excluded reflections are zero
+                der_residual = numpy.zeros((index_true.size, der_model_p.shape[1]), dtype=float)
+                der_residual[index_true] = -der_model_p/exp_value[1, index_true][:, na]
+                dict_in_out["der_residual"] = der_residual
+                dict_in_out["flags_der_residual"] = numpy.array(l_flag_analytical, dtype=bool)
 
     return chi_sq, n_hkl, der_chi_sq, dder_chi_sq, l_parameter_name
     
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""Compiled layout of refined parameters in global_dict.
+
+The parameter map is formed once per refinement. It gives stable indexes
+of parameters and keeps, for each array of global_dict, flat indexes of
+refined elements, so parameters are put into (taken from) global_dict by
+one numpy operation per array. Derivatives of experiments are summed into
+the full gradient and Hessian by vectorized scatter-add.
+
+Functions
+---------
+    - form_parameter_map
+    - get_parameters_by_map
+    - set_parameters_by_map
+    - get_indexes_by_map
+    - add_derivatives_by_map
+    - form_constraint_matrix
+"""
+import numpy
+
+na = numpy.newaxis
+
+
+def form_parameter_map(global_dict: dict, parameter_names, linear_constraints=()) -> dict:
+    """Form the map of refined parameters.
+
+    parameter_names are (block_key, name, index) as they are given by
+    rhochi_calc_chi_sq_by_dictionary. Linear constraints on one parameter
+    (see set_parameters_by_dictionary) give parameters calculated from
+    refined ones, they are put into global_dict together with them.
+    """
+    parameter_names = tuple(parameter_names)
+    dict_index = {way: ind for ind, way in enumerate(parameter_names)}
+    if len(dict_index) != len(parameter_names):
+        raise AttributeError("Names of refined parameters are not unique")
+
+    constraint_names, constraint_index, constraint_coefficient = [], [], []
+    for linear_constraint in linear_constraints:
+        first_name = linear_constraint[0][1]
+        second_name = linear_constraint[1][1]
+        constraint_names.append(second_name)
+        constraint_index.append(dict_index[first_name])
+        constraint_coefficient.append(-linear_constraint[1][0]/linear_constraint[0][0])
+
+    dict_block = {}
+    for position, way in enumerate(parameter_names + tuple(constraint_names)):
+        block_key = (way[0], way[1])
+        if block_key not in dict_block.keys():
+            dict_block[block_key] = ([], [])
+        shape = numpy.shape(global_dict[way[0]][way[1]])
+        dict_block[block_key][0].append(numpy.ravel_multi_index(way[2], shape))
+        dict_block[block_key][1].append(position)
+
+    blocks = tuple([
+        (block_key[0], block_key[1], numpy.array(flat_index, dtype=int), numpy.array(position, dtype=int))
+        for block_key, (flat_index, position) in dict_block.items()])
+
+    parameter_map = {
+        "parameter_names": parameter_names,
+        "index": dict_index,
+        "blocks": blocks,
+        "constraint_index": numpy.array(constraint_index, dtype=int),
+        "constraint_coefficient": numpy.array(constraint_coefficient, dtype=float)}
+    return parameter_map
+
+
+def get_parameters_by_map(global_dict: dict, parameter_map: dict):
+    """Take values of refined parameters from global_dict (gather)."""
+    n_parameter = len(parameter_map["parameter_names"])
+    n_full = n_parameter + parameter_map["constraint_index"].size
+    l_param = numpy.zeros((n_full,), dtype=float)
+    for way_0, way_1, flat_index, position in parameter_map["blocks"]:
+        l_param[position] = numpy.ravel(global_dict[way_0][way_1])[flat_index]
+    return l_param[:n_parameter]
+
+
+def set_parameters_by_map(global_dict: dict, parameter_map: dict, l_param):
+    """Put refined parameters into global_dict (scatter).
+
+    Constrained parameters are recalculated.
+    """
+    l_param = numpy.asarray(l_param, dtype=float)
+    l_param_full = numpy.concatenate([
+        l_param, parameter_map["constraint_coefficient"] * l_param[parameter_map["constraint_index"]]], axis=0)
+    for way_0, way_1, flat_index, position in parameter_map["blocks"]:
+        global_dict[way_0][way_1].flat[flat_index] = l_param_full[position]
+
+
+def get_indexes_by_map(parameter_map: dict, parameter_names):
+    """Give indexes of parameters in the map."""
+    dict_index = parameter_map["index"]
+    return numpy.array([dict_index[way] for way in parameter_names], dtype=int)
+
+
+def add_derivatives_by_map(
+        parameter_map: dict, der_sum, dder_sum, parameter_names, der, dder):
+    """Add the gradient and the Hessian of one experiment to the full ones (scatter-add).
+
+    der_sum and dder_sum are changed in place.
+    """
+    ind = get_indexes_by_map(parameter_map, parameter_names)
+    numpy.add.at(der_sum, ind, der)
+    numpy.add.at(dder_sum, (ind[:, na], ind[na, :]), dder)
+
+
+def form_constraint_matrix(parameter_names, parameter_names_free, linear_constraints=()):
+    """Form the matrix T [parameter, free parameter] of linear constraints.
+
+    Full parameters are T * free parameters, the inversed Hessian matrix
+    of free parameters is transformed as T * hess_inv * T^T.
+    """
+    dict_index = {way: ind for ind, way in enumerate(parameter_names)}
+    dict_index_free = {way: ind for ind, way in enumerate(parameter_names_free)}
+    matrix_t = numpy.zeros((len(parameter_names), len(parameter_names_free)), dtype=float)
+    matrix_t[[dict_index[way] for way in parameter_names_free], numpy.arange(len(parameter_names_free))] = 1.
+    for linear_constraint in linear_constraints:
+        first_name = linear_constraint[0][1]
+        second_name = linear_constraint[1][1]
+        coeff = -linear_constraint[1][0]/linear_constraint[0][0]
+        if second_name in dict_index.keys():
+            matrix_t[dict_index[second_name], dict_index_free[first_name]] = coeff
+    return matrix_t
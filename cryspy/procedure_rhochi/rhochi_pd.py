@@ -1,6 +1,7 @@
 import numpy
 import scipy
 import scipy.interpolate
+import scipy.sparse
 
 from cryspy.A_functions_base.matrix_operations import calc_m1_m2_m1t, calc_m_v
 
@@ -11,7 +12,7 @@ from cryspy.A_functions_base.structure_factor import \
     calc_f_nucl_by_dictionary, \
     calc_f_charge_by_dictionary, \
     calc_sft_ccs_by_dictionary, \
-    calc_index_hkl_multiplicity_in_range, \
+    calc_index_hkl_multiplicity_by_superset, \
     calc_f_m_perp_ordered_by_dictionary
 
 from cryspy.A_functions_base.integrated_intensity_powder_diffraction import \
@@ -20,51 +21,73 @@ from cryspy.A_functions_base.integrated_intensity_powder_diffraction import \
 from cryspy.A_functions_base.preferred_orientation import calc_preferred_orientation_pd
 
 from cryspy.A_functions_base.powder_diffraction_const_wavelength import \
-    calc_profile_pseudo_voight, calc_lorentz_factor
+    calc_profile_pseudo_voight, calc_profile_pseudo_voight_sparse, calc_lorentz_factor, get_sparse_profile, \
+    calc_signal_plus_minus_by_profile
 
-from .rhochi_diffrn import get_flags
+from cryspy.A_functions_base.reflection_store import calc_by_reflection_store
+
+from cryspy.A_functions_base.function_1_cache import get_cached_node, set_cached_node, calc_by_profile_cache
+from cryspy.A_functions_base.function_1_profiling import profiled_stage, record_array_size
+
+from .rhochi_diffrn import get_flags, calc_dder_iint_by_atom_parameters
 
 
 na = numpy.newaxis
 
+@profiled_stage
 def calc_background(ttheta, background_ttheta, background_intensity, flag_background_intensity: bool = False):
     x_p = numpy.copy(background_ttheta)
     y_p = numpy.copy(background_intensity)
+    # y_p = m_p * background_intensity, rows of extrapolated points are linear combinations
+    m_p = numpy.eye(background_ttheta.size, dtype=float)
     x_min = ttheta.min()
     x_max = ttheta.max()
     if x_p.min() > x_min:
-        y_0 = (y_p[1]-y_p[0])*(x_min - x_p[0])/(x_p[1]-x_p[0]) + y_p[0]
+        c_0 = (x_min - x_p[0])/(x_p[1]-x_p[0])
+        y_0 = (y_p[1]-y_p[0])*c_0 + y_p[0]
         x_p = numpy.insert(x_p, 0, x_min)
         y_p = numpy.insert(y_p, 0, y_0)
+        m_p = numpy.insert(m_p, 0, (1.-c_0)*m_p[0] + c_0*m_p[1], axis=0)
     if x_p.max() <= x_max:
         x_max = x_max + 1.
-        y_last = (y_p[-1]-y_p[-2])*(x_max - x_p[-2])/(x_p[-1]-x_p[-2]) + y_p[-2]
+        c_last = (x_max - x_p[-2])/(x_p[-1]-x_p[-2])
+        y_last = (y_p[-1]-y_p[-2])*c_last + y_p[-2]
         x_p = numpy.append(x_p, x_max)
         y_p = numpy.append(y_p, y_last)
+        m_p = numpy.append(m_p, ((1.-c_last)*m_p[-2] + c_last*m_p[-1])[na, :], axis=0)
     x_left = x_p[:-1]
     x_right = x_p[1:]
     flags = numpy.logical_and(ttheta[:, na] >= x_left[na, :], ttheta[:, na] < x_right[na, :])
     p0 = numpy.argwhere(flags)[:,1]
-    p1 = p0 + 1 
+    p1 = p0 + 1
     intensity = (y_p[p1]-y_p[p0]) * (ttheta-x_p[p0])/(x_p[p1]-x_p[p0]) + y_p[p0]
     # f = scipy.interpolate.interp1d(
     #     background_ttheta, background_intensity, kind="linear", fill_value="extrapolate")
     # intensity = f(ttheta)
     dder = {}
     if flag_background_intensity:
-        ttheta_shift = ttheta[:, na] - background_ttheta[na, :]
-        diff_b_tth = background_ttheta[1:]-background_ttheta[:-1]
         # y_n + (y_np1-y_np)*(x-x_n)/(x_np1-x_n)
-        # 1  -(x-x_n)/(x_np1-x_n) + (x-x_nm1)/(x_n-x_nm1) 
-        dder_bkgr = numpy.zeros((ttheta.size, background_ttheta.size), dtype=float)
-        dder["background_intensity"] = dder_bkgr 
-    return intensity, dder 
+        c_p = (ttheta-x_p[p0])/(x_p[p1]-x_p[p0])
+        dder_bkgr = (1.-c_p)[:, na] * m_p[p0, :] + c_p[:, na] * m_p[p1, :]
+        dder["background_intensity"] = dder_bkgr
+    return intensity, dder
 
 
+@profiled_stage
 def calc_chi_sq_for_pd_by_dictionary(
         dict_pd, dict_crystals, dict_in_out: dict = None, flag_use_precalculated_data: bool=False,
-        flag_calc_analytical_derivatives: bool = False):
+        flag_calc_analytical_derivatives: bool = False,
+        dict_reflection_store: dict = None):
     """Calculate chi_sq for diffrn experiment.
+
+    Structure factors are taken from the store of crystal reflections shared
+    by experiments if dict_reflection_store is given (see reflection_store).
+
+    The analytical derivatives are calculated over the phase scales, the
+    background intensities and the atom parameters (fract_xyz, occupancy,
+    b_iso, beta) of nonmagnetic phases measured by neutrons. For the other
+    parameters (unit cell, profile, magnetic atoms, X-rays) the derivatives
+    are not given, their flags in dict_in_out["flags_der_residual"] are False.
     """
     if dict_in_out is None:
         flag_dict = False
@@ -89,7 +112,6 @@ def calc_chi_sq_for_pd_by_dictionary(
 
 
     wavelength = dict_pd["wavelength"]
-    flags_wavelength = dict_pd["flags_wavelength"]
     radiation = dict_pd["radiation"]
 
     if "beam_polarization" in dict_pd_keys:
@@ -116,12 +138,14 @@ def calc_chi_sq_for_pd_by_dictionary(
     flags_background_intensity = dict_pd["flags_background_intensity"]
 
     flag_background_intensity = numpy.any(flags_background_intensity)
-    if (flag_use_precalculated_data and ("signal_background" in dict_in_out) and not(flag_background_intensity)):
-        signal_background = dict_in_out["signal_background"]
-    else:
+    dict_dependency = {"ttheta": ttheta, "background_ttheta": background_ttheta, "background_intensity": background_intensity}
+    flag_hit, signal_background = get_cached_node(
+        dict_in_out, "signal_background", dict_dependency,
+        flag_use_precalculated_data=flag_use_precalculated_data and not(flag_background_intensity and flag_calc_analytical_derivatives))
+    if not(flag_hit):
         signal_background, dder_s_bkgr = calc_background(ttheta, background_ttheta, background_intensity,
             flag_background_intensity= (flag_background_intensity and flag_calc_analytical_derivatives))
-        dict_in_out["signal_background"] = signal_background
+        set_cached_node(dict_in_out, "signal_background", signal_background, dict_dependency)
 
     pd_phase_name = dict_pd["phase_name"]
     pd_phase_scale = dict_pd["phase_scale"]
@@ -134,16 +158,10 @@ def calc_chi_sq_for_pd_by_dictionary(
     resolution_parameters = dict_pd["resolution_parameters"] # U, V, W, X, Y
     if "asymmetry_parameters" in dict_pd_keys:
         asymmetry_parameters = dict_pd["asymmetry_parameters"] # p1, p2, p3, p4
-        flags_asymmetry_parameters = dict_pd["flags_asymmetry_parameters"] 
-        flag_asymmetry_parameters = numpy.any(flags_asymmetry_parameters)
         p_1, p_2, p_3, p_4 = asymmetry_parameters[0], asymmetry_parameters[1], asymmetry_parameters[2], asymmetry_parameters[3]
-
     else:
         p_1, p_2, p_3, p_4 = 0., 0., 0., 0.
-        flag_asymmetry_parameters = False
 
-    flags_resolution_parameters = dict_pd["flags_resolution_parameters"] 
-    
     if "texture_name" in dict_pd_keys:
         flag_texture = True
         pd_texture_name = dict_pd["texture_name"]
@@ -165,9 +183,11 @@ def calc_chi_sq_for_pd_by_dictionary(
 
     total_signal_plus = numpy.zeros_like(ttheta_zs)
     total_signal_minus = numpy.zeros_like(ttheta_zs)
-    for p_name, p_scale, p_resolution, p_ig, flags_p_scale, flags_p_resolution, flags_p_ig in zip(pd_phase_name, 
+    dict_der_signal_scale = {}
+    dict_der_signal_crystal = {}
+    for i_phase, (p_name, p_scale, p_resolution, p_ig, flags_p_scale, flags_p_resolution, flags_p_ig) in enumerate(zip(pd_phase_name, 
             pd_phase_scale, pd_phase_resolution_parameters.transpose(), pd_phase_ig,
-            flags_pd_phase_scale, flags_pd_phase_resolution_parameters.transpose(), flags_pd_phase_ig):
+            flags_pd_phase_scale, flags_pd_phase_resolution_parameters.transpose(), flags_pd_phase_ig)):
         p_name = p_name.lower()
         flag_phase_texture = False
         if flag_texture:
@@ -190,7 +210,6 @@ def calc_chi_sq_for_pd_by_dictionary(
             dict_in_out_phase = {}
             dict_in_out[f"dict_in_out_{p_name:}"] = dict_in_out_phase
 
-        dict_in_out_phase_keys = dict_in_out_phase.keys()
         dict_crystal_keys = dict_crystal.keys()
 
         if "reduced_symm_elems" in dict_crystal_keys:
@@ -211,52 +230,51 @@ def calc_chi_sq_for_pd_by_dictionary(
             unit_cell_parameters = numpy.dot(sc_uc, unit_cell_parameters) + v_uc
 
 
-        if (flag_use_precalculated_data and 
-                ("index_hkl" in dict_in_out_phase_keys) and 
-                ("multiplicity_hkl" in dict_in_out_phase_keys) and not(flag_unit_cell_parameters or flags_offset_ttheta)):
-            index_hkl = dict_in_out_phase["index_hkl"]
-            multiplicity_hkl = dict_in_out_phase["multiplicity_hkl"]
+        if flag_phase_texture:
+            reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [0], [1], [0], [0], [0], [1]], dtype=int)
+            translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = reduced_symm_elems_p1, translation_elems_p1, False
+        elif "reduced_symm_elems" in dict_crystal_keys:
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = reduced_symm_elems, translation_elems, dict_crystal["centrosymmetry"]
         else:
-            if flag_phase_texture:
-                reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [0], [1], [0], [0], [0], [1]], dtype=int)
-                translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
-                index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                    sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems_p1, translation_elems_p1, False)
-            else:
-                if "reduced_symm_elems" in dict_crystal_keys:
-                    centrosymmetry = dict_crystal["centrosymmetry"]
-                    index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                        sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry)
-                else:
-                    translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
-                    index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                        sthovl_min, sthovl_max, unit_cell_parameters, full_mcif_elems[:13], translation_elems_p1, False)
+            translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = full_mcif_elems[:13], translation_elems_p1, False
 
-            if (("index_hkl" in dict_in_out_phase_keys) and flag_use_precalculated_data):
-                if index_hkl.shape != dict_in_out_phase["index_hkl"].shape:
-                    flag_use_precalculated_data = False
-                else: 
-                    flag_use_precalculated_data = numpy.all(numpy.logical_and(dict_in_out_phase["index_hkl"], index_hkl))
+        # the superset of reflections is kept while the unit cell is refined
+        index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_by_superset(
+            dict_in_out_phase, sthovl_min, sthovl_max, unit_cell_parameters, hkl_symm_elems, hkl_translation_elems,
+            hkl_centrosymmetry, flag_use_precalculated_data=flag_use_precalculated_data)
+        record_array_size(f"{dict_pd['type_name']:}, {p_name:}: n_hkl", index_hkl.shape[1])
 
-            dict_in_out_phase["index_hkl"] = index_hkl
-            dict_in_out_phase["multiplicity_hkl"] = multiplicity_hkl
-
-        flag_sthovl_hkl = flag_unit_cell_parameters
         sthovl_hkl, dder_sthovl_hkl = calc_sthovl_by_unit_cell_parameters(index_hkl,
             unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
 
-        flag_ttheta_hkl = flag_sthovl_hkl or flags_wavelength
         ttheta_hkl = 2*numpy.arcsin(sthovl_hkl*wavelength)
         dict_in_out_phase["ttheta_hkl"] = ttheta_hkl + offset_ttheta
+        dder_iint_crystal = {}
         if radiation[0].startswith("neutrons"):
-            f_nucl, dder_f_nucl = calc_f_nucl_by_dictionary(
-                dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+            # the derivatives over atom parameters are chained for nonmagnetic phases only
+            flag_atom_derivatives = flag_calc_analytical_derivatives and not(
+                (("atom_para_index" in dict_crystal_keys) and ("atom_para_susceptibility" in dict_crystal_keys)) or
+                ("atom_ordered_index" in dict_crystal_keys))
+            f_nucl, dder_f_nucl = calc_by_reflection_store(
+                calc_f_nucl_by_dictionary, dict_crystal, dict_in_out_phase,
+                dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+                flag_use_precalculated_data=flag_use_precalculated_data,
+                flag_calc_analytical_derivatives=flag_atom_derivatives)
             flag_f_nucl = len(dder_f_nucl.keys()) > 0
+            if flag_atom_derivatives and flag_f_nucl:
+                # iint is |f_nucl|^2, derivatives [hkl, ..., a]
+                dder_iint_crystal = calc_dder_iint_by_atom_parameters(
+                    {"f_nucl_real": 2.*f_nucl.real, "f_nucl_imag": 2.*f_nucl.imag}, dder_f_nucl, {}, {}, None,
+                    dict_crystal["atom_fract_xyz"].shape[-1])
 
             flag_para = False
             if (("atom_para_index" in dict_crystal_keys) and ("atom_para_susceptibility" in dict_crystal_keys)):
-                sft_ccs, dder_sft_ccs = calc_sft_ccs_by_dictionary(
-                    dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+                sft_ccs, dder_sft_ccs = calc_by_reflection_store(
+                    calc_sft_ccs_by_dictionary, dict_crystal, dict_in_out_phase,
+                    dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+                    flag_use_precalculated_data=flag_use_precalculated_data)
                 flag_sft_ccs  = len(dder_sft_ccs.keys()) > 0
 
                 flag_matrix_t = flag_unit_cell_parameters
@@ -269,8 +287,10 @@ def calc_chi_sq_for_pd_by_dictionary(
 
             flag_ordered = False
             if "atom_ordered_index" in dict_crystal_keys:
-                f_m_perp_o_ccs, dder_f_m_perp_o_ccs = calc_f_m_perp_ordered_by_dictionary(
-                    dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+                f_m_perp_o_ccs, dder_f_m_perp_o_ccs = calc_by_reflection_store(
+                    calc_f_m_perp_ordered_by_dictionary, dict_crystal, dict_in_out_phase,
+                    dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+                    flag_use_precalculated_data=flag_use_precalculated_data)
                 flag_f_m_perp_o =  len(dder_f_m_perp_o_ccs.keys()) > 0
                 flag_ordered = True
 
@@ -279,34 +299,30 @@ def calc_chi_sq_for_pd_by_dictionary(
                     index_hkl, unit_cell_parameters, flag_unit_cell_parameters=flag_unit_cell_parameters)
                 f_m_perp_o, dder_f_m_perp_o = calc_m_v(matrix_t, f_m_perp_o_ccs, flag_m=flag_unit_cell_parameters, flag_v=flag_f_m_perp_o)
 
-            if flag_para and not(flag_ordered):
-                flag_iint_plus_minus = flag_f_nucl or flag_tensor_sigma or flags_beam_polarization or flags_flipper_efficiency
-                if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minu" in dict_in_out_phase_keys) and
-                        flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                    iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-                else:
+            dict_dependency = {"f_nucl": f_nucl, "beam_polarization": beam_polarization,
+                "flipper_efficiency": flipper_efficiency, "magnetic_field": magnetic_field}
+            if flag_para:
+                dict_dependency["tensor_sigma"] = tensor_sigma
+            if flag_ordered:
+                dict_dependency["f_m_perp_o"] = f_m_perp_o
+            flag_hit_plus, iint_plus = get_cached_node(
+                dict_in_out_phase, "iint_plus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+            flag_hit_minus, iint_minus = get_cached_node(
+                dict_in_out_phase, "iint_minus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+            if not(flag_hit_plus and flag_hit_minus):
+                if flag_para and not(flag_ordered):
                     iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_1d_para(
                         f_nucl, tensor_sigma, beam_polarization, flipper_efficiency, magnetic_field,
                         flag_f_nucl=flag_f_nucl, flag_tensor_sigma=flag_tensor_sigma,
                         flag_polarization=flags_beam_polarization, flag_flipper=flags_flipper_efficiency)
-            elif not(flag_para) and flag_ordered:
-                flag_iint_plus_minus = flag_f_nucl or flag_f_m_perp_o or flags_beam_polarization or flags_flipper_efficiency
-                if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minus" in dict_in_out_phase_keys) and
-                        flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                    iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-                else:
+                elif not(flag_para) and flag_ordered:
                     iint_plus, dder_plus = calc_powder_iint_1d_ordered(
                         f_nucl, f_m_perp_o,
                         flag_f_nucl=flag_f_nucl and flag_calc_analytical_derivatives,
                         flag_f_m_perp=flag_f_m_perp_o and flag_calc_analytical_derivatives)
                     iint_minus = iint_plus
                     dder_minus = dder_plus
-            elif flag_para and flag_ordered:
-                flag_iint_plus_minus = flag_f_nucl or flag_tensor_sigma or flag_f_m_perp_o or flags_beam_polarization or flags_flipper_efficiency
-                if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minu" in dict_in_out_phase_keys) and
-                        flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                    iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-                else:
+                elif flag_para and flag_ordered:
                     iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_1d_mix(
                         f_nucl, f_m_perp_o, tensor_sigma, beam_polarization, flipper_efficiency, magnetic_field,
                         flag_f_nucl=flag_f_nucl and flag_calc_analytical_derivatives,
@@ -314,12 +330,11 @@ def calc_chi_sq_for_pd_by_dictionary(
                         flag_tensor_sigma=flag_tensor_sigma and flag_calc_analytical_derivatives,
                         flag_polarization=flags_beam_polarization and flag_calc_analytical_derivatives,
                         flag_flipper=flags_flipper_efficiency and flag_calc_analytical_derivatives)
-            else:
-                iint_plus = numpy.square(numpy.abs(f_nucl))
-                iint_minus = numpy.square(numpy.abs(f_nucl))
-
-            dict_in_out_phase["iint_plus"] = iint_plus
-            dict_in_out_phase["iint_minus"] = iint_minus
+                else:
+                    iint_plus = numpy.square(numpy.abs(f_nucl))
+                    iint_minus = numpy.square(numpy.abs(f_nucl))
+                set_cached_node(dict_in_out_phase, "iint_plus", iint_plus, dict_dependency)
+                set_cached_node(dict_in_out_phase, "iint_minus", iint_minus, dict_dependency)
         elif radiation[0].startswith("X-rays"):
             f_charge, dder_f_charge = calc_f_charge_by_dictionary(
                 dict_crystal, wavelength, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
@@ -337,33 +352,40 @@ def calc_chi_sq_for_pd_by_dictionary(
             flag_texture_g1 = numpy.any(flags_texture_g1)
             flag_texture_g2 = numpy.any(flags_texture_g2)
             flag_texture_axis = numpy.any(flags_texture_axis)
-            flag_hh = numpy.any([flag_texture_g1, flag_texture_g2, flag_texture_axis])
-            if (flag_use_precalculated_data and 
-                    ("preferred_orientation" in dict_in_out_phase_keys) and
-                    not(flag_hh)):
-                preferred_orientation = dict_in_out_phase["preferred_orientation"]
-            else:
+            dict_dependency = {"index_hkl": index_hkl, "texture_g1": texture_g1, "texture_g2": texture_g2,
+                "texture_axis": texture_axis, "unit_cell_parameters": unit_cell_parameters}
+            flag_hit, preferred_orientation = get_cached_node(
+                dict_in_out_phase, "preferred_orientation", dict_dependency,
+                flag_use_precalculated_data=flag_use_precalculated_data)
+            if not(flag_hit):
                 preferred_orientation, dder_po = calc_preferred_orientation_pd(
                     index_hkl, texture_g1, texture_g2, texture_axis, unit_cell_parameters, 
                     flag_texture_g1=flag_texture_g1 and flag_calc_analytical_derivatives,
                     flag_texture_g2=flag_texture_g2 and flag_calc_analytical_derivatives,
                     flag_texture_axis=flag_texture_axis and flag_calc_analytical_derivatives)
-                dict_in_out_phase["preferred_orientation"] = preferred_orientation
-        
-        flag_rp = numpy.any(flags_p_resolution) or numpy.any(flags_resolution_parameters)
+                set_cached_node(dict_in_out_phase, "preferred_orientation", preferred_orientation, dict_dependency)
         
         hh = resolution_parameters + p_resolution
         u, v, w, x, y = hh[0], hh[1], hh[2], hh[3], hh[4]
         
-        profile_pv, dder_pv = calc_profile_pseudo_voight(ttheta_zs, ttheta_hkl, u, v, w, p_ig, x, y,
-            p_1, p_2, p_3, p_4, 
-            flag_ttheta=flags_offset_ttheta,
-            flag_ttheta_hkl=flag_ttheta_hkl, flag_u=flag_rp,
-            flag_v=flag_rp, flag_w=flag_rp, flag_i_g=flags_p_ig,
-            flag_x=flag_rp, flag_y=flag_rp, 
-            flag_p_1=flag_asymmetry_parameters, flag_p_2=flag_asymmetry_parameters,
-            flag_p_3=flag_asymmetry_parameters, flag_p_4=flag_asymmetry_parameters)
-        dict_in_out_phase["profile_pv"] = profile_pv
+        n_fwhm = get_sparse_profile()
+        dict_dependency = {"ttheta_zs": ttheta_zs, "ttheta_hkl": ttheta_hkl, "u": u, "v": v, "w": w,
+            "i_g": p_ig, "x": x, "y": y, "p_1": p_1, "p_2": p_2, "p_3": p_3, "p_4": p_4, "n_fwhm": n_fwhm}
+        flag_hit, profile_pv = get_cached_node(
+            dict_in_out_phase, "profile_pv", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit) and (n_fwhm is not None):
+            # the profile is calculated inside the windows of peaks and kept as CSR matrix [tth, hkl]
+            profile_pv, dder_pv = calc_by_profile_cache(
+                "profile_pv_sparse", calc_profile_pseudo_voight_sparse, ttheta_zs, ttheta_hkl, u, v, w, p_ig, x, y,
+                p_1, p_2, p_3, p_4, n_fwhm)
+            set_cached_node(dict_in_out_phase, "profile_pv", profile_pv, dict_dependency)
+        elif not(flag_hit):
+            # the derivatives of the profile are not calculated, so the profile is taken
+            # from the process-wide cache while the profile parameters are unchanged
+            profile_pv, dder_pv = calc_by_profile_cache(
+                "profile_pv", calc_profile_pseudo_voight, ttheta_zs, ttheta_hkl, u, v, w, p_ig, x, y,
+                p_1, p_2, p_3, p_4)
+            set_cached_node(dict_in_out_phase, "profile_pv", profile_pv, dict_dependency)
 
 
         # flags_p_scale
@@ -373,17 +395,33 @@ def calc_chi_sq_for_pd_by_dictionary(
         dict_in_out_phase["iint_plus_with_factors"] = 0.5 * p_scale * lf * iint_m_plus
         dict_in_out_phase["iint_minus_with_factors"] = 0.5 * p_scale * lf * iint_m_minus
         if flag_texture:
-            # 0.5 to have the same meaning for the scale factor as in FullProf
-            signal_plus = 0.5 * p_scale * lorentz_factor * (profile_pv * (iint_m_plus * preferred_orientation)[na, :]).sum(axis=1) # sum over hkl
-            signal_minus = 0.5 * p_scale * lorentz_factor * (profile_pv * (iint_m_minus * preferred_orientation)[na, :]).sum(axis=1) 
+            iint_m_plus = iint_m_plus * preferred_orientation
+            iint_m_minus = iint_m_minus * preferred_orientation
             dict_in_out_phase["iint_plus_with_factors"] *= preferred_orientation
             dict_in_out_phase["iint_minus_with_factors"] *= preferred_orientation
-        else:
-            signal_plus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_plus[na, :]).sum(axis=1) 
-            signal_minus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_minus[na, :]).sum(axis=1) 
+        # one product of the profile [tth, hkl] (dense or sparse) and the intensities [hkl, 2]
+        signal_plus, signal_minus = calc_signal_plus_minus_by_profile(profile_pv, iint_m_plus, iint_m_minus)
+        # 0.5 to have the same meaning for the scale factor as in FullProf
+        signal_plus = 0.5 * p_scale * lorentz_factor * signal_plus
+        signal_minus = 0.5 * p_scale * lorentz_factor * signal_minus
         
         dict_in_out_phase["signal_plus"] = signal_plus
         dict_in_out_phase["signal_minus"] = signal_minus
+        if flag_calc_analytical_derivatives and flags_p_scale and (p_scale != 0.):
+            # the signal is linear over the phase scale
+            dict_der_signal_scale[(i_phase, )] = (signal_plus/p_scale, signal_minus/p_scale)
+        for name, dder_iint in dder_iint_crystal.items():
+            flags = dict_crystal[f"flags_{name:}"]
+            # derivatives of the intensities [hkl, parameter] are the same for up and down
+            der_iint_m = dder_iint[:, flags] * multiplicity_hkl[:, na]
+            if flag_texture:
+                der_iint_m = der_iint_m * preferred_orientation[:, na]
+            if scipy.sparse.issparse(profile_pv):
+                der_signal = profile_pv.dot(der_iint_m)
+            else:
+                der_signal = numpy.matmul(profile_pv, der_iint_m)
+            dict_der_signal_crystal[(dict_crystal["type_name"], name)] = (
+                0.5 * p_scale * lorentz_factor[:, na] * der_signal, numpy.argwhere(flags))
         total_signal_plus += signal_plus
         total_signal_minus += signal_minus
 
@@ -420,12 +458,14 @@ def calc_chi_sq_for_pd_by_dictionary(
 
     chi_sq = 0.
     n_point = 0
+    l_residual = []
     if flag_chi_sq_sum:
         in_points = numpy.logical_not(excluded_points)
         total_signal_sum = total_signal_plus + total_signal_minus + signal_background
         chi_sq_sum = ((numpy.square((signal_exp - total_signal_sum)/signal_sigma)*in_points)).sum(axis=0)
         chi_sq += chi_sq_sum
         n_point += numpy.sum(in_points)
+        l_residual.append(numpy.where(in_points, (signal_exp - total_signal_sum)/signal_sigma, 0.))
     
     if flag_chi_sq_difference:
         signal_exp_diff = signal_exp_plus[0, :] - signal_exp_minus[0, :]
@@ -434,8 +474,12 @@ def calc_chi_sq_for_pd_by_dictionary(
         chi_sq_diff = (numpy.square((signal_exp_diff - total_signal_diff)/signal_sigma_diff)).sum(axis=0)
         chi_sq += chi_sq_diff
         n_point += signal_exp_diff.shape[0]
+        l_residual.append((signal_exp_diff - total_signal_diff)/signal_sigma_diff)
     if numpy.isnan(chi_sq):
         chi_sq = 1e30
+    if flag_dict:
+        # weighted residuals (signal_exp - signal_calc)/sigma, excluded points are zero
+        dict_in_out["residual"] = numpy.concatenate(l_residual, axis=0)
 
 
     flags_pd = get_flags(dict_pd)
@@ -455,11 +499,49 @@ def calc_chi_sq_for_pd_by_dictionary(
             parameter_name = [(crystal_type_name, ) + way + (tuple(ind_1d[ind,:]), ) for ind in range(ind_1d.shape[0])]
             l_parameter_name.extend(parameter_name)
     
-    if flag_background_intensity:
-        pass
-
     der_chi_sq = numpy.zeros((len(l_parameter_name), ), dtype=float) 
     dder_chi_sq = numpy.zeros((len(l_parameter_name), len(l_parameter_name)), dtype=float)
 
+    if flag_calc_analytical_derivatives:
+        # Jacobian of the model signal over refined parameters,
+        # columns of parameters without analytical derivatives are zero
+        pd_type_name = dict_pd["type_name"]
+        der_signal_sum = numpy.zeros((ttheta.size, len(l_parameter_name)), dtype=float)
+        der_signal_diff = numpy.zeros((ttheta.size, len(l_parameter_name)), dtype=float)
+        flags_der_residual = numpy.zeros((len(l_parameter_name), ), dtype=bool)
+        for ind_scale, (der_signal_plus, der_signal_minus) in dict_der_signal_scale.items():
+            ind_p = l_parameter_name.index((pd_type_name, "phase_scale", ind_scale))
+            der_signal_sum[:, ind_p] = der_signal_plus + der_signal_minus
+            der_signal_diff[:, ind_p] = der_signal_plus - der_signal_minus
+            flags_der_residual[ind_p] = True
+        if flag_background_intensity and ("background_intensity" in dder_s_bkgr.keys()):
+            for ind_b in numpy.argwhere(flags_background_intensity):
+                ind_p = l_parameter_name.index((pd_type_name, "background_intensity", tuple(ind_b)))
+                der_signal_sum[:, ind_p] = dder_s_bkgr["background_intensity"][:, ind_b[0]]
+                flags_der_residual[ind_p] = True
+        for (crystal_type_name, name), (der_signal, ind_1d) in dict_der_signal_crystal.items():
+            for i_column, ind_a in enumerate(ind_1d):
+                ind_p = l_parameter_name.index((crystal_type_name, name, tuple(ind_a)))
+                der_signal_sum[:, ind_p] = 2. * der_signal[:, i_column]
+                flags_der_residual[ind_p] = True
+        # Jacobian of weighted residuals [point, parameter] in the order of dict_in_out["residual"]
+        l_der_residual = []
+
+        if flag_chi_sq_sum:
+            inv_sigma_sq = in_points/numpy.square(signal_sigma)
+            diff_signal = signal_exp - total_signal_sum
+            der_chi_sq += -2. * ((diff_signal * inv_sigma_sq)[:, na] * der_signal_sum).sum(axis=0)
+            dder_chi_sq += 2. * numpy.matmul(der_signal_sum.transpose(), inv_sigma_sq[:, na] * der_signal_sum)
+            l_der_residual.append(-der_signal_sum * (in_points/signal_sigma)[:, na])
+        if flag_chi_sq_difference:
+            inv_sigma_sq_diff = 1./numpy.square(signal_sigma_diff)
+            diff_signal_diff = signal_exp_diff - total_signal_diff
+            der_chi_sq += -2. * ((diff_signal_diff * inv_sigma_sq_diff)[:, na] * der_signal_diff).sum(axis=0)
+            dder_chi_sq += 2. * numpy.matmul(der_signal_diff.transpose(), inv_sigma_sq_diff[:, na] * der_signal_diff)
+            l_der_residual.append(-der_signal_diff / signal_sigma_diff[:, na])
+        if flag_dict:
+            dict_in_out["der_residual"] = numpy.concatenate(l_der_residual, axis=0)
+            dict_in_out["flags_der_residual"] = flags_der_residual
+
     return chi_sq, n_point, der_chi_sq, dder_chi_sq, l_parameter_name
     
\ No newline at end of file
@@ -9,7 +9,7 @@ from cryspy.A_functions_base.unit_cell import \
 
 from cryspy.A_functions_base.structure_factor import \
     calc_f_nucl_by_dictionary, calc_sft_ccs_by_dictionary, \
-    calc_index_hkl_multiplicity_in_range, calc_f_m_perp_ordered_by_dictionary
+    calc_index_hkl_multiplicity_by_superset, calc_f_m_perp_ordered_by_dictionary
 
 from cryspy.A_functions_base.integrated_intensity_powder_diffraction import \
     calc_powder_iint_2d_para, calc_powder_iint_2d_ordered, calc_powder_iint_2d_mix
@@ -18,13 +18,20 @@ from cryspy.A_functions_base.preferred_orientation import \
     calc_preferred_orientation_pd2d, calc_gamma_nu_for_textured_peaks
 
 from cryspy.A_functions_base.powder_diffraction_const_wavelength import \
-    calc_profile_pseudo_voight_2d, calc_lorentz_factor, calc_ttheta_phi_by_gamma_nu
+    calc_profile_pseudo_voight_2d, calc_lorentz_factor, calc_ttheta_phi_by_gamma_nu, \
+    calc_signal_plus_minus_by_profile
+
+from cryspy.A_functions_base.reflection_store import calc_by_reflection_store
+
+from cryspy.A_functions_base.function_1_cache import get_cached_node, set_cached_node
+from cryspy.A_functions_base.function_1_profiling import profiled_stage, record_array_size
 
 from .rhochi_diffrn import get_flags
 
 na = numpy.newaxis
 
 
+@profiled_stage
 def calc_background(gamma, nu, background_gamma, background_nu, background_intensity, flag_background_intensity: bool = False):
     # f = scipy.interpolate.interp2d( 
     #     background_gamma, background_nu, background_intensity.transpose(), kind="linear", fill_value=None) #FIXME: not sure about transpose
@@ -95,10 +102,15 @@ def calc_background(gamma, nu, background_gamma, background_nu, background_inten
     return signal, dder 
 
 
+@profiled_stage
 def calc_chi_sq_for_pd2d_by_dictionary(
         dict_pd, dict_crystals, dict_in_out: dict = None, flag_use_precalculated_data: bool=False,
-        flag_calc_analytical_derivatives: bool = False):
+        flag_calc_analytical_derivatives: bool = False,
+        dict_reflection_store: dict = None):
     """Calculate chi_sq for diffrn experiment.
+
+    Structure factors are taken from the store of crystal reflections shared
+    by experiments if dict_reflection_store is given (see reflection_store).
     """
     if dict_in_out is None:
         flag_dict = False
@@ -175,12 +187,15 @@ def calc_chi_sq_for_pd2d_by_dictionary(
     flags_background_intensity = dict_pd["flags_background_intensity"]
 
     flag_background_intensity = numpy.any(flags_background_intensity)
-    if (flag_use_precalculated_data and ("signal_background" in dict_in_out) and not(flag_background_intensity)):
-        signal_background = dict_in_out["signal_background"]
-    else:
+    dict_dependency = {"gamma": gamma, "nu": nu, "background_gamma": background_gamma,
+        "background_nu": background_nu, "background_intensity": background_intensity}
+    flag_hit, signal_background = get_cached_node(
+        dict_in_out, "signal_background", dict_dependency,
+        flag_use_precalculated_data=flag_use_precalculated_data and not(flag_background_intensity and flag_calc_analytical_derivatives))
+    if not(flag_hit):
         signal_background, dder_s_bkgr = calc_background(gamma, nu, background_gamma, background_nu, background_intensity,
             flag_background_intensity= (flag_background_intensity and flag_calc_analytical_derivatives))
-        dict_in_out["signal_background"] = signal_background
+        set_cached_node(dict_in_out, "signal_background", signal_background, dict_dependency)
 
     pd_phase_name = dict_pd["phase_name"]
     pd_phase_scale = dict_pd["phase_scale"]
@@ -245,8 +260,6 @@ def calc_chi_sq_for_pd2d_by_dictionary(
             dict_in_out_phase = {}
             dict_in_out[f"dict_in_out_{p_name:}"] = dict_in_out_phase
 
-        dict_in_out_phase_keys = dict_in_out_phase.keys()
-
         if "reduced_symm_elems" in dict_crystal_keys:
             reduced_symm_elems  = dict_crystal["reduced_symm_elems"]
             translation_elems = dict_crystal["translation_elems"]
@@ -264,37 +277,21 @@ def calc_chi_sq_for_pd2d_by_dictionary(
             v_uc = dict_crystal["v_uc"]
             unit_cell_parameters = numpy.dot(sc_uc, unit_cell_parameters) + v_uc            
 
-        if (flag_use_precalculated_data and 
-                ("index_hkl" in dict_in_out_phase_keys) and 
-                ("multiplicity_hkl" in dict_in_out_phase_keys) and not(flag_unit_cell_parameters or flag_ttheta)):
-            index_hkl = dict_in_out_phase["index_hkl"]
-            multiplicity_hkl = dict_in_out_phase["multiplicity_hkl"]
+        if flag_phase_texture:
+            reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [0], [1], [0], [0], [0], [1]], dtype=int)
+            translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = reduced_symm_elems_p1, translation_elems_p1, False
+        elif "reduced_symm_elems" in dict_crystal_keys:
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = reduced_symm_elems, translation_elems, dict_crystal["centrosymmetry"]
         else:
-            if flag_phase_texture:
-                reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [0], [1], [0], [0], [0], [1]], dtype=int)
-                translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
-                index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                    sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems_p1, translation_elems_p1, False)
-                # index_hkl = numpy.reshape(numpy.stack([index_hkl, -1*index_hkl], axis=2), (3, 2*index_hkl.shape[1]))
-                # multiplicity_hkl = numpy.ones_like(index_hkl[0])
-            else:
-                if "reduced_symm_elems" in dict_crystal_keys:
-                    centrosymmetry = dict_crystal["centrosymmetry"]
-                    index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                        sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry)
-                else:
-                    translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
-                    index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                        sthovl_min, sthovl_max, unit_cell_parameters, full_mcif_elems[:13], translation_elems_p1, False)
-
-            if (("index_hkl" in dict_in_out_phase_keys) and flag_use_precalculated_data):
-                if index_hkl.shape != dict_in_out_phase["index_hkl"].shape:
-                    flag_use_precalculated_data = False
-                else: 
-                    flag_use_precalculated_data = numpy.all(numpy.logical_and(dict_in_out_phase["index_hkl"], index_hkl))
-
-            dict_in_out_phase["index_hkl"] = index_hkl
-            dict_in_out_phase["multiplicity_hkl"] = multiplicity_hkl
+            translation_elems_p1 = numpy.array([[0], [0], [0], [1]], dtype=int)
+            hkl_symm_elems, hkl_translation_elems, hkl_centrosymmetry = full_mcif_elems[:13], translation_elems_p1, False
+
+        # the superset of reflections is kept while the unit cell is refined
+        index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_by_superset(
+            dict_in_out_phase, sthovl_min, sthovl_max, unit_cell_parameters, hkl_symm_elems, hkl_translation_elems,
+            hkl_centrosymmetry, flag_use_precalculated_data=flag_use_precalculated_data)
+        record_array_size(f"{dict_pd['type_name']:}, {p_name:}: n_hkl", index_hkl.shape[1])
 
         flag_sthovl_hkl = flag_unit_cell_parameters
         sthovl_hkl, dder_sthovl_hkl = calc_sthovl_by_unit_cell_parameters(index_hkl,
@@ -304,14 +301,18 @@ def calc_chi_sq_for_pd2d_by_dictionary(
         ttheta_hkl = 2*numpy.arcsin(wavelength * sthovl_hkl)
         dict_in_out_phase["ttheta_hkl"] = ttheta_hkl
 
-        f_nucl, dder_f_nucl = calc_f_nucl_by_dictionary(
-            dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+        f_nucl, dder_f_nucl = calc_by_reflection_store(
+            calc_f_nucl_by_dictionary, dict_crystal, dict_in_out_phase,
+            dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+            flag_use_precalculated_data=flag_use_precalculated_data)
         flag_f_nucl = len(dder_f_nucl.keys()) > 0
 
         flag_para = False
         if "atom_para_index" in dict_crystal_keys:
-            sft_ccs, dder_sft_ccs = calc_sft_ccs_by_dictionary(
-                dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+            sft_ccs, dder_sft_ccs = calc_by_reflection_store(
+                calc_sft_ccs_by_dictionary, dict_crystal, dict_in_out_phase,
+                dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+                flag_use_precalculated_data=flag_use_precalculated_data)
             flag_sft_ccs  = len(dder_sft_ccs.keys()) > 0
             flag_matrix_t = flag_unit_cell_parameters
             matrix_t, dder_matrix_t = calc_matrix_t(
@@ -323,8 +324,10 @@ def calc_chi_sq_for_pd2d_by_dictionary(
 
         flag_ordered = False
         if "atom_ordered_index" in dict_crystal_keys:
-            f_m_perp_o_ccs, dder_f_m_perp_o_ccs = calc_f_m_perp_ordered_by_dictionary(
-                dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+            f_m_perp_o_ccs, dder_f_m_perp_o_ccs = calc_by_reflection_store(
+                calc_f_m_perp_ordered_by_dictionary, dict_crystal, dict_in_out_phase,
+                dict_reflection_store=dict_reflection_store, label=f"{dict_pd['type_name']:}_{p_name:}",
+                flag_use_precalculated_data=flag_use_precalculated_data)
             flag_f_m_perp_o =  len(dder_f_m_perp_o_ccs.keys()) > 0
             flag_ordered = True
 
@@ -334,12 +337,18 @@ def calc_chi_sq_for_pd2d_by_dictionary(
             f_m_perp_o, dder_f_m_perp_o = calc_m_v(matrix_t, f_m_perp_o_ccs, flag_m=flag_unit_cell_parameters, flag_v=flag_f_m_perp_o)
             
 
-        if flag_para and not(flag_ordered):
-            flag_iint_plus_minus = flag_f_nucl or flag_tensor_sigma or flags_beam_polarization or flags_flipper_efficiency
-            if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minu" in dict_in_out_phase_keys) and
-                    flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-            else:
+        dict_dependency = {"f_nucl": f_nucl, "beam_polarization": beam_polarization,
+            "flipper_efficiency": flipper_efficiency, "magnetic_field": magnetic_field, "alpha_det": alpha_det}
+        if flag_para:
+            dict_dependency["tensor_sigma"] = tensor_sigma
+        if flag_ordered:
+            dict_dependency["f_m_perp_o"] = f_m_perp_o
+        flag_hit_plus, iint_plus = get_cached_node(
+            dict_in_out_phase, "iint_plus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        flag_hit_minus, iint_minus = get_cached_node(
+            dict_in_out_phase, "iint_minus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit_plus and flag_hit_minus):
+            if flag_para and not(flag_ordered):
                 iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_2d_para(
                     f_nucl, tensor_sigma, beam_polarization, flipper_efficiency, magnetic_field,
                     alpha_det, dict_in_out_phase, 
@@ -347,13 +356,7 @@ def calc_chi_sq_for_pd2d_by_dictionary(
                     flag_tensor_sigma=flag_tensor_sigma and flag_calc_analytical_derivatives,
                     flag_polarization=flags_beam_polarization and flag_calc_analytical_derivatives,
                     flag_flipper=flags_flipper_efficiency and flag_calc_analytical_derivatives)
-
-        elif not(flag_para) and flag_ordered:
-            flag_iint_plus_minus = flag_f_nucl or flag_f_m_perp_o or flags_beam_polarization or flags_flipper_efficiency
-            if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minus" in dict_in_out_phase_keys) and
-                    flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-            else:
+            elif not(flag_para) and flag_ordered:
                 iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_2d_ordered(
                     f_nucl, f_m_perp_o, beam_polarization, flipper_efficiency,
                     alpha_det, dict_in_out_phase, 
@@ -361,13 +364,7 @@ def calc_chi_sq_for_pd2d_by_dictionary(
                     flag_f_m_perp=flag_f_m_perp_o and flag_calc_analytical_derivatives,
                     flag_polarization=flags_beam_polarization and flag_calc_analytical_derivatives,
                     flag_flipper=flags_flipper_efficiency and flag_calc_analytical_derivatives)
-
-        elif flag_para and flag_ordered:
-            flag_iint_plus_minus = flag_f_nucl or flag_tensor_sigma or flag_f_m_perp_o or flags_beam_polarization or flags_flipper_efficiency
-            if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minu" in dict_in_out_phase_keys) and
-                    flag_use_precalculated_data and not(flag_iint_plus_minus)):
-                iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-            else:
+            elif flag_para and flag_ordered:
                 iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_2d_mix(
                     f_nucl, tensor_sigma, f_m_perp_o, beam_polarization, flipper_efficiency, magnetic_field,
                     alpha_det, dict_in_out_phase, 
@@ -376,39 +373,39 @@ def calc_chi_sq_for_pd2d_by_dictionary(
                     flag_f_m_perp_ordered=flag_f_m_perp_o and flag_calc_analytical_derivatives,
                     flag_polarization=flags_beam_polarization and flag_calc_analytical_derivatives,
                     flag_flipper=flags_flipper_efficiency and flag_calc_analytical_derivatives)
-        else:
-            iint_plus = numpy.square(numpy.abs(f_nucl))
-            iint_minus = numpy.square(numpy.abs(f_nucl))
-
-        dict_in_out_phase["iint_plus"] = iint_plus
-        dict_in_out_phase["iint_minus"] = iint_minus
+            else:
+                iint_plus = numpy.square(numpy.abs(f_nucl))
+                iint_minus = numpy.square(numpy.abs(f_nucl))
+            set_cached_node(dict_in_out_phase, "iint_plus", iint_plus, dict_dependency)
+            set_cached_node(dict_in_out_phase, "iint_minus", iint_minus, dict_dependency)
 
         if flag_phase_texture:
             flag_texture_g1 = numpy.any(flags_texture_g1)
             flag_texture_g2 = numpy.any(flags_texture_g2)
             flag_texture_axis = numpy.any(flags_texture_axis)
-            flag_hh = numpy.any([flag_texture_g1, flag_texture_g2, flag_texture_axis])
-            if (flag_use_precalculated_data and 
-                    ("preferred_orientation" in dict_in_out_phase_keys) and
-                    not(flag_hh)):
-                preferred_orientation = dict_in_out_phase["preferred_orientation"]
-            else:
+            dict_dependency = {"alpha_det": alpha_det, "index_hkl": index_hkl, "texture_g1": texture_g1,
+                "texture_g2": texture_g2, "texture_axis": texture_axis, "unit_cell_parameters": unit_cell_parameters}
+            flag_hit, preferred_orientation = get_cached_node(
+                dict_in_out_phase, "preferred_orientation", dict_dependency,
+                flag_use_precalculated_data=flag_use_precalculated_data)
+            if not(flag_hit):
                 preferred_orientation, dder_po = calc_preferred_orientation_pd2d(alpha_det,
                     index_hkl, texture_g1, texture_g2, texture_axis, unit_cell_parameters,
                     flag_texture_g1=flag_texture_g1 and flag_calc_analytical_derivatives,
                     flag_texture_g2=flag_texture_g2 and flag_calc_analytical_derivatives,
                     flag_texture_axis=flag_texture_axis and flag_calc_analytical_derivatives)
-                dict_in_out_phase["preferred_orientation"] = preferred_orientation
+                set_cached_node(dict_in_out_phase, "preferred_orientation", preferred_orientation, dict_dependency)
 
                 # it is not necessary calculations but it is better to now (gamma,nu)_max of peaks
 
                 eq_axis = calc_eq_ccs_by_unit_cell_parameters(
                     texture_axis, unit_cell_parameters, flag_unit_cell_parameters=False)[0]
-                if "eq_ccs" in dict_in_out_phase_keys:
-                    eq_ccs = dict_in_out_phase["eq_ccs"]
-                else:
+                dict_dependency = {"index_hkl": index_hkl, "unit_cell_parameters": unit_cell_parameters}
+                flag_hit, eq_ccs = get_cached_node(
+                    dict_in_out_phase, "eq_ccs", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+                if not(flag_hit):
                     eq_ccs = calc_eq_ccs_by_unit_cell_parameters(index_hkl, unit_cell_parameters=unit_cell_parameters, flag_unit_cell_parameters=False)[0]
-                    dict_in_out_phase["eq_ccs"] = eq_ccs
+                    set_cached_node(dict_in_out_phase, "eq_ccs", eq_ccs, dict_dependency)
                 ttheta_hkl = dict_in_out_phase["ttheta_hkl"]
                 gamma_hkl, nu_hkl = calc_gamma_nu_for_textured_peaks(
                     eq_axis, eq_ccs, ttheta_hkl, texture_g1)
@@ -421,10 +418,11 @@ def calc_chi_sq_for_pd2d_by_dictionary(
         u, v, w, x, y = hh[0], hh[1], hh[2], hh[3], hh[4]
         p_1, p_2, p_3, p_4 = asymmetry_parameters[0], asymmetry_parameters[1], asymmetry_parameters[2], asymmetry_parameters[3]
 
-        flag_profile_pv = flag_rp or flag_asymmetry_parameters or flag_p_phi
-        if flag_use_precalculated_data and ("profile_pv" in dict_in_out_keys) and not(flag_profile_pv):
-            profile_pv = dict_in_out_phase["profile_pv"]
-        else:
+        dict_dependency = {"ttheta_zs": ttheta_zs, "phi_zs": phi_zs, "ttheta_hkl": ttheta_hkl, "u": u, "v": v, "w": w,
+            "i_g": p_ig, "x": x, "y": y, "p_1": p_1, "p_2": p_2, "p_3": p_3, "p_4": p_4, "p_phi": p_phi}
+        flag_hit, profile_pv = get_cached_node(
+            dict_in_out_phase, "profile_pv", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             profile_pv, dder_pv = calc_profile_pseudo_voight_2d(ttheta_zs, phi_zs, ttheta_hkl, u, v, w, p_ig, x, y,
                 p_1, p_2, p_3, p_4, 
                 p_phi,
@@ -439,7 +437,7 @@ def calc_chi_sq_for_pd2d_by_dictionary(
                 flag_p_3=flag_asymmetry_parameters and flag_calc_analytical_derivatives,
                 flag_p_4=flag_asymmetry_parameters and flag_calc_analytical_derivatives,
                 flag_p_phi=flag_p_phi and flag_calc_analytical_derivatives)
-            dict_in_out_phase["profile_pv"] = profile_pv
+            set_cached_node(dict_in_out_phase, "profile_pv", profile_pv, dict_dependency)
 
 
         # flags_p_scale
@@ -452,7 +450,13 @@ def calc_chi_sq_for_pd2d_by_dictionary(
             signal_plus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_plus * preferred_orientation).sum(axis=2) # sum over hkl
             signal_minus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_minus * preferred_orientation).sum(axis=2) 
 
+        elif (iint_m_plus.ndim == 1) and (iint_m_minus.ndim == 1):
+            # one product of the profile [tth, phi, hkl] and the intensities [hkl, 2]
+            signal_plus, signal_minus = calc_signal_plus_minus_by_profile(profile_pv, iint_m_plus, iint_m_minus)
+            signal_plus = 0.5 * p_scale * lorentz_factor * signal_plus
+            signal_minus = 0.5 * p_scale * lorentz_factor * signal_minus
         else:
+            # magnetic intensities depend on the direction of the detector [tth, phi, hkl]
             signal_plus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_plus).sum(axis=2) 
             signal_minus = 0.5 * p_scale * lorentz_factor * (profile_pv * iint_m_minus).sum(axis=2) 
 
@@ -481,6 +485,7 @@ def calc_chi_sq_for_pd2d_by_dictionary(
 
     chi_sq = 0.
     n_point = 0
+    l_residual = []
     if flag_chi_sq_sum:
         in_points = numpy.logical_not(excluded_points)
         if flag_polarized:
@@ -498,6 +503,7 @@ def calc_chi_sq_for_pd2d_by_dictionary(
         chi_sq_sum = numpy.sum(numpy.square(diff_signal_sum[in_points])*inv_sigma_sq_sum[in_points])
         chi_sq += chi_sq_sum
         n_point += numpy.sum(in_points)
+        l_residual.append(numpy.where(in_points, diff_signal_sum/signal_sigma_sum, 0.).flatten())
 
     if flag_chi_sq_difference:
         signal_exp_diff = signal_exp_plus[0, :] - signal_exp_minus[0, :]
@@ -508,9 +514,14 @@ def calc_chi_sq_for_pd2d_by_dictionary(
         chi_sq_diff = numpy.sum(numpy.square((signal_exp_diff - total_signal_diff)[nan_points_diff]/signal_sigma_diff[nan_points_diff]))
         chi_sq += chi_sq_diff
         n_point += numpy.sum(nan_points_diff)
+        l_residual.append(numpy.where(
+            nan_points_diff, (signal_exp_diff - total_signal_diff)/signal_sigma_diff, 0.).flatten())
 
     if numpy.isnan(chi_sq):
         chi_sq = 1e30
+    if flag_dict:
+        # weighted residuals (signal_exp - signal_calc)/sigma, excluded points are zero
+        dict_in_out["residual"] = numpy.concatenate(l_residual, axis=0)
 
     flags_pd2d = get_flags(dict_pd)
     l_flags_crystal = [get_flags(dict_crystal) for dict_crystal in dict_crystals]
@@ -10,7 +10,7 @@ from cryspy.A_functions_base.unit_cell import \
 
 from cryspy.A_functions_base.structure_factor import \
     calc_f_nucl_by_dictionary, calc_sft_ccs_by_dictionary, \
-    calc_index_hkl_multiplicity_in_range
+    calc_index_hkl_multiplicity_by_superset
 
 from cryspy.A_functions_base.integrated_intensity_powder_diffraction import \
     calc_powder_iint_1d_para
@@ -28,12 +28,18 @@ from cryspy.A_functions_base.powder_diffraction_tof import \
 from cryspy.A_functions_base.powder_diffraction_tof_zcode import \
     calc_profile_by_zcode_parameters
 
+from cryspy.A_functions_base.reflection_store import calc_by_reflection_store
+
+from cryspy.A_functions_base.function_1_cache import get_cached_node, set_cached_node
+from cryspy.A_functions_base.function_1_profiling import profiled_stage, record_array_size
+
 from .rhochi_diffrn import get_flags
 from .rhochi_pd import calc_background
 
 na = numpy.newaxis
 
 
+@profiled_stage
 def calc_background_by_cosines(x, background_coefficients, x_min: float = 0., x_max: float = None, flag_background_coefficients: bool = False):
     if x_max is None:
         x_max = numpy.max(x)
@@ -50,6 +56,7 @@ def calc_background_by_cosines(x, background_coefficients, x_min: float = 0., x_
     return y, dder
 
 
+@profiled_stage
 def calc_spectrum_incident(time, coefficients, type: str = "Maxwell", flag_coefficients: bool = False):
     exp = numpy.exp
     time_sq = numpy.square(time)
@@ -73,10 +80,15 @@ def calc_spectrum_incident(time, coefficients, type: str = "Maxwell", flag_coeff
     return res, dder
 
 
+@profiled_stage
 def calc_chi_sq_for_tof_by_dictionary(
         dict_tof, dict_crystals, dict_in_out: dict = None, flag_use_precalculated_data: bool = False,
-        flag_calc_analytical_derivatives: bool = False):
+        flag_calc_analytical_derivatives: bool = False,
+        dict_reflection_store: dict = None):
     """Calculate chi_sq for diffrn experiment.
+
+    Structure factors are taken from the store of crystal reflections shared
+    by experiments if dict_reflection_store is given (see reflection_store).
     """
     if dict_in_out is None:
         flag_dict = False
@@ -100,22 +112,12 @@ def calc_chi_sq_for_tof_by_dictionary(
         d = calc_d_by_time_for_thermal_neutrons(time, zero, dtt1, dtt2)
         d_min_max = calc_d_min_max_by_time_thermal_neutrons(
             time, zero, dtt1, dtt2)
-        flag_time = (
-            numpy.any(dict_tof["flags_zero"]) or
-            numpy.any(dict_tof["flags_dtt1"]) or
-            numpy.any(dict_tof["flags_dtt2"]))
     else:  # epithermal
         zero = dict_tof["zero"]
         dtt1 = dict_tof["dtt1"]
         zerot = dict_tof["zerot"]
         dtt1t = dict_tof["dtt1t"]
         dtt2t = dict_tof["dtt2t"]
-        flag_time = (
-            numpy.any(dict_tof["flags_zero"]) or
-            numpy.any(dict_tof["flags_dtt1"]) or
-            numpy.any(dict_tof["flags_zerot"]) or
-            numpy.any(dict_tof["flags_dtt1t"]) or
-            numpy.any(dict_tof["flags_dtt2t"]))
         d_min_max = calc_d_min_max_by_time_epithermal_neutrons(
             time, zero, dtt1, zerot, dtt1t, dtt2t)
         raise AttributeError("Epithermal neutrons are not introudiced")
@@ -146,26 +148,28 @@ def calc_chi_sq_for_tof_by_dictionary(
         flags_background_coefficients = dict_tof["flags_background_coefficients"]
 
         flag_background_coefficients = numpy.any(flags_background_coefficients)
-        if (flag_use_precalculated_data and ("signal_background" in dict_in_out) and not(flag_background_coefficients)):
-            signal_background = dict_in_out["signal_background"]
-        else:
+        dict_dependency = {"time": time, "background_coefficients": background_coefficients}
+        flag_hit, signal_background = get_cached_node(
+            dict_in_out, "signal_background", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             signal_background, dder_s_bkgr = calc_background_by_cosines(time, background_coefficients,
                                                                         flag_background_coefficients=(flag_background_coefficients and flag_calc_analytical_derivatives))
-            dict_in_out["signal_background"] = signal_background
+            set_cached_node(dict_in_out, "signal_background", signal_background, dict_dependency)
     elif "background_time" in dict_tof_keys:
         background_time = dict_tof["background_time"]
         background_intensity = dict_tof["background_intensity"]
         flags_background_intensity = dict_tof["flags_background_intensity"]
         flag_background_intensity = numpy.any(flags_background_intensity)
-        if (flag_use_precalculated_data and ("signal_background" in dict_in_out) and not(flag_background_intensity)):
-            signal_background = dict_in_out["signal_background"]
-        else:
+        dict_dependency = {"time": time, "background_time": background_time, "background_intensity": background_intensity}
+        flag_hit, signal_background = get_cached_node(
+            dict_in_out, "signal_background", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             signal_background, dder_s_bkgr = calc_background(
                 time,
                 background_time,
                 background_intensity,
                 flag_background_intensity=(flag_background_intensity and flag_calc_analytical_derivatives))
-            dict_in_out["signal_background"] = signal_background
+            set_cached_node(dict_in_out, "signal_background", signal_background, dict_dependency)
     else:
         signal_background = numpy.zeros_like(time)
         dict_in_out["signal_background"] = signal_background
@@ -173,15 +177,14 @@ def calc_chi_sq_for_tof_by_dictionary(
     if "spectrum_incident_type" in dict_tof_keys:
         spectrum_incident_type = dict_tof["spectrum_incident_type"]
         spectrum_incident_coefficients = dict_tof["spectrum_incident_coefficients"]
-        flags_spectrum_incident_coefficients = dict_tof["flags_spectrum_incident_coefficients"]
-        flag_spectrum_incident_coefficients = numpy.any(
-            flags_spectrum_incident_coefficients)
-        if (flag_use_precalculated_data and ("spectrum_incident" in dict_in_out) and not(flag_spectrum_incident_coefficients)):
-            spectrum_incident = dict_in_out["spectrum_incident"]
-        else:
+        dict_dependency = {"time": time, "spectrum_incident_coefficients": spectrum_incident_coefficients,
+            "spectrum_incident_type": spectrum_incident_type}
+        flag_hit, spectrum_incident = get_cached_node(
+            dict_in_out, "spectrum_incident", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             spectrum_incident, dder_si = calc_spectrum_incident(
                 time, spectrum_incident_coefficients, type=spectrum_incident_type)
-        dict_in_out["spectrum_incident"] = spectrum_incident
+            set_cached_node(dict_in_out, "spectrum_incident", spectrum_incident, dict_dependency)
     else:
         spectrum_incident = numpy.ones_like(time)
         dict_in_out["spectrum_incident"] = spectrum_incident
@@ -201,31 +204,16 @@ def calc_chi_sq_for_tof_by_dictionary(
         profile_betas = dict_tof["profile_betas"]
         profile_sigmas = dict_tof["profile_sigmas"]
         profile_gammas = dict_tof["profile_gammas"]
-        flag_profile_shape = (
-            numpy.any(dict_tof["flags_profile_alphas"]) or
-            numpy.any(dict_tof["flags_profile_betas"]) or
-            numpy.any(dict_tof["flags_profile_sigmas"]) or
-            numpy.any(dict_tof["flags_profile_gammas"]))
     elif profile_peak_shape == "Gauss":
         profile_alphas = dict_tof["profile_alphas"]
         profile_betas = dict_tof["profile_betas"]
         profile_sigmas = dict_tof["profile_sigmas"]
-        flag_profile_shape = (
-            numpy.any(dict_tof["flags_profile_alphas"]) or
-            numpy.any(dict_tof["flags_profile_betas"]) or
-            numpy.any(dict_tof["flags_profile_sigmas"]))
     elif profile_peak_shape == "type0m":
         profile_alphas = dict_tof["profile_alphas"]
         profile_betas = dict_tof["profile_betas"]
         profile_sigmas = dict_tof["profile_sigmas"]
         profile_gammas = dict_tof["profile_gammas"]
         profile_rs = dict_tof["profile_rs"]
-        flag_profile_shape = (
-            numpy.any(dict_tof["flags_profile_alphas"]) or
-            numpy.any(dict_tof["flags_profile_betas"]) or
-            numpy.any(dict_tof["flags_profile_sigmas"]) or
-            numpy.any(dict_tof["flags_profile_gammas"]) or
-            numpy.any(dict_tof["flags_profile_rs"]))
 
     if "texture_name" in dict_tof_keys:
         flag_texture = True
@@ -265,8 +253,6 @@ def calc_chi_sq_for_tof_by_dictionary(
             dict_in_out_phase = {}
             dict_in_out[f"dict_in_out_{p_name:}"] = dict_in_out_phase
 
-        dict_in_out_phase_keys = dict_in_out_phase.keys()
-
         reduced_symm_elems = dict_crystal["reduced_symm_elems"]
         translation_elems = dict_crystal["translation_elems"]
         centrosymmetry = dict_crystal["centrosymmetry"]
@@ -280,32 +266,20 @@ def calc_chi_sq_for_tof_by_dictionary(
             unit_cell_parameters = numpy.dot(
                 sc_uc, unit_cell_parameters) + v_uc
 
-        if (flag_use_precalculated_data and
-                ("index_hkl" in dict_in_out_phase_keys) and
-                ("multiplicity_hkl" in dict_in_out_phase_keys) and not(flag_unit_cell_parameters)):
-            index_hkl = dict_in_out_phase["index_hkl"]
-            multiplicity_hkl = dict_in_out_phase["multiplicity_hkl"]
+        if flag_phase_texture:
+            reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [
+                                                0], [1], [0], [0], [0], [1]], dtype=int)
+            translation_elems_p1 = numpy.array(
+                [[0], [0], [0], [1]], dtype=int)
+            hkl_symm_elems, hkl_translation_elems = reduced_symm_elems_p1, translation_elems_p1
         else:
-            if flag_phase_texture:
-                reduced_symm_elems_p1 = numpy.array([[0], [0], [0], [1], [1], [0], [0], [
-                                                    0], [1], [0], [0], [0], [1]], dtype=int)
-                translation_elems_p1 = numpy.array(
-                    [[0], [0], [0], [1]], dtype=int)
-                index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                    sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems_p1, translation_elems_p1, centrosymmetry)
-            else:
-                index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_in_range(
-                    sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry)
-
-            if (("index_hkl" in dict_in_out_phase_keys) and flag_use_precalculated_data):
-                if index_hkl.shape != dict_in_out_phase["index_hkl"].shape:
-                    flag_use_precalculated_data = False
-                else:
-                    flag_use_precalculated_data = numpy.all(
-                        numpy.logical_and(dict_in_out_phase["index_hkl"], index_hkl))
-
-            dict_in_out_phase["index_hkl"] = index_hkl
-            dict_in_out_phase["multiplicity_hkl"] = multiplicity_hkl
+            hkl_symm_elems, hkl_translation_elems = reduced_symm_elems, translation_elems
+
+        # the superset of reflections is kept while the unit cell is refined
+        index_hkl, multiplicity_hkl = calc_index_hkl_multiplicity_by_superset(
+            dict_in_out_phase, sthovl_min, sthovl_max, unit_cell_parameters, hkl_symm_elems, hkl_translation_elems,
+            centrosymmetry, flag_use_precalculated_data=flag_use_precalculated_data)
+        record_array_size(f"{dict_tof['type_name']:}, {p_name:}: n_hkl", index_hkl.shape[1])
 
         flag_sthovl_hkl = flag_unit_cell_parameters
         sthovl_hkl, dder_sthovl_hkl = calc_sthovl_by_unit_cell_parameters(index_hkl,
@@ -326,12 +300,16 @@ def calc_chi_sq_for_tof_by_dictionary(
         dict_in_out_phase["time_hkl"] = time_hkl
         dict_in_out_phase["d_hkl"] = d_hkl
 
-        f_nucl, dder_f_nucl = calc_f_nucl_by_dictionary(
-            dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+        f_nucl, dder_f_nucl = calc_by_reflection_store(
+            calc_f_nucl_by_dictionary, dict_crystal, dict_in_out_phase,
+            dict_reflection_store=dict_reflection_store, label=f"{dict_tof['type_name']:}_{p_name:}",
+            flag_use_precalculated_data=flag_use_precalculated_data)
         flag_f_nucl = len(dder_f_nucl.keys()) > 0
 
-        sft_ccs, dder_sft_ccs = calc_sft_ccs_by_dictionary(
-            dict_crystal, dict_in_out_phase, flag_use_precalculated_data=flag_use_precalculated_data)
+        sft_ccs, dder_sft_ccs = calc_by_reflection_store(
+            calc_sft_ccs_by_dictionary, dict_crystal, dict_in_out_phase,
+            dict_reflection_store=dict_reflection_store, label=f"{dict_tof['type_name']:}_{p_name:}",
+            flag_use_precalculated_data=flag_use_precalculated_data)
         flag_sft_ccs = len(dder_sft_ccs.keys()) > 0
 
         flag_matrix_t = flag_unit_cell_parameters
@@ -342,43 +320,48 @@ def calc_chi_sq_for_tof_by_dictionary(
         tensor_sigma, dder_tensor_sigma = calc_m1_m2_m1t(
             matrix_t, sft_ccs, flag_m1=flag_sft_ccs, flag_m2=flag_unit_cell_parameters)
 
-        flag_iint_plus_minus = flag_f_nucl or flag_tensor_sigma or flags_beam_polarization or flags_flipper_efficiency
-
-        if (("iint_plus" in dict_in_out_phase_keys) and ("iint_minu" in dict_in_out_phase_keys) and
-                flag_use_precalculated_data and not(flag_iint_plus_minus)):
-            iint_plus, iint_minus = dict_in_out_phase["iint_plus"], dict_in_out_phase["iint_minus"]
-        else:
+        dict_dependency = {"f_nucl": f_nucl, "tensor_sigma": tensor_sigma, "beam_polarization": beam_polarization,
+            "flipper_efficiency": flipper_efficiency, "magnetic_field": magnetic_field}
+        flag_hit_plus, iint_plus = get_cached_node(
+            dict_in_out_phase, "iint_plus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        flag_hit_minus, iint_minus = get_cached_node(
+            dict_in_out_phase, "iint_minus", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit_plus and flag_hit_minus):
             iint_plus, iint_minus, dder_plus, dder_minus = calc_powder_iint_1d_para(
                 f_nucl, tensor_sigma, beam_polarization, flipper_efficiency, magnetic_field,
                 flag_f_nucl=flag_f_nucl, flag_tensor_sigma=flag_tensor_sigma,
                 flag_polarization=flags_beam_polarization, flag_flipper=flags_flipper_efficiency)
-            dict_in_out_phase["iint_plus"] = iint_plus
-            dict_in_out_phase["iint_minus"] = iint_minus
+            set_cached_node(dict_in_out_phase, "iint_plus", iint_plus, dict_dependency)
+            set_cached_node(dict_in_out_phase, "iint_minus", iint_minus, dict_dependency)
 
         if flag_phase_texture:
             flag_texture_g1 = numpy.any(flags_texture_g1)
             flag_texture_g2 = numpy.any(flags_texture_g2)
             flag_texture_axis = numpy.any(flags_texture_axis)
-            flag_hh = numpy.any(
-                [flag_texture_g1, flag_texture_g2, flag_texture_axis])
-            if (flag_use_precalculated_data and
-                    ("preferred_orientation" in dict_in_out_phase_keys) and
-                    not(flag_hh)):
-                preferred_orientation = dict_in_out_phase["preferred_orientation"]
-            else:
+            dict_dependency = {"index_hkl": index_hkl, "texture_g1": texture_g1, "texture_g2": texture_g2,
+                "texture_axis": texture_axis, "unit_cell_parameters": unit_cell_parameters}
+            flag_hit, preferred_orientation = get_cached_node(
+                dict_in_out_phase, "preferred_orientation", dict_dependency,
+                flag_use_precalculated_data=flag_use_precalculated_data)
+            if not(flag_hit):
                 preferred_orientation, dder_po = calc_preferred_orientation_tof(
                     index_hkl, texture_g1, texture_g2, texture_axis, unit_cell_parameters,
                     flag_texture_g1=flag_texture_g1 and flag_calc_analytical_derivatives,
                     flag_texture_g2=flag_texture_g2 and flag_calc_analytical_derivatives,
                     flag_texture_axis=flag_texture_axis and flag_calc_analytical_derivatives)
-                dict_in_out_phase["preferred_orientation"] = preferred_orientation
-
-        flag_profile_tof = (
-            flag_unit_cell_parameters or flag_time or flag_profile_shape)
-        if (("profile_tof" in dict_in_out_phase_keys) and
-                flag_use_precalculated_data and not(flag_profile_tof)):
-            profile_tof = dict_in_out_phase["profile_tof"]
-        else:
+                set_cached_node(dict_in_out_phase, "preferred_orientation", preferred_orientation, dict_dependency)
+
+        dict_dependency = {"profile_peak_shape": profile_peak_shape, "profile_alphas": profile_alphas,
+            "profile_betas": profile_betas, "profile_sigmas": profile_sigmas, "time": time, "time_hkl": time_hkl, "d_hkl": d_hkl}
+        if profile_peak_shape in ("pseudo-Voigt", "Gauss"):
+            dict_dependency["d"] = d
+        if profile_peak_shape in ("pseudo-Voigt", "type0m"):
+            dict_dependency["profile_gammas"] = profile_gammas
+        if profile_peak_shape == "type0m":
+            dict_dependency["profile_rs"] = profile_rs
+        flag_hit, profile_tof = get_cached_node(
+            dict_in_out_phase, "profile_tof", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+        if not(flag_hit):
             if profile_peak_shape == "pseudo-Voigt":
                 profile_tof = calc_peak_shape_function(
                     profile_alphas, profile_betas, profile_sigmas,
@@ -404,8 +387,7 @@ def calc_chi_sq_for_tof_by_dictionary(
                     profile_rs[0], profile_rs[1], profile_rs[2],
                     profile_alphas[0], profile_alphas[1],
                     profile_betas[0], profile_betas[1], profile_betas[2])
-
-            dict_in_out_phase["profile_tof"] = profile_tof
+            set_cached_node(dict_in_out_phase, "profile_tof", profile_tof, dict_dependency)
 
         # flags_p_scale
         iint_m_plus = iint_plus * multiplicity_hkl
@@ -473,6 +455,7 @@ def calc_chi_sq_for_tof_by_dictionary(
 
     chi_sq = 0.
     n_point = 0
+    l_residual = []
     if flag_chi_sq_sum:
         in_points = numpy.logical_not(excluded_points)
         total_signal_sum = total_signal_plus + total_signal_minus + signal_background
@@ -480,6 +463,7 @@ def calc_chi_sq_for_tof_by_dictionary(
             (signal_exp - total_signal_sum)/signal_sigma)*in_points)).sum(axis=0)
         chi_sq += chi_sq_sum
         n_point += numpy.sum(in_points)
+        l_residual.append(numpy.where(in_points, (signal_exp - total_signal_sum)/signal_sigma, 0.))
 
     if flag_chi_sq_difference:
         signal_exp_diff = signal_exp_plus[0, :] - signal_exp_minus[0, :]
@@ -490,8 +474,12 @@ def calc_chi_sq_for_tof_by_dictionary(
             (signal_exp_diff - total_signal_diff)/signal_sigma_diff)).sum(axis=0)
         chi_sq += chi_sq_diff
         n_point += signal_exp_diff.shape[0]
+        l_residual.append((signal_exp_diff - total_signal_diff)/signal_sigma_diff)
     if numpy.isnan(chi_sq):
         chi_sq = 1e30
+    if flag_dict:
+        # weighted residuals (signal_exp - signal_calc)/sigma, excluded points are zero
+        dict_in_out["residual"] = numpy.concatenate(l_residual, axis=0)
 
     flags_pd = get_flags(dict_tof)
     l_flags_crystal = [get_flags(dict_crystal)
@@ -0,0 +1,22 @@
+import numpy
+
+from cryspy.procedure_rhochi.rhochi_pd import calc_background
+
+ttheta = numpy.linspace(4., 60., 57, dtype=float)
+background_ttheta = numpy.array([10., 20., 35., 50.], dtype=float)
+background_intensity = numpy.array([12., 7., 9., 4.], dtype=float)
+
+
+def test_calc_background():
+    intensity, dder = calc_background(
+        ttheta, background_ttheta, background_intensity, flag_background_intensity=True)
+    assert numpy.all(numpy.isclose(
+        intensity[6:47], numpy.interp(ttheta[6:47], background_ttheta, background_intensity)))
+
+    delta = 1e-5
+    for ind in range(background_intensity.size):
+        background_intensity_shifted = numpy.copy(background_intensity)
+        background_intensity_shifted[ind] += delta
+        intensity_shifted = calc_background(ttheta, background_ttheta, background_intensity_shifted)[0]
+        der_numerical = (intensity_shifted - intensity)/delta
+        assert numpy.all(numpy.isclose(dder["background_intensity"][:, ind], der_numerical, atol=1e-6))
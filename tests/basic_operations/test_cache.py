@@ -0,0 +1,136 @@
+import numpy
+import scipy.sparse
+
+from cryspy.A_functions_base.function_1_cache import \
+    get_cached_node, \
+    set_cached_node, \
+    get_cache_statistics, \
+    reset_cache_statistics, \
+    calc_by_symmetry_cache, \
+    set_symmetry_cache_budget, \
+    get_symmetry_cache_budget, \
+    clear_symmetry_cache, \
+    calc_by_profile_cache, \
+    set_profile_cache_budget, \
+    get_profile_cache_budget, \
+    clear_profile_cache, \
+    calc_by_table_cache, \
+    set_table_cache_directory, \
+    get_table_cache_directory, \
+    clear_table_cache
+
+
+def test_cached_node():
+    reset_cache_statistics()
+    dict_in_out = {}
+    param = numpy.array([1., 2., 3.], dtype=float)
+
+    dict_dependency = {"param": param, "flag": True}
+    flag_hit, value = get_cached_node(dict_in_out, "node", dict_dependency)
+    assert not(flag_hit)
+    set_cached_node(dict_in_out, "node", 2.*param, dict_dependency)
+
+    flag_hit, value = get_cached_node(dict_in_out, "node", {"param": param, "flag": True})
+    assert flag_hit
+    assert numpy.all(numpy.isclose(value, 2.*param))
+
+    flag_hit, value = get_cached_node(
+        dict_in_out, "node", {"param": param, "flag": True}, flag_use_precalculated_data=False)
+    assert not(flag_hit)
+
+    param[1] = 5.
+    flag_hit, value = get_cached_node(dict_in_out, "node", {"param": param, "flag": True})
+    assert not(flag_hit)
+
+    assert get_cache_statistics()["node"] == (1, 3)
+
+
+def test_calc_by_symmetry_cache():
+    def func(index_hkl, factor):
+        l_call.append(factor)
+        return factor*index_hkl.astype(float)
+
+    l_call = []
+    index_hkl = numpy.array([[1, 2], [0, 1], [3, 4]], dtype=int)
+    byte_budget = get_symmetry_cache_budget()
+    clear_symmetry_cache()
+    set_symmetry_cache_budget(100)
+    try:
+        res_1 = calc_by_symmetry_cache("node", func, index_hkl, 1.)
+        res_2 = calc_by_symmetry_cache("node", func, index_hkl.copy(), 1.)
+        assert res_1 is res_2
+        assert not(res_1.flags.writeable)
+        # the budget is for two nodes, the least recently used is removed
+        calc_by_symmetry_cache("node", func, index_hkl, 2.)
+        calc_by_symmetry_cache("node", func, index_hkl, 1.)
+        calc_by_symmetry_cache("node", func, index_hkl, 3.)
+        calc_by_symmetry_cache("node", func, index_hkl, 2.)
+        assert l_call == [1., 2., 3., 2.]
+    finally:
+        set_symmetry_cache_budget(byte_budget)
+        clear_symmetry_cache()
+
+
+def test_calc_by_profile_cache():
+    def func(ttheta, ttheta_hkl, u):
+        l_call.append(u)
+        profile = numpy.exp(-numpy.square(ttheta[:, numpy.newaxis] - ttheta_hkl[numpy.newaxis, :])/u)
+        return scipy.sparse.csr_matrix(numpy.where(profile > 1e-3, profile, 0.)), {}
+
+    l_call = []
+    ttheta = numpy.linspace(0., 1., 11)
+    ttheta_hkl = numpy.array([0.2, 0.7], dtype=float)
+    byte_budget = get_profile_cache_budget()
+    clear_profile_cache()
+    try:
+        profile_1 = calc_by_profile_cache("profile", func, ttheta, ttheta_hkl, 0.01)[0]
+        # the profile is reused for new arrays with the same values
+        profile_2 = calc_by_profile_cache("profile", func, ttheta.copy(), ttheta_hkl.copy(), 0.01)[0]
+        assert profile_1 is profile_2
+        assert not(profile_1.data.flags.writeable)
+        calc_by_profile_cache("profile", func, ttheta, ttheta_hkl, 0.02)
+        assert l_call == [0.01, 0.02]
+        # the profile larger than the budget is not kept
+        set_profile_cache_budget(10)
+        calc_by_profile_cache("profile", func, ttheta, ttheta_hkl, 0.01)
+        calc_by_profile_cache("profile", func, ttheta, ttheta_hkl, 0.01)
+        assert l_call == [0.01, 0.02, 0.01, 0.01]
+    finally:
+        set_profile_cache_budget(byte_budget)
+        clear_profile_cache()
+
+
+def test_calc_by_table_cache(tmp_path):
+    def func(ion_name, table_sthovl):
+        l_call.append(ion_name)
+        return numpy.exp(-table_sthovl)
+
+    l_call = []
+    table_sthovl = numpy.linspace(0., 2., 11)
+    directory = get_table_cache_directory()
+    set_table_cache_directory(tmp_path)
+    try:
+        table_1 = calc_by_table_cache("table", func, "Fe3+", table_sthovl)
+        assert calc_by_table_cache("table", func, "Fe3+", table_sthovl.copy()) is table_1
+        # the table is loaded from the cache directory in the next session
+        clear_table_cache()
+        table_2 = calc_by_table_cache("table", func, "Fe3+", table_sthovl)
+        assert l_call == ["Fe3+"]
+        assert numpy.all(table_1 == table_2)
+        assert not(table_2.flags.writeable)
+        # the table of the other source data is calculated
+        calc_by_table_cache("table", func, "Fe3+", table_sthovl, source_hash="other")
+        assert l_call == ["Fe3+", "Fe3+"]
+        clear_table_cache(flag_files=True)
+        assert len(list(tmp_path.iterdir())) == 0
+
+        # without the directory the tables are not saved
+        set_table_cache_directory(None)
+        calc_by_table_cache("table", func, "Fe3+", table_sthovl)
+        clear_table_cache()
+        calc_by_table_cache("table", func, "Fe3+", table_sthovl)
+        assert l_call == ["Fe3+", "Fe3+", "Fe3+", "Fe3+"]
+        assert len(list(tmp_path.iterdir())) == 0
+    finally:
+        clear_table_cache()
+        set_table_cache_directory(directory)
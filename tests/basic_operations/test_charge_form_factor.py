@@ -0,0 +1,18 @@
+import numpy
+
+from cryspy.A_functions_base.charge_form_factor import \
+    calc_scattering_amplitude_for_ion, \
+    calc_scattering_amplitude_by_table
+
+
+def test_calc_scattering_amplitude_by_table():
+    table_sthovl = numpy.linspace(0., 2., 501)
+    table_atom_scattering_amplitude = numpy.stack([
+        calc_scattering_amplitude_for_ion(ion_name, table_sthovl) for ion_name in ("O", "Pb")], axis=0)
+    sthovl = numpy.array([0., 0.1234, 0.5, 1.9999, 2.5], dtype=float)
+
+    scattering_amplitude = calc_scattering_amplitude_by_table(sthovl, table_sthovl, table_atom_scattering_amplitude)
+    assert scattering_amplitude.shape == (5, 2)
+    for i_atom, table_sc_ampl in enumerate(table_atom_scattering_amplitude):
+        assert numpy.all(numpy.isclose(
+            scattering_amplitude[:, i_atom], numpy.interp(sthovl, table_sthovl, table_sc_ampl), rtol=1e-12))
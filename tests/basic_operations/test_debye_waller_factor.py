@@ -5,7 +5,8 @@ from cryspy.A_functions_base.debye_waller_factor import \
     calc_b_iso_beta, \
     calc_power_dwf_iso, \
     calc_power_dwf_aniso, \
-    calc_dwf
+    calc_dwf, \
+    calc_dwf_by_atoms
 
 na = numpy.newaxis
 
@@ -280,3 +281,18 @@ def test_calc_dwf():
     print(dwf)
     
     assert numpy.all(numpy.isclose(res, dwf))
+
+
+def test_calc_dwf_by_atoms():
+    beta_mixed = numpy.copy(beta)
+    beta_mixed[:, [0, 2, 4]] = 0.
+    res = calc_dwf_by_atoms(index_hkl, sthovl, b_iso, beta_mixed, symm_elems_r)
+    res_full = calc_dwf(
+        index_hkl[:, :, na, na], sthovl[:, na, na], b_iso[na, na, :], beta_mixed[:, na, na, :],
+        symm_elems_r[:, na, :, na])[0]
+    assert res.shape == res_full.shape
+    assert numpy.all(numpy.isclose(res, res_full))
+
+    res_iso = calc_dwf_by_atoms(index_hkl, sthovl, b_iso, numpy.zeros_like(beta), symm_elems_r)
+    assert res_iso.shape == (index_hkl.shape[1], 1, b_iso.shape[0])
+    assert numpy.all(numpy.isclose(res_iso[:, 0, :], numpy.exp(-power_dwf_iso)))
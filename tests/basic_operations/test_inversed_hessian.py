@@ -0,0 +1,35 @@
+import numpy
+
+from cryspy.A_functions_base.function_1_inversed_hessian import \
+    estimate_inversed_hessian_matrix, \
+    estimate_jacobian_matrix, \
+    estimate_inversed_hessian_matrix_by_jacobian
+
+matrix_a = numpy.array([
+    [1., 2., 0.5],
+    [0.3, -1., 2.],
+    [4., 0., 1.],
+    [0.7, 0.2, -3.]], dtype=float)
+vector_b = numpy.array([1., 2., 3., 4.], dtype=float)
+param_0 = numpy.array([0.5, -1.5, 2.], dtype=float)
+
+def func_residual(param):
+    return numpy.matmul(matrix_a, param) - vector_b
+
+def func_chi_sq(param):
+    return numpy.square(func_residual(param)).sum()
+
+hess_inv_exact = numpy.linalg.inv(2.*numpy.matmul(matrix_a.transpose(), matrix_a))
+
+
+def test_estimate_inversed_hessian_matrix():
+    hess_inv, first_der = estimate_inversed_hessian_matrix(func_chi_sq, param_0)
+    assert numpy.all(numpy.isclose(hess_inv, hess_inv_exact, rtol=1e-5))
+
+
+def test_estimate_inversed_hessian_matrix_by_jacobian():
+    jacobian = estimate_jacobian_matrix(func_residual, param_0)
+    assert numpy.all(numpy.isclose(jacobian, matrix_a, rtol=1e-5))
+
+    hess_inv = estimate_inversed_hessian_matrix_by_jacobian(jacobian)
+    assert numpy.all(numpy.isclose(hess_inv, hess_inv_exact, rtol=1e-5))
@@ -6,7 +6,8 @@ from cryspy.A_functions_base.magnetic_form_factor import \
     get_j0_j2_parameters, \
     calc_j0,\
     calc_j2,\
-    calc_form_factor
+    calc_form_factor, \
+    calc_form_factor_by_table
 
 na = numpy.newaxis
 
@@ -94,5 +95,10 @@ def test_calc_form_factor():
     assert numpy.all(numpy.isclose(form_factor, res))
 
 
+def test_calc_form_factor_by_table():
+    sthovl_grid = numpy.linspace(0., 3., 301)
+    res = calc_form_factor_by_table(sthovl_grid, lande_factor, kappa, j0_parameters, j2_parameters)
+    res_2, dder = calc_form_factor(
+        sthovl_grid[:, na], lande_factor[na, :], kappa[na, :], j0_parameters[:, na, :], j2_parameters[:, na, :])
 
-
+    assert numpy.all(numpy.isclose(res, res_2, rtol=0., atol=1e-9))
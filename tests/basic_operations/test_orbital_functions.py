@@ -0,0 +1,34 @@
+import numpy
+
+from cryspy.A_functions_base.orbital_functions import \
+    calc_jl, \
+    calc_jl_table, \
+    calc_jl_by_table, \
+    TABLE_X_STEP, \
+    TABLE_X_MAX
+
+l_orbital = [
+    (numpy.array([1.], dtype=float), numpy.array([4], dtype=int), numpy.array([1.2], dtype=float)),
+    (numpy.array([1.], dtype=float), numpy.array([2], dtype=int), numpy.array([0.5], dtype=float)),
+    (numpy.array([0.6, 0.4], dtype=float), numpy.array([3, 4], dtype=int), numpy.array([2.1, 5.7], dtype=float))]
+
+
+def test_calc_jl_table():
+    for coeff, n, zeta in l_orbital:
+        table = calc_jl_table(coeff, n, zeta)
+        table_x = numpy.arange(table.shape[-1])*TABLE_X_STEP
+        assert numpy.all(numpy.isclose(table[0], calc_jl(table_x, coeff, n, zeta).transpose(), rtol=1e-12, atol=0.))
+
+        # derivatives are compared with the central differences out of zero
+        step = 1e-6
+        jl_der = (calc_jl(table_x[1:]+step, coeff, n, zeta) - calc_jl(table_x[1:]-step, coeff, n, zeta)).transpose()/(2.*step)
+        assert numpy.all(numpy.isclose(table[1][:, 1:], jl_der, rtol=0., atol=1e-8))
+
+
+def test_calc_jl_by_table():
+    sthovl = numpy.concatenate([numpy.linspace(0., 0.01, 1001), numpy.linspace(0.01, TABLE_X_MAX, 3001)])
+    for coeff, n, zeta in l_orbital:
+        for kappa in (1., 0.9):
+            res = calc_jl_by_table(sthovl, coeff, n, zeta, kappa=kappa)
+            res_2 = calc_jl(sthovl, coeff, n, zeta, kappa=kappa)
+            assert numpy.all(numpy.isclose(res, res_2, rtol=0., atol=1e-7))
@@ -0,0 +1,50 @@
+import numpy
+
+from cryspy.procedure_rhochi.rhochi_parameter_map import \
+    form_parameter_map, \
+    get_parameters_by_map, \
+    set_parameters_by_map, \
+    add_derivatives_by_map
+
+global_dict = {
+    "crystal_phase1": {
+        "unit_cell_parameters": numpy.array([5., 5., 5., 90., 90., 90.], dtype=float),
+        "atom_fract_xyz": numpy.zeros((3, 2), dtype=float)},
+    "pd_powder1": {
+        "phase_scale": numpy.array([1.], dtype=float)}}
+
+parameter_names = [
+    ("crystal_phase1", "unit_cell_parameters", (0, )),
+    ("pd_powder1", "phase_scale", (0, )),
+    ("crystal_phase1", "atom_fract_xyz", (1, 1)),
+    ("crystal_phase1", "atom_fract_xyz", (0, 0))]
+
+
+def test_set_get_parameters_by_map():
+    linear_constraints = [
+        ((1., ("crystal_phase1", "atom_fract_xyz", (1, 1))), (-1., ("crystal_phase1", "atom_fract_xyz", (2, 1))))]
+    parameter_map = form_parameter_map(global_dict, parameter_names, linear_constraints)
+    l_param = numpy.array([6., 2., 0.1, 0.3], dtype=float)
+    set_parameters_by_map(global_dict, parameter_map, l_param)
+    assert global_dict["crystal_phase1"]["unit_cell_parameters"][0] == 6.
+    assert global_dict["pd_powder1"]["phase_scale"][0] == 2.
+    assert global_dict["crystal_phase1"]["atom_fract_xyz"][1, 1] == 0.1
+    assert global_dict["crystal_phase1"]["atom_fract_xyz"][0, 0] == 0.3
+    assert numpy.isclose(global_dict["crystal_phase1"]["atom_fract_xyz"][2, 1], 0.1)
+    assert numpy.all(get_parameters_by_map(global_dict, parameter_map) == l_param)
+
+
+def test_add_derivatives_by_map():
+    parameter_map = form_parameter_map(global_dict, parameter_names)
+    der_sum = numpy.zeros((4, ), dtype=float)
+    dder_sum = numpy.zeros((4, 4), dtype=float)
+    add_derivatives_by_map(
+        parameter_map, der_sum, dder_sum, parameter_names[2:0:-1],
+        numpy.array([1., 2.]), numpy.array([[1., 2.], [3., 4.]]))
+    add_derivatives_by_map(
+        parameter_map, der_sum, dder_sum, parameter_names[1:2],
+        numpy.array([1.]), numpy.array([[1.]]))
+    assert numpy.all(der_sum == numpy.array([0., 3., 1., 0.]))
+    dder_sum_exact = numpy.zeros((4, 4), dtype=float)
+    dder_sum_exact[1, 1], dder_sum_exact[1, 2], dder_sum_exact[2, 1], dder_sum_exact[2, 2] = 5., 3., 2., 1.
+    assert numpy.all(dder_sum == dder_sum_exact)
@@ -0,0 +1,64 @@
+import numpy
+
+from cryspy.A_functions_base.powder_diffraction_const_wavelength import \
+    calc_profile_pseudo_voight, \
+    calc_profile_pseudo_voight_sparse, \
+    calc_profile_cutoff_error, \
+    calc_n_fwhm_by_accuracy, \
+    calc_signal_plus_minus_by_profile
+
+ttheta = numpy.linspace(10., 150., 14001)*numpy.pi/180.
+ttheta_hkl = numpy.array([30., 47.3, 47.35, 90., 121.])*numpy.pi/180.
+u, v, w, i_g, x, y = 0.2, -0.2, 0.12, 0., 0.05, 0.
+p_1, p_2, p_3, p_4 = 0.1, 0., 0.02, 0.
+
+
+def test_calc_profile_pseudo_voight_sparse():
+    profile_dense = calc_profile_pseudo_voight(
+        ttheta, ttheta_hkl, u, v, w, i_g, x, y, p_1, p_2, p_3, p_4)[0]
+    n_fwhm = 20.
+    profile_sparse = calc_profile_pseudo_voight_sparse(
+        ttheta, ttheta_hkl, u, v, w, i_g, x, y, p_1, p_2, p_3, p_4, n_fwhm=n_fwhm)[0]
+    assert profile_sparse.shape == profile_dense.shape
+    profile_coo = profile_sparse.tocoo()
+    assert numpy.allclose(profile_coo.data, profile_dense[profile_coo.row, profile_coo.col], rtol=1e-12, atol=0.)
+
+    # the lost area of each peak is bounded by the cutoff error
+    step = (ttheta[1]-ttheta[0])*180./numpy.pi
+    area_dense = profile_dense.sum(axis=0)*step
+    area_lost = (profile_dense - profile_sparse.toarray()).sum(axis=0)*step
+    assert numpy.all(area_lost >= 0.)
+    assert numpy.all(area_lost <= calc_profile_cutoff_error(n_fwhm)*area_dense)
+
+    # the same result for the unsorted points
+    order = numpy.random.default_rng(0).permutation(ttheta.size)
+    profile_unsorted = calc_profile_pseudo_voight_sparse(
+        ttheta[order], ttheta_hkl, u, v, w, i_g, x, y, p_1, p_2, p_3, p_4, n_fwhm=n_fwhm)[0]
+    assert numpy.allclose(profile_unsorted.toarray(), profile_sparse.toarray()[order])
+
+
+def test_calc_n_fwhm_by_accuracy():
+    for accuracy in (1e-1, 1e-2, 1e-3):
+        assert numpy.isclose(calc_profile_cutoff_error(calc_n_fwhm_by_accuracy(accuracy)), accuracy)
+    assert calc_profile_cutoff_error(3., eta=0.) < 1e-11
+
+
+def test_calc_signal_plus_minus_by_profile():
+    profile_dense = calc_profile_pseudo_voight(
+        ttheta, ttheta_hkl, u, v, w, i_g, x, y, p_1, p_2, p_3, p_4)[0]
+    profile_sparse = calc_profile_pseudo_voight_sparse(
+        ttheta, ttheta_hkl, u, v, w, i_g, x, y, p_1, p_2, p_3, p_4, n_fwhm=20.)[0]
+    iint_plus = numpy.array([1., 2., 0.5, 3., 4.], dtype=float)
+    iint_minus = numpy.array([2., 1., 0.5, 3., 0.], dtype=float)
+    for profile in (profile_dense, profile_sparse):
+        signal_plus, signal_minus = calc_signal_plus_minus_by_profile(profile, iint_plus, iint_minus)
+        assert numpy.allclose(signal_plus, profile.dot(iint_plus))
+        assert numpy.allclose(signal_minus, profile.dot(iint_minus))
+    signal_plus, signal_minus = calc_signal_plus_minus_by_profile(profile_dense, iint_plus, iint_plus)
+    assert numpy.allclose(signal_plus, (profile_dense * iint_plus[numpy.newaxis, :]).sum(axis=1))
+    assert numpy.all(signal_plus == signal_minus)
+
+    # profile [tth, phi, hkl]
+    profile_2d = numpy.stack([profile_dense, 2.*profile_dense], axis=1)
+    signal_plus, signal_minus = calc_signal_plus_minus_by_profile(profile_2d, iint_plus, iint_minus)
+    assert numpy.allclose(signal_minus, (profile_2d * iint_minus).sum(axis=2))
@@ -0,0 +1,36 @@
+import numpy
+
+from cryspy.A_functions_base.function_1_profiling import \
+    profiled_stage, \
+    record_array_size, \
+    enable_profiling, \
+    disable_profiling, \
+    reset_profiling, \
+    get_profiling_report
+
+
+@profiled_stage
+def calc_square(x):
+    return numpy.square(x)
+
+
+def test_profiling():
+    reset_profiling()
+    calc_square(numpy.arange(5))
+    record_array_size("x", 5)
+    report = get_profiling_report()
+    assert "calc_square" not in report["stage"].keys()
+    assert "x" not in report["size"].keys()
+
+    enable_profiling()
+    try:
+        y = calc_square(numpy.arange(5))
+        calc_square(numpy.arange(5))
+        record_array_size("x", 5)
+    finally:
+        disable_profiling()
+    assert numpy.all(y == numpy.array([0, 1, 4, 9, 16]))
+    report = get_profiling_report()
+    assert report["stage"]["calc_square"]["calls"] == 2
+    assert report["stage"]["calc_square"]["time"] >= 0.
+    assert report["size"]["x"] == 5
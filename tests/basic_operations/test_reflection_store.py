@@ -0,0 +1,50 @@
+import numpy
+
+from cryspy.A_functions_base.function_1_cache import get_cached_node, set_cached_node
+from cryspy.A_functions_base.reflection_store import \
+    calc_hkl_keys, \
+    calc_index_hkl_by_keys, \
+    calc_by_reflection_store, \
+    reset_reflection_store
+
+index_hkl_1 = numpy.array([[1, 0, 2, -3], [0, 1, 1, 2], [0, 0, -1, 5]], dtype=int)
+index_hkl_2 = numpy.array([[2, 1, 4], [1, 0, 0], [-1, 0, 0]], dtype=int)
+
+L_CALCULATED_HKL = []
+
+
+def calc_f_by_dictionary(
+        dict_crystal, dict_in_out, flag_use_precalculated_data: bool = False,
+        flag_calc_analytical_derivatives: bool = False):
+    index_hkl = dict_in_out["index_hkl"]
+    dict_dependency = {"index_hkl": index_hkl, "scale": dict_crystal["scale"]}
+    flag_hit, f_nucl = get_cached_node(
+        dict_in_out, "f_nucl", dict_dependency, flag_use_precalculated_data=flag_use_precalculated_data)
+    if not(flag_hit):
+        L_CALCULATED_HKL.append(index_hkl.shape[1])
+        f_nucl = dict_crystal["scale"]*(index_hkl[0] + 10.*index_hkl[1] + 100.*index_hkl[2])
+        set_cached_node(dict_in_out, "f_nucl", f_nucl, dict_dependency)
+    return f_nucl, {}
+
+
+def test_calc_hkl_keys():
+    assert numpy.all(calc_index_hkl_by_keys(calc_hkl_keys(index_hkl_1)) == index_hkl_1)
+
+
+def test_calc_by_reflection_store():
+    dict_crystal = {"name": "phase", "scale": 2.}
+    dict_reflection_store = {}
+    dict_in_out_1, dict_in_out_2 = {"index_hkl": index_hkl_1}, {"index_hkl": index_hkl_2}
+    for i_evaluation in range(2):
+        reset_reflection_store(dict_reflection_store)
+        L_CALCULATED_HKL.clear()
+        f_nucl_1 = calc_by_reflection_store(
+            calc_f_by_dictionary, dict_crystal, dict_in_out_1, dict_reflection_store, label="exp_1")[0]
+        f_nucl_2 = calc_by_reflection_store(
+            calc_f_by_dictionary, dict_crystal, dict_in_out_2, dict_reflection_store, label="exp_2")[0]
+    # reflections of both experiments are calculated once
+    assert L_CALCULATED_HKL == [5]
+
+    assert numpy.all(f_nucl_1 == calc_f_by_dictionary(dict_crystal, {"index_hkl": index_hkl_1})[0])
+    assert numpy.all(f_nucl_2 == calc_f_by_dictionary(dict_crystal, {"index_hkl": index_hkl_2})[0])
+    assert numpy.all(dict_in_out_2["f_nucl"] == f_nucl_2)
@@ -0,0 +1,72 @@
+import os
+import numpy
+import pytest
+
+import cryspy
+from cryspy.procedure_rhochi.rhochi import \
+    calc_sequential_chain, \
+    rhochi_sequential_refinement, \
+    rhochi_rietveld_refinement_with_parameters
+from cryspy.procedure_rhochi.rhochi_by_dictionary import rhochi_sequential_refinement_by_dictionary
+
+DIR = os.path.dirname(__file__)
+F_NAME = os.path.join(DIR, "..", "HoTi_single_test", "main.rcif")
+
+
+def test_calc_sequential_chain():
+    dict_result = calc_sequential_chain([F_NAME, F_NAME], method="LM")
+    assert dict_result["label"] == ["main.rcif", "main.rcif"]
+
+    l_global_dict = [cryspy.load_file(F_NAME).get_dictionary() for ind in range(2)]
+    dict_result_2 = rhochi_sequential_refinement_by_dictionary(l_global_dict, method="LM")
+    assert numpy.all(numpy.isclose(dict_result["chi_sq"], dict_result_2["chi_sq"], rtol=1e-10))
+    assert numpy.all(numpy.isclose(dict_result["parameter_value"], dict_result_2["parameter_value"], rtol=1e-10))
+
+
+def test_rhochi_sequential_refinement(tmp_path):
+    file_table = os.path.join(tmp_path, "table.txt")
+    l_result = rhochi_sequential_refinement(
+        [[F_NAME, F_NAME], [F_NAME, ]], method="LM", n_processes=2, file_table=file_table)
+    assert len(l_result) == 2
+    assert l_result[0]["parameter_value"].shape[0] == 2
+    assert l_result[1]["parameter_value"].shape[0] == 1
+    # the first datasets of both chains are refined from the same starting values
+    assert numpy.all(numpy.isclose(l_result[0]["parameter_value"][0], l_result[1]["parameter_value"][0], rtol=1e-10))
+
+    # one chain is given as a list of files
+    l_result_2 = rhochi_sequential_refinement([F_NAME, F_NAME], method="LM")
+    assert len(l_result_2) == 1
+    assert numpy.all(numpy.isclose(l_result_2[0]["chi_sq"], l_result[0]["chi_sq"], rtol=1e-10))
+
+    with open(file_table, "r") as fid:
+        ls_table = fid.readlines()
+    assert ls_table[0].startswith("# chain 1")
+    assert sum([line.startswith("  main.rcif") for line in ls_table]) == 3
+
+
+def test_rhochi_rietveld_refinement_with_parameters_constraints():
+    # chi_11 and chi_12 are bound by the constraint, hess_inv of the optimizer is given for free parameters
+    for optimization_method in ("LM", "BFGS"):
+        cryspy_object = cryspy.load_file(F_NAME)
+        item = cryspy_object.crystal_ho2ti2o7.atom_site_susceptibility["Ho1"]
+        item.chi_11_mark, item.chi_12_mark = "a", "a"
+        dict_out = rhochi_rietveld_refinement_with_parameters(
+            cryspy_object, optimization_method=optimization_method, covariance_method="hess_inv")
+        n_parameter = len(dict_out["parameter_name"])
+        assert n_parameter == 4
+        assert dict_out["correlation_matrix"].shape == (n_parameter, n_parameter)
+        assert item.chi_11_sigma > 0.
+        assert numpy.isclose(item.chi_11_sigma, item.chi_12_sigma, rtol=1e-10)
+        assert cryspy_object.inversed_hessian.sigma.size == n_parameter
+
+
+def test_rhochi_rietveld_refinement_with_parameters_covariance_method():
+    cryspy_object = cryspy.load_file(F_NAME)
+    with pytest.raises(AttributeError):
+        rhochi_rietveld_refinement_with_parameters(cryspy_object, covariance_method="jacobain")
+
+    # Powell method gives no inversed Hessian matrix
+    with pytest.warns(UserWarning, match="Inversed Hessian matrix is not given"):
+        rhochi_rietveld_refinement_with_parameters(
+            cryspy_object, optimization_method="Powell", covariance_method="hess_inv")
+    assert cryspy_object.inversed_hessian.sigma.size == 4
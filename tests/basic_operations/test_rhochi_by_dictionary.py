@@ -0,0 +1,236 @@
+import os
+import copy
+import concurrent.futures
+import numpy
+
+import cryspy
+from cryspy.A_functions_base.function_1_inversed_hessian import \
+    estimate_jacobian_matrix, \
+    estimate_inversed_hessian_matrix_by_jacobian
+from cryspy.procedure_rhochi.rhochi_parameter_map import \
+    form_parameter_map, \
+    get_parameters_by_map, \
+    set_parameters_by_map
+from cryspy.procedure_rhochi.rhochi_by_dictionary import \
+    rhochi_calc_chi_sq_by_dictionary, \
+    rhochi_calc_residual_by_dictionary, \
+    rhochi_calc_residual_jacobian_by_dictionary, \
+    rhochi_lm_refinement_by_dictionary, \
+    rhochi_batch_refinement_by_dictionary, \
+    rhochi_rietveld_refinement_by_dictionary, \
+    rhochi_sequential_refinement_by_dictionary, \
+    carry_parameters_by_dictionary, \
+    init_chi_sq_worker, \
+    calc_gradient_by_pool
+
+DIR = os.path.dirname(__file__)
+
+
+def load_single_crystal():
+    return cryspy.load_file(os.path.join(DIR, "..", "HoTi_single_test", "main.rcif")).get_dictionary()
+
+
+def load_powder():
+    global_dict = cryspy.load_file(os.path.join(DIR, "..", "two_phases_simul_pd", "main.rcif")).get_dictionary()
+    dict_pd = global_dict["pd_exp"]
+    dict_pd["flags_phase_scale"][:] = True
+    dict_pd["flags_background_intensity"][:] = True
+    dict_pd["flags_offset_ttheta"][:] = True
+    return global_dict
+
+
+def calc_numerical_jacobian(global_dict, parameter_names):
+    parameter_map = form_parameter_map(global_dict, parameter_names)
+    param_0 = get_parameters_by_map(global_dict, parameter_map)
+    def func_residual(param):
+        set_parameters_by_map(global_dict, parameter_map, param)
+        return rhochi_calc_residual_by_dictionary(global_dict, dict_in_out={})
+    return estimate_jacobian_matrix(func_residual, param_0)
+
+
+def test_rhochi_calc_residual_by_dictionary():
+    for global_dict in (load_single_crystal(), load_powder()):
+        chi_sq, n_point = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out={})[:2]
+        dict_in_out = {}
+        for flag_use_precalculated_data in (False, True):
+            residual = rhochi_calc_residual_by_dictionary(
+                global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=flag_use_precalculated_data)
+            assert residual.shape[0] >= n_point
+            assert numpy.isclose(numpy.square(residual).sum(), chi_sq, rtol=1e-10)
+
+
+def test_rhochi_calc_residual_jacobian_by_dictionary():
+    for global_dict in (load_single_crystal(), load_powder()):
+        dict_in_out = {}
+        parameter_names = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out=dict_in_out)[4]
+        residual, der_residual, flags_analytical = rhochi_calc_residual_jacobian_by_dictionary(
+            global_dict, parameter_names, dict_in_out=dict_in_out)
+        assert numpy.any(flags_analytical)
+        assert numpy.all(der_residual[:, numpy.logical_not(flags_analytical)] == 0.)
+
+        jacobian = calc_numerical_jacobian(global_dict, parameter_names)
+        for ind in numpy.flatnonzero(flags_analytical):
+            assert numpy.all(numpy.isclose(
+                der_residual[:, ind], jacobian[:, ind], rtol=1e-3, atol=1e-3*numpy.abs(jacobian[:, ind]).max()))
+
+
+def test_rhochi_calc_residual_jacobian_by_dictionary_powder_atoms():
+    global_dict = load_powder()
+    dict_crystal = global_dict["crystal_pbso4"]
+    dict_crystal["flags_atom_fract_xyz"][0, 0] = True
+    dict_crystal["flags_atom_b_iso"][1] = True
+    dict_crystal["flags_atom_occupancy"][2] = True
+    global_dict["crystal_na2ca3al2f14"]["flags_atom_fract_xyz"][0, 3] = True
+    dict_in_out = {}
+    parameter_names = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out=dict_in_out)[4]
+    residual, der_residual, flags_analytical = rhochi_calc_residual_jacobian_by_dictionary(
+        global_dict, parameter_names, dict_in_out=dict_in_out)
+    ind_atom = [ind for ind, way in enumerate(parameter_names) if way[1].startswith("atom_")]
+    assert len(ind_atom) == 4
+    assert numpy.all(flags_analytical[ind_atom])
+
+    jacobian = calc_numerical_jacobian(global_dict, parameter_names)
+    for ind in ind_atom:
+        assert numpy.all(numpy.isclose(
+            der_residual[:, ind], jacobian[:, ind], rtol=1e-3, atol=1e-3*numpy.abs(jacobian[:, ind]).max()))
+
+
+def test_rhochi_lm_refinement_by_dictionary():
+    global_dict = load_powder()
+    chi_sq_0 = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out={})[0]
+    chi_sq, parameter_names, dict_in_out, res = rhochi_lm_refinement_by_dictionary(global_dict)
+    assert res["success"]
+    assert chi_sq < chi_sq_0
+
+    # hess_inv is the inversed full Gauss-Newton Hessian, mixed terms of numerical columns included
+    jacobian = calc_numerical_jacobian(global_dict, parameter_names)
+    hess_inv = estimate_inversed_hessian_matrix_by_jacobian(jacobian)
+    assert res["hess_inv"].shape == (len(parameter_names), len(parameter_names))
+    assert numpy.all(numpy.isclose(res["hess_inv"], hess_inv, rtol=1e-2, atol=1e-2*numpy.abs(hess_inv).max()))
+
+
+def test_rhochi_batch_refinement_by_dictionary():
+    global_dict = load_single_crystal()
+    parameter_names = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out={})[4]
+    param_0 = get_parameters_by_map(global_dict, form_parameter_map(global_dict, parameter_names))
+    # the job with None starts from global_dict, not from the end point of the previous job
+    l_job = [(global_dict, 1.1*param_0, "BFGS"), (global_dict, None, "LM"), (global_dict, 0.9*param_0, "LM")]
+    l_result_1 = rhochi_batch_refinement_by_dictionary(l_job, n_processes=1)
+    l_result_2 = rhochi_batch_refinement_by_dictionary(l_job, n_processes=2)
+
+    assert [dict_result["job"] for dict_result in l_result_1] == [dict_result["job"] for dict_result in l_result_2]
+    for dict_result_1, dict_result_2 in zip(l_result_1, l_result_2):
+        assert numpy.isclose(dict_result_1["chi_sq"], dict_result_2["chi_sq"], rtol=1e-10)
+        assert numpy.all(numpy.isclose(dict_result_1["parameter_value"], dict_result_2["parameter_value"], rtol=1e-10))
+        assert dict_result_1["status"] == dict_result_2["status"]
+
+    # the same job alone gives the same result
+    dict_result = rhochi_batch_refinement_by_dictionary([(global_dict, None, "LM")], n_processes=1)[0]
+    dict_result_1 = [hh for hh in l_result_1 if hh["job"] == 1][0]
+    assert numpy.all(numpy.isclose(dict_result_1["parameter_value"], dict_result["parameter_value"], rtol=1e-10))
+
+    # global_dict of the caller is not changed
+    assert numpy.all(get_parameters_by_map(global_dict, form_parameter_map(global_dict, parameter_names)) == param_0)
+
+
+def test_rhochi_calc_chi_sq_by_dictionary_executor():
+    # two experiments of each dictionary share crystals (and the reflection store)
+    global_dict_single = load_single_crystal()
+    global_dict_single["diffrn_ho2ti2o7_2"] = copy.deepcopy(global_dict_single["diffrn_ho2ti2o7"])
+    global_dict_powder = load_powder()
+    global_dict_powder["pd_exp_2"] = copy.deepcopy(global_dict_powder["pd_exp"])
+    for global_dict in (global_dict_single, global_dict_powder):
+        for flag_calc_analytical_derivatives in (False, True):
+            res_serial = rhochi_calc_chi_sq_by_dictionary(
+                global_dict, dict_in_out={}, flag_calc_analytical_derivatives=flag_calc_analytical_derivatives)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                dict_in_out = {}
+                for flag_use_precalculated_data in (False, True):
+                    res_executor = rhochi_calc_chi_sq_by_dictionary(
+                        global_dict, dict_in_out=dict_in_out, flag_use_precalculated_data=flag_use_precalculated_data,
+                        flag_calc_analytical_derivatives=flag_calc_analytical_derivatives, executor=executor)
+                    assert res_executor[0] == res_serial[0]
+                    assert res_executor[1] == res_serial[1]
+                    assert numpy.all(res_executor[2] == res_serial[2])
+                    assert numpy.all(res_executor[3] == res_serial[3])
+                    assert res_executor[4] == res_serial[4]
+
+
+def test_rhochi_rietveld_refinement_by_dictionary_n_threads():
+    global_dict = load_single_crystal()
+    global_dict["diffrn_ho2ti2o7_2"] = copy.deepcopy(global_dict["diffrn_ho2ti2o7"])
+    res_serial = rhochi_rietveld_refinement_by_dictionary(copy.deepcopy(global_dict))[3]
+    res_threads = rhochi_rietveld_refinement_by_dictionary(copy.deepcopy(global_dict), n_threads=2)[3]
+    assert numpy.all(res_threads.x == res_serial.x)
+
+
+def test_calc_gradient_by_pool():
+    global_dict = load_single_crystal()
+    chi_sq_0, n_point, der_chi_sq, dder_chi_sq, parameter_names = rhochi_calc_chi_sq_by_dictionary(
+        global_dict, dict_in_out={})
+    parameter_map = form_parameter_map(global_dict, parameter_names)
+    param_0 = get_parameters_by_map(global_dict, parameter_map)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, initializer=init_chi_sq_worker,
+            initargs=(copy.deepcopy(global_dict), parameter_names, ())) as executor:
+        gradient = calc_gradient_by_pool(executor, param_0, chi_sq_0)
+
+    # serial forward differences with the same steps
+    gradient_serial = numpy.zeros_like(param_0)
+    for ind in range(param_0.size):
+        step = numpy.sqrt(numpy.finfo(float).eps) * max(1., abs(param_0[ind])) * (1. if param_0[ind] >= 0. else -1.)
+        param = numpy.copy(param_0)
+        param[ind] += step
+        step = param[ind] - param_0[ind]
+        set_parameters_by_map(global_dict, parameter_map, param)
+        gradient_serial[ind] = (rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out={})[0] - chi_sq_0)/step
+    assert numpy.all(numpy.isclose(gradient, gradient_serial, rtol=1e-10, atol=0.))
+
+
+def test_carry_parameters_by_dictionary():
+    global_dict_from, global_dict_to = load_single_crystal(), load_single_crystal()
+    parameter_names = rhochi_calc_chi_sq_by_dictionary(global_dict_from, dict_in_out={})[4]
+    parameter_map = form_parameter_map(global_dict_from, parameter_names)
+    param_from = 1.2*get_parameters_by_map(global_dict_from, parameter_map)
+    set_parameters_by_map(global_dict_from, parameter_map, param_from)
+    # the parameter which is not refined in global_dict_to is not changed
+    global_dict_to["diffrn_ho2ti2o7"]["flags_extinction_radius"][0] = False
+    extinction_radius = numpy.copy(global_dict_to["diffrn_ho2ti2o7"]["extinction_radius"])
+
+    carry_parameters_by_dictionary(global_dict_from, global_dict_to, parameter_names)
+    for way, value in zip(parameter_names, param_from):
+        if way[1] == "extinction_radius":
+            assert numpy.all(global_dict_to["diffrn_ho2ti2o7"]["extinction_radius"] == extinction_radius)
+        else:
+            assert global_dict_to[way[0]][way[1]][way[2]] == value
+
+
+def test_rhochi_sequential_refinement_by_dictionary():
+    # three datasets with the same experiment names, the starting values of the last ones are shifted
+    l_global_dict = [load_single_crystal() for ind in range(3)]
+    parameter_names = rhochi_calc_chi_sq_by_dictionary(l_global_dict[0], dict_in_out={})[4]
+    parameter_map = form_parameter_map(l_global_dict[0], parameter_names)
+    param_0 = get_parameters_by_map(l_global_dict[0], parameter_map)
+    for global_dict in l_global_dict[1:]:
+        set_parameters_by_map(global_dict, parameter_map, 1.3*param_0)
+
+    dict_warm = rhochi_sequential_refinement_by_dictionary(
+        copy.deepcopy(l_global_dict), l_label=["a", "b", "c"], method="LM")
+    dict_cold = rhochi_sequential_refinement_by_dictionary(
+        copy.deepcopy(l_global_dict), l_label=["a", "b", "c"], method="LM", flag_warm_start=False)
+    assert dict_warm["label"] == ["a", "b", "c"]
+    assert dict_warm["parameter_name"] == parameter_names
+    assert dict_warm["parameter_value"].shape == (3, len(parameter_names))
+    assert numpy.all(numpy.isfinite(dict_warm["parameter_sigma"]))
+
+    # the warm start gives the same results as the calculation from scratch
+    assert numpy.all(numpy.isclose(dict_warm["chi_sq"], dict_cold["chi_sq"], rtol=1e-8))
+    assert numpy.all(numpy.isclose(dict_warm["parameter_value"], dict_cold["parameter_value"], rtol=1e-8))
+
+    # the refinement of the same data from carried converged parameters does not move them
+    global_dict = copy.deepcopy(l_global_dict[0])
+    set_parameters_by_map(global_dict, parameter_map, dict_warm["parameter_value"][0])
+    chi_sq_0 = rhochi_calc_chi_sq_by_dictionary(global_dict, dict_in_out={})[0]
+    assert numpy.all(numpy.isclose(dict_warm["chi_sq"][1:], chi_sq_0, rtol=1e-5))
+    assert numpy.all(numpy.isclose(
+        dict_warm["parameter_value"][1:], dict_warm["parameter_value"][0], rtol=1e-3, atol=1e-6))
@@ -0,0 +1,339 @@
+import numpy
+
+import cryspy
+from cryspy.A_functions_base.structure_factor import \
+    calc_f_nucl, \
+    calc_sft_ccs, \
+    calc_f_m_perp_ordered, \
+    calc_pr1, \
+    calc_pr2, \
+    calc_pr3, \
+    calc_pr4, \
+    calc_f_asym_a_by_pr, \
+    calc_f_by_f_asym_a_pr, \
+    calc_index_hkl_multiplicity_in_range, \
+    calc_index_hkl_multiplicity_by_superset, \
+    set_structure_factor_memory_budget, \
+    get_structure_factor_memory_budget
+from cryspy.A_functions_base.unit_cell import calc_sthovl_by_unit_cell_parameters
+from cryspy.A_functions_base.debye_waller_factor import calc_dwf
+from cryspy.A_functions_base.symmetry_elements import calc_equivalent_reflections
+from cryspy.A_functions_base.structure_factor_kernel import \
+    set_structure_factor_kernel, \
+    get_structure_factor_kernel
+
+index_hkl = numpy.array([
+    [1, 0, 0, 2, 1, 1, 3, 2, -1, 4],
+    [0, 1, 0, 1, 1, 2, 0, 2, 3, 1],
+    [0, 0, 1, 0, 1, 3, 1, 2, 2, -2]], dtype=int)
+
+# identity and inversion of y
+reduced_symm_elems = numpy.array([
+    [0, 0], [0, 0], [0, 0], [1, 2],
+    [1, 1], [0, 0], [0, 0],
+    [0, 0], [1, -1], [0, 0],
+    [0, 0], [0, 0], [1, 1]], dtype=int)
+translation_elems = numpy.array([[0], [0], [0], [1]], dtype=int)
+
+unit_cell_parameters = numpy.array([5., 6., 7., 0.5*numpy.pi, 0.5*numpy.pi, 0.5*numpy.pi], dtype=float)
+atom_fract_xyz = numpy.array([[0.1, 0.3, 0.7], [0.2, 0.15, 0.4], [0.3, 0.8, 0.05]], dtype=float)
+atom_occupancy = numpy.array([1., 0.5, 0.8], dtype=float)
+scat_length_neutron = numpy.array([0.5, -0.3, 0.9], dtype=complex)
+atom_b_iso = numpy.array([0.3, 0.5, 0.8], dtype=float)
+atom_beta = numpy.array([
+    [0.01, 0., 0.], [0.02, 0., 0.], [0.01, 0., 0.],
+    [0.001, 0., 0.], [0., 0., 0.], [0.002, 0., 0.]], dtype=float)
+
+atom_lande_factor = numpy.array([2., 1.9, 2.1], dtype=float)
+atom_kappa = numpy.array([1., 1.1, 0.9], dtype=float)
+# j0 and j2 parameters of Co3+, O2- and Co2+
+atom_j0_parameters = numpy.array([
+    [0.3902, 0.99895, 0.4332], [12.5078, 12.09652, 14.3553], [0.6324, 0.28854, 0.5857],
+    [4.4574, 0.12914, 4.6077], [-0.15, 0.11425, -0.0382], [0.0343, -0.22968, 0.1338],
+    [0.1272, -0.40685, 0.0179]], dtype=float)
+atom_j2_parameters = numpy.array([
+    [1.7058, 0., 1.9049], [8.8595, 0., 11.6444], [1.1409, 0., 1.3159], [3.3086, 0., 4.3574],
+    [0.1474, 0., 0.3146], [1.0899, 0., 1.6453], [-0.0025, 0., 0.0017]], dtype=float)
+atom_susceptibility = numpy.array([
+    [0.3, -0.2, 0.5], [0.1, 0.4, 0.2], [0.6, 0.1, -0.3],
+    [0.05, 0.1, 0.02], [-0.1, 0.03, 0.07], [0.02, -0.04, 0.1]], dtype=float)
+atom_moment_crystalaxis_xyz = numpy.array([[1., 0.5, -0.3], [0.2, -1., 0.4], [0.7, 0.3, 1.2]], dtype=float)
+
+na = numpy.newaxis
+
+
+def check_derivatives_numerically(func, dict_arg, dder, n_component: int = 0):
+    """Compare analytical derivatives [component, ..., hkl, a] with central differences."""
+    delta = 1e-6
+    for name, value in dict_arg.items():
+        for index in numpy.ndindex(value.shape):
+            value_plus, value_minus = numpy.copy(value), numpy.copy(value)
+            value_plus[index] += delta
+            value_minus[index] -= delta
+            der_numerical = (func(**{name: value_plus})[0] - func(**{name: value_minus})[0])/(2.*delta)
+            der_analytical = dder[name][(slice(None), )*n_component + index[:-1] + (slice(None), index[-1])]
+            assert numpy.all(numpy.isclose(der_analytical, der_numerical, atol=1e-5))
+
+
+def test_calc_f_nucl_centrosymmetric():
+    centrosymmetry_position = numpy.array([0, 0, 0, 1], dtype=int)
+    dict_in_out = {}
+    f_nucl, dder = calc_f_nucl(
+        index_hkl, reduced_symm_elems, True, centrosymmetry_position, translation_elems,
+        unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out=dict_in_out)
+
+    sthovl = calc_sthovl_by_unit_cell_parameters(index_hkl, unit_cell_parameters)[0]
+    debye_waller_factor = calc_dwf(
+        index_hkl[:, :, na, na], sthovl[:, na, na], atom_b_iso[na, na, :],
+        atom_beta[:, na, na, :], reduced_symm_elems[:, na, :, na])[0]
+    f_asym = calc_f_asym_a_by_pr(
+        dict_in_out["atom_multiplicity"], debye_waller_factor, atom_occupancy,
+        calc_pr1(index_hkl, reduced_symm_elems, atom_fract_xyz)[0], calc_pr2(index_hkl, reduced_symm_elems))[0]
+    f_nucl_complex = calc_f_by_f_asym_a_pr(
+        f_asym, scat_length_neutron, calc_pr3(index_hkl, translation_elems), True,
+        calc_pr4(index_hkl, centrosymmetry_position))[0]
+    assert numpy.all(numpy.isclose(f_nucl, f_nucl_complex))
+
+
+def test_calc_f_nucl_by_hkl_chunks():
+    f_nucl, dder = calc_f_nucl(
+        index_hkl, reduced_symm_elems, False, None, translation_elems,
+        unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out={})
+
+    set_structure_factor_memory_budget(2000)
+    assert get_structure_factor_memory_budget() == 2000
+    dict_in_out = {}
+    try:
+        f_nucl_chunk, dder = calc_f_nucl(
+            index_hkl, reduced_symm_elems, False, None, translation_elems,
+            unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+            dict_in_out=dict_in_out)
+    finally:
+        set_structure_factor_memory_budget(None)
+
+    assert not("pr_1" in dict_in_out.keys())
+    assert numpy.all(numpy.isclose(f_nucl, f_nucl_chunk))
+
+
+def test_calc_f_nucl_fused_kernel():
+    f_nucl, dder = calc_f_nucl(
+        index_hkl, reduced_symm_elems, False, None, translation_elems,
+        unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out={})
+
+    set_structure_factor_kernel("fused", flag_jit=False)
+    assert get_structure_factor_kernel() == "fused_numpy"
+    dict_in_out = {}
+    try:
+        f_nucl_fused, dder = calc_f_nucl(
+            index_hkl, reduced_symm_elems, False, None, translation_elems,
+            unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+            dict_in_out=dict_in_out)
+    finally:
+        set_structure_factor_kernel("chain")
+
+    assert not("pr_1" in dict_in_out.keys())
+    assert numpy.all(numpy.isclose(f_nucl, f_nucl_fused))
+
+
+def test_calc_f_nucl_changed_atom():
+    dict_in_out = {}
+    calc_f_nucl(
+        index_hkl, reduced_symm_elems, False, None, translation_elems,
+        unit_cell_parameters, atom_fract_xyz, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out=dict_in_out, flag_use_precalculated_data=True)
+    f_asym_atom = dict_in_out["f_asym_atom"]
+
+    atom_fract_xyz_2 = numpy.copy(atom_fract_xyz)
+    atom_fract_xyz_2[1, 2] += 0.03
+    f_nucl, dder = calc_f_nucl(
+        index_hkl, reduced_symm_elems, False, None, translation_elems,
+        unit_cell_parameters, atom_fract_xyz_2, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out=dict_in_out, flag_use_precalculated_data=True)
+    assert numpy.all(dict_in_out["f_asym_atom"][:, :2] == f_asym_atom[:, :2])
+
+    f_nucl_2, dder = calc_f_nucl(
+        index_hkl, reduced_symm_elems, False, None, translation_elems,
+        unit_cell_parameters, atom_fract_xyz_2, atom_occupancy, scat_length_neutron, atom_b_iso, atom_beta,
+        dict_in_out={})
+    assert numpy.all(numpy.isclose(f_nucl, f_nucl_2))
+
+
+def test_calc_f_nucl_derivatives():
+    def func(**kwargs):
+        dict_arg = {
+            "unit_cell_parameters": unit_cell_parameters, "atom_fract_xyz": atom_fract_xyz,
+            "atom_occupancy": atom_occupancy, "atom_b_iso": atom_b_iso, "atom_beta": atom_beta}
+        dict_arg.update(kwargs)
+        return calc_f_nucl(
+            index_hkl, reduced_symm_elems, False, None, translation_elems,
+            dict_arg["unit_cell_parameters"], dict_arg["atom_fract_xyz"], dict_arg["atom_occupancy"],
+            scat_length_neutron, dict_arg["atom_b_iso"], dict_arg["atom_beta"], dict_in_out={},
+            flag_unit_cell_parameters=True, flag_atom_fract_xyz=True, flag_atom_occupancy=True,
+            flag_atom_b_iso=True, flag_atom_beta=True)
+
+    f_nucl, dder = func()
+    delta = 1e-6
+    for name, value in (("unit_cell_parameters", unit_cell_parameters), ("atom_fract_xyz", atom_fract_xyz),
+            ("atom_occupancy", atom_occupancy), ("atom_b_iso", atom_b_iso), ("atom_beta", atom_beta)):
+        for index in numpy.ndindex(value.shape):
+            value_plus, value_minus = numpy.copy(value), numpy.copy(value)
+            value_plus[index] += delta
+            value_minus[index] -= delta
+            der_numerical = (func(**{name: value_plus})[0] - func(**{name: value_minus})[0])/(2.*delta)
+            if name == "unit_cell_parameters":
+                der_analytical = dder[name][index]
+            else:
+                der_analytical = dder[name][index[:-1] + (slice(None), index[-1])]
+            assert numpy.all(numpy.isclose(der_analytical, der_numerical, atol=1e-5))
+
+
+def test_calc_index_hkl_multiplicity_in_range():
+    unit_cell_parameters_mono = numpy.array([5., 6., 7., 0.5*numpy.pi, 0.6*numpy.pi, 0.5*numpy.pi], dtype=float)
+    h_max, k_max, l_max = 7, 8, 9
+    index_hkl_box = numpy.stack(numpy.meshgrid(
+        numpy.arange(-h_max, h_max+1), numpy.arange(-k_max, k_max+1), numpy.arange(-l_max, l_max+1),
+        indexing="ij"), axis=0).reshape((3, -1))
+    sthovl_box = calc_sthovl_by_unit_cell_parameters(index_hkl_box, unit_cell_parameters_mono)[0]
+    for centrosymmetry in (False, True):
+        index_hkl, multiplicity = calc_index_hkl_multiplicity_in_range(
+            0.1, 0.6, unit_cell_parameters_mono, reduced_symm_elems, translation_elems, centrosymmetry)
+        sthovl = calc_sthovl_by_unit_cell_parameters(index_hkl, unit_cell_parameters_mono)[0]
+        assert numpy.all(numpy.diff(sthovl) >= 0.)
+
+        # each reflection of the box in the range is equivalent to one reflection with its multiplicity
+        flag_box = numpy.logical_and(sthovl_box >= 0.1, sthovl_box <= 0.6)
+        index_hkl_equivalent = calc_equivalent_reflections(index_hkl, reduced_symm_elems, centrosymmetry=centrosymmetry)
+        l_hkl = [tuple(hkl) for hkl in index_hkl_equivalent.transpose((1, 2, 0)).reshape((-1, 3))]
+        assert set(l_hkl) == set(tuple(hkl) for hkl in index_hkl_box[:, flag_box].transpose())
+        assert multiplicity.sum() == numpy.count_nonzero(flag_box)
+
+
+def calc_index_hkl_multiplicity_by_box(
+        sthovl_min, sthovl_max, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry):
+    """Reference: all reflections of the hkl box are merged into the maximal equivalent ones."""
+    h_max, k_max, l_max = [int(2.*parameter*sthovl_max) for parameter in unit_cell_parameters[:3]]
+    index_hkl_box = numpy.stack(numpy.meshgrid(
+        numpy.arange(-h_max, h_max+1), numpy.arange(-k_max, k_max+1), numpy.arange(-l_max, l_max+1),
+        indexing="ij"), axis=0).reshape((3, -1))
+    index_hkl_equivalent = calc_equivalent_reflections(index_hkl_box, reduced_symm_elems, centrosymmetry=centrosymmetry)
+    label_hkl_equivalent = 1000000*index_hkl_equivalent[0] + 1000*index_hkl_equivalent[1] + index_hkl_equivalent[2]
+    index_max = numpy.argmax(label_hkl_equivalent, axis=1)
+    index_hkl_max = index_hkl_equivalent[:, numpy.arange(index_max.size), index_max]
+    index_hkl, multiplicity = numpy.unique(index_hkl_max, axis=1, return_counts=True)
+    sthovl = calc_sthovl_by_unit_cell_parameters(index_hkl, unit_cell_parameters)[0]
+    flag = numpy.logical_and(
+        numpy.logical_not(numpy.isclose(calc_pr3(index_hkl, translation_elems), 0.)),
+        numpy.logical_and(sthovl >= sthovl_min, sthovl <= sthovl_max))
+    return index_hkl[:, flag], multiplicity[flag]
+
+
+def test_calc_index_hkl_multiplicity_in_range_all_space_groups():
+    rad = numpy.pi/180.
+    dict_cell = {
+        "triclinic": (5., 6., 7., 80.*rad, 75.*rad, 95.*rad),
+        "monoclinic": (5., 6., 7., 90.*rad, 105.*rad, 90.*rad),
+        "orthorhombic": (5., 6., 7., 90.*rad, 90.*rad, 90.*rad),
+        "tetragonal": (5., 5., 7., 90.*rad, 90.*rad, 90.*rad),
+        "trigonal": (5., 5., 7., 90.*rad, 90.*rad, 120.*rad),
+        "hexagonal": (5., 5., 7., 90.*rad, 90.*rad, 120.*rad),
+        "cubic": (6., 6., 6., 90.*rad, 90.*rad, 90.*rad)}
+    for it_number in range(1, 231):
+        space_group = cryspy.SpaceGroup(it_number=it_number)
+        reduced_symm_elems = space_group.reduced_space_group_symop.get_symm_elems()
+        l_translation = []
+        for shift in space_group.shift:
+            lcm = numpy.lcm.reduce([fraction.denominator for fraction in shift])
+            l_translation.append([int(fraction*lcm) for fraction in shift] + [lcm, ])
+        translation_elems = numpy.array(l_translation, dtype=int).transpose()
+        centrosymmetry = bool(space_group.centrosymmetry)
+        unit_cell_parameters = numpy.array(dict_cell[space_group.crystal_system], dtype=float)
+
+        index_hkl, multiplicity = calc_index_hkl_multiplicity_in_range(
+            0.05, 0.5, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry)
+        index_hkl_box, multiplicity_box = calc_index_hkl_multiplicity_by_box(
+            0.05, 0.5, unit_cell_parameters, reduced_symm_elems, translation_elems, centrosymmetry)
+        assert index_hkl.shape == index_hkl_box.shape, it_number
+        assert set(zip(*index_hkl, multiplicity)) == set(zip(*index_hkl_box, multiplicity_box)), it_number
+
+
+def test_calc_index_hkl_multiplicity_by_superset():
+    dict_in_out = {}
+    index_hkl_1, multiplicity_1 = calc_index_hkl_multiplicity_by_superset(
+        dict_in_out, 0.12, 0.47, unit_cell_parameters, reduced_symm_elems, translation_elems, True,
+        flag_use_precalculated_data=True)
+    index_hkl_2, multiplicity_2 = calc_index_hkl_multiplicity_in_range(
+        0.12, 0.47, unit_cell_parameters, reduced_symm_elems, translation_elems, True)
+    assert numpy.all(index_hkl_1 == index_hkl_2)
+    assert numpy.all(multiplicity_1 == multiplicity_2)
+
+    # small change of the unit cell keeps the reflections in the range
+    unit_cell_parameters_2 = unit_cell_parameters * numpy.array([1.0001, 0.9999, 1., 1., 1., 1.])
+    index_hkl_3, multiplicity_3 = calc_index_hkl_multiplicity_by_superset(
+        dict_in_out, 0.12, 0.47, unit_cell_parameters_2, reduced_symm_elems, translation_elems, True,
+        flag_use_precalculated_data=True)
+    assert index_hkl_3 is index_hkl_1
+
+    # the reflections in the range are changed, the superset is kept
+    unit_cell_parameters_3 = unit_cell_parameters * numpy.array([1.01, 1., 1., 1., 1., 1.])
+    index_hkl_superset = dict_in_out["index_hkl_superset"]
+    index_hkl_4, multiplicity_4 = calc_index_hkl_multiplicity_by_superset(
+        dict_in_out, 0.12, 0.47, unit_cell_parameters_3, reduced_symm_elems, translation_elems, True,
+        flag_use_precalculated_data=True)
+    assert dict_in_out["index_hkl_superset"] is index_hkl_superset
+    index_hkl_5, multiplicity_5 = calc_index_hkl_multiplicity_in_range(
+        0.12, 0.47, unit_cell_parameters_3, reduced_symm_elems, translation_elems, True)
+    assert set(zip(*index_hkl_4, multiplicity_4)) == set(zip(*index_hkl_5, multiplicity_5))
+    # reflections are sorted by sthovl of the current unit cell
+    sthovl_4 = calc_sthovl_by_unit_cell_parameters(index_hkl_4, unit_cell_parameters_3)[0]
+    sthovl_5 = calc_sthovl_by_unit_cell_parameters(index_hkl_5, unit_cell_parameters_3)[0]
+    assert numpy.all(numpy.diff(sthovl_4) >= -1e-12)
+    assert numpy.all(numpy.isclose(sthovl_4, sthovl_5, rtol=0., atol=1e-12))
+
+
+def test_calc_sft_ccs_derivatives():
+    # symmetry constraints are not applied
+    atom_sc_chi = numpy.repeat(numpy.eye(6)[:, :, na], atom_fract_xyz.shape[-1], axis=2)
+    dict_arg = {
+        "atom_para_fract_xyz": atom_fract_xyz, "atom_para_occupancy": atom_occupancy,
+        "atom_para_susceptibility": atom_susceptibility, "atom_para_b_iso": atom_b_iso,
+        "atom_para_beta": atom_beta}
+    def func(**kwargs):
+        dict_arg_h = dict(dict_arg)
+        dict_arg_h.update(kwargs)
+        return calc_sft_ccs(
+            index_hkl, reduced_symm_elems, False, None, translation_elems, unit_cell_parameters,
+            dict_arg_h["atom_para_fract_xyz"], dict_arg_h["atom_para_occupancy"], dict_arg_h["atom_para_susceptibility"],
+            dict_arg_h["atom_para_b_iso"], dict_arg_h["atom_para_beta"],
+            atom_lande_factor, atom_kappa, atom_j0_parameters, atom_j2_parameters, atom_sc_chi, dict_in_out={},
+            flag_atom_para_fract_xyz=True, flag_atom_para_occupancy=True, flag_atom_para_susceptibility=True,
+            flag_atom_para_b_iso=True, flag_atom_para_beta=True)
+
+    sft_ccs, dder = func()
+    check_derivatives_numerically(func, dict_arg, dder, n_component=1)
+
+
+def test_calc_f_m_perp_ordered_derivatives():
+    # the second element is combined with time reversal
+    full_mcif_elems = numpy.concatenate([reduced_symm_elems, numpy.array([[1, -1]], dtype=int)], axis=0)
+    dict_arg = {
+        "atom_ordered_fract_xyz": atom_fract_xyz, "atom_ordered_occupancy": atom_occupancy,
+        "atom_ordered_moment_crystalaxis_xyz": atom_moment_crystalaxis_xyz, "atom_ordered_b_iso": atom_b_iso,
+        "atom_ordered_beta": atom_beta}
+    def func(**kwargs):
+        dict_arg_h = dict(dict_arg)
+        dict_arg_h.update(kwargs)
+        return calc_f_m_perp_ordered(
+            index_hkl, full_mcif_elems, unit_cell_parameters,
+            dict_arg_h["atom_ordered_fract_xyz"], dict_arg_h["atom_ordered_occupancy"],
+            dict_arg_h["atom_ordered_moment_crystalaxis_xyz"], dict_arg_h["atom_ordered_b_iso"],
+            dict_arg_h["atom_ordered_beta"],
+            atom_lande_factor, atom_kappa, atom_j0_parameters, atom_j2_parameters, dict_in_out={},
+            flag_atom_ordered_fract_xyz=True, flag_atom_ordered_occupancy=True,
+            flag_atom_ordered_moment_crystalaxis_xyz=True, flag_atom_ordered_b_iso=True,
+            flag_atom_ordered_beta=True)
+
+    f_m_perp_o, dder = func()
+    check_derivatives_numerically(func, dict_arg, dder, n_component=1)